@@ -16,6 +16,8 @@
 #ifndef AZURE_PERF
 #define AZURE_PERF
 
+#include <sys/types.h>
+
 /*All the strings are utf-8 encoded*/
 
 /*The max buf size for all string*/
@@ -48,6 +50,52 @@
 #define AP_ERR_INVALID_REFRESH_INTERVAL     (-17)
 #define AP_ERR_INVALID_TIMESTAMP            (-18)
 #define AP_ERR_INVALID_MACHINE_NAME         (-19)
+#define AP_ERR_INVALID_MAP                  (-20)
+#define AP_ERR_MAP_BUSY                     (-21)
+
+/*
+ * Binary counter map, published by the extension next to the text file 
+ * (<ap_file>.map). It's a header followed by a fixed number of fixed size 
+ * records, updated in place. The writer makes seq odd while it updates the
+ * records, so a reader copies them without locking, and retries if seq was
+ * odd or changed meanwhile. Records with an empty type name are unused.
+ */
+#define AP_MAP_MAGIC        (0x46504541)
+#define AP_MAP_VERSION      (1)
+#define AP_MAP_READ_RETRY   (1000)
+
+typedef struct
+{
+    unsigned int    magic;
+    unsigned int    version;
+    unsigned int    header_size;
+    unsigned int    record_size;
+    unsigned int    capacity;
+    unsigned int    seq;
+    unsigned int    count;
+    unsigned int    reserved;
+    long long       update_time;
+    char            reserved2[24];
+} ap_map_header;
+
+typedef struct
+{
+    int             counter_type;
+    int             is_empty;
+    unsigned int    refresh_interval;
+    unsigned int    reserved;
+    long long       timestamp;
+    union {
+        long long   val_large;
+        double      val_double;
+    };
+    char            type_name[TYPE_NAME_MAX];
+    char            property_name[PROPERTY_NAME_MAX];
+    char            instance_name[INSTANCE_NAME_MAX];
+    char            unit_name[UNIT_NAME_MAX];
+    char            machine_name[MACHINE_NAME_MAX];
+    char            val_str[STRING_VALUE_MAX];
+} ap_map_record;
 
 
 typedef struct 
@@ -76,6 +124,10 @@ typedef struct
     int             len; 
     int             err;
     char            *ap_file;
+    void            *map;
+    size_t          map_size;
+    dev_t           map_dev;
+    ino_t           map_ino;
 } ap_handler;
 
 ap_handler* ap_open();
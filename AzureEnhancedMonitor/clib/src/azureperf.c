@@ -18,6 +18,12 @@
 #include <stdlib.h> 
 #include <string.h> 
 #include <errno.h>
+#include <fcntl.h>
+#include <limits.h>
+#include <sched.h>
+#include <unistd.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
 #include <azureperf.h> 
 
 #define INTMIN(X, Y) (((X) < (Y)) ? (X) : (Y))
@@ -35,13 +41,24 @@ static char DEFAULT_AP_FILE[] = "/var/lib/AzureEnhancedMonitor/PerfCounters";
 ap_handler* ap_open()
 {
     ap_handler *handler = malloc(sizeof(ap_handler));
-    handler->ap_file = DEFAULT_AP_FILE;
     memset(handler, 0, sizeof(ap_handler));
+    handler->ap_file = DEFAULT_AP_FILE;
     return handler;
 }
 
+void unmap_counters(ap_handler *handler)
+{
+    if(handler->map)
+    {
+        munmap(handler->map, handler->map_size);
+        handler->map = 0;
+        handler->map_size = 0;
+    }
+}
+
 void ap_close(ap_handler *handler)
 {
+    unmap_counters(handler);
     free(handler);
 }
 
@@ -284,6 +301,152 @@ EXIT:
     return ret;
 }
 
+int valid_map(const ap_map_header *header, size_t size)
+{
+    return size >= sizeof(ap_map_header) &&
+           header->magic == AP_MAP_MAGIC &&
+           header->version == AP_MAP_VERSION &&
+           header->header_size == sizeof(ap_map_header) &&
+           header->record_size == sizeof(ap_map_record) &&
+           header->capacity <= PERF_COUNT_MAX &&
+           size >= header->header_size + 
+                   (size_t)header->record_size * header->capacity;
+}
+
+//Map <ap_file>.map, or keep the current mapping if the file wasn't replaced.
+//Returns 1 if it's mapped, 0 if there's no map file.
+int map_counters(ap_handler *handler)
+{
+    char path[PATH_MAX];
+    struct stat st;
+    void *map = 0;
+    int fd = -1;
+
+    if(snprintf(path, PATH_MAX, "%s.map", handler->ap_file) >= PATH_MAX)
+    {
+        unmap_counters(handler);
+        return 0;
+    }
+    if(stat(path, &st) != 0)
+    {
+        unmap_counters(handler);
+        return 0;
+    }
+    if(handler->map && handler->map_dev == st.st_dev && 
+            handler->map_ino == st.st_ino)
+    {
+        return 1;
+    }
+
+    unmap_counters(handler);
+    fd = open(path, O_RDONLY);
+    if(fd < 0)
+    {
+        return 0;
+    }
+    if(fstat(fd, &st) == 0 && st.st_size >= sizeof(ap_map_header))
+    {
+        map = mmap(0, st.st_size, PROT_READ, MAP_SHARED, fd, 0);
+    }
+    close(fd);
+    if(map == 0 || map == MAP_FAILED)
+    {
+        return 0;
+    }
+    if(!valid_map((const ap_map_header*)map, st.st_size))
+    {
+        munmap(map, st.st_size);
+        handler->err = AP_ERR_INVALID_MAP;
+        return 1;
+    }
+    handler->map = map;
+    handler->map_size = st.st_size;
+    handler->map_dev = st.st_dev;
+    handler->map_ino = st.st_ino;
+    return 1;
+}
+
+void copy_str(char *dst, const char *src, size_t size)
+{
+    memcpy(dst, src, size - 1);
+    dst[size - 1] = 0;
+}
+
+void read_pc_from_record(perf_counter *pc, const ap_map_record *record)
+{
+    pc->counter_typer = record->counter_type;
+    copy_str(pc->type_name, record->type_name, TYPE_NAME_MAX);
+    copy_str(pc->property_name, record->property_name, PROPERTY_NAME_MAX);
+    copy_str(pc->instance_name, record->instance_name, INSTANCE_NAME_MAX);
+    pc->is_empty = record->is_empty;
+    if(!pc->is_empty)
+    {
+        switch(pc->counter_typer)
+        {
+            case PERF_COUNTER_TYPE_INT:
+               pc->val_int = (int)record->val_large;
+               break;
+            case PERF_COUNTER_TYPE_LARGE:
+               pc->val_large = record->val_large;
+               break;
+            case PERF_COUNTER_TYPE_DOUBLE:
+               pc->val_double = record->val_double;
+               break;
+            default:
+               copy_str(pc->val_str, record->val_str, STRING_VALUE_MAX);
+               break;
+        }
+    }
+    copy_str(pc->unit_name, record->unit_name, UNIT_NAME_MAX);
+    pc->refresh_interval = record->refresh_interval;
+    pc->timestamp = record->timestamp;
+    copy_str(pc->machine_name, record->machine_name, MACHINE_NAME_MAX);
+}
+
+void read_map(ap_handler *handler)
+{
+    const ap_map_header *header = (const ap_map_header*)handler->map;
+    const ap_map_record *records = (const ap_map_record*)
+        ((const char*)handler->map + sizeof(ap_map_header));
+    unsigned int seq = 0;
+    unsigned int count = 0;
+    unsigned int i = 0;
+    int retry = 0;
+
+    for(; retry < AP_MAP_READ_RETRY; retry++)
+    {
+        seq = __atomic_load_n(&header->seq, __ATOMIC_ACQUIRE);
+        if(seq & 1)
+        {
+            //The writer is updating the records
+            sched_yield();
+            continue;
+        }
+
+        memset(handler->buf, 0, sizeof(perf_counter) * PERF_COUNT_MAX);
+        handler->len = 0;
+        count = INTMIN(header->count, header->capacity);
+        for(i = 0; i < count; i++)
+        {
+            if(records[i].type_name[0] == 0)
+            {
+                continue;
+            }
+            read_pc_from_record(&handler->buf[handler->len], &records[i]);
+            handler->len++;
+        }
+
+        __atomic_thread_fence(__ATOMIC_ACQUIRE);
+        if(__atomic_load_n(&header->seq, __ATOMIC_RELAXED) == seq)
+        {
+            return;
+        }
+    }
+    memset(handler->buf, 0, sizeof(perf_counter) * PERF_COUNT_MAX);
+    handler->len = 0;
+    handler->err = AP_ERR_MAP_BUSY;
+}
+
 void ap_refresh(ap_handler *handler)
 {
     FILE *fp = 0;
@@ -292,6 +455,25 @@ void ap_refresh(ap_handler *handler)
     //Reset handler 
     memset(handler->buf, 0, sizeof(perf_counter) * PERF_COUNT_MAX);
     handler->len = 0;
+    handler->err = 0;
+
+    //Read the binary counter map if it's published, without parsing
+    if(map_counters(handler))
+    {
+        if(!handler->err)
+        {
+            read_map(handler);
+        }
+        if(handler->err != AP_ERR_MAP_BUSY && handler->err != AP_ERR_INVALID_MAP)
+        {
+            return;
+        }
+        //The map can't be read (e.g. the writer died while updating it),
+        //parse the text file the writer still publishes instead.
+        memset(handler->buf, 0, sizeof(perf_counter) * PERF_COUNT_MAX);
+        handler->len = 0;
+        handler->err = 0;
+    }
    
     errno = 0;
     fp = fopen(handler->ap_file, "r");
@@ -320,7 +502,7 @@ int ap_metric_all(ap_handler *handler, perf_counter *all, size_t size)
     int size_to_cp = 0;
     if(handler->err)
     {
-        return;
+        return 0;
     }
     size_to_cp = INTMIN(handler->len, size);
     if(size_to_cp > 0)
@@ -0,0 +1,101 @@
+//
+// Copyright 2014 Microsoft Corporation
+//
+// Licensed under the Apache License, Version 2.0 (the "License");
+// you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+//
+//     http://www.apache.org/licenses/LICENSE-2.0
+//
+// Unless required by applicable law or agreed to in writing, software
+// distributed under the License is distributed on an "AS IS" BASIS,
+// WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and
+// limitations under the License.
+//
+
+//
+// Measures the cost of ap_refresh, reading the counters from the text file
+// and from the counter map. Publish both with 
+// AzureEnhancedMonitor/ext/test/benchmark_perf_counters.py <cycles> <dir>
+// and run: bin/benchmark <dir>/PerfCounters
+//
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+#include <unistd.h>
+#include <azureperf.h> 
+
+static const char default_input[] = "./test/cases/positive_case";
+
+double now()
+{
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec + ts.tv_nsec / 1e9;
+}
+
+int bench(const char *name, char *ap_file, int cycles)
+{
+    ap_handler *handler = 0;
+    double start = 0;
+    int i = 0;
+    int ret = 0;
+
+    handler = ap_open();
+    handler->ap_file = ap_file;
+    start = now();
+    for(; i < cycles; i++)
+    {
+        ap_refresh(handler);
+        if(handler->err)
+        {
+            printf("%-20s error %d\n", name, handler->err);
+            ret = handler->err;
+            goto EXIT;
+        }
+    }
+    printf("%-20s %d counters %10.3f us/refresh\n", name, handler->len,
+            (now() - start) * 1e6 / cycles);
+EXIT:
+    ap_close(handler);
+    return ret;
+}
+
+int main(int argc, char ** argv)
+{
+    char *ap_file = (char*) default_input;
+    char map_file[256];
+    char hidden_map_file[256];
+    int cycles = 10000;
+
+    if(argc >= 2)
+    {
+        ap_file = argv[1];
+    }
+    if(argc >= 3)
+    {
+        cycles = atoi(argv[2]);
+    }
+    snprintf(map_file, sizeof(map_file), "%s.map", ap_file);
+    snprintf(hidden_map_file, sizeof(hidden_map_file), "%s.bak", map_file);
+
+    if(access(map_file, R_OK) == 0)
+    {
+        if(bench("counter map", ap_file, cycles))
+        {
+            return 1;
+        }
+        //Hide the map to read the text file
+        rename(map_file, hidden_map_file);
+        bench("text", ap_file, cycles);
+        rename(hidden_map_file, map_file);
+    }
+    else
+    {
+        bench("text", ap_file, cycles);
+    }
+    return 0;
+}
@@ -15,7 +15,9 @@
 //
 
 #include <stdio.h>
+#include <stdlib.h>
 #include <string.h>
+#include <unistd.h>
 #include <azureperf.h> 
 
 static const char default_input[] = "./test/cases/positive_case";
@@ -28,7 +30,12 @@ int main(int argc, char ** argv)
         ap_file = argv[1];
     }
     printf("Parsing perf counters from: %s\n", ap_file);
-    run_test(ap_file);
+    if(run_test(ap_file))
+    {
+        return 1;
+    }
+    printf("Reading perf counters from map of: %s\n", ap_file);
+    return run_map_test(ap_file);
 }
 
 void print_counter(perf_counter *pc)
@@ -216,3 +223,199 @@ EXIT:
     return ret;
 }
 
+//Publish the counters the way the extension does
+int write_map(const char *path, ap_handler *handler, unsigned int seq)
+{
+    ap_map_header header;
+    ap_map_record record;
+    perf_counter *pc;
+    FILE *fp = 0;
+    int i = 0;
+
+    memset(&header, 0, sizeof(header));
+    header.magic = AP_MAP_MAGIC;
+    header.version = AP_MAP_VERSION;
+    header.header_size = sizeof(ap_map_header);
+    header.record_size = sizeof(ap_map_record);
+    header.capacity = PERF_COUNT_MAX;
+    header.seq = seq;
+    header.count = handler->len;
+
+    fp = fopen(path, "w");
+    if(0 == fp)
+    {
+        return -1;
+    }
+    fwrite(&header, sizeof(header), 1, fp);
+    for(; i < PERF_COUNT_MAX; i++)
+    {
+        memset(&record, 0, sizeof(record));
+        if(i < handler->len)
+        {
+            pc = &handler->buf[i];
+            record.counter_type = pc->counter_typer;
+            record.is_empty = pc->is_empty;
+            record.refresh_interval = pc->refresh_interval;
+            record.timestamp = pc->timestamp;
+            switch(pc->counter_typer)
+            {
+                case PERF_COUNTER_TYPE_INT:
+                    record.val_large = pc->val_int;
+                    break;
+                case PERF_COUNTER_TYPE_LARGE:
+                    record.val_large = pc->val_large;
+                    break;
+                case PERF_COUNTER_TYPE_DOUBLE:
+                    record.val_double = pc->val_double;
+                    break;
+                default:
+                    strncpy(record.val_str, pc->val_str, STRING_VALUE_MAX - 1);
+                    break;
+            }
+            strncpy(record.type_name, pc->type_name, TYPE_NAME_MAX - 1);
+            strncpy(record.property_name, pc->property_name, 
+                    PROPERTY_NAME_MAX - 1);
+            strncpy(record.instance_name, pc->instance_name, 
+                    INSTANCE_NAME_MAX - 1);
+            strncpy(record.unit_name, pc->unit_name, UNIT_NAME_MAX - 1);
+            strncpy(record.machine_name, pc->machine_name, MACHINE_NAME_MAX - 1);
+        }
+        fwrite(&record, sizeof(record), 1, fp);
+    }
+    fclose(fp);
+    return 0;
+}
+
+int copy_file(const char *src, const char *dst)
+{
+    char buf[4096];
+    size_t len = 0;
+    FILE *in = 0;
+    FILE *out = 0;
+    int ret = -1;
+
+    in = fopen(src, "r");
+    out = fopen(dst, "w");
+    if(0 == in || 0 == out)
+    {
+        goto EXIT;
+    }
+    while((len = fread(buf, 1, sizeof(buf), in)) > 0)
+    {
+        fwrite(buf, 1, len, out);
+    }
+    ret = 0;
+
+EXIT:
+    if(in)
+    {
+        fclose(in);
+    }
+    if(out)
+    {
+        fclose(out);
+    }
+    return ret;
+}
+
+int expect_text_counters(ap_handler *handler, ap_handler *text, 
+                         const char *what)
+{
+    ap_refresh(handler);
+    if(handler->err || handler->len != text->len ||
+            memcmp(handler->buf, text->buf, sizeof(perf_counter) * text->len))
+    {
+        printf("%s: err %d, %d counters\n", what, handler->err, handler->len);
+        return 1;
+    }
+    return 0;
+}
+
+int run_map_test(char* ap_file)
+{
+    int ret = 1;
+    ap_handler *text = 0;
+    ap_handler *handler = 0;
+    char dir[] = "/tmp/azureperf.XXXXXX";
+    char base[64];
+    char path[64];
+    char tmp_path[64];
+    char garbage[sizeof(ap_map_header) + sizeof(ap_map_record)];
+    FILE *fp = 0;
+
+    if(sizeof(ap_map_header) != 64 || sizeof(ap_map_record) != 928)
+    {
+        printf("Unexpected map layout: header %zu, record %zu\n", 
+                sizeof(ap_map_header), sizeof(ap_map_record));
+        return 1;
+    }
+    if(0 == mkdtemp(dir))
+    {
+        return 1;
+    }
+    snprintf(base, sizeof(base), "%s/PerfCounters", dir);
+    snprintf(path, sizeof(path), "%s.map", base);
+    snprintf(tmp_path, sizeof(tmp_path), "%s.tmp", path);
+
+    text = ap_open();
+    text->ap_file = ap_file;
+    ap_refresh(text);
+    handler = ap_open();
+    handler->ap_file = base;
+    //The writer publishes the text file along with the map
+    if(copy_file(ap_file, base))
+    {
+        goto EXIT;
+    }
+
+    write_map(path, text, 2);
+    if(expect_text_counters(handler, text, "Map doesn't match the text counters"))
+    {
+        goto EXIT;
+    }
+    printf("Found counters in map:%d\n", handler->len);
+
+    //The writer died while updating it: the text file is parsed instead
+    write_map(path, text, 3);
+    if(expect_text_counters(handler, text, "No fallback from a map being updated"))
+    {
+        goto EXIT;
+    }
+
+    //Not a valid map: the text file is parsed instead
+    fp = fopen(tmp_path, "w");
+    if(0 == fp)
+    {
+        goto EXIT;
+    }
+    memset(garbage, 0xab, sizeof(garbage));
+    fwrite(garbage, sizeof(garbage), 1, fp);
+    fclose(fp);
+    rename(tmp_path, path);
+    if(expect_text_counters(handler, text, "No fallback from an invalid map"))
+    {
+        goto EXIT;
+    }
+
+    //Replaced by a new file: mapped again
+    text->len = 1;
+    write_map(tmp_path, text, 4);
+    rename(tmp_path, path);
+    ap_refresh(handler);
+    if(handler->err || handler->len != 1)
+    {
+        printf("Replaced map wasn't read: err %d, %d counters\n",
+                handler->err, handler->len);
+        goto EXIT;
+    }
+    printf("Map test passed\n");
+    ret = 0;
+
+EXIT:
+    ap_close(text);
+    ap_close(handler);
+    unlink(path);
+    unlink(base);
+    rmdir(dir);
+    return ret;
+}
@@ -13,9 +13,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import ctypes
+import errno
+import httplib
 import os
 import re
 import socket
+import struct
+import threading
 import traceback
 import time
 import datetime
@@ -23,6 +28,10 @@ import psutil
 import urlparse
 import xml.dom.minidom as minidom
 from azure.storage import TableService, Entity
+try:
+    import requests
+except ImportError:
+    requests = None
 from Utils.WAAgentUtil import waagent, AddExtensionEvent
 
 
@@ -30,6 +39,7 @@ FAILED_TO_RETRIEVE_MDS_DATA="(03100)Failed to retrieve mds data"
 FAILED_TO_RETRIEVE_LOCAL_DATA="(03101)Failed to retrieve local data"
 FAILED_TO_RETRIEVE_STORAGE_DATA="(03102)Failed to retrieve storage data"
 FAILED_TO_SERIALIZE_PERF_COUNTERS="(03103)Failed to serialize perf counters"
+DATA_SOURCE_TIMED_OUT="(03104)Data source collection timed out"
 
 def timedelta_total_seconds(delta):
 
@@ -38,6 +48,28 @@ def timedelta_total_seconds(delta):
     else:
         return delta.total_seconds()
 
+CLOCK_MONOTONIC = 1
+_clock_gettime = None
+class _timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+def getMonotonicTime():
+    """
+    Seconds from CLOCK_MONOTONIC, which isn't affected by changes of the
+    system time. Python 2 has no time.monotonic().
+    """
+    global _clock_gettime
+    if _clock_gettime is None:
+        try:
+            _clock_gettime = ctypes.CDLL(None, use_errno=True).clock_gettime
+        except Exception:
+            _clock_gettime = False
+    if _clock_gettime:
+        ts = _timespec()
+        if _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) == 0:
+            return ts.tv_sec + ts.tv_nsec * 1e-9
+    return time.time()
+
 def get_host_base_from_uri(blob_uri):
     uri = urlparse.urlparse(blob_uri)
     netloc = uri.netloc
@@ -52,6 +84,11 @@ MonitoringInterval = 60 * MonitoringIntervalInMinute
 AzureTableDelayInMinute = 5 #Five minute
 AzureTableDelay = 60 * AzureTableDelayInMinute
 
+#Storage analytics minutes missed (e.g. the collection was late) are read
+#in the next collection, up to this many.
+StorageCatchUpInMinute = 15 #Fifteen minute
+StorageCatchUp = 60 * StorageCatchUpInMinute
+
 AzureEnhancedMonitorVersion = "2.0.0"
 LibDir = "/var/lib/AzureEnhancedMonitor"
 
@@ -125,18 +162,210 @@ def getAzureDiagnosticKeyRange():
     endKey = getMDSPartitionKey(identity, getMDSTimestamp(endTime))
     return startKey, endKey
 
+def quoteODataString(s):
+    return "'{0}'".format(s.replace("'", "''"))
+
+#Errors of a request sent on a connection the server already closed
+ConnectionErrors = (httplib.HTTPException, socket.error)
+if requests is not None:
+    ConnectionErrors += (requests.exceptions.ConnectionError,)
+
+class TableClient(object):
+    """
+    The TableService of a storage account, reused for all the queries to the
+    account. When the azure sdk takes a request session, the client passes
+    one so that the https connection is kept alive between the requests,
+    otherwise the sdk opens a new connection for each request.
+    """
+    def __init__(self, accountName, accountKey, hostBase):
+        self.accountName = accountName
+        self.accountKey = accountKey
+        self.hostBase = hostBase
+        #Guards the queries
+        self.lock = threading.Lock()
+        self.queries = {}
+        self.session = None
+        self.tableService = None
+        if requests is not None:
+            try:
+                session = requests.Session()
+                self.tableService = TableService(account_name = accountName,
+                                                 account_key = accountKey,
+                                                 host_base = hostBase,
+                                                 request_session = session)
+                self.session = session
+            except TypeError:
+                #The sdk doesn't take a request session
+                pass
+        if self.tableService is None:
+            self.tableService = TableService(account_name = accountName, 
+                                             account_key = accountKey,
+                                             host_base = hostBase)
+
+    def queryEntities(self, table, ofilter, oselect, top=None):
+        """
+        Query all the pages of the result. If the server closed the kept 
+        alive connection, the query is sent again on a new one.
+        """
+        entities = []
+        nextPartitionKey = None
+        nextRowKey = None
+        while True:
+            args = (table, ofilter, oselect, 
+                    None if top is None else top - len(entities),
+                    nextPartitionKey, nextRowKey)
+            try:
+                page = self.tableService.query_entities(*args)
+            except ConnectionErrors:
+                page = self.tableService.query_entities(*args)
+            entities.extend(page)
+            continuation = getattr(page, "x_ms_continuation", None)
+            if not continuation or (top is not None and len(entities) >= top):
+                return entities
+            try:
+                nextPartitionKey = continuation["NextPartitionKey"]
+                nextRowKey = continuation["NextRowKey"]
+            except KeyError:
+                return entities
+
+    def getQuery(self, table, columns, ofilter=None):
+        """
+        Get the range query of a table. Readers of the same table (and 
+        filter) share one query, which selects the columns of all of them.
+        """
+        with self.lock:
+            query = self.queries.get((table, ofilter))
+            if query is None:
+                query = TableRangeQuery(self, table, ofilter)
+                self.queries[(table, ofilter)] = query
+            query.addColumns(columns)
+            return query
+
+class TableRangeQuery(object):
+    """
+    Query of a partition key range of a table. The table service returns
+    rows ordered by PartitionKey and RowKey, so the query remembers the last 
+    row it got and only fetches the rows after it, keeping the rows it 
+    already has that are still in the range.
+    """
+    #Readers asking for the same range within this many seconds (i.e. in 
+    #the same collection cycle) share one request.
+    reuseInterval = 10
+
+    def __init__(self, client, table, ofilter=None, clock=getMonotonicTime):
+        self.client = client
+        self.table = table
+        self.ofilter = ofilter
+        self.clock = clock
+        self.columns = set(["PartitionKey", "RowKey"])
+        self.listeners = []
+        self.reset()
+
+    def reset(self):
+        self.rows = []
+        self.lastPartitionKey = None
+        self.lastRowKey = None
+        self.lastRange = None
+        self.lastFetch = None
+        for listener in self.listeners:
+            listener.reset()
+
+    def getListener(self, listenerType):
+        """
+        Get the listener of the given type, adding one if there's none yet.
+        Listeners are told about the rows as they are fetched (addRows) 
+        and dropped (dropBefore, reset), to keep aggregates of the rows of 
+        the range up to date.
+        """
+        with self.client.lock:
+            for listener in self.listeners:
+                if isinstance(listener, listenerType):
+                    return listener
+            listener = listenerType()
+            listener.addRows(self.rows)
+            self.listeners.append(listener)
+            return listener
+
+    def addColumns(self, columns):
+        if not self.columns.issuperset(columns):
+            self.columns.update(columns)
+            #The rows fetched so far miss the new columns
+            self.reset()
+
+    def buildFilter(self, startKey, endKey):
+        if self.lastPartitionKey is None or self.lastPartitionKey < startKey:
+            ofilter = "PartitionKey ge {0} and PartitionKey lt {1}".format(
+                    quoteODataString(startKey), 
+                    quoteODataString(endKey))
+        else:
+            ofilter = ("((PartitionKey eq {0} and RowKey gt {1}) or "
+                       "(PartitionKey gt {0} and PartitionKey lt {2}))").format(
+                    quoteODataString(self.lastPartitionKey),
+                    quoteODataString(self.lastRowKey),
+                    quoteODataString(endKey))
+        if self.ofilter:
+            ofilter = "{0} and {1}".format(ofilter, self.ofilter)
+        return ofilter
+
+    def fetch(self, startKey, endKey, top=None):
+        """
+        Get the rows whose PartitionKey is in [startKey, endKey).
+        """
+        with self.client.lock:
+            if self.lastPartitionKey is not None and \
+                    self.lastPartitionKey >= endKey:
+                #The range went backwards (e.g. the clock was set back)
+                self.reset()
+            if len(self.rows) > 0 and self.rows[0].PartitionKey < startKey:
+                self.rows = filter(lambda r : r.PartitionKey >= startKey, 
+                                   self.rows)
+                for listener in self.listeners:
+                    listener.dropBefore(startKey)
+
+            now = self.clock()
+            recent = self.lastFetch is not None and \
+                     now - self.lastFetch < self.reuseInterval
+            enough = top is not None and len(self.rows) >= top
+            if not enough and not (recent and self.lastRange == (startKey, 
+                                                                 endKey)):
+                rows = self.client.queryEntities(
+                        self.table, 
+                        self.buildFilter(startKey, endKey),
+                        ",".join(sorted(self.columns)), 
+                        None if top is None else top - len(self.rows))
+                if len(rows) > 0:
+                    self.lastPartitionKey = rows[-1].PartitionKey
+                    self.lastRowKey = rows[-1].RowKey
+                self.rows.extend(rows)
+                for listener in self.listeners:
+                    listener.addRows(rows)
+                self.lastRange = (startKey, endKey)
+                self.lastFetch = now
+            return self.rows if top is None else self.rows[:top]
+
+#Table clients by account, reused across collection cycles
+_tableClients = {}
+_tableClientsLock = threading.Lock()
+
+def getTableClient(accountName, accountKey, hostBase):
+    with _tableClientsLock:
+        client = _tableClients.get((accountName, hostBase))
+        #A new key (e.g. after it was regenerated) needs a new client
+        if client is None or client.accountKey != accountKey:
+            client = TableClient(accountName, accountKey, hostBase)
+            _tableClients[(accountName, hostBase)] = client
+        return client
+
 def getAzureDiagnosticCPUData(accountName, accountKey, hostBase,
                               startKey, endKey, deploymentId):
     try:
         waagent.Log("Retrieve diagnostic data(CPU).")
-        table = "LinuxCpuVer2v0"
-        tableService = TableService(account_name = accountName, 
-                                    account_key = accountKey,
-                                    host_base = hostBase)
-        ofilter = ("PartitionKey ge '{0}' and PartitionKey lt '{1}' "
-                   "and DeploymentId eq '{2}'").format(startKey, endKey, deploymentId)
-        oselect = ("PercentProcessorTime,DeploymentId")
-        data = tableService.query_entities(table, ofilter, oselect, 1)
+        client = getTableClient(accountName, accountKey, hostBase)
+        query = client.getQuery("LinuxCpuVer2v0",
+                                ["PercentProcessorTime", "DeploymentId"],
+                                "DeploymentId eq {0}".format(
+                                    quoteODataString(deploymentId)))
+        data = query.fetch(startKey, endKey, 1)
         if data is None or len(data) == 0:
             return None
         cpuPercent = float(data[0].PercentProcessorTime)
@@ -153,14 +382,12 @@ def getAzureDiagnosticMemoryData(accountName, accountKey, hostBase,
                                  startKey, endKey, deploymentId):
     try:
         waagent.Log("Retrieve diagnostic data: Memory")
-        table = "LinuxMemoryVer2v0"
-        tableService = TableService(account_name = accountName, 
-                                    account_key = accountKey,
-                                    host_base = hostBase)
-        ofilter = ("PartitionKey ge '{0}' and PartitionKey lt '{1}' "
-                   "and DeploymentId eq '{2}'").format(startKey, endKey, deploymentId)
-        oselect = ("PercentAvailableMemory,DeploymentId")
-        data = tableService.query_entities(table, ofilter, oselect, 1)
+        client = getTableClient(accountName, accountKey, hostBase)
+        query = client.getQuery("LinuxMemoryVer2v0",
+                                ["PercentAvailableMemory", "DeploymentId"],
+                                "DeploymentId eq {0}".format(
+                                    quoteODataString(deploymentId)))
+        data = query.fetch(startKey, endKey, 1)
         if data is None or len(data) == 0:
             return None
         memoryPercent = 100 - float(data[0].PercentAvailableMemory)
@@ -282,49 +509,120 @@ class AzureDiagnosticMetric(object):
     def getLastHardwareChange(self):
         return self.linux.getLastHardwareChange()
 
+def parseCpuList(cpuList):
+    """
+    Parse a list of cpus in the kernel format, e.g. "0-3,6,8-9".
+    """
+    cpus = []
+    for part in cpuList.strip().split(","):
+        if not part:
+            continue
+        first, sep, last = part.partition("-")
+        if sep:
+            cpus.extend(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(first))
+    return cpus
+
+def parseCPUInfo(cpuinfo):
+    """
+    Parse /proc/cpuinfo. Returns a list of dicts, one per processor.
+    """
+    processors = []
+    processor = {}
+    for line in cpuinfo.split("\n"):
+        key, sep, value = line.partition(":")
+        if not sep:
+            if processor:
+                processors.append(processor)
+                processor = {}
+            continue
+        processor[key.strip()] = value.strip()
+    if processor:
+        processors.append(processor)
+    return processors
+
+def readFirstLine(path):
+    try:
+        with open(path) as F:
+            return F.readline().strip()
+    except IOError:
+        return None
+
+def readCPUTopology(cpus, sysCpuDir):
+    """
+    Count the sockets and the cores of the given cpus from 
+    /sys/devices/system/cpu/cpu<N>/topology. Returns None if it isn't 
+    available.
+    """
+    packages = set()
+    cores = set()
+    for cpu in cpus:
+        topologyDir = os.path.join(sysCpuDir, "cpu{0}".format(cpu), "topology")
+        package = readFirstLine(os.path.join(topologyDir, "physical_package_id"))
+        core = readFirstLine(os.path.join(topologyDir, "core_id"))
+        if package is None or core is None:
+            return None
+        packages.add(package)
+        cores.add((package, core))
+    if len(cores) == 0:
+        return None
+    return len(packages), len(cores)
+
+#CPU topology, cached until a cpu is hotplugged, i.e. until the content of 
+#/sys/devices/system/cpu/online changes.
+_cpuInfoCache = None
+
 class CPUInfo(object):
 
     @staticmethod
-    def getCPUInfo():
-        cpuinfo = waagent.GetFileContents("/proc/cpuinfo")
-        ret, lscpu = waagent.RunGetOutput("lscpu")
-        return CPUInfo(cpuinfo, lscpu)
-
-    def __init__(self, cpuinfo, lscpu):
+    def getCPUInfo(procCpuInfo="/proc/cpuinfo", 
+                   sysCpuDir="/sys/devices/system/cpu"):
+        global _cpuInfoCache
+        online = readFirstLine(os.path.join(sysCpuDir, "online"))
+        if _cpuInfoCache is None or online is None or \
+                _cpuInfoCache.online != online:
+            cpuinfo = waagent.GetFileContents(procCpuInfo)
+            _cpuInfoCache = CPUInfo(cpuinfo, online, sysCpuDir)
+        return _cpuInfoCache
+
+    def __init__(self, cpuinfo, online=None, 
+                 sysCpuDir="/sys/devices/system/cpu"):
         self.cpuinfo = cpuinfo
-        self.lscpu = lscpu
-        self.cores = 1;
-        self.coresPerCpu = 1;
-        self.threadsPerCore = 1;
-        
-        coresMatch = re.search("CPU(s):\s+(\d+)", self.lscpu)
-        if coresMatch:
-            self.cores = int(coresMatch.group(1))
-        
-        coresPerCpuMatch = re.search("Core(s) per socket:\s+(\d+)", self.lscpu)
-        if coresPerCpuMatch:
-            self.coresPerCpu = int(coresPerCpuMatch.group(1))
-        
-        threadsPerCoreMatch = re.search("Core(s) per socket:\s+(\d+)", self.lscpu)
-        if threadsPerCoreMatch:
-            self.threadsPerCore = int(threadsPerCoreMatch.group(1))
-        
-        model = re.search("model name\s+:\s+(.*)\s", self.cpuinfo)
-        vendorId = re.search("vendor_id\s+:\s+(.*)\s", self.cpuinfo)
+        self.online = online
+        self.sysCpuDir = sysCpuDir
+        processors = parseCPUInfo(cpuinfo)
+        first = processors[0] if len(processors) > 0 else {}
+
+        if online:
+            cpus = parseCpuList(online)
+        else:
+            cpus = map(lambda p : int(p.get("processor", 0)), processors)
+        self.cores = max(len(cpus), 1)
+
+        topology = readCPUTopology(cpus, sysCpuDir)
+        if topology is not None:
+            sockets, physicalCores = topology
+        else:
+            #No sysfs: use the per-socket counts of /proc/cpuinfo
+            sockets = len(set(map(lambda p : p.get("physical id"), 
+                                  processors))) or 1
+            physicalCores = int(first.get("cpu cores", 0)) * sockets or \
+                            self.cores
+        self.coresPerCpu = max(physicalCores / sockets, 1)
+        self.threadsPerCore = max(self.cores / physicalCores, 1)
+
+        model = first.get("model name")
+        vendorId = first.get("vendor_id")
         if model and vendorId:
-            self.processorType = "{0}, {1}".format(model.group(1), 
-                                                   vendorId.group(1))
+            self.processorType = "{0}, {1}".format(model, vendorId)
         else:
             self.processorType = None
-        
-        freqMatch = re.search("CPU MHz:\s+(.*)\s", self.lscpu)
-        if freqMatch:
-            self.frequency = float(freqMatch.group(1))
-        else:
-            self.frequency = None
 
-        ht = re.match("flags\s.*\sht\s", self.cpuinfo)
-        self.isHTon = ht is not None
+        freq = first.get("cpu MHz")
+        self.frequency = float(freq) if freq else None
+
+        self.isHTon = self.threadsPerCore > 1
 
     def getNumOfCoresPerCPU(self):
         return self.coresPerCpu
@@ -339,6 +637,11 @@ class CPUInfo(object):
         return self.processorType
    
     def getFrequency(self):
+        #The current frequency, where cpufreq is available
+        curFreq = readFirstLine(os.path.join(self.sysCpuDir, 
+                                             "cpu0/cpufreq/scaling_cur_freq"))
+        if curFreq:
+            return int(curFreq) / 1000.0
         return self.frequency
 
     def isHyperThreadingOn(self):
@@ -357,8 +660,8 @@ class MemoryInfo(object):
     def getMemPercent(self):
         return self.memInfo[2] #%
 
-def getMacAddress(adapterId):
-    nicAddrPath = os.path.join("/sys/class/net", adapterId, "address")
+def getMacAddress(adapterId, sysClassNet="/sys/class/net"):
+    nicAddrPath = os.path.join(sysClassNet, adapterId, "address")
     mac = waagent.GetFileContents(nicAddrPath)
     mac = mac.strip()
     mac = mac.replace(":", "-")
@@ -374,88 +677,313 @@ def sameList(l1, l2):
             return False
     return True
 
+def readNetDevCounters(path="/proc/net/dev"):
+    """
+    Read the byte counters of all the interfaces in a single pass.
+    Returns a list of (interface, bytes received, bytes sent), in the order
+    of the file.
+    """
+    counters = []
+    with open(path) as F:
+        #Skip the 2 header lines
+        for line in F.readlines()[2:]:
+            nicName, sep, fields = line.partition(":")
+            if not sep:
+                continue
+            fields = fields.split()
+            counters.append((nicName.strip(), long(fields[0]), long(fields[8])))
+    return counters
+
+def counterDelta(old, new):
+    """
+    Difference of 2 samples of a counter that may have wrapped around
+    since the old one was taken. Counters that still fit in 32 bits are 
+    assumed to be 32-bit ones (some drivers still have them).
+    """
+    if new >= old:
+        return new - old
+    width = 1 << 32 if old < (1 << 32) else 1 << 64
+    return new + width - old
+
 class NetworkInfo(object):
-    def __init__(self):
-        self.nics = psutil.net_io_counters(pernic=True)
-        self.nicNames = []
-        for nicName, stat in self.nics.iteritems():
-            if nicName != 'lo':
-                self.nicNames.append(nicName)
+    #Counters of the previous cycle, as (monotonic time, {nic: (recv, sent)}).
+    #The rates are computed against them, so sampling never sleeps.
+    lastSample = None
+
+    def __init__(self, procNetDev="/proc/net/dev", clock=getMonotonicTime):
+        counters = readNetDevCounters(procNetDev)
+        now = clock()
+        lastSample = NetworkInfo.lastSample
+        NetworkInfo.lastSample = (now, dict(map(lambda c : (c[0], c[1:]), 
+                                                counters)))
+        self.nicNames = [c[0] for c in counters if c[0] != 'lo']
+        self.readRates = {}
+        self.writeRates = {}
+        if lastSample is None:
+            return
+        lastTime, lastCounters = lastSample
+        interval = now - lastTime
+        if interval <= 0:
+            return
+        for nicName, bytesRecv, bytesSent in counters:
+            if nicName not in lastCounters:
+                continue
+            lastRecv, lastSent = lastCounters[nicName]
+            self.readRates[nicName] = counterDelta(lastRecv, bytesRecv) / interval
+            self.writeRates[nicName] = counterDelta(lastSent, bytesSent) / interval
+
+    @staticmethod
+    def sample():
+        """
+        Take the first sample, so that the first cycle has rates too.
+        """
+        NetworkInfo()
 
     def getAdapterIds(self):
         return self.nicNames
 
     def getNetworkReadBytes(self, adapterId):
-        net = psutil.net_io_counters(pernic=True)
-        if net[adapterId] != None:
-            bytes_recv1 = net[adapterId][1]
-            time1 = time.time()
-            
-            time.sleep(0.2)
-            
-            net = psutil.net_io_counters(pernic=True)
-            bytes_recv2 = net[adapterId][1]
-            time2 = time.time()
-            
-            interval = (time2 - time1)
-            
-            return (bytes_recv2 - bytes_recv1) / interval
-        else:
-            return 0
+        #None until the adapter has been sampled in a previous cycle
+        return self.readRates.get(adapterId)
 
     def getNetworkWriteBytes(self, adapterId):
-        net = psutil.net_io_counters(pernic=True)
-        if net[adapterId] != None:
-            bytes_sent1 = net[adapterId][0]
-            time1 = time.time()
-            
-            time.sleep(0.2)
-            
-            net = psutil.net_io_counters(pernic=True)
-            bytes_sent2 = net[adapterId][0]
-            time2 = time.time()
-            
-            interval = (time2 - time1)
-            
-            return (bytes_sent2 - bytes_sent1) / interval
-        else:
-            return 0
+        return self.writeRates.get(adapterId)
 
     def getNetstat(self):
-        retCode, output = waagent.RunGetOutput("netstat -s", chk_err=False)
-        return output
+        stats = parseProcNetStats("/proc/net/snmp")
+        stats.update(parseProcNetStats("/proc/net/netstat"))
+        return stats
 
     def getNetworkPacketRetransmitted(self):
-        netstat = self.getNetstat()
-        match = re.search("(\d+)\s*segments retransmited", netstat)
-        if match != None:
-            return int(match.group(1))
-        else:
-            waagent.Error("Failed to parse netstat output: {0}".format(netstat))
+        try:
+            return self.getNetstat()["Tcp.RetransSegs"]
+        except (IOError, KeyError) as e:
+            waagent.Error("Failed to read network statistics: {0}".format(e))
             updateLatestErrorRecord(FAILED_TO_RETRIEVE_LOCAL_DATA)
             AddExtensionEvent(message=FAILED_TO_RETRIEVE_LOCAL_DATA)
             return None
 
+def parseProcNetStats(path):
+    """
+    Parse /proc/net/snmp or /proc/net/netstat, which have pairs of lines
+    like "Tcp: RtoAlgorithm RtoMin ..." and "Tcp: 1 200 ...".
+    Returns a dict like {"Tcp.RtoAlgorithm": 1, "Tcp.RtoMin": 200, ...}.
+    """
+    stats = {}
+    with open(path) as F:
+        lines = F.readlines()
+    for header, values in zip(lines[0::2], lines[1::2]):
+        prefix, _, names = header.partition(":")
+        _, _, values = values.partition(":")
+        for name, value in zip(names.split(), values.split()):
+            stats["{0}.{1}".format(prefix, name)] = int(value)
+    return stats
+
+
+NETLINK_KOBJECT_UEVENT = 15
+#inotify event masks from <sys/inotify.h>
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = os.O_NONBLOCK
+
+def parseUevent(data):
+    """
+    Parse a kernel uevent: "<action>@<devpath>" followed by KEY=VALUE 
+    fields, all NUL separated. udev's own messages (starting with 
+    "libudev") are ignored.
+    """
+    fields = data.split("\0")
+    if len(fields) == 0 or "@" not in fields[0]:
+        return None
+    uevent = {}
+    for field in fields[1:]:
+        key, sep, value = field.partition("=")
+        if sep:
+            uevent[key] = value
+    return uevent
+
+class UeventMonitor(object):
+    """
+    Listens to the kernel uevents (the ones udev gets) through netlink, 
+    and reports whether a device of the given subsystems was added, 
+    removed or changed since the last poll, without blocking.
+    """
+    def __init__(self, subsystems):
+        self.subsystems = subsystems
+        self.sock = None
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, 
+                                 NETLINK_KOBJECT_UEVENT)
+            #Group 1: the kernel's events
+            sock.bind((0, 1))
+            sock.setblocking(False)
+            self.sock = sock
+        except (AttributeError, socket.error) as e:
+            waagent.Log("Uevents are not available: {0}".format(e))
+
+    def isAvailable(self):
+        return self.sock is not None
+
+    def poll(self):
+        changed = False
+        while True:
+            try:
+                data = self.sock.recv(64 * 1024)
+            except socket.error as e:
+                if e.errno == errno.ENOBUFS:
+                    #Events were dropped
+                    changed = True
+                    continue
+                return changed
+            uevent = parseUevent(data)
+            if uevent is not None and \
+                    uevent.get("SUBSYSTEM") in self.subsystems:
+                changed = True
+
+class InotifyMonitor(object):
+    """
+    Reports whether entries were created or removed in the given 
+    directories since the last poll, without blocking. It's the fallback
+    for disks where netlink isn't available: sysfs doesn't generate inotify
+    events, but udev maintains /dev/disk/by-id.
+    """
+    def __init__(self, paths):
+        self.fd = None
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK)
+        except Exception:
+            return
+        if fd < 0:
+            return
+        mask = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+        watches = 0
+        for path in paths:
+            if libc.inotify_add_watch(fd, ctypes.c_char_p(path), 
+                                      ctypes.c_uint32(mask)) >= 0:
+                watches += 1
+        if watches == 0:
+            os.close(fd)
+            return
+        self.fd = fd
+
+    def isAvailable(self):
+        return self.fd is not None
+
+    def poll(self):
+        changed = False
+        while True:
+            try:
+                if not os.read(self.fd, 64 * 1024):
+                    return changed
+                changed = True
+            except OSError:
+                return changed
+
+class HardwareInventory(object):
+    """
+    The NICs (MAC addresses) and data disks (LUNs) of the VM. They are 
+    read once, and read again only when udev reports a net or block device
+    change (or, without netlink, when /dev/disk/by-id changes), and every 
+    refreshInterval seconds as a safety net for missed events. So steady 
+    cycles don't read /sys, and a hot-added disk shows up in the next 
+    collection.
+    """
+    refreshInterval = 10 * 60
+
+    def __init__(self, monitor=None, sysBlock="/sys/block", 
+                 sysClassNet="/sys/class/net", clock=getMonotonicTime):
+        self.sysBlock = sysBlock
+        self.sysClassNet = sysClassNet
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.lastRefresh = None
+        self.macs = {}
+        self.luns = {}
+        if monitor is None:
+            monitor = UeventMonitor(["block", "net"])
+            if not monitor.isAvailable():
+                monitor = InotifyMonitor(["/dev/disk/by-id"])
+        self.monitor = monitor if monitor.isAvailable() else None
+
+    def refreshIfChanged(self):
+        now = self.clock()
+        #Read the events in any case, they are covered by a refresh
+        changed = self.monitor is not None and self.monitor.poll()
+        if changed or self.lastRefresh is None or \
+                now - self.lastRefresh >= self.refreshInterval:
+            self.refresh()
+            self.lastRefresh = now
+
+    def refresh(self):
+        luns = {}
+        for dev in getDataDisks(self.sysBlock):
+            try:
+                lun = getFirstLun(dev, self.sysBlock)
+            except OSError:
+                #Not a scsi disk, or just removed
+                continue
+            if lun is not None:
+                luns[lun] = dev
+        self.luns = luns
+        self.macs = {}
+
+    def getLunToDevMap(self):
+        with self.lock:
+            self.refreshIfChanged()
+            return dict(self.luns)
+
+    def getMacAddress(self, adapterId):
+        with self.lock:
+            self.refreshIfChanged()
+            mac = self.macs.get(adapterId)
+            if mac is None:
+                mac = getMacAddress(adapterId, self.sysClassNet)
+                self.macs[adapterId] = mac
+            return mac
+
+_hardwareInventory = None
+_hardwareInventoryLock = threading.Lock()
+
+def getHardwareInventory():
+    global _hardwareInventory
+    with _hardwareInventoryLock:
+        if _hardwareInventory is None:
+            _hardwareInventory = HardwareInventory()
+        return _hardwareInventory
 
 HwInfoFile = os.path.join(LibDir, "HwInfo")
+#(HwInfoFile, timestamp, macs) of the last hardware change, so that the file
+#is only read once, and only written when the hardware changes.
+_hwInfoCache = None
+
 class HardwareChangeInfo(object):
-    def __init__(self, networkInfo):
+    def __init__(self, networkInfo, inventory=None):
         self.networkInfo = networkInfo
+        self.inventory = inventory or getHardwareInventory()
 
     def getHwInfo(self):
+        global _hwInfoCache
+        if _hwInfoCache is not None and _hwInfoCache[0] == HwInfoFile:
+            return _hwInfoCache[1:]
         if not os.path.isfile(HwInfoFile):
             return None, None
         hwInfo = waagent.GetFileContents(HwInfoFile).split("\n")
-        return int(hwInfo[0]), hwInfo[1:]
+        _hwInfoCache = (HwInfoFile, int(hwInfo[0]), hwInfo[1:])
+        return _hwInfoCache[1:]
 
     def setHwInfo(self, timestamp, hwInfo):
+        global _hwInfoCache
         content = str(timestamp)
         content = content + "\n" + "\n".join(hwInfo)
         waagent.SetFileContents(HwInfoFile, content)
+        _hwInfoCache = (HwInfoFile, timestamp, hwInfo)
 
     def getLastHardwareChange(self):
         oldTime, oldMacs = self.getHwInfo()
-        newMacs = map(lambda x : getMacAddress(x), 
+        newMacs = map(lambda x : self.inventory.getMacAddress(x), 
                       self.networkInfo.getAdapterIds())
         newTime = int(time.time())
         newMacs.sort()
@@ -544,7 +1072,7 @@ class LinuxMetric(object):
         return self.networkInfo.getAdapterIds()
 
     def getNetworkAdapterMapping(self, adapterId):
-        return getMacAddress(adapterId)
+        return getHardwareInventory().getMacAddress(adapterId)
 
     def getMaxNetworkBandwidth(self, adapterId):
         return 1000 #Mbit/s 
@@ -565,8 +1093,13 @@ class LinuxMetric(object):
         return self.hwChangeInfo.getLastHardwareChange()
 
 class VMDataSource(object):
+    #Seconds from the start of a cycle after which the counters of the
+    #previous cycle are published instead
+    collectDeadline = 30
+
     def __init__(self, config):
         self.config = config
+        NetworkInfo.sample()
 
     def collect(self):
         counters = []
@@ -802,24 +1335,35 @@ def getStorageTimestamp(unixTimestamp):
                           ts.tm_min)
     
 
-def getStorageTableKeyRange():
+def getStorageTableTimeRange(now=None, lastEndTime=None):
+    """
+    Time range of the storage analytics minutes to read: the minute 
+    AzureTableDelay ago, widened back to lastEndTime (the end of the range 
+    read last) so that no minute is skipped.
+    """
+    if now is None:
+        now = time.time()
     #Round down by MonitoringInterval
-    endTime = int(time.time()) / MonitoringInterval * MonitoringInterval 
+    endTime = int(now) / MonitoringInterval * MonitoringInterval 
     endTime = endTime - AzureTableDelay
     startTime = endTime - MonitoringInterval
+    if lastEndTime is not None and lastEndTime < startTime:
+        startTime = max(lastEndTime, endTime - StorageCatchUp)
+    return startTime, endTime
+
+def getStorageTableKeyRange(now=None, lastEndTime=None):
+    startTime, endTime = getStorageTableTimeRange(now, lastEndTime)
     return getStorageTimestamp(startTime), getStorageTimestamp(endTime)
 
 def getStorageMetrics(account, key, hostBase, table, startKey, endKey):
     try:
         waagent.Log("Retrieve storage metrics data.")
-        tableService = TableService(account_name = account, 
-                                    account_key = key,
-                                    host_base = hostBase)
-        ofilter = ("PartitionKey ge '{0}' and PartitionKey lt '{1}'"
-                   "").format(startKey, endKey)
-        oselect = ("TotalRequests,TotalIngress,TotalEgress,AverageE2ELatency,"
-                   "AverageServerLatency,RowKey")
-        metrics = tableService.query_entities(table, ofilter, oselect)
+        client = getTableClient(account, key, hostBase)
+        query = client.getQuery(table, ["TotalRequests", "TotalIngress", 
+                                        "TotalEgress", "AverageE2ELatency",
+                                        "AverageServerLatency"])
+        metrics = query.getListener(StorageStatAccumulator)
+        query.fetch(startKey, endKey)
         waagent.Log("{0} records returned.".format(len(metrics)))
         return metrics
     except Exception as e:
@@ -829,15 +1373,16 @@ def getStorageMetrics(account, key, hostBase, table, startKey, endKey):
         AddExtensionEvent(message=FAILED_TO_RETRIEVE_STORAGE_DATA)
         return None
 
-def getDataDisks():
-    blockDevs = os.listdir('/sys/block')
+def getDataDisks(sysBlock="/sys/block"):
+    blockDevs = os.listdir(sysBlock)
     dataDisks = filter(lambda d : re.match("sd[c-z]", d), blockDevs)
     return dataDisks
 
-def getFirstLun(dev):
-    path = os.path.join("/sys/block", dev, "device/scsi_disk")
+def getFirstLun(dev, sysBlock="/sys/block"):
+    #The entries are named <host>:<channel>:<target>:<lun>
+    path = os.path.join(sysBlock, dev, "device/scsi_disk")
     for lun in os.listdir(path):
-        return int(lun[-1])
+        return int(lun.split(":")[-1])
 
 class DiskInfo(object):
     def __init__(self, config):
@@ -858,14 +1403,9 @@ class DiskInfo(object):
                 "/dev/sda": osdisk,
         }
 
-        dataDisks = getDataDisks()
-        if dataDisks is None or len(dataDisks) == 0:
+        lunToDevMap = getHardwareInventory().getLunToDevMap()
+        if len(lunToDevMap) == 0:
             return diskMapping
-        
-        lunToDevMap = {}
-        for dev in dataDisks:
-            lun = getFirstLun(dev)
-            lunToDevMap[lun] = dev
 
         diskCount = self.config.getDataDiskCount()
         for i in range(0, diskCount):
@@ -905,37 +1445,122 @@ def isUserWrite(op):
             return True
     return False
 
-def storageStat(metrics, opFilter):
+#The kind of operation of the row keys, i.e. "r" (user read), "w" (user 
+#write) or None. There are a few dozens of them.
+_storageOpKinds = {}
+
+def getStorageOpKind(op):
+    kind = _storageOpKinds.get(op, False)
+    if kind is False:
+        kind = "r" if isUserRead(op) else "w" if isUserWrite(op) else None
+        _storageOpKinds[op] = kind
+    return kind
+
+class StorageStatAccumulator(object):
+    """
+    Read and write totals of storage metrics rows, accumulated per 
+    partition (i.e. per minute) in a single pass as the rows are fetched. 
+    The totals of the rows of the range are kept up to date, so reading a 
+    stat doesn't depend on the number of rows.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        #partition -> kind -> [bytes, ops, ops * e2eLatency, 
+        #                      ops * serverLatency], plus the row count
+        self.partitions = {}
+        self.sum()
+
+    def addRows(self, rows):
+        for row in rows:
+            partition = self.partitions.get(getattr(row, "PartitionKey", None))
+            if partition is None:
+                partition = {"r" : [0, 0, 0, 0], "w" : [0, 0, 0, 0], "rows" : 0}
+                self.partitions[getattr(row, "PartitionKey", None)] = partition
+            partition["rows"] += 1
+            kind = getStorageOpKind(row.RowKey)
+            if kind is None:
+                continue
+            totals = partition[kind]
+            totals[0] += row.TotalIngress + row.TotalEgress
+            totals[1] += row.TotalRequests
+            totals[2] += row.TotalRequests * row.AverageE2ELatency
+            totals[3] += row.TotalRequests * row.AverageServerLatency
+        self.sum()
+
+    def dropBefore(self, startKey):
+        for key in self.partitions.keys():
+            if key < startKey:
+                del self.partitions[key]
+        self.sum()
+
+    def sum(self):
+        #The totals are rebuilt while holding the lock of the table client,
+        #but read by the collectors without it: they are published in one
+        #assignment and never changed after, so a reader sees either the old
+        #or the new totals, not a mix of both.
+        totals = {"r" : [0, 0, 0, 0], "w" : [0, 0, 0, 0]}
+        rowCount = 0
+        for partition in self.partitions.itervalues():
+            rowCount += partition["rows"]
+            for kind in ["r", "w"]:
+                totals[kind] = map(sum, zip(totals[kind], partition[kind]))
+        self.totals = (rowCount, tuple(totals["r"]), tuple(totals["w"]))
+
+    def __len__(self):
+        return self.totals[0]
+
+    def getStats(self, minutes=1):
+        """
+        Read and write stats, both from the same totals, of rows covering 
+        the given number of minutes.
+        """
+        rowCount, readTotals, writeTotals = self.totals
+        return (getStorageStat(readTotals, minutes), 
+                getStorageStat(writeTotals, minutes))
+
+def getStorageStat(totals, minutes=1):
+    #The counters are per minute: the totals of a window of several minutes
+    #(catching up on late collections) are averaged over its minutes
+    totalBytes, ops, e2eLatency, serverLatency = totals
     stat = {}
-    stat['bytes'] = None
-    stat['ops'] = None
+    stat['bytes'] = int(round(float(totalBytes) / minutes))
+    stat['ops'] = int(round(float(ops) / minutes))
     stat['e2eLatency'] = None
     stat['serverLatency'] = None
-    stat['throughput'] = None
-    if metrics is None:
-        return stat
-
-    metrics = filter(lambda x : opFilter(x.RowKey), metrics)
-    stat['bytes'] = sum(map(lambda x : x.TotalIngress + x.TotalEgress, 
-                            metrics))
-    stat['ops'] = sum(map(lambda x : x.TotalRequests, metrics))
-    if stat['ops'] != 0:
-        stat['e2eLatency'] = sum(map(lambda x : x.TotalRequests * \
-                                                x.AverageE2ELatency, 
-                                     metrics)) / stat['ops']
-        stat['serverLatency'] = sum(map(lambda x : x.TotalRequests * \
-                                                   x.AverageServerLatency, 
-                                        metrics)) / stat['ops']
+    if ops != 0:
+        stat['e2eLatency'] = e2eLatency / ops
+        stat['serverLatency'] = serverLatency / ops
     #Convert to MB/s
-    stat['throughput'] = float(stat['bytes']) / (1024 * 1024) / 60 
+    stat['throughput'] = float(totalBytes) / (1024 * 1024) / (60 * minutes)
     return stat
 
+def storageStats(metrics, minutes=1):
+    if metrics is None:
+        stat = {
+            'bytes' : None,
+            'ops' : None,
+            'e2eLatency' : None,
+            'serverLatency' : None,
+            'throughput' : None
+        }
+        return stat, dict(stat)
+    if not isinstance(metrics, StorageStatAccumulator):
+        rows = metrics
+        metrics = StorageStatAccumulator()
+        metrics.addRows(rows)
+    return metrics.getStats(minutes)
+
 class AzureStorageStat(object):
 
-    def __init__(self, metrics):
+    def __init__(self, metrics, minutes=1):
+        """
+        metrics is the StorageStatAccumulator of the storage account (or a 
+        list of storage metrics rows), covering the given number of minutes.
+        """
         self.metrics = metrics
-        self.rStat = storageStat(metrics, isUserRead)
-        self.wStat = storageStat(metrics, isUserWrite)
+        self.rStat, self.wStat = storageStats(metrics, minutes)
 
     def getReadBytes(self):
         return self.rStat['bytes']
@@ -969,8 +1594,13 @@ class AzureStorageStat(object):
 
 
 class StorageDataSource(object):
-    def __init__(self, config):
+    collectDeadline = 30
+
+    def __init__(self, config, clock=time.time):
         self.config = config
+        self.clock = clock
+        #Account -> end time of the storage analytics minutes read last
+        self.lastEndTimes = {}
 
     def collect(self):
         counters = []
@@ -996,7 +1626,10 @@ class StorageDataSource(object):
 
     def collectMetrixForStandardStorage(self, account):
         counters = []
-        startKey, endKey = getStorageTableKeyRange()
+        #The minutes since the range read last, in case the previous 
+        #collection was late or failed
+        startTime, endTime = getStorageTableTimeRange(
+                self.clock(), self.lastEndTimes.get(account))
         tableName = self.config.getStorageAccountMinuteTable(account)
         accountKey = self.config.getStorageAccountKey(account)
         hostBase = self.config.getStorageHostBase(account)
@@ -1004,9 +1637,12 @@ class StorageDataSource(object):
                                     accountKey,
                                     hostBase,
                                     tableName,
-                                    startKey,
-                                    endKey)
-        stat = AzureStorageStat(metrics)
+                                    getStorageTimestamp(startTime),
+                                    getStorageTimestamp(endTime))
+        if metrics is not None:
+            self.lastEndTimes[account] = endTime
+        stat = AzureStorageStat(metrics, 
+                                (endTime - startTime) / MonitoringInterval)
         counters.append(self.createCounterStorageId(account))
         counters.append(self.createCounterReadBytes(account, stat))
         counters.append(self.createCounterReadOps(account, stat))
@@ -1174,6 +1810,9 @@ class HvInfo(object):
         return self.hvVersion
 
 class StaticDataSource(object):
+    collectDeadline = 10
+    collectInterval = 15 * MonitoringInterval
+
     def __init__(self, config):
         self.config = config
 
@@ -1307,23 +1946,424 @@ class PerfCounter(object):
 
     __repr__ = __str__
 
+class DataSourceCollector(object):
+    """
+    Runs the collection of a data source in a thread, and keeps the counters
+    it collected last. A collection that is still running (e.g. waiting for a
+    storage table) isn't started again.
+    """
+    def __init__(self, dataSource):
+        self.dataSource = dataSource
+        self.name = dataSource.__class__.__name__
+        self.deadline = getattr(dataSource, "collectDeadline", 
+                                MonitoringInterval / 2)
+        #Seconds between two collections
+        self.interval = getattr(dataSource, "collectInterval", 
+                                MonitoringInterval)
+        self.thread = None
+        self.counters = None
+        self.error = None
+        self.latency = None
+        #Collections that missed their deadline, and that weren't started 
+        #because the previous one was still running
+        self.missedDeadlines = 0
+        self.skippedCollections = 0
+
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            self.skippedCollections += 1
+            return False
+        self.error = None
+        self.thread = threading.Thread(target=self._collect,
+                                       name=self.name)
+        self.thread.daemon = True
+        self.thread.start()
+        return True
+
+    def _collect(self):
+        startTime = time.time()
+        try:
+            self.counters = self.dataSource.collect()
+        except Exception as e:
+            waagent.Error((u"Failed to collect {0}: {1} {2}"
+                           "").format(self.name, e, traceback.format_exc()))
+            self.error = e
+        finally:
+            self.latency = time.time() - startTime
+
+    def wait(self, timeout):
+        """
+        Wait for the collection to finish.
+        Returns False if it's still running after timeout seconds.
+        """
+        self.thread.join(max(timeout, 0))
+        if self.thread.is_alive():
+            self.missedDeadlines += 1
+            return False
+        return True
+
+class CollectionScheduler(object):
+    """
+    Timer wheel of the data source collections, with a slot per tick of 
+    MonitoringInterval seconds. A collector fires every collectInterval 
+    seconds of its data source (rounded to ticks), and all of them at the 
+    first tick. The ticks are anchored to the start time, so the time spent 
+    collecting doesn't make the cycles drift, and the counters are published
+    every tick (SAP requires them to be refreshed every minute). Ticks 
+    missed because a cycle overran are accounted for and skipped: the 
+    collections due in them fire in the next tick.
+    """
+    def __init__(self, collectors, tick=MonitoringInterval, 
+                 clock=getMonotonicTime, sleep=time.sleep):
+        self.tick = tick
+        self.clock = clock
+        self.sleep = sleep
+        self.intervals = {}
+        for collector in collectors:
+            ticks = int(round(float(collector.interval) / tick))
+            self.intervals[collector] = max(ticks, 1)
+        #Longer than any interval, so that a slot holds a single round
+        self.wheel = [[] for i in range(0, max(self.intervals.values()) + 1)]
+        self.wheel[0] = list(collectors)
+        self.startTime = None
+        self.ticks = 0
+        self.missedTicks = 0
+
+    def getNextTickTime(self):
+        return self.startTime + self.ticks * self.tick
+
+    def wait(self):
+        """
+        Sleep until the next tick, and return the collectors due in it.
+        """
+        now = self.clock()
+        if self.startTime is None:
+            self.startTime = now
+        late = now - self.getNextTickTime()
+        missed = 0
+        if late < 0:
+            self.sleep(-late)
+        else:
+            missed = int(late / self.tick)
+        if missed > 0:
+            self.missedTicks += missed
+            waagent.Warn(("Missed {0} collection cycle(s), {1} in total."
+                          "").format(missed, self.missedTicks))
+
+        due = []
+        for i in range(0, missed + 1):
+            slot = self.ticks % len(self.wheel)
+            collectors = self.wheel[slot]
+            self.wheel[slot] = []
+            for collector in collectors:
+                if collector not in due:
+                    due.append(collector)
+                nextTick = self.ticks + self.intervals[collector]
+                self.wheel[nextTick % len(self.wheel)].append(collector)
+            self.ticks += 1
+        return due
+
 class EnhancedMonitor(object):
     def __init__(self, config):
         self.dataSources = []
         self.dataSources.append(VMDataSource(config))
         self.dataSources.append(StorageDataSource(config))
         self.dataSources.append(StaticDataSource(config))
+        self.collectors = map(DataSourceCollector, self.dataSources)
+        #Collector -> latency of its last collection, None if it was late
+        self.latencies = {}
         self.writer = PerfCounterWriter()
 
-    def run(self):
+    def run(self, dueCollectors=None):
+        #The data sources are collected concurrently, so that a slow one 
+        #(e.g. storage tables) doesn't delay the others. A data source that 
+        #misses its deadline, or isn't due in this cycle, gets the counters
+        #it collected last published, with their original timestamps, so 
+        #that they show up as stale.
+        if dueCollectors is None:
+            dueCollectors = self.collectors
+        startTime = time.time()
+        for collector in dueCollectors:
+            if not collector.start():
+                waagent.Warn(("{0} is still collecting the previous cycle, "
+                              "{1} collection(s) skipped in total."
+                              "").format(collector.name,
+                                         collector.skippedCollections))
+
         counters = []
-        for dataSource in self.dataSources:
-            counters.extend(dataSource.collect())
+        latencies = []
+        lateSources = []
+        error = None
+        for collector in self.collectors:
+            if collector not in dueCollectors:
+                pass
+            elif collector.wait(startTime + collector.deadline - time.time()):
+                self.latencies[collector] = collector.latency
+                latencies.append("{0}={1:.2f}s".format(collector.name,
+                                                       collector.latency))
+                error = error or collector.error
+            else:
+                self.latencies[collector] = None
+                latencies.append("{0}=late({1})".format(collector.name,
+                                                        collector.missedDeadlines))
+                lateSources.append(collector.name)
+            if collector.counters is not None:
+                counters.extend(collector.counters)
+
+        waagent.Log("Collection latency: {0}".format(", ".join(latencies)))
         clearLastErrorRecord()
+        if lateSources:
+            waagent.Warn(("Publishing stale counters of late data sources: "
+                          "{0}").format(", ".join(lateSources)))
+            updateLatestErrorRecord(DATA_SOURCE_TIMED_OUT)
         self.writer.write(counters)
+        if error is not None:
+            raise error
 
 EventFile=os.path.join(LibDir, "PerfCounters")
+
+#Binary layout of the perf counters, shared with clib (see azureperf.h).
+#A header followed by PERF_COUNT_MAX fixed size records, in native byte 
+#order without padding. The strings are utf-8 and NUL terminated.
+PerfCounterMapMagic = 0x46504541 #"AEPF"
+PerfCounterMapVersion = 1
+PerfCountMax = 128
+#magic, version, header size, record size, capacity, seq, count, reserved,
+#update time
+PerfCounterMapHeader = struct.Struct("=IIIIIIIIq24x")
+PerfCounterMapSeqOffset = 20
+#counter type, is empty, refresh interval, reserved, timestamp, value, 
+#followed by the names: type name, property name, instance name, unit name,
+#machine name, and the string value.
+PerfCounterRecordHead = struct.Struct("=iiIIq8s")
+PerfCounterRecordNames = struct.Struct("=64s128s256s64s128s")
+PerfCounterRecordStrValue = struct.Struct("=256s")
+PerfCounterRecordSize = PerfCounterRecordHead.size + \
+                        PerfCounterRecordNames.size + \
+                        PerfCounterRecordStrValue.size
+
+def packCounterString(s, size):
+    if s is None:
+        return ""
+    if not isinstance(s, unicode):
+        s = unicode(str(s), "utf8", "ignore")
+    #Keep the NUL terminator and don't cut a multi-byte char in halves
+    return s.encode("utf8")[:size - 1].decode("utf8", "ignore").encode("utf8")
+
+def packCounterNames(counter):
+    return PerfCounterRecordNames.pack(packCounterString(counter.category, 64),
+                                       packCounterString(counter.name, 128),
+                                       packCounterString(counter.instance, 256),
+                                       packCounterString(counter.unit, 64),
+                                       packCounterString(counter.machine, 128))
+
+def packCounterValue(counter):
+    """
+    Returns the packed numeric value and the packed string value of a 
+    counter, or None if it has no (valid) value.
+    """
+    value = counter.value
+    if value is None:
+        return None
+    try:
+        if counter.counterType == PerfCounterType.COUNTER_TYPE_DOUBLE:
+            return struct.pack("=d", float(value)), ""
+        elif counter.counterType in [PerfCounterType.COUNTER_TYPE_INT, 
+                                     PerfCounterType.COUNTER_TYPE_LARGE]:
+            return struct.pack("=q", int(value)), ""
+    except (TypeError, ValueError, OverflowError):
+        waagent.Warn(("Invalid value of counter {0}\\{1}: {2}"
+                      "").format(counter.category, counter.name, value))
+        return None
+    return "", packCounterString(value, PerfCounterRecordStrValue.size)
+
+def packCounter(counter, names):
+    value = packCounterValue(counter)
+    numValue, strValue = value if value is not None else ("", "")
+    return "".join([PerfCounterRecordHead.pack(counter.counterType,
+                                               1 if value is None else 0,
+                                               counter.refreshInterval,
+                                               0,
+                                               counter.timestamp,
+                                               numValue),
+                    names,
+                    PerfCounterRecordStrValue.pack(strValue)])
+
+class PerfCounterMap(object):
+    """
+    The perf counters in the binary layout, updated in place. Each counter
+    keeps its record across updates, and only the records that changed are
+    written. Readers mmap the file and read it without locking: the writer
+    makes the sequence number in the header odd while it updates records,
+    and a reader retries if the sequence number was odd or changed while it
+    was copying them (a seqlock).
+
+    The records are written with write(2) rather than through a mapping, so 
+    that the kernel orders the updates of the sequence number and of the 
+    records, which python can't do with plain memory stores.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+        self.seq = 0
+        self.slots = {}
+        self.names = {}
+        self.states = [None] * PerfCountMax
+        self.records = [None] * PerfCountMax
+
+    def getSize(self):
+        return PerfCounterMapHeader.size + PerfCounterRecordSize * PerfCountMax
+
+    def open(self):
+        #Reuse the file if it has this layout, so that readers keep their 
+        #mapping. Otherwise a new one replaces it.
+        try:
+            fd = os.open(self.path, os.O_RDWR)
+        except OSError:
+            fd = None
+        if fd is not None:
+            header = os.read(fd, PerfCounterMapHeader.size)
+            if len(header) == PerfCounterMapHeader.size and \
+                    os.fstat(fd).st_size == self.getSize():
+                magic, version, headerSize, recordSize, capacity, seq = \
+                        PerfCounterMapHeader.unpack(header)[:6]
+                if (magic, version, headerSize, recordSize, capacity) == \
+                        (PerfCounterMapMagic, PerfCounterMapVersion, 
+                         PerfCounterMapHeader.size, PerfCounterRecordSize,
+                         PerfCountMax):
+                    self.fd = fd
+                    #Even, whether or not the last writer was interrupted
+                    self.seq = (seq + 1) & ~1
+                    self.loadSlots()
+                    return
+            os.close(fd)
+
+        tmpPath = "{0}.tmp".format(self.path)
+        with open(tmpPath, "wb") as F:
+            F.write(self.packHeader(0, 0))
+            F.write("\0" * (self.getSize() - PerfCounterMapHeader.size))
+        os.rename(tmpPath, self.path)
+        self.fd = os.open(self.path, os.O_RDWR)
+        self.seq = 0
+        self.records = ["\0" * PerfCounterRecordSize] * PerfCountMax
+
+    def loadSlots(self):
+        """
+        Keep the counters in the records they had, so that readers find
+        them at the same place after the writer was restarted.
+        """
+        self.slots = {}
+        self.records = [None] * PerfCountMax
+        for i in range(0, PerfCountMax):
+            offset = PerfCounterMapHeader.size + PerfCounterRecordSize * i
+            os.lseek(self.fd, offset + PerfCounterRecordHead.size, os.SEEK_SET)
+            names = os.read(self.fd, PerfCounterRecordNames.size)
+            if len(names) < PerfCounterRecordNames.size:
+                break
+            names = map(lambda n : n.rstrip("\0").decode("utf8", "ignore"),
+                        PerfCounterRecordNames.unpack(names)[:3])
+            if names[0]:
+                self.slots[tuple(names)] = i
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def packHeader(self, seq, count):
+        return PerfCounterMapHeader.pack(PerfCounterMapMagic, 
+                                         PerfCounterMapVersion,
+                                         PerfCounterMapHeader.size, 
+                                         PerfCounterRecordSize,
+                                         PerfCountMax,
+                                         seq,
+                                         count,
+                                         0,
+                                         int(time.time()))
+
+    def writeAt(self, offset, data):
+        os.lseek(self.fd, offset, os.SEEK_SET)
+        while data:
+            written = os.write(self.fd, data)
+            data = data[written:]
+
+    def assignSlots(self, counters):
+        keys = map(lambda c : (c.category, c.name, c.instance), counters)
+        slots = {}
+        for key in keys:
+            if key in self.slots:
+                slots[key] = self.slots[key]
+        freeSlots = sorted(set(range(0, PerfCountMax)) - set(slots.values()))
+        for key in keys:
+            if key not in slots:
+                if len(freeSlots) == 0:
+                    waagent.Warn(("Too many perf counters, {0}\\{1} is "
+                                  "dropped.").format(key[0], key[1]))
+                    continue
+                slots[key] = freeSlots.pop(0)
+        self.slots = slots
+        return keys
+
+    def update(self, counters):
+        if self.fd is None:
+            self.open()
+        records = ["\0" * PerfCounterRecordSize] * PerfCountMax
+        states = [None] * PerfCountMax
+        #Only pack the counters that changed, and the names rarely do
+        names = {}
+        for key, counter in zip(self.assignSlots(counters), counters):
+            if key not in self.slots:
+                continue
+            slot = self.slots[key]
+            namesKey = (key, counter.unit, counter.machine)
+            states[slot] = (namesKey, counter.counterType, counter.value, 
+                            counter.refreshInterval, counter.timestamp)
+            names[namesKey] = self.names.get(namesKey) or \
+                              packCounterNames(counter)
+            if states[slot] == self.states[slot] and \
+                    self.records[slot] is not None:
+                records[slot] = self.records[slot]
+            else:
+                records[slot] = packCounter(counter, names[namesKey])
+        self.names = names
+        self.states = states
+        changed = filter(lambda i : records[i] != self.records[i], 
+                         range(0, PerfCountMax))
+        count = max(self.slots.values()) + 1 if self.slots else 0
+        if len(changed) == 0:
+            self.writeAt(0, self.packHeader(self.seq, count))
+            return
+
+        try:
+            self.writeAt(PerfCounterMapSeqOffset, 
+                         struct.pack("=I", (self.seq + 1) & 0xffffffff))
+            #Coalesce adjacent records into one write
+            i = 0
+            while i < len(changed):
+                j = i
+                while j + 1 < len(changed) and changed[j + 1] == changed[j] + 1:
+                    j += 1
+                self.writeAt(PerfCounterMapHeader.size + \
+                             PerfCounterRecordSize * changed[i],
+                             "".join(records[changed[i]:changed[j] + 1]))
+                i = j + 1
+            self.seq = (self.seq + 2) & 0xffffffff
+            self.writeAt(0, self.packHeader(self.seq, count))
+        except (IOError, OSError):
+            #Start over from a clean file on the next update
+            self.close()
+            raise
+        self.records = records
+
 class PerfCounterWriter(object):
+    """
+    Publishes the perf counters to the binary counter map, and to the text
+    file that existing readers parse, unless textFormat is False.
+    """
+    def __init__(self, textFormat=True):
+        self.textFormat = textFormat
+        self.counterMaps = {}
+
     def write(self, counters, maxRetry = 3, eventFile=EventFile):
         for i in range(0, maxRetry):
             try:
@@ -1331,7 +2371,7 @@ class PerfCounterWriter(object):
                 waagent.Log(("Write {0} counters to event file."
                              "").format(len(counters)))
                 return
-            except IOError as e:
+            except (IOError, OSError) as e:
                 waagent.Warn((u"Write to perf counters file failed: {0}"
                               "").format(e))
                 waagent.Log("Retry: {0}".format(i))
@@ -1344,8 +2384,14 @@ class PerfCounterWriter(object):
         raise
 
     def _write(self, counters, eventFile):
-        with open(eventFile, "w+") as F:
-            F.write("".join(map(lambda c : str(c), counters)).encode("utf8"))
+        counterMap = self.counterMaps.get(eventFile)
+        if counterMap is None:
+            counterMap = PerfCounterMap("{0}.map".format(eventFile))
+            self.counterMaps[eventFile] = counterMap
+        counterMap.update(counters)
+        if self.textFormat:
+            with open(eventFile, "w+") as F:
+                F.write("".join(map(lambda c : str(c), counters)).encode("utf8"))
 
 class EnhancedMonitorConfig(object):
     def __init__(self, publicConfig, privateConfig):
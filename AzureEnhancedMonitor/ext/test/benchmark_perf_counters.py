@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+#
+#CustomScript extension
+#
+# Copyright 2014 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#Compares the cost per cycle of publishing the perf counters as text and as
+#the binary counter map. The counters come from the clib test case, and the
+#published files are left in the output dir, for the reader benchmark of
+#clib (make benchmark AP_FILE=<dir>/PerfCounters).
+
+import env
+import os
+import sys
+import tempfile
+import time
+import aem
+
+TestCase = os.path.join(env.root, "../clib/test/cases/positive_case")
+
+def loadCounters(path):
+    counters = []
+    with open(path) as F:
+        for line in F.read().decode("utf8").split("\n"):
+            fields = line.split(";")
+            if len(fields) < 10:
+                continue
+            counterType = int(fields[0])
+            value = fields[5] if fields[4] == "0" else None
+            if value is not None and \
+                    counterType != aem.PerfCounterType.COUNTER_TYPE_STRING:
+                value = float(value) \
+                        if counterType == aem.PerfCounterType.COUNTER_TYPE_DOUBLE \
+                        else int(value)
+            counters.append(aem.PerfCounter(counterType = counterType,
+                                            category = fields[1],
+                                            name = fields[2],
+                                            instance = fields[3],
+                                            value = value,
+                                            unit = fields[6],
+                                            refreshInterval = int(fields[7]),
+                                            timestamp = int(fields[8])))
+    return counters
+
+def timeit(writer, counters, eventFile, cycles):
+    start = time.time()
+    for i in range(0, cycles):
+        #The dynamic counters get a new timestamp every cycle
+        for counter in counters:
+            if counter.refreshInterval > 0:
+                counter.timestamp += 60
+        writer._write(counters, eventFile)
+    return (time.time() - start) * 1000.0 / cycles
+
+class TextWriter(aem.PerfCounterWriter):
+    def _write(self, counters, eventFile):
+        with open(eventFile, "w+") as F:
+            F.write("".join(map(lambda c : str(c), counters)).encode("utf8"))
+
+if __name__ == '__main__':
+    cycles = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    outputDir = sys.argv[2] if len(sys.argv) > 2 else tempfile.mkdtemp()
+    counters = loadCounters(TestCase)
+    eventFile = os.path.join(outputDir, "PerfCounters")
+    print "{0} counters, output in {1}".format(len(counters), outputDir)
+    print "{0:<40}{1:>10.3f} ms/cycle".format("text", 
+            timeit(TextWriter(), counters, eventFile, cycles))
+    print "{0:<40}{1:>10.3f} ms/cycle".format("counter map", 
+            timeit(aem.PerfCounterWriter(textFormat=False), counters, 
+                   eventFile, cycles))
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+#
+#CustomScript extension
+#
+# Copyright 2014 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#Compares the cost per collection cycle of the in-process /proc parsers with
+#the netstat/lscpu invocations they replaced. The parsers run against the
+#canned files in test/proc, the commands (if installed) against the host.
+
+import env
+import os
+import shutil
+import subprocess
+import sys
+import time
+import aem
+from Utils.WAAgentUtil import waagent
+from test_aem import makeSysCpuDir
+
+def timeit(func, cycles):
+    start = time.time()
+    for i in range(0, cycles):
+        func()
+    return (time.time() - start) * 1000.0 / cycles
+
+def runCommand(cmd):
+    devnull = open(os.devnull, 'w')
+    try:
+        subprocess.call(cmd, stdout=devnull, stderr=devnull)
+    finally:
+        devnull.close()
+
+def hasCommand(cmd):
+    for path in os.environ.get("PATH", "").split(os.pathsep):
+        if os.access(os.path.join(path, cmd), os.X_OK):
+            return True
+    return False
+
+def report(name, msPerCycle):
+    print "{0:<40}{1:>10.3f} ms/cycle".format(name, msPerCycle)
+
+if __name__ == '__main__':
+    cycles = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    procCpuInfo = os.path.join(env.test_dir, "proc/cpuinfo")
+    procNetSnmp = os.path.join(env.test_dir, "proc/net_snmp")
+    procNetStat = os.path.join(env.test_dir, "proc/net_netstat")
+    sysCpuDir = makeSysCpuDir(coreIds=[0, 0, 1, 1])
+    try:
+        def parseCPUInfo():
+            aem.CPUInfo(waagent.GetFileContents(procCpuInfo), "0-3", sysCpuDir)
+
+        def parseNetStats():
+            aem.parseProcNetStats(procNetSnmp)
+            aem.parseProcNetStats(procNetStat)
+
+        report("cpuinfo + topology (parsed)", timeit(parseCPUInfo, cycles))
+        report("cpuinfo + topology (cached)", 
+               timeit(lambda : aem.CPUInfo.getCPUInfo(procCpuInfo, sysCpuDir),
+                      cycles))
+        report("/proc/net/snmp + netstat", timeit(parseNetStats, cycles))
+    finally:
+        shutil.rmtree(sysCpuDir)
+
+    #Forking is orders of magnitude slower, a few runs are enough
+    commandCycles = max(cycles / 100, 1)
+    for cmd in (["lscpu"], ["netstat", "-s"]):
+        if hasCommand(cmd[0]):
+            report(" ".join(cmd), 
+                   timeit(lambda : runCommand(cmd), commandCycles))
+        else:
+            print "{0:<40}{1:>10}".format(" ".join(cmd), "not installed")
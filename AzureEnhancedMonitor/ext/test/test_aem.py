@@ -16,10 +16,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import BaseHTTPServer
+import SocketServer
 import datetime
+import errno
 import os
 import json
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import time
 import unittest
+import urllib2
 
 import env
 import aem
@@ -95,6 +105,13 @@ TestPrivateConfig = """\
     }]
 }
 """
+TestNetDev = """\
+Inter-|   Receive                                                |  Transmit
+ face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets errs drop fifo colls carrier compressed
+    lo:   74004    8652    0    0    0     0          0         0    74004    8652    0    0    0     0       0          0
+  eth0: {0[0]}    1000    0    0    0     0          0         0 {0[1]}     800    0    0    0     0       0          0
+  eth1: {1[0]}    1000    0    0    0     0          0         0 {1[1]}     800    0    0    0     0       0          0
+"""
 class TestAEM(unittest.TestCase):
     def setUp(self):
         waagent.LoggerInit("/dev/null", "/dev/stdout")
@@ -169,6 +186,46 @@ class TestAEM(unittest.TestCase):
         self.assertEquals(float, type(percent))
         self.assertTrue(percent >= 0 and percent <= 100)
 
+    def test_cpuinfo_topology(self):
+        sysCpuDir = makeSysCpuDir(coreIds=[0, 0, 1, 1])
+        procCpuInfo = os.path.join(env.test_dir, "proc/cpuinfo")
+        try:
+            cpuinfo = aem.CPUInfo.getCPUInfo(procCpuInfo, sysCpuDir)
+            self.assertEquals(4, cpuinfo.getNumOfCores())
+            self.assertEquals(2, cpuinfo.getNumOfCoresPerCPU())
+            self.assertEquals(2, cpuinfo.getNumOfThreadsPerCore())
+            self.assertTrue(cpuinfo.isHyperThreadingOn())
+            self.assertEquals(("Intel(R) Xeon(R) Platinum 8272CL CPU @ 2.60GHz, "
+                               "GenuineIntel"), cpuinfo.getProcessorType())
+            self.assertEquals(2593.907, cpuinfo.getFrequency())
+
+            #Cached until a cpu is hotplugged
+            self.assertTrue(cpuinfo is aem.CPUInfo.getCPUInfo(procCpuInfo, 
+                                                              sysCpuDir))
+            waagent.SetFileContents(os.path.join(sysCpuDir, "online"), "0-2\n")
+            cpuinfo = aem.CPUInfo.getCPUInfo(procCpuInfo, sysCpuDir)
+            self.assertEquals(3, cpuinfo.getNumOfCores())
+        finally:
+            shutil.rmtree(sysCpuDir)
+
+    def test_cpuinfo_without_sysfs(self):
+        procCpuInfo = os.path.join(env.test_dir, "proc/cpuinfo")
+        cpuinfo = aem.CPUInfo.getCPUInfo(procCpuInfo, "/nonexistent")
+        self.assertEquals(4, cpuinfo.getNumOfCores())
+        self.assertEquals(2, cpuinfo.getNumOfCoresPerCPU())
+        self.assertEquals(2, cpuinfo.getNumOfThreadsPerCore())
+
+    def test_parse_proc_net_stats(self):
+        stats = aem.parseProcNetStats(os.path.join(env.test_dir, 
+                                                   "proc/net_snmp"))
+        self.assertEquals(1457, stats["Tcp.RetransSegs"])
+        self.assertEquals(-1, stats["Tcp.MaxConn"])
+        self.assertEquals(45, stats["IcmpMsg.InType3"])
+        stats = aem.parseProcNetStats(os.path.join(env.test_dir, 
+                                                   "proc/net_netstat"))
+        self.assertEquals(803, stats["TcpExt.TCPTimeouts"])
+        self.assertEquals(5318273411, stats["IpExt.InOctets"])
+
     def test_meminfo(self):
         meminfo = aem.MemoryInfo()
         self.assertNotEquals(None, meminfo.getMemSize())
@@ -178,16 +235,37 @@ class TestAEM(unittest.TestCase):
         self.assertTrue(percent >= 0 and percent <= 100)
 
     def test_networkinfo(self):
+        aem.NetworkInfo.sample()
         netinfo = aem.NetworkInfo()
         adapterIds = netinfo.getAdapterIds()
         self.assertNotEquals(None, adapterIds)
         self.assertNotEquals(0, len(adapterIds))
         adapterId = adapterIds[0]
         self.assertNotEquals(None, aem.getMacAddress(adapterId))
-        self.assertNotEquals(None, netinfo.getNetworkReadBytes())
-        self.assertNotEquals(None, netinfo.getNetworkWriteBytes())
+        self.assertNotEquals(None, netinfo.getNetworkReadBytes(adapterId))
+        self.assertNotEquals(None, netinfo.getNetworkWriteBytes(adapterId))
         self.assertNotEquals(None, netinfo.getNetworkPacketRetransmitted())
 
+    def test_networkinfo_rates(self):
+        procNetDev = "/tmp/net_dev"
+        def sample(now, eth0, eth1):
+            waagent.SetFileContents(procNetDev, TestNetDev.format(eth0, eth1))
+            return aem.NetworkInfo(procNetDev, clock=lambda : now)
+
+        aem.NetworkInfo.lastSample = None
+        netinfo = sample(100.0, (1000, 2000), (4294967000, 0))
+        self.assertEquals(["eth0", "eth1"], netinfo.getAdapterIds())
+        self.assertEquals(None, netinfo.getNetworkReadBytes("eth0"))
+
+        #Rates over the 60s since the previous cycle, with eth1's 32 bit
+        #receive counter wrapped around
+        netinfo = sample(160.0, (61000, 8000), (59704, 600))
+        self.assertEquals(1000, netinfo.getNetworkReadBytes("eth0"))
+        self.assertEquals(100, netinfo.getNetworkWriteBytes("eth0"))
+        self.assertEquals(1000, netinfo.getNetworkReadBytes("eth1"))
+        self.assertEquals(10, netinfo.getNetworkWriteBytes("eth1"))
+        os.remove(procNetDev)
+
     def test_hwchangeinfo(self):
         netinfo = aem.NetworkInfo()
         testHwInfoFile = "/tmp/HwInfo"
@@ -209,13 +287,73 @@ class TestAEM(unittest.TestCase):
         self.assertNotEquals(None, hwChangeInfo.getLastHardwareChange())
 
         
+    def test_hardware_inventory(self):
+        sysDir = tempfile.mkdtemp()
+        sysBlock = os.path.join(sysDir, "block")
+        sysClassNet = os.path.join(sysDir, "net")
+        makeScsiDisk(sysBlock, "sda", "0:0:0:0")
+        makeScsiDisk(sysBlock, "sdc", "5:0:0:1")
+        makeNic(sysClassNet, "eth0", "00:0d:3a:20:7c:81")
+        monitor = MockMonitor()
+        now = [1000]
+        try:
+            inventory = aem.HardwareInventory(monitor, sysBlock, sysClassNet,
+                                              lambda : now[0])
+            self.assertEquals({1 : "sdc"}, inventory.getLunToDevMap())
+            self.assertEquals("00-0d-3a-20-7c-81", 
+                              inventory.getMacAddress("eth0"))
+
+            #Cached until an event comes
+            makeScsiDisk(sysBlock, "sdd", "5:0:0:12")
+            makeNic(sysClassNet, "eth0", "00:0d:3a:20:7c:82")
+            self.assertEquals({1 : "sdc"}, inventory.getLunToDevMap())
+            monitor.changed = True
+            self.assertEquals({1 : "sdc", 12 : "sdd"}, 
+                              inventory.getLunToDevMap())
+            self.assertEquals("00-0d-3a-20-7c-82", 
+                              inventory.getMacAddress("eth0"))
+
+            #Or until the safety refresh
+            shutil.rmtree(os.path.join(sysBlock, "sdc"))
+            now[0] += 60
+            self.assertEquals({1 : "sdc", 12 : "sdd"}, 
+                              inventory.getLunToDevMap())
+            now[0] += aem.HardwareInventory.refreshInterval
+            self.assertEquals({12 : "sdd"}, inventory.getLunToDevMap())
+        finally:
+            shutil.rmtree(sysDir)
+
+    def test_parse_uevent(self):
+        uevent = aem.parseUevent("add@/devices/vmbus/host5/target5:0:0/"
+                                 "5:0:0:1/block/sdc\0ACTION=add\0"
+                                 "DEVNAME=sdc\0SUBSYSTEM=block\0SEQNUM=1\0")
+        self.assertEquals("block", uevent["SUBSYSTEM"])
+        self.assertEquals("sdc", uevent["DEVNAME"])
+        self.assertEquals(None, aem.parseUevent("libudev\0\xfe\xed"))
+
     def test_linux_metric(self):
         config = self.test_config()
         metric = aem.LinuxMetric(config)
-        self.validate_cnm_metric(metric)
+        #A fake /proc/net/dev, with the counters of the previous cycle, 
+        #then of this one, 60s later
+        procNetDev = "/tmp/net_dev"
+        aem.NetworkInfo.lastSample = None
+        try:
+            waagent.SetFileContents(procNetDev, 
+                                    TestNetDev.format((1000, 2000), (0, 0)))
+            aem.NetworkInfo(procNetDev, clock=lambda : 100.0)
+            waagent.SetFileContents(procNetDev, 
+                                    TestNetDev.format((61000, 8000), 
+                                                      (6000, 600)))
+            metric.networkInfo = aem.NetworkInfo(procNetDev, 
+                                                 clock=lambda : 160.0)
+        finally:
+            os.remove(procNetDev)
+        self.validate_cnm_metric(metric, {"eth0" : (1000, 100), 
+                                          "eth1" : (100, 10)})
 
     #Metric for CPU, network and memory
-    def validate_cnm_metric(self, metric):
+    def validate_cnm_metric(self, metric, networkRates):
         self.assertNotEquals(None, metric.getCurrHwFrequency())
         self.assertNotEquals(None, metric.getMaxHwFrequency())
         self.assertNotEquals(None, metric.getCurrVMProcessingPower())
@@ -232,15 +370,17 @@ class TestAEM(unittest.TestCase):
         self.assertNotEquals(None, metric.getGuaranteedMemAssigned())
         self.assertNotEquals(None, metric.getMaxMemAssigned())
         self.assertNotEquals(None, metric.getVMMemConsumption())
+        #The adapters are iterated like VMDataSource does. Their mapping 
+        #(MAC address) comes from sysfs, see test_hardware_inventory.
         adapterIds = metric.getNetworkAdapterIds()
-        self.assertNotEquals(None, adapterIds)
-        self.assertNotEquals(0, len(adapterIds))
-        adapterId = adapterIds[0]
-        self.assertNotEquals(None, metric.getNetworkAdapterMapping(adapterId))
-        self.assertNotEquals(None, metric.getMaxNetworkBandwidth(adapterId))
-        self.assertNotEquals(None, metric.getMinNetworkBandwidth(adapterId))
-        self.assertNotEquals(None, metric.getNetworkReadBytes())
-        self.assertNotEquals(None, metric.getNetworkWriteBytes())
+        self.assertEquals(sorted(networkRates.keys()), sorted(adapterIds))
+        for adapterId in adapterIds:
+            self.assertNotEquals(None, metric.getMaxNetworkBandwidth(adapterId))
+            self.assertNotEquals(None, metric.getMinNetworkBandwidth(adapterId))
+            readRate, writeRate = networkRates[adapterId]
+            self.assertEquals(readRate, metric.getNetworkReadBytes(adapterId))
+            self.assertEquals(writeRate, 
+                              metric.getNetworkWriteBytes(adapterId))
         self.assertNotEquals(None, metric.getNetworkPacketRetransmitted())
         self.assertNotEquals(None, metric.getLastHardwareChange())
 
@@ -299,6 +439,75 @@ class TestAEM(unittest.TestCase):
         self.assertNotEquals(None, stat.getWriteOpServerLatency())
         self.assertNotEquals(None, stat.getWriteOpThroughput())
 
+    def test_storage_stat_accumulator(self):
+        metrics = mock_getStorageMetrics()
+        stat = aem.AzureStorageStat(metrics)
+        reads = filter(lambda x : aem.isUserRead(x.RowKey), metrics)
+        writes = filter(lambda x : aem.isUserWrite(x.RowKey), metrics)
+        readOps = sum(map(lambda x : x.TotalRequests, reads))
+        self.assertEquals(readOps, stat.getReadOps())
+        self.assertEquals(sum(map(lambda x : x.TotalIngress + x.TotalEgress, 
+                                  writes)), stat.getWriteBytes())
+        self.assertAlmostEquals(sum(map(lambda x : x.TotalRequests * \
+                                                   x.AverageE2ELatency, 
+                                        reads)) / readOps,
+                                stat.getReadOpE2ELatency())
+
+        #Rows added in batches and dropped with their partition
+        accumulator = aem.StorageStatAccumulator()
+        for i, row in enumerate(metrics):
+            row.PartitionKey = "P1" if i % 2 == 0 else "P2"
+        accumulator.addRows(metrics[:3])
+        accumulator.addRows(metrics[3:])
+        self.assertEquals(len(metrics), len(accumulator))
+        self.assertEquals(stat.rStat, aem.AzureStorageStat(accumulator).rStat)
+        self.assertEquals(stat.wStat, aem.AzureStorageStat(accumulator).wStat)
+        accumulator.dropBefore("P2")
+        self.assertEquals(aem.AzureStorageStat(metrics[1::2]).wStat,
+                          aem.AzureStorageStat(accumulator).wStat)
+
+        stat = aem.AzureStorageStat(None)
+        self.assertEquals(None, stat.getReadOps())
+
+    def test_storage_stat_over_several_minutes(self):
+        accumulator = aem.StorageStatAccumulator()
+        accumulator.addRows([MockRow("P1", "user;GetBlob", 3),
+                             MockRow("P2", "user;GetBlob", 6),
+                             MockRow("P3", "user;PutBlob", 9)])
+        oneMinute = aem.AzureStorageStat(accumulator)
+        stat = aem.AzureStorageStat(accumulator, 3)
+        #Per minute counters, averaged over the minutes of the window
+        self.assertEquals(9, oneMinute.getReadOps())
+        self.assertEquals(3, stat.getReadOps())
+        self.assertEquals(3, stat.getWriteOps())
+        self.assertEquals(330, stat.getReadBytes())
+        self.assertEquals(330, stat.getWriteBytes())
+        self.assertAlmostEquals(oneMinute.getReadOpThroughput() / 3,
+                                stat.getReadOpThroughput())
+        self.assertAlmostEquals(330.0 / (1024 * 1024) / 60,
+                                stat.getReadOpThroughput())
+        self.assertEquals(oneMinute.getReadOpE2ELatency(),
+                          stat.getReadOpE2ELatency())
+
+    def test_storage_stat_read_while_rows_change(self):
+        accumulator = aem.StorageStatAccumulator()
+        rows = [MockRow("P1", "user;GetBlob"), MockRow("P1", "user;PutBlob")]
+        stop = threading.Event()
+        def update():
+            while not stop.is_set():
+                accumulator.addRows(rows)
+                accumulator.dropBefore("P2")
+        thread = threading.Thread(target=update)
+        thread.start()
+        try:
+            #The read and write stats always come from the same totals
+            for i in range(0, 20000):
+                stat = aem.AzureStorageStat(accumulator)
+                self.assertEquals(stat.getReadOps(), stat.getWriteOps())
+        finally:
+            stop.set()
+            thread.join()
+
     def test_disk_info(self):
         config = self.test_config()
         mapping = aem.DiskInfo(config).getDiskMapping()
@@ -364,6 +573,84 @@ class TestAEM(unittest.TestCase):
         self.assertRaises(IOError, writer.write, counters, 2, testEventFile)
         print("==============================")
 
+    def test_counter_map(self):
+        self.assertEquals(64, aem.PerfCounterMapHeader.size)
+        self.assertEquals(928, aem.PerfCounterRecordSize)
+
+        testDir = tempfile.mkdtemp()
+        testEventFile = os.path.join(testDir, "PerfCounters")
+        try:
+            writer = aem.PerfCounterWriter(textFormat=False)
+            counters = [aem.PerfCounter(counterType = 1,
+                                        category = "cpu",
+                                        name = "cores",
+                                        value = 4,
+                                        timestamp = 100),
+                        aem.PerfCounter(counterType = 2,
+                                        category = "memory",
+                                        name = "usage",
+                                        value = 12.5,
+                                        unit = "%",
+                                        timestamp = 100,
+                                        refreshInterval = 60),
+                        aem.PerfCounter(counterType = 4,
+                                        category = "config",
+                                        name = "name",
+                                        value = None,
+                                        timestamp = 100)]
+            writer.write(counters, eventFile = testEventFile)
+            self.assertFalse(os.path.exists(testEventFile))
+            header, records = readCounterMap(testEventFile + ".map")
+            self.assertEquals(aem.PerfCounterMapMagic, header[0])
+            self.assertEquals(2, header[5]) #seq
+            self.assertEquals(3, header[6]) #count
+            self.assertEquals((1, 0, 0, 0, 100), records[0][:5])
+            self.assertEquals(4, struct.unpack("=q", records[0][5])[0])
+            self.assertEquals("cpu", records[0][6])
+            self.assertEquals("cores", records[0][7])
+            self.assertEquals(12.5, struct.unpack("=d", records[1][5])[0])
+            self.assertEquals("%", records[1][9])
+            self.assertEquals(1, records[2][1]) #empty
+
+            #Only the record of the counter that changed is rewritten, in 
+            #place
+            inode = os.stat(testEventFile + ".map").st_ino
+            counters[1].value = 25.0
+            counters[1].timestamp = 160
+            records[0] = None
+            updated = []
+            writeAt = aem.PerfCounterMap.writeAt
+            def recordWrites(counterMap, offset, data):
+                updated.append((offset, len(data)))
+                writeAt(counterMap, offset, data)
+            aem.PerfCounterMap.writeAt = recordWrites
+            try:
+                writer.write(counters, eventFile = testEventFile)
+            finally:
+                aem.PerfCounterMap.writeAt = writeAt
+            self.assertTrue((aem.PerfCounterMapHeader.size + 
+                             aem.PerfCounterRecordSize, 
+                             aem.PerfCounterRecordSize) in updated)
+            self.assertEquals(3, len(updated)) #seq, record, header
+            header, records = readCounterMap(testEventFile + ".map")
+            self.assertEquals(4, header[5])
+            self.assertEquals(25.0, struct.unpack("=d", records[1][5])[0])
+            self.assertEquals(inode, os.stat(testEventFile + ".map").st_ino)
+
+            #A removed counter frees its record, a new writer reuses the file
+            writer = aem.PerfCounterWriter()
+            writer.write(counters[1:], eventFile = testEventFile)
+            header, records = readCounterMap(testEventFile + ".map")
+            self.assertEquals(inode, os.stat(testEventFile + ".map").st_ino)
+            self.assertEquals(6, header[5])
+            self.assertEquals(3, header[6])
+            self.assertEquals("", records[0][6])
+            self.assertEquals("usage", records[1][7])
+            with open(testEventFile) as F:
+                self.assertEquals("".join(map(str, counters[1:])), F.read())
+        finally:
+            shutil.rmtree(testDir)
+
     def test_easyHash(self):
         hashVal = aem.easyHash('a')
         self.assertEquals(97, hashVal)
@@ -393,6 +680,502 @@ class TestAEM(unittest.TestCase):
         storageTimestamp = aem.getStorageTimestamp(unixTimestamp)
         self.assertEquals("20150126T0354", storageTimestamp)
 
+class TestCollectionScheduler(unittest.TestCase):
+    def setUp(self):
+        waagent.LoggerInit("/dev/null", "/dev/stdout")
+        aem.LibDir = "/tmp"
+        self.released = threading.Event()
+        self.monitor = aem.EnhancedMonitor(TestAEM("test_config").test_config())
+        self.monitor.writer = MockWriter()
+        self.endpoints = []
+        self.getStorageMetrics = aem.getStorageMetrics
+
+    def tearDown(self):
+        aem.getStorageMetrics = self.getStorageMetrics
+        self.released.set()
+        for endpoint in self.endpoints:
+            endpoint.close()
+
+    def slowEndpoint(self, delay=0):
+        endpoint = SlowEndpoint(delay)
+        self.endpoints.append(endpoint)
+        return endpoint
+
+    def setDataSources(self, *dataSources):
+        self.monitor.collectors = map(aem.DataSourceCollector, dataSources)
+
+    def test_data_sources_are_collected_concurrently(self):
+        a = EndpointDataSource("a", self.slowEndpoint(delay=0.5))
+        b = EndpointDataSource("b", self.slowEndpoint(delay=0.5))
+        self.setDataSources(a, b)
+        startTime = time.time()
+        self.monitor.run()
+        self.assertTrue(time.time() - startTime < 0.9)
+        self.assertEquals(["a", "b"], 
+                          map(lambda c : c.name, self.monitor.writer.counters))
+        #Each collector has its own latency, even for the same source class
+        for collector in self.monitor.collectors:
+            self.assertTrue(self.monitor.latencies[collector] >= 0.5)
+
+    def test_slow_endpoint_does_not_delay_other_collectors(self):
+        slow = EndpointDataSource("slow", self.slowEndpoint(delay=0.5), 
+                                  deadline=0.2)
+        self.setDataSources(slow, 
+                            EndpointDataSource("fast", self.slowEndpoint()),
+                            MockDataSource("local"))
+        slowCollector, fastCollector, localCollector = self.monitor.collectors
+        self.monitor.run()
+        self.assertEquals(None, self.monitor.latencies[slowCollector])
+        self.assertTrue(self.monitor.latencies[fastCollector] < 0.2)
+        self.assertTrue(self.monitor.latencies[localCollector] < 0.2)
+        self.assertEquals(["fast", "local"], 
+                          map(lambda c : c.name, self.monitor.writer.counters))
+        #The slow collection finishes in the background
+        slowCollector.thread.join(1)
+        self.assertTrue(slowCollector.latency >= 0.5)
+
+    def test_late_data_source_publishes_stale_counters(self):
+        endpoint = self.slowEndpoint()
+        slow = EndpointDataSource("slow", endpoint, deadline=0.2)
+        self.setDataSources(EndpointDataSource("fast", self.slowEndpoint()), slow)
+        self.monitor.run()
+        firstCounter = self.monitor.writer.counters[1]
+
+        #The slow endpoint now takes until released to respond
+        endpoint.released = self.released
+        startTime = time.time()
+        self.monitor.run()
+        self.assertTrue(time.time() - startTime < 1)
+        fast, stale = self.monitor.writer.counters
+        self.assertEquals("fast", fast.name)
+        self.assertTrue(stale is firstCounter)
+        self.assertEquals(aem.DATA_SOURCE_TIMED_OUT, aem.getLatestErrorRecord())
+        self.assertEquals(None, 
+                          self.monitor.latencies[self.monitor.collectors[1]])
+
+        #Not collected twice concurrently
+        self.monitor.run()
+        self.assertEquals(2, endpoint.requests)
+
+        self.released.set()
+        time.sleep(0.1)
+        self.monitor.run()
+        self.assertEquals(3, endpoint.requests)
+        self.assertFalse(self.monitor.writer.counters[1] is firstCounter)
+
+    def test_late_data_source_without_counters_is_skipped(self):
+        self.setDataSources(MockDataSource("fast"), 
+                            MockDataSource("slow", deadline=0.2,
+                                           released=self.released))
+        self.monitor.run()
+        self.assertEquals(["fast"], 
+                          map(lambda c : c.name, self.monitor.writer.counters))
+
+    def test_data_sources_not_due_publish_last_counters(self):
+        fast = aem.DataSourceCollector(MockDataSource("fast"))
+        slow = aem.DataSourceCollector(MockDataSource("slow"))
+        self.monitor.collectors = [fast, slow]
+        self.monitor.run()
+        self.monitor.run([fast])
+        self.assertEquals(2, fast.dataSource.collections)
+        self.assertEquals(1, slow.dataSource.collections)
+        self.assertEquals([2, 1], 
+                          map(lambda c : c.value, self.monitor.writer.counters))
+
+    def test_timer_wheel(self):
+        clock = MockClock()
+        fast = MockCollector(60)
+        storage = MockCollector(300)
+        static = MockCollector(900)
+        scheduler = aem.CollectionScheduler([fast, storage, static], 
+                                            clock=clock.time, 
+                                            sleep=clock.sleep)
+        fired = []
+        for i in range(0, 16):
+            fired.append(scheduler.wait())
+            #Collecting takes time, but doesn't shift the next ticks
+            clock.now += 7
+        self.assertEquals(900 + 7, clock.now - 1000)
+        self.assertEquals(16, len(filter(lambda d : fast in d, fired)))
+        self.assertEquals([0, 5, 10, 15], 
+                          filter(lambda i : storage in fired[i], range(0, 16)))
+        self.assertEquals([0, 15], 
+                          filter(lambda i : static in fired[i], range(0, 16)))
+        self.assertEquals(0, scheduler.missedTicks)
+
+    def test_no_storage_minute_is_skipped(self):
+        clock = MockClock()
+        #Ticks a tenth of a second before a minute starts
+        clock.now = 1400000039.9
+        dataSource = aem.StorageDataSource(TestAEM("test_config").test_config(),
+                                           clock=clock.time)
+        collector = aem.DataSourceCollector(dataSource)
+        scheduler = aem.CollectionScheduler([collector], clock=clock.time, 
+                                            sleep=clock.sleep)
+        ranges = []
+        def getStorageMetrics(account, key, hostBase, table, startKey, endKey):
+            if account == "asdf":
+                ranges.append((startKey, endKey))
+            return []
+        aem.getStorageMetrics = getStorageMetrics
+        #Collections starting right away or a bit late, on either side of 
+        #the minute, and one starting more than two minutes late
+        for delay in [0.2, 0, 0.2, 0, 130, 0, 0.2, 0]:
+            self.assertEquals([collector], scheduler.wait())
+            clock.now += delay
+            dataSource.collect()
+        self.assertEquals(1, scheduler.missedTicks)
+        for previous, current in zip(ranges, ranges[1:]):
+            self.assertTrue(current[0] <= previous[1])
+            self.assertTrue(current[1] >= previous[1])
+        #The late collection reads all the minutes since the previous one
+        self.assertEquals(("20140513T1651", "20140513T1655"), ranges[4])
+
+    def test_timer_wheel_missed_ticks(self):
+        clock = MockClock()
+        fast = MockCollector(60)
+        storage = MockCollector(300)
+        scheduler = aem.CollectionScheduler([fast, storage], 
+                                            clock=clock.time, 
+                                            sleep=clock.sleep)
+        self.assertEquals([fast, storage], scheduler.wait())
+        self.assertEquals([fast], scheduler.wait())
+        #A cycle overran until after the 7th tick: the collections due in 
+        #the missed ticks fire once, right away
+        clock.now += 330
+        self.assertEquals([fast, storage], scheduler.wait())
+        self.assertEquals(1390, clock.now)
+        self.assertEquals(4, scheduler.missedTicks)
+        #Back on the ticks anchored to the start time
+        self.assertEquals([fast], scheduler.wait())
+        self.assertEquals(1420, clock.now)
+
+def readCounterMap(path):
+    with open(path, "rb") as F:
+        data = F.read()
+    header = aem.PerfCounterMapHeader.unpack_from(data, 0)
+    recordStruct = struct.Struct("=iiIIq8s64s128s256s64s128s256s")
+    records = []
+    for i in range(0, header[4]):
+        record = recordStruct.unpack_from(data, header[2] + header[3] * i)
+        records.append(record[:6] + tuple(map(lambda s : s.rstrip("\0"), 
+                                              record[6:])))
+    return header, records
+
+def makeScsiDisk(sysBlock, dev, hctl):
+    os.makedirs(os.path.join(sysBlock, dev, "device/scsi_disk", hctl))
+
+def makeNic(sysClassNet, nic, mac):
+    if not os.path.isdir(os.path.join(sysClassNet, nic)):
+        os.makedirs(os.path.join(sysClassNet, nic))
+    waagent.SetFileContents(os.path.join(sysClassNet, nic, "address"), 
+                            mac + "\n")
+
+class MockMonitor(object):
+    def __init__(self):
+        self.changed = False
+
+    def isAvailable(self):
+        return True
+
+    def poll(self):
+        changed = self.changed
+        self.changed = False
+        return changed
+
+def makeSysCpuDir(coreIds):
+    sysCpuDir = tempfile.mkdtemp()
+    waagent.SetFileContents(os.path.join(sysCpuDir, "online"),
+                            "0-{0}\n".format(len(coreIds) - 1))
+    for cpu, coreId in enumerate(coreIds):
+        topologyDir = os.path.join(sysCpuDir, "cpu{0}".format(cpu), "topology")
+        os.makedirs(topologyDir)
+        waagent.SetFileContents(os.path.join(topologyDir, "physical_package_id"),
+                                "0\n")
+        waagent.SetFileContents(os.path.join(topologyDir, "core_id"),
+                                "{0}\n".format(coreId))
+    return sysCpuDir
+
+class TestTableQuery(unittest.TestCase):
+    def setUp(self):
+        waagent.LoggerInit("/dev/null", "/dev/stdout")
+        self.tableService = aem.TableService
+        aem.TableService = MockTableService
+        self.now = 1000
+
+    def tearDown(self):
+        aem.TableService = self.tableService
+        aem._tableClients.clear()
+
+    def getQuery(self, client, table, columns):
+        query = client.getQuery(table, columns)
+        query.clock = lambda : self.now
+        return query
+
+    def test_table_client_is_reused(self):
+        client = aem.getTableClient("asdf", "qwer", ".table.core.windows.net")
+        self.assertTrue(client is aem.getTableClient("asdf", "qwer", 
+                                                     ".table.core.windows.net"))
+        self.assertFalse(client is aem.getTableClient("asdf", "zxcv", 
+                                                      ".table.core.windows.net"))
+        self.assertFalse(client is aem.getTableClient("zxcv", "qwer", 
+                                                      ".table.core.windows.net"))
+
+    def test_request_session_is_passed_to_sdk(self):
+        requests = aem.requests
+        aem.requests = MockRequests
+        aem.TableService = MockSessionTableService
+        try:
+            client = aem.getTableClient("asdf", "qwer", 
+                                        ".table.core.windows.net")
+        finally:
+            aem.requests = requests
+        self.assertTrue(isinstance(client.session, MockRequests.Session))
+        self.assertTrue(client.session is client.tableService.session)
+
+    def test_sdk_without_request_session(self):
+        requests = aem.requests
+        aem.requests = MockRequests
+        try:
+            client = aem.getTableClient("asdf", "qwer", 
+                                        ".table.core.windows.net")
+        finally:
+            aem.requests = requests
+        self.assertEquals(None, client.session)
+        self.assertTrue(isinstance(client.tableService, MockTableService))
+
+    def test_query_is_sent_again_on_connection_error(self):
+        client = aem.getTableClient("asdf", "qwer", ".table.core.windows.net")
+        tableService = client.tableService
+        tableService.errors = [socket.error(errno.ECONNRESET, "reset")]
+        tableService.pages = [[MockRow("P1", "user;A")]]
+        self.assertEquals(1, len(client.queryEntities("metrics", None, None)))
+        self.assertEquals(2, len(tableService.requests))
+
+    def test_only_new_rows_are_fetched(self):
+        client = aem.getTableClient("asdf", "qwer", ".table.core.windows.net")
+        tableService = client.tableService
+        query = self.getQuery(client, "metrics", ["TotalRequests"])
+        tableService.pages = [[MockRow("P1", "user;A"), MockRow("P1", "user;B")]]
+        rows = query.fetch("P1", "P2")
+        self.assertEquals(["user;A", "user;B"], map(lambda r : r.RowKey, rows))
+        self.assertEquals("PartitionKey ge 'P1' and PartitionKey lt 'P2'", 
+                          tableService.requests[-1]["filter"])
+        self.assertEquals("PartitionKey,RowKey,TotalRequests",
+                          tableService.requests[-1]["select"])
+
+        #Same range in the next cycle: rows after the last one only
+        self.now += 60
+        tableService.pages = [[MockRow("P1", "user;C")]]
+        rows = query.fetch("P1", "P2")
+        self.assertEquals(["user;A", "user;B", "user;C"], 
+                          map(lambda r : r.RowKey, rows))
+        self.assertEquals(("((PartitionKey eq 'P1' and RowKey gt 'user;B') or "
+                           "(PartitionKey gt 'P1' and PartitionKey lt 'P2'))"),
+                          tableService.requests[-1]["filter"])
+
+        #The range moved on: the rows of the previous one are dropped
+        self.now += 60
+        tableService.pages = [[MockRow("P2", "user;A")]]
+        rows = query.fetch("P2", "P3")
+        self.assertEquals([("P2", "user;A")], 
+                          map(lambda r : (r.PartitionKey, r.RowKey), rows))
+        self.assertEquals("PartitionKey ge 'P2' and PartitionKey lt 'P3'", 
+                          tableService.requests[-1]["filter"])
+        self.assertEquals(3, len(tableService.requests))
+
+    def test_readers_of_same_table_share_query(self):
+        client = aem.getTableClient("asdf", "qwer", ".table.core.windows.net")
+        tableService = client.tableService
+        query = self.getQuery(client, "metrics", ["TotalRequests"])
+        self.assertTrue(query is client.getQuery("metrics", ["TotalIngress"]))
+        tableService.pages = [[MockRow("P1", "user;A")]]
+        query.fetch("P1", "P2")
+        self.assertEquals(1, len(query.fetch("P1", "P2")))
+        self.assertEquals(1, len(tableService.requests))
+        self.assertEquals("PartitionKey,RowKey,TotalIngress,TotalRequests",
+                          tableService.requests[-1]["select"])
+
+    def test_listener(self):
+        client = aem.getTableClient("asdf", "qwer", ".table.core.windows.net")
+        tableService = client.tableService
+        query = self.getQuery(client, "metrics", ["TotalRequests"])
+        tableService.pages = [[MockRow("P1", "user;GetBlob", 2)]]
+        query.fetch("P1", "P2")
+        accumulator = query.getListener(aem.StorageStatAccumulator)
+        self.assertTrue(accumulator is 
+                        query.getListener(aem.StorageStatAccumulator))
+        self.assertEquals(2, aem.AzureStorageStat(accumulator).getReadOps())
+
+        self.now += 60
+        tableService.pages = [[MockRow("P1", "user;PutBlob", 3),
+                               MockRow("P2", "user;GetBlob", 5)]]
+        query.fetch("P1", "P3")
+        stat = aem.AzureStorageStat(accumulator)
+        self.assertEquals(7, stat.getReadOps())
+        self.assertEquals(3, stat.getWriteOps())
+
+        self.now += 60
+        query.fetch("P2", "P3")
+        stat = aem.AzureStorageStat(accumulator)
+        self.assertEquals(5, stat.getReadOps())
+        self.assertEquals(0, stat.getWriteOps())
+        self.assertEquals(1, len(accumulator))
+
+    def test_top(self):
+        client = aem.getTableClient("asdf", "qwer", ".table.core.windows.net")
+        tableService = client.tableService
+        query = self.getQuery(client, "LinuxCpuVer2v0", ["PercentProcessorTime"])
+        tableService.pages = [[MockRow("P1", "r1")]]
+        self.assertEquals(1, len(query.fetch("P1", "P2", 1)))
+        self.assertEquals(1, tableService.requests[-1]["top"])
+
+        #Already got a row of the range
+        self.now += 60
+        self.assertEquals("r1", query.fetch("P1", "P2", 1)[0].RowKey)
+        self.assertEquals(1, len(tableService.requests))
+
+    def test_continuation(self):
+        client = aem.getTableClient("asdf", "qwer", ".table.core.windows.net")
+        tableService = client.tableService
+        query = self.getQuery(client, "metrics", ["TotalRequests"])
+        firstPage = MockPage([MockRow("P1", "user;A")])
+        firstPage.x_ms_continuation = {"NextPartitionKey": "P1",
+                                       "NextRowKey": "user;B"}
+        tableService.pages = [firstPage, [MockRow("P1", "user;B")]]
+        self.assertEquals(2, len(query.fetch("P1", "P2")))
+        self.assertEquals("P1", tableService.requests[-1]["nextPartitionKey"])
+        self.assertEquals("user;B", tableService.requests[-1]["nextRowKey"])
+
+class MockPage(list):
+    pass
+
+class MockRow(object):
+    def __init__(self, partitionKey, rowKey, requests=1):
+        self.PartitionKey = partitionKey
+        self.RowKey = rowKey
+        self.TotalRequests = requests
+        self.TotalIngress = 100 * requests
+        self.TotalEgress = 10 * requests
+        self.AverageE2ELatency = 5.0
+        self.AverageServerLatency = 4.0
+
+class MockTableService(object):
+    def __init__(self, account_name, account_key, host_base):
+        self.pages = []
+        self.requests = []
+        self.errors = []
+
+    def query_entities(self, table, filter=None, select=None, top=None,
+                       next_partition_key=None, next_row_key=None):
+        self.requests.append({
+            "table": table,
+            "filter": filter,
+            "select": select,
+            "top": top,
+            "nextPartitionKey": next_partition_key,
+            "nextRowKey": next_row_key
+        })
+        if len(self.errors) > 0:
+            raise self.errors.pop(0)
+        return self.pages.pop(0) if len(self.pages) > 0 else []
+
+class MockSessionTableService(MockTableService):
+    def __init__(self, account_name, account_key, host_base, 
+                 request_session=None):
+        super(MockSessionTableService, self).__init__(account_name, 
+                                                      account_key, host_base)
+        self.session = request_session
+
+class MockRequests(object):
+    class Session(object):
+        pass
+
+class MockDataSource(object):
+    def __init__(self, name, delay=0, deadline=5, released=None):
+        self.name = name
+        self.delay = delay
+        self.collectDeadline = deadline
+        self.released = released
+        self.collections = 0
+
+    def collect(self):
+        self.collections += 1
+        time.sleep(self.delay)
+        if self.released is not None:
+            self.released.wait()
+        return [aem.PerfCounter(counterType = aem.PerfCounterType.COUNTER_TYPE_INT,
+                                category = "test",
+                                name = self.name,
+                                value = self.collections)]
+
+class SlowEndpoint(object):
+    """
+    Local http endpoint standing in for a remote one (e.g. storage tables),
+    which takes delay seconds to respond, and waits for released if set.
+    """
+    def __init__(self, delay=0, released=None):
+        self.delay = delay
+        self.released = released
+        self.requests = 0
+        endpoint = self
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                endpoint.requests += 1
+                time.sleep(endpoint.delay)
+                if endpoint.released is not None:
+                    endpoint.released.wait()
+                body = str(endpoint.requests)
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+        self.server = Server(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:{0}/".format(self.server.server_port)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class EndpointDataSource(object):
+    def __init__(self, name, endpoint, deadline=5):
+        self.name = name
+        self.url = endpoint.url
+        self.collectDeadline = deadline
+
+    def collect(self):
+        value = int(urllib2.urlopen(self.url, timeout=10).read())
+        return [aem.PerfCounter(counterType = aem.PerfCounterType.COUNTER_TYPE_INT,
+                                category = "test",
+                                name = self.name,
+                                value = value)]
+
+class MockCollector(object):
+    def __init__(self, interval):
+        self.interval = interval
+
+class MockClock(object):
+    def __init__(self):
+        self.now = 1000
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+class MockWriter(object):
+    def write(self, counters):
+        self.counters = counters
+
 def mock_getStorageMetrics(*args, **kwargs):
         with open(os.path.join(env.test_dir, "storage_metrics")) as F:
             test_data = F.read()
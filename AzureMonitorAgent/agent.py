@@ -48,6 +48,7 @@ from threading import Thread
 import telegraf_utils.telegraf_config_handler as telhandler
 import metrics_ext_utils.metrics_constants as metrics_constants
 import metrics_ext_utils.metrics_ext_handler as me_handler
+from metrics_ext_utils.metrics_config_watcher import MetricsConfigWatcher
 
 try:
     from Utils.WAAgentUtil import waagent
@@ -496,86 +497,76 @@ def start_metrics_process():
 
 def metrics_watcher(hutil_error, hutil_log):
     """
-    Watcher thread to monitor metric configuration changes and to take action on them
-    """    
-    
-    # check every 30 seconds
-    sleepTime =  30
+    Watcher thread to monitor metric configuration changes and to take action on them.
+    It wakes up as soon as mdsd rewrites the metric counters config (once the writes settled), and every
+    health_check_interval seconds to check that telegraf and ME are running and to refresh the MSI token.
+    """
 
-    # sleep before starting the monitoring.
-    time.sleep(sleepTime)
+    health_check_interval = 30
+    max_restart_retries = 10
+    telegraf_restart_retries = 0
+    me_restart_retries = 0
+    me_configured = False
     last_crc = None
     me_msi_token_expiry_epoch = None
+    next_health_check = 0
+    config_watcher = MetricsConfigWatcher(MdsdCounterJsonPath)
 
     while True:
         try:
+            data = ''
             if os.path.isfile(MdsdCounterJsonPath):
-                f = open(MdsdCounterJsonPath, "r")
-                data = f.read()
-                
-                if (data != ''):                    
-                    crc = hashlib.sha256(data).hexdigest()                    
-                    generate_token = False
-                    me_token_path = os.path.join(os.getcwd(), "/config/metrics_configs/AuthToken-MSI.json")
-
-                    if me_msi_token_expiry_epoch is None or me_msi_token_expiry_epoch == "":
-                        if os.path.isfile(me_token_path):
-                            with open(me_token_path, "r") as f:
-                                authtoken_content = f.read()
-                                if authtoken_content and "expires_on" in authtoken_content:
-                                    me_msi_token_expiry_epoch = authtoken_content["expires_on"]
-                                else:
-                                    generate_token = True
-                        else:
-                            generate_token = True
-
-                    if me_msi_token_expiry_epoch:                
-                        currentTime = datetime.datetime.now()
-                        token_expiry_time = datetime.datetime.fromtimestamp(int(me_msi_token_expiry_epoch))
-                        if token_expiry_time - currentTime < datetime.timedelta(minutes=30):
-                            # The MSI Token will expire within 30 minutes. We need to refresh the token
-                            generate_token = True
-
-                    if generate_token:
-                        generate_token = False
-                        msi_token_generated, me_msi_token_expiry_epoch, log_messages = me_handler.generate_MSI_token()
-                        if msi_token_generated:
-                            hutil_log("Successfully refreshed metrics-extension MSI Auth token.")
-                        else:
-                            hutil_error(log_messages)
-                    
-                    if(crc != last_crc):
-                        hutil_log("Start processing metric configuration")
-                        hutil_log(data)
-
-                        json_data = json.loads(data)  
-                        
-                        telegraf_config, telegraf_namespaces = telhandler.handle_config(
-                            json_data, 
-                            "udp://127.0.0.1:" + metrics_constants.ama_metrics_extension_udp_port, 
-                            "unix:///var/run/mdsd/default_influx.socket",
-                            is_lad=False)
-                        
-                        me_handler.setup_me(is_lad=False)
-
-                        start_telegraf_out, log_messages = telhandler.start_telegraf(is_lad=False)
-                        if start_telegraf_out:
-                            hutil_log("Successfully started metrics-sourcer.")
-                        else:
-                            hutil_error(log_messages)
+                with open(MdsdCounterJsonPath, "r") as f:
+                    data = f.read()
+
+            if data != '':
+                crc = hashlib.sha256(data).hexdigest()
+                if crc != last_crc:
+                    hutil_log("Start processing metric configuration")
+                    hutil_log(data)
+
+                    json_data = json.loads(data)
+
+                    # Only the telegraf config depends on the counters. It's diffed against the deployed one, and
+                    # telegraf is reloaded or restarted only if needed.
+                    telegraf_config, telegraf_namespaces = telhandler.handle_config(
+                        json_data,
+                        "udp://127.0.0.1:" + metrics_constants.ama_metrics_extension_udp_port,
+                        "unix:///var/run/mdsd/default_influx.socket",
+                        is_lad=False)
+
+                    start_telegraf_out, log_messages = telhandler.apply_config_changes(is_lad=False)
+                    if start_telegraf_out:
+                        hutil_log("Successfully applied the metrics-sourcer config.")
+                    else:
+                        hutil_error(log_messages)
 
+                    last_crc = crc
 
+                # ME's config only depends on the VM, so it's set up once (retried on the next wake up until it
+                # succeeds). ME is (re)started by the health check.
+                if not me_configured:
+                    me_configured = me_handler.setup_me(is_lad=False)
+                    if me_configured:
                         start_metrics_out, log_messages = me_handler.start_metrics(is_lad=False)
                         if start_metrics_out:
                             hutil_log("Successfully started metrics-extension.")
                         else:
                             hutil_error(log_messages)
+                    else:
+                        hutil_error("Failed to set up metrics-extension. Retrying on the next wake up.")
 
-                        last_crc = crc
+                if time.time() >= next_health_check:
+                    next_health_check = time.time() + health_check_interval
 
-                    telegraf_restart_retries = 0
-                    me_restart_retries = 0
-                    max_restart_retries = 10
+                    # The token comes from the MSI token cache shared with the other processes, which only
+                    # queries IMDS when the token is about to expire
+                    msi_token_generated, expiry_epoch, log_messages = me_handler.generate_MSI_token()
+                    if not msi_token_generated:
+                        hutil_error(log_messages)
+                    elif expiry_epoch != me_msi_token_expiry_epoch:
+                        me_msi_token_expiry_epoch = expiry_epoch
+                        hutil_log("Successfully refreshed metrics-extension MSI Auth token.")
 
                     # Check if telegraf is running, if not, then restart
                     if not telhandler.is_running(is_lad=False):
@@ -606,7 +597,7 @@ def metrics_watcher(hutil_error, hutil_log):
                             if me_out:
                                 hutil_log(me_msg)
                             else:
-                                hutil_error(me_msg)                  
+                                hutil_error(me_msg)
                             start_metrics_out, log_messages = me_handler.start_metrics(is_lad=False)
 
                             if start_metrics_out:
@@ -616,16 +607,18 @@ def metrics_watcher(hutil_error, hutil_log):
                         else:
                             hutil_error("MetricsExtension binary process is not running. Failed to restart after {0} retries. Please check /var/log/syslog for ME logs".format(max_restart_retries))
                     else:
-                        me_restart_retries = 0   
-        
+                        me_restart_retries = 0
+
         except IOError as e:
             hutil_error('I/O error in monitoring metrics. Exception={0}'.format(e))
 
         except Exception as e:
             hutil_error('Error in monitoring metrics. Exception={0}'.format(e))
 
-        finally:
-            time.sleep(sleepTime)
+        # Until the next health check (or for a whole interval if it was skipped because there's no config yet, or
+        # processing it failed, in which case it's retried then)
+        timeout = next_health_check - time.time()
+        config_watcher.wait(timeout if timeout > 0 else health_check_interval)
 
 def metrics():
     """
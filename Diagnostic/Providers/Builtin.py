@@ -35,11 +35,11 @@
 # the PublicConfig JSON delivered to LAD would itself contain actual OMI queries. The implementation of such a provider
 # might construct an mdsd configuration file cause mdsd to run the specified queries and store the data in tables.
 
+import re
 import Utils.ProviderUtil as ProvUtil
 from collections import defaultdict
 import xml.etree.ElementTree as ET
 import Utils.XmlUtil as XmlUtil
-from xml.sax.saxutils import quoteattr
 
 
 # These are the built-in metrics this code provides, grouped by class. The builtin countername space is
@@ -95,17 +95,17 @@ _defaultCqlCondition = {
 #
 # Some of the OMI metrics are retrieved in some other unit (e.g. "MiB") and need to be scaled
 # to the expected unit before being passed along the pipeline. The _scaling map holds all OMI counter
-# names that need to be scaled. If a counterSpecifier isn't in this list, no scaling is needed.
+# names that need to be scaled, and their scaleUp factor. If a counterSpecifier isn't in this list, no scaling is needed.
 _scaling = defaultdict(lambda:defaultdict(str),
             { 'memory' : defaultdict(str,
-                { 'AvailableMemory': 'scaleUp="1048576"',
-                  'UsedMemory': 'scaleUp="1048576"',
-                  'AvailableSwap': 'scaleUp="1048576"',
-                  'UsedSwap': 'scaleUp="1048576"'
+                { 'AvailableMemory': '1048576',
+                  'UsedMemory': '1048576',
+                  'AvailableSwap': '1048576',
+                  'UsedSwap': '1048576'
                 } ),
               'filesystem' : defaultdict(str,
-                 {'FreeMegabytes': 'scaleUp="1048576"',
-                  'UsedMegabytes': 'scaleUp="1048576"',
+                 {'FreeMegabytes': '1048576',
+                  'UsedMegabytes': '1048576',
                   }),
               } )
 
@@ -124,6 +124,23 @@ def default_condition(class_name):
     return _defaultCqlCondition[class_name] if class_name in _defaultCqlCondition else ''
 
 
+def normalized_condition(class_name, condition):
+    """
+    Get the condition clause actually used in the OMI query of a metric, in a canonical form so that conditions
+    selecting the same instances compare equal (e.g., no condition and the default condition of the class, or
+    conditions differing only by whitespace outside of quoted values).
+    :param str class_name: The builtin class of the metric
+    :param str condition: The condition of the metric, or None
+    :return str: The condition clause, or '' if there's none
+    """
+    if not condition:
+        condition = default_condition(class_name)
+    parts = re.split(r'("[^"]*"|\'[^\']*\')', condition.strip())
+    for i in range(0, len(parts), 2):  # Even parts are outside of quotes
+        parts[i] = re.sub(r'\s*(<>|<=|>=|=|<|>)\s*', r'\1', re.sub(r'\s+', ' ', parts[i]))
+    return ''.join(parts)
+
+
 class BuiltinMetric:
     def __init__(self, counterSpec):
         """
@@ -218,9 +235,9 @@ def AddMetric(counter_spec):
     # (class, instanceId, sampleRate) -> [ metric ]
     # Given a class, instance within that class, and sample rate, we have a list of the requested metrics
     # matching those constraints. For that set of constraints, we also have a common eventName, the local
-    # table where we store the collected metrics.
+    # table where we store the collected metrics. Conditions are normalized, so that equivalent ones share a group.
 
-    key = (metric.class_name(), metric.condition(), metric.sample_rate())
+    key = (metric.class_name(), normalized_condition(metric.class_name(), metric.condition()), metric.sample_rate())
     if key not in _eventNames:
         _eventNames[key] = ProvUtil.MakeUniqueEventName('builtin')
     _metrics[key].append(metric)
@@ -236,34 +253,28 @@ def UpdateXML(doc):
     :return: None
     """
     global _metrics, _eventNames, _omiClassName
-    for group in _metrics:
+    # The elements are built directly (rather than formatted as strings and parsed back) and are serialized only
+    # once, along with the rest of the document.
+    # Groups at different sample rates keep their own query: each local table gets rows at its own rate.
+    for group in sorted(_metrics, key=lambda g: _eventNames[g]):
         (class_name, condition_clause, sample_rate) = group
-        if not condition_clause:
-            condition_clause = default_condition(class_name)
-        columns = []
-        mappings = []
+        column_string = ','.join(metric.counter_name() for metric in _metrics[group])
+        if condition_clause:
+            cql_query = "SELECT {0} FROM {1} WHERE {2}".format(column_string, _omiClassName[class_name],
+                                                               condition_clause)
+        else:
+            cql_query = "SELECT {0} FROM {1}".format(column_string, _omiClassName[class_name])
+        query = ET.Element('OMIQuery', {'cqlQuery': cql_query, 'eventName': _eventNames[group],
+                                        'omiNamespace': 'root/scx', 'sampleRateInSeconds': str(sample_rate),
+                                        'storeType': 'local'})
+        unpivot = ET.SubElement(query, 'Unpivot', {'columnName': 'CounterName', 'columnValue': 'Value',
+                                                   'columns': column_string})
         for metric in _metrics[group]:
             omi_name = metric.counter_name()
+            mapping = ET.SubElement(unpivot, 'MapName', {'name': omi_name})
             scale = _scaling[class_name][omi_name]
-            columns.append(omi_name)
-            mappings.append('<MapName name="{0}" {1}>{2}</MapName>'.format(omi_name, scale, metric.label()))
-        column_string = ','.join(columns)
-        if condition_clause:
-            cql_query = quoteattr("SELECT {0} FROM {1} WHERE {2}".format(column_string,
-                                                                         _omiClassName[class_name], condition_clause))
-        else:
-            cql_query = quoteattr("SELECT {0} FROM {1}".format(column_string, _omiClassName[class_name]))
-        query = '''
-<OMIQuery cqlQuery={qry} eventName={evname} omiNamespace="root/scx" sampleRateInSeconds="{rate}" storeType="local">
-  <Unpivot columnName="CounterName" columnValue="Value" columns={columns}>
-    {mappings}
-  </Unpivot>
-</OMIQuery>'''.format(
-            qry=cql_query,
-            evname=quoteattr(_eventNames[group]),
-            columns=quoteattr(column_string),
-            rate=sample_rate,
-            mappings='\n    '.join(mappings)
-        )
-        XmlUtil.addElement(doc, 'Events/OMI', ET.fromstring(query))
+            if scale:
+                mapping.set('scaleUp', scale)
+            mapping.text = metric.label()
+        XmlUtil.addElement(doc, 'Events/OMI', query)
     return
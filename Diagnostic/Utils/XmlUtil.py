@@ -16,8 +16,88 @@
 #  OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
 #  OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import re
 import xml.etree.ElementTree as ET
 
+_simple_path_step = re.compile(r'^[\w.-]+$')
+
+
+class IndexedXmlTree(ET.ElementTree):
+    """
+    ElementTree that indexes the children of each element by tag, so that resolving a path made only of tag names
+    (e.g., 'Events/DerivedEvents/DerivedEvent') costs a dict lookup per step instead of a scan of all the siblings at
+    every step. The mdsd config grows to thousands of elements with large per-counter configurations, and every
+    setXmlValue/addElement resolves its path again.
+
+    Elements must be added and removed through this tree (append/remove/remove_all, or addElement/removeElement
+    below), which keep the index up to date: an element of the tree changed directly isn't indexed again. Paths
+    with predicates, wildcards or '//' are passed on to ElementTree.
+    """
+
+    def __init__(self, element=None, file=None):
+        ET.ElementTree.__init__(self, element, file)
+        self._children = {}  # id(element) -> (element, {tag: [children]})
+
+    def _children_by_tag(self, element):
+        entry = self._children.get(id(element))
+        if entry is None or entry[0] is not element:
+            by_tag = {}
+            for child in element:
+                by_tag.setdefault(child.tag, []).append(child)
+            entry = (element, by_tag)
+            self._children[id(element)] = entry
+        return entry[1]
+
+    def _forget(self, element):
+        for descendant in element.iter():
+            self._children.pop(id(descendant), None)
+
+    def findall(self, path, namespaces=None):
+        steps = path.split('/')
+        if namespaces or not all(_simple_path_step.match(step) for step in steps):
+            return ET.ElementTree.findall(self, path, namespaces)
+        elements = [self.getroot()]
+        for step in steps:
+            if step == '.':
+                continue
+            elements = [child for element in elements for child in self._children_by_tag(element).get(step, ())]
+        return elements
+
+    def find(self, path, namespaces=None):
+        elements = self.findall(path, namespaces)
+        return elements[0] if elements else None
+
+    def append(self, parent, element):
+        """
+        Append an element to a parent element of this tree, updating the index.
+        """
+        by_tag = self._children_by_tag(parent)
+        parent.append(element)
+        by_tag.setdefault(element.tag, []).append(element)
+
+    def remove(self, parent, element):
+        """
+        Remove a child element of a parent element of this tree, updating the index.
+        """
+        by_tag = self._children_by_tag(parent)
+        parent.remove(element)
+        siblings = by_tag[element.tag]
+        siblings.remove(element)
+        if not siblings:
+            del by_tag[element.tag]
+        self._forget(element)
+
+    def remove_all(self, parent, tag):
+        """
+        Remove all the children of a parent element of this tree with a given tag, in a single pass.
+        """
+        removed = self._children_by_tag(parent).pop(tag, None)
+        if not removed:
+            return
+        parent[:] = [child for child in parent if child.tag != tag]
+        for element in removed:
+            self._forget(element)
+
 
 def setXmlValue(xml,path,property,value,selector=[]):
     elements = xml.findall(path)
@@ -41,7 +121,10 @@ def addElement(xml,path,el,selector=[],addOnlyOnce=False):
     for element in elements:
         if selector and element.get(selector[0])!=selector[1]:
             continue
-        element.append(el)
+        if isinstance(xml, IndexedXmlTree):
+            xml.append(element, el)
+        else:
+            element.append(el)
         if addOnlyOnce:
             return
 
@@ -53,7 +136,15 @@ def createElement(schema):
 def removeElement(tree, parent_path, removed_element_name):
     parents = tree.findall(parent_path)
     for parent in parents:
-        element = parent.find(removed_element_name)
-        while element is not None:
-            parent.remove(element)
-            element = parent.find(removed_element_name)
\ No newline at end of file
+        if not _simple_path_step.match(removed_element_name):
+            element = parent.find(removed_element_name)
+            while element is not None:
+                if isinstance(tree, IndexedXmlTree):
+                    tree.remove(parent, element)
+                else:
+                    parent.remove(element)
+                element = parent.find(removed_element_name)
+        elif isinstance(tree, IndexedXmlTree):
+            tree.remove_all(parent, removed_element_name)
+        else:
+            parent[:] = [child for child in parent if child.tag != removed_element_name]
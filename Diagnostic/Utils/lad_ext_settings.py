@@ -170,3 +170,12 @@ class LadExtSettings(ExtSettings):
             return " -T {0}".format(flags)
         else:
             return ""
+
+    def get_mdsd_memory_leak_policy(self):
+        """
+        Return the mdsd memory leak detection policy overrides, if any, from public config
+        :rtype: dict
+        :return: mdsdMemoryLeakPolicy setting (e.g., {"maxMemoryPercent": 50}) or an empty dictionary
+        """
+        policy = self.read_public_config('mdsdMemoryLeakPolicy')
+        return policy if isinstance(policy, dict) else {}
@@ -21,6 +21,7 @@ from xml.etree import ElementTree as ET
 import Utils.LadDiagnosticUtil as LadUtil
 from Utils.lad_exceptions import LadLoggingConfigException
 import Utils.mdsd_xml_templates as mxt
+import Utils.XmlUtil as XmlUtil
 from Utils.omsagent_util import get_syslog_ng_src_name
 
 
@@ -563,12 +564,11 @@ def copy_sub_elems(dst_xml, src_xml, path):
     :param str path: The path of the element whose sub-elements will be copied.
     :return: None. dst_xml will be updated with copied sub-elements
     """
-    dst_elem = dst_xml.find(path)
     src_elem = src_xml.find(path)
     if src_elem is None:
         return
     for sub_elem in src_elem:
-        dst_elem.append(sub_elem)
+        XmlUtil.addElement(dst_xml, path, sub_elem, addOnlyOnce=True)
 
 
 def copy_source_mdsdevent_eh_url_elems(mdsd_xml_tree, mdsd_logging_xml_string):
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+#
+# Azure Linux extension
+#
+# Linux Azure Diagnostic Extension (Current version is specified in manifest.xml)
+# Copyright (c) Microsoft Corporation
+# All rights reserved.
+# MIT License
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the ""Software""), to deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+# Software.
+# THE SOFTWARE IS PROVIDED *AS IS*, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os
+
+
+class IncrementalLogReader(object):
+    """
+    Reads only what was appended to a log file since the last read, following it across rotation and truncation.
+    """
+
+    def __init__(self, path, from_end=True, max_read_size=1024 * 1024):
+        """
+        Constructor
+        :param str path: Path of the log file (e.g., mdsd.err)
+        :param bool from_end: Whether the content already in the file at construction should be skipped
+        :param int max_read_size: Max bytes read per call, so that a burst of logs can't take a lot of memory.
+                                  The rest is returned by the next calls (but a rotated file is read in full).
+        """
+        self._path = path
+        self._max_read_size = max_read_size
+        self._fd = None
+        self._inode = None
+        self._offset = 0
+        self._partial_line = ''
+        self._open(seek_end=from_end)
+
+    def _open(self, seek_end=False):
+        self._close()
+        try:
+            self._fd = os.open(self._path, os.O_RDONLY)
+        except OSError:
+            return False
+        stat = os.fstat(self._fd)
+        self._inode = (stat.st_dev, stat.st_ino)
+        self._offset = stat.st_size if seek_end else 0
+        self._partial_line = ''
+        return True
+
+    def _close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _read(self):
+        # Unbuffered reads at an explicit offset, so that nothing stale is returned after a truncation
+        os.lseek(self._fd, self._offset, os.SEEK_SET)
+        data = os.read(self._fd, self._max_read_size)
+        self._offset += len(data)
+        return data
+
+    def _read_all(self):
+        data = []
+        while True:
+            piece = self._read()
+            if not piece:
+                return ''.join(data)
+            data.append(piece)
+
+    def _split_lines(self, data):
+        lines = (self._partial_line + data).split('\n')
+        self._partial_line = lines.pop()
+        return [line.rstrip('\r') for line in lines]
+
+    def read_new_lines(self):
+        """
+        :return list: Complete lines (without line endings) appended since the last call. A trailing line that
+                      isn't terminated yet is kept until it is.
+        """
+        data = ''
+        if self._fd is not None:
+            try:
+                stat = os.stat(self._path)
+            except OSError:
+                stat = None
+            if stat is None or (stat.st_dev, stat.st_ino) != self._inode:
+                # Rotated (or removed): drain all that was appended to the old file before switching to the new one.
+                # Its unterminated last line won't be completed anymore, so it's a line of its own.
+                lines = self._split_lines(self._read_all())
+                if self._partial_line:
+                    lines.append(self._partial_line.rstrip('\r'))
+                    self._partial_line = ''
+                if stat is not None:
+                    self._open()
+                    lines += self._split_lines(self._read())
+                else:
+                    self._close()
+                return lines
+            elif stat.st_size < self._offset:
+                # Truncated: start over from the beginning
+                self._offset = 0
+                self._partial_line = ''
+                data = self._read()
+            elif stat.st_size > self._offset:
+                data = self._read()
+        elif self._open():
+            # The file didn't exist at the last call, so all of it is new
+            data = self._read()
+
+        if not data:
+            return []
+        return self._split_lines(data)
+
+    def close(self):
+        self._close()
+
@@ -57,17 +57,6 @@ per_RouteEvent_tmpl = """
 """
 
 
-derived_event = """
-<DerivedEvent duration="{interval}" eventName="{target}" isFullName="true" source="{source}" storeType="{type}"/>
-
-"""
-
-
-lad_query = '<LADQuery columnName="CounterName" columnValue="Average" partitionKey="" />'
-
-
-obo_field = '<OboDirectPartitionField name="{name}" value="{value}" />'
-
 # OMI is not used anymore
 
 entire_xml_cfg_tmpl = """
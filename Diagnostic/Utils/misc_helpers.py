@@ -10,6 +10,7 @@
 # The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
 # THE SOFTWARE IS PROVIDED *AS IS*, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import collections
 import os
 import tempfile
 import re
@@ -17,6 +18,7 @@ import string
 import traceback
 import xml.dom.minidom
 import binascii
+import time
 
 from Utils.WAAgentUtil import waagent
 from Utils.lad_exceptions import LadLoggingConfigException
@@ -57,31 +59,189 @@ def get_storage_endpoints_with_account(account, endpoint_without_account):
     return (tableEndpoint, blobEndpoint)
 
 
-def check_suspected_memory_leak(pid, logger_err):
+def read_process_memory_usage_in_KB(pid, proc_root='/proc'):
     """
-    Check suspected memory leak of a process, by inspecting /proc/<pid>/status's VmRSS value.
-    :param pid: ID of the process we are checking.
-    :param logger_err: Error logging function (e.g., hutil.error)
-    :return (bool, int): Bool indicating whether memory leak is suspected. Int for memory usage in KB in true case.
+    Read the memory usage of a process from /proc. PSS (from /proc/<pid>/smaps_rollup, Linux 4.14+) is preferred,
+    because it doesn't charge the process for the whole of the shared libraries it maps. VmRSS from
+    /proc/<pid>/status is used on older kernels.
+    :param pid: ID of the process
+    :param str proc_root: Mount point of procfs (overridable for tests)
+    :return (int, str): Memory usage in KB and the metric used ('Pss' or 'VmRSS')
     """
-    memory_leak_threshold_in_KB = 2000000  # Roughly 2GB. TODO: Make it configurable or automatically calculated
-    memory_usage_in_KB = 0
-    memory_leak_suspected = False
-
     try:
-        # Check /proc/[pid]/status file for "VmRSS" to find out the process's virtual memory usage
-        # Note: "VmSize" for some reason starts out very high (>2000000) at this moment, so can't use that.
-        with open("/proc/{0}/status".format(pid)) as proc_file:
-            for line in proc_file:
-                if line.startswith("VmRSS:"):  # Example line: "VmRSS:   33904 kB"
-                    memory_usage_in_KB = int(line.split()[1])
-                    memory_leak_suspected = memory_usage_in_KB > memory_leak_threshold_in_KB
-                    break
-    except Exception as e:
-        # Not to throw in case any statement above fails (e.g., invalid pid). Just log.
-        logger_err("Failed to check memory usage of pid={0}.\nError: {1}\nTrace:\n{2}".format(pid, e, traceback.format_exc()))
+        with open(os.path.join(proc_root, str(pid), 'smaps_rollup')) as smaps_file:
+            for line in smaps_file:
+                if line.startswith("Pss:"):  # Example line: "Pss:               33904 kB"
+                    return int(line.split()[1]), 'Pss'
+    except (IOError, OSError):
+        pass
+    # Note: "VmSize" for some reason starts out very high (>2000000) at this moment, so can't use that.
+    with open(os.path.join(proc_root, str(pid), 'status')) as status_file:
+        for line in status_file:
+            if line.startswith("VmRSS:"):  # Example line: "VmRSS:   33904 kB"
+                return int(line.split()[1]), 'VmRSS'
+    raise ValueError("No VmRSS in {0}".format(os.path.join(proc_root, str(pid), 'status')))
+
+
+def read_total_memory_in_KB(proc_root='/proc'):
+    """
+    :return int: MemTotal from /proc/meminfo in KB
+    """
+    with open(os.path.join(proc_root, 'meminfo')) as meminfo_file:
+        for line in meminfo_file:
+            if line.startswith("MemTotal:"):  # Example line: "MemTotal:        8167848 kB"
+                return int(line.split()[1])
+    raise ValueError("No MemTotal in {0}".format(os.path.join(proc_root, 'meminfo')))
+
+
+class MemoryLeakDetector(object):
+    """
+    Detects a suspected memory leak of a process (mdsd) from the trend of its memory usage, instead of a fixed size
+    that is too low for big VMs and too high for small ones. Memory usage samples of the last
+    growth_window_in_minutes are kept, and a leak is suspected when either:
+    - the usage exceeds max_memory_percent of the VM's total memory, or
+    - a least-squares fit of the samples over the last growth_window_in_minutes shows a steady (r^2 >= min_fit_r2)
+      growth faster than max_growth_percent_per_hour of the total memory, once the usage is over
+      min_memory_percent_for_growth (so that a process warming up isn't taken for a leak).
+    """
+
+    # Default policy. Each can be overridden by the 'mdsdMemoryLeakPolicy' public setting.
+    default_policy = {
+        'enabled': True,
+        'maxMemoryPercent': 30,
+        'maxGrowthPercentPerHour': 5,
+        'growthWindowInMinutes': 60,
+        'minMemoryPercentForGrowth': 5,
+    }
+
+    def __init__(self, logger_err, policy=None, min_fit_r2=0.8, proc_root='/proc'):
+        """
+        Constructor
+        :param logger_err: Error logging function (e.g., hutil.error)
+        :param dict policy: Overrides of default_policy (e.g., LadExtSettings.get_mdsd_memory_leak_policy())
+        :param float min_fit_r2: Coefficient of determination above which the growth is considered steady
+        :param str proc_root: Mount point of procfs (overridable for tests)
+        """
+        self._logger_err = logger_err
+        self._policy = dict(self.default_policy)
+        for key, value in (policy or {}).items():
+            if key not in self._policy:
+                logger_err("Ignoring unknown mdsdMemoryLeakPolicy setting '{0}'".format(key))
+                continue
+            parsed = self._parse_bool(value) if key == 'enabled' else self._parse_float(value)
+            if parsed is None:
+                logger_err("Ignoring invalid mdsdMemoryLeakPolicy setting '{0}': {1}".format(key, value))
+            else:
+                self._policy[key] = parsed
+        self._min_fit_r2 = min_fit_r2
+        self._proc_root = proc_root
+        # (time in seconds, memory usage in KB) of the last growthWindowInMinutes, trimmed by check()
+        self._samples = collections.deque()
+        self._pid = None
+        self._total_memory_in_KB = None
+
+    @staticmethod
+    def _parse_bool(value):
+        """
+        Parse a boolean setting, which may come as a JSON boolean or as a string (e.g., "false").
+        :return: The bool value, or None if the value isn't a boolean
+        """
+        if isinstance(value, bool):
+            return value
+        if isinstance(value, basestring) and value.strip().lower() in ('true', 'false'):
+            return value.strip().lower() == 'true'
+        return None
 
-    return memory_leak_suspected, memory_usage_in_KB
+    @staticmethod
+    def _parse_float(value):
+        """
+        Parse a numeric setting.
+        :return: The float value, or None if the value isn't a number
+        """
+        if isinstance(value, bool):
+            return None
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+
+    def reset(self):
+        """
+        Drop all samples (e.g., because the process was restarted).
+        :return: None
+        """
+        self._samples.clear()
+
+    def check(self, pid, now=None):
+        """
+        Take a memory usage sample of the process and check whether a memory leak is suspected.
+        :param pid: ID of the process we are checking. Samples are reset when it changes.
+        :param now: Sample time in seconds (defaults to time.time())
+        :return (bool, int, str): Bool indicating whether memory leak is suspected, int for the memory usage in KB,
+                                  and str for the evidence of the leak (empty if not suspected).
+        """
+        if pid != self._pid:
+            self._pid = pid
+            self.reset()
+        try:
+            if self._total_memory_in_KB is None:
+                self._total_memory_in_KB = read_total_memory_in_KB(self._proc_root)
+            memory_usage_in_KB, metric = read_process_memory_usage_in_KB(pid, self._proc_root)
+        except Exception as e:
+            # Not to throw in case any statement above fails (e.g., invalid pid). Just log.
+            self._logger_err("Failed to check memory usage of pid={0}.\nError: {1}\nTrace:\n{2}".format(
+                pid, e, traceback.format_exc()))
+            return False, 0, ''
+
+        now = time.time() if now is None else now
+        if self._samples and now < self._samples[-1][0]:
+            self.reset()  # The clock went backwards
+        self._samples.append((now, memory_usage_in_KB))
+        # Keep the samples of the last growthWindowInMinutes, plus the last one before it so that check() can tell
+        # when the samples cover the whole window.
+        window_start = now - self._policy['growthWindowInMinutes'] * 60
+        while len(self._samples) > 1 and self._samples[1][0] <= window_start:
+            self._samples.popleft()
+        if not self._policy['enabled']:
+            return False, memory_usage_in_KB, ''
+
+        total_in_KB = float(self._total_memory_in_KB)
+        usage_percent = memory_usage_in_KB * 100 / total_in_KB
+        usage_msg = "{0} {1}MB ({2:.1f}% of {3}MB total memory)".format(metric, memory_usage_in_KB // 1024,
+                                                                        usage_percent, int(total_in_KB) // 1024)
+        if usage_percent > self._policy['maxMemoryPercent']:
+            return True, memory_usage_in_KB, "{0} exceeds {1}% of total memory".format(
+                usage_msg, self._policy['maxMemoryPercent'])
+
+        window = self._samples[-1][0] - self._samples[0][0]
+        if window < self._policy['growthWindowInMinutes'] * 60 or \
+                usage_percent < self._policy['minMemoryPercentForGrowth']:
+            return False, memory_usage_in_KB, ''
+
+        slope, r2 = self._fit_trend()
+        growth_percent_per_hour = slope * 3600 * 100 / total_in_KB
+        if growth_percent_per_hour > self._policy['maxGrowthPercentPerHour'] and r2 >= self._min_fit_r2:
+            return True, memory_usage_in_KB, "{0} grew by {1}MB/hour ({2:.1f}% of total memory/hour, r^2={3:.2f}) " \
+                                             "over the last {4} minutes ({5} samples)".format(
+                usage_msg, int(slope * 3600) // 1024, growth_percent_per_hour, r2, int(window / 60),
+                len(self._samples))
+        return False, memory_usage_in_KB, ''
+
+    def _fit_trend(self):
+        """
+        Least-squares linear fit of the samples (those of the last growthWindowInMinutes, as trimmed by check()).
+        :return (float, float): Slope in KB/second and coefficient of determination (r^2) of the fit
+        """
+        n = float(len(self._samples))
+        t0 = self._samples[0][0]
+        mean_t = sum(t - t0 for t, _ in self._samples) / n
+        mean_m = sum(m for _, m in self._samples) / n
+        s_tt = sum((t - t0 - mean_t) ** 2 for t, _ in self._samples)
+        s_mm = sum((m - mean_m) ** 2 for _, m in self._samples)
+        s_tm = sum((t - t0 - mean_t) * (m - mean_m) for t, m in self._samples)
+        if s_tt == 0 or s_mm == 0:
+            return 0.0, 0.0
+        return s_tm / s_tt, (s_tm * s_tm) / (s_tt * s_mm)
 
 
 class LadLogHelper(object):
@@ -106,16 +266,18 @@ class LadLogHelper(object):
         self._ext_name = ext_name
         self._ext_ver = ext_ver
 
-    def log_suspected_memory_leak_and_kill_mdsd(self, memory_usage_in_KB, mdsd_process, ext_op):
+    def log_suspected_memory_leak_and_kill_mdsd(self, memory_usage_in_KB, mdsd_process, ext_op, evidence=''):
         """
         Log suspected-memory-leak message both in ext logs and as a waagent event.
         :param memory_usage_in_KB: Memory usage in KB (to be included in the log)
         :param mdsd_process: Python Process object for the mdsd process to kill
         :param ext_op: Extension operation type to use for waagent event (waagent.WALAEventOperation.HeartBeat)
+        :param evidence: Why the memory leak is suspected (e.g., from MemoryLeakDetector.check())
         :return: None
         """
-        memory_leak_msg = "Suspected mdsd memory leak (Virtual memory usage: {0}MB). " \
-                          "Recycling mdsd to self-mitigate.".format(int((memory_usage_in_KB + 1023) / 1024))
+        memory_leak_msg = "Suspected mdsd memory leak (Memory usage: {0}MB{1}). " \
+                          "Recycling mdsd to self-mitigate.".format(int((memory_usage_in_KB + 1023) / 1024),
+                                                                     ": " + evidence if evidence else '')
         self._logger_log(memory_leak_msg)
         # Add a telemetry for a possible statistical analysis
         self._waagent_event_adder(name=self._ext_name,
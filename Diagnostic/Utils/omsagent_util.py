@@ -411,29 +411,39 @@ def setup_omsagent(configurator, run_command, logger_log, logger_error):
                         "> /etc/opt/omi/conf/omiserver.conf_temp")
             run_command("mv /etc/opt/omi/conf/omiserver.conf_temp /etc/opt/omi/conf/omiserver.conf")
 
-    # 2. Configure all fluentd plugins (in_syslog, in_tail, out_mdsd)
-    # 2.1. First get a free TCP/UDP port for fluentd in_syslog plugin.
-    port = get_fluentd_syslog_src_port()
-    if port < 0:
-        return 3, 'setup_omsagent(): Failed at getting a free TCP/UDP port for fluentd in_syslog'
-    # 2.2. Configure syslog
-    cmd_exit_code, cmd_output = configure_syslog(run_command, port,
-                                                 configurator.get_fluentd_syslog_src_config(),
-                                                 configurator.get_rsyslog_config(),
-                                                 configurator.get_syslog_ng_config())
-    if cmd_exit_code != 0:
-        return 4, 'setup_omsagent(): Failed at configuring in_syslog. Exit code={0}, Output={1}'.format(cmd_exit_code,
-                                                                                                        cmd_output)
-    # 2.3. Configure filelog
-    cmd_exit_code, cmd_output = configure_filelog(configurator.get_fluentd_tail_src_config())
-    if cmd_exit_code != 0:
-        return 5, 'setup_omsagent(): Failed at configuring in_tail. Exit code={0}, Output={1}'.format(cmd_exit_code,
-                                                                                                      cmd_output)
-    # 2.4. Configure out_mdsd
-    cmd_exit_code, cmd_output = configure_out_mdsd(configurator.get_fluentd_out_mdsd_config())
-    if cmd_exit_code != 0:
-        return 6, 'setup_omsagent(): Failed at configuring out_mdsd. Exit code={0}, Output={1}'.format(cmd_exit_code,
-                                                                                                       cmd_output)
+    # 2. Configure all fluentd plugins (in_syslog, in_tail, out_mdsd), but only those whose configs changed since
+    #    they were last applied, so that a re-enable with the same settings doesn't restart syslog and omsagent.
+    syslog_cfg_changed = configurator.has_config_changed('syslog') or not os.path.isfile(fluentd_syslog_src_cfg_path)
+    fluentd_cfg_changed = configurator.has_config_changed('fluentd') or not os.path.isfile(fluentd_tail_src_cfg_path) \
+                          or not os.path.isfile(fluentd_out_mdsd_cfg_path)
+    if not syslog_cfg_changed and not fluentd_cfg_changed:
+        logger_log("omsagent (fluentd) and syslog configs are unchanged. Not reconfiguring or restarting them.")
+        return 0, "setup_omsagent(): Succeeded (configs unchanged)"
+
+    if syslog_cfg_changed:
+        # 2.1. First get a free TCP/UDP port for fluentd in_syslog plugin.
+        port = get_fluentd_syslog_src_port()
+        if port < 0:
+            return 3, 'setup_omsagent(): Failed at getting a free TCP/UDP port for fluentd in_syslog'
+        # 2.2. Configure syslog
+        cmd_exit_code, cmd_output = configure_syslog(run_command, port,
+                                                     configurator.get_fluentd_syslog_src_config(),
+                                                     configurator.get_rsyslog_config(),
+                                                     configurator.get_syslog_ng_config())
+        if cmd_exit_code != 0:
+            return 4, 'setup_omsagent(): Failed at configuring in_syslog. Exit code={0}, ' \
+                      'Output={1}'.format(cmd_exit_code, cmd_output)
+    if fluentd_cfg_changed:
+        # 2.3. Configure filelog
+        cmd_exit_code, cmd_output = configure_filelog(configurator.get_fluentd_tail_src_config())
+        if cmd_exit_code != 0:
+            return 5, 'setup_omsagent(): Failed at configuring in_tail. Exit code={0}, ' \
+                      'Output={1}'.format(cmd_exit_code, cmd_output)
+        # 2.4. Configure out_mdsd
+        cmd_exit_code, cmd_output = configure_out_mdsd(configurator.get_fluentd_out_mdsd_config())
+        if cmd_exit_code != 0:
+            return 6, 'setup_omsagent(): Failed at configuring out_mdsd. Exit code={0}, ' \
+                      'Output={1}'.format(cmd_exit_code, cmd_output)
 
     # 3. Restart omsagent
     cmd_exit_code, cmd_output = control_omsagent('restart', run_command)
@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+#
+# Azure Linux extension
+#
+# Linux Azure Diagnostic Extension (Current version is specified in manifest.xml)
+# Copyright (c) Microsoft Corporation
+# All rights reserved.
+# MIT License
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the ""Software""), to deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+# Software.
+# THE SOFTWARE IS PROVIDED *AS IS*, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import ctypes
+import errno
+import os
+import select
+import time
+
+from metrics_ext_utils.proc_util import read_proc_stat, find_pid_by_executable
+
+# pidfd_open(2) has the same syscall number on every architecture (unified syscall table, Linux 5.3+)
+_NR_pidfd_open = 434
+_pidfd_supported = True
+
+
+def open_pidfd(pid):
+    """
+    Open a pidfd for a process, which becomes readable when the process exits.
+    :param int pid: ID of the process
+    :return: File descriptor, or None if pidfds are not supported on this system or the process is gone
+    """
+    global _pidfd_supported
+    if not _pidfd_supported:
+        return None
+    if hasattr(os, 'pidfd_open'):
+        try:
+            return os.pidfd_open(pid)
+        except OSError as e:
+            if e.errno == errno.ENOSYS:
+                _pidfd_supported = False
+            return None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.syscall(_NR_pidfd_open, pid, 0)
+    except Exception:
+        _pidfd_supported = False
+        return None
+    if fd < 0:
+        if ctypes.get_errno() in (errno.ENOSYS, errno.EPERM):
+            _pidfd_supported = False
+        return None
+    return fd
+
+
+def get_process_rss_kb(pid, proc_root='/proc'):
+    """
+    Read the resident set size of a process from /proc/<pid>/status.
+    :param int pid: ID of the process
+    :param str proc_root: Mount point of procfs (overridable for tests)
+    :return int: VmRSS in KB, or None if the process doesn't exist (or is a zombie)
+    """
+    try:
+        with open(os.path.join(proc_root, str(pid), 'status')) as status_file:
+            for line in status_file:
+                if line.startswith("VmRSS:"):  # Example line: "VmRSS:   33904 kB"
+                    return int(line.split()[1])
+    except (IOError, OSError):
+        pass
+    return None
+
+
+class SupervisedProcess(object):
+    """
+    A process kept running by ProcessSupervisor, along with its restart policy.
+    """
+
+    def __init__(self, name, start, find_pid=None, on_exit=None, max_restarts=None,
+                 min_backoff=1, max_backoff=300, stable_uptime=60):
+        """
+        Constructor
+        :param str name: Name used in log messages (e.g., 'mdsd')
+        :param start: Callable that (re)starts the process and returns its subprocess.Popen object or pid,
+                      or None if it failed to start
+        :param find_pid: Optional callable returning the pid of an already running instance, used to adopt processes
+                         that are started elsewhere (e.g., by systemd) instead of starting them
+        :param on_exit: Optional callable invoked with (SupervisedProcess, uptime in seconds) when the process exits
+        :param int max_restarts: Number of consecutive restarts after quick exits before giving up. None means forever.
+        :param min_backoff: Delay in seconds before the first restart after a quick exit. Doubled on each quick exit.
+        :param max_backoff: Upper bound in seconds of the restart delay
+        :param stable_uptime: Uptime in seconds after which an exit is no longer considered quick. Exits after that
+                              are restarted immediately and reset the backoff.
+        """
+        self.name = name
+        self.max_restarts = max_restarts
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.stable_uptime = stable_uptime
+        self.popen = None  # subprocess.Popen object, when the process was started as our child
+        self.pid = None
+        self.returncode = None
+        self.quick_exits = 0  # Number of consecutive quick exits (or failed starts)
+        self.restart_time = None  # time.time() at which the process is due to be restarted
+        self.given_up = False
+        self._start = start
+        self._find_pid = find_pid
+        self._on_exit = on_exit
+        self._proc_start_time = None  # Start time from /proc/<pid>/stat, so that a reused pid isn't taken as alive
+        self._started_at = None
+        self._pidfd = None
+
+    def attach(self, target, proc_root='/proc'):
+        """
+        Start watching a process.
+        :param target: subprocess.Popen object or pid of the process
+        :param str proc_root: Mount point of procfs
+        :return: None
+        """
+        self.detach()
+        if hasattr(target, 'pid'):
+            self.popen = target
+            self.pid = target.pid
+        else:
+            self.popen = None
+            self.pid = int(target)
+        stat = read_proc_stat(self.pid, proc_root)
+        self._proc_start_time = stat[1] if stat else None
+        self._started_at = time.time()
+        self.returncode = None
+        self.restart_time = None
+        self._pidfd = open_pidfd(self.pid)
+
+    def detach(self):
+        """
+        Stop watching the current process, if any, releasing its pidfd.
+        :return: None
+        """
+        if self._pidfd is not None:
+            os.close(self._pidfd)
+            self._pidfd = None
+        self.pid = None
+
+    def is_alive(self, proc_root='/proc'):
+        """
+        Check whether the watched process is still running, reaping it if it's our child.
+        :param str proc_root: Mount point of procfs
+        :return bool: True if the process is running
+        """
+        if self.pid is None:
+            return False
+        if self.popen is not None:
+            self.returncode = self.popen.poll()
+            return self.returncode is None
+        stat = read_proc_stat(self.pid, proc_root)
+        if stat is None or stat[1] != self._proc_start_time:
+            return False
+        if stat[0] in ('Z', 'X'):
+            # Processes such as telegraf can be children of this daemon when there's no systemd, so try to reap it
+            try:
+                pid, status = os.waitpid(self.pid, os.WNOHANG)
+                if pid == self.pid:
+                    self.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+            except OSError:
+                pass
+            return False
+        return True
+
+    def get_rss_kb(self, proc_root='/proc'):
+        """
+        :return int: Resident set size of the watched process in KB, or None if it's not running
+        """
+        return get_process_rss_kb(self.pid, proc_root) if self.pid is not None else None
+
+    def get_uptime(self):
+        """
+        :return float: Seconds since the process was (re)started or adopted, or None if it's not running
+        """
+        return time.time() - self._started_at if self.pid is not None else None
+
+    def get_pidfd(self):
+        return self._pidfd
+
+
+class ProcessSupervisor(object):
+    """
+    Waits for supervised processes to exit and restarts them with exponential backoff as soon as they do.
+
+    Exits are noticed through pidfds (Linux 5.3+), which are polled all at once; on older kernels the processes are
+    checked through /proc (and waitpid for our own children) every poll_interval seconds instead.
+    """
+
+    def __init__(self, logger_log, logger_error, poll_interval=1, proc_root='/proc'):
+        """
+        Constructor
+        :param logger_log: Normal logging function (e.g., hutil.log)
+        :param logger_error: Error logging function (e.g., hutil.error)
+        :param poll_interval: Seconds between /proc checks of processes for which no pidfd could be opened
+        :param str proc_root: Mount point of procfs (overridable for tests)
+        """
+        self._logger_log = logger_log
+        self._logger_error = logger_error
+        self._poll_interval = poll_interval
+        self._proc_root = proc_root
+        self._processes = []
+
+    def add(self, process):
+        """
+        Add a process to supervise. It's started (or adopted) on the next start() call.
+        :param SupervisedProcess process: Process to supervise
+        :return: None
+        """
+        self._processes.append(process)
+
+    def start(self):
+        """
+        Adopt the already running instances of the processes that have a find_pid callable, and start the others.
+        :return: None
+        """
+        for process in self._processes:
+            pid = process._find_pid() if process._find_pid else None
+            if pid:
+                self._logger_log("Supervising already running {0} (pid {1})".format(process.name, pid))
+                process.attach(pid, self._proc_root)
+            else:
+                self._launch(process)
+
+    def wait(self, timeout):
+        """
+        Supervise the processes for timeout seconds, restarting any of them that exits (once its backoff elapses).
+        :param timeout: Seconds to supervise for
+        :return: None. Returns early if all processes were given up.
+        """
+        deadline = time.time() + timeout
+        while True:
+            now = time.time()
+            self._check(now)
+            if now >= deadline or all(p.given_up for p in self._processes):
+                return
+            self._wait_for_exit(self._next_wakeup(now, deadline) - now)
+
+    def close(self):
+        """
+        Stop supervising, releasing any pidfds. The processes are left running.
+        :return: None
+        """
+        for process in self._processes:
+            process.detach()
+
+    def _check(self, now):
+        for process in self._processes:
+            if process.given_up:
+                continue
+            if process.pid is not None and not process.is_alive(self._proc_root):
+                self._handle_exit(process, now)
+            if process.pid is None and process.restart_time is not None and process.restart_time <= now:
+                self._launch(process)
+
+    def _next_wakeup(self, now, deadline):
+        wakeup = deadline
+        for process in self._processes:
+            if process.given_up:
+                continue
+            if process.pid is None and process.restart_time is not None:
+                wakeup = min(wakeup, process.restart_time)
+            elif process.pid is not None and process.get_pidfd() is None:
+                wakeup = min(wakeup, now + self._poll_interval)
+        return max(wakeup, now)
+
+    def _wait_for_exit(self, wait_time):
+        pidfds = [p.get_pidfd() for p in self._processes if p.pid is not None and p.get_pidfd() is not None]
+        if not pidfds:
+            time.sleep(wait_time)
+            return
+        poller = select.poll()
+        for pidfd in pidfds:
+            poller.register(pidfd, select.POLLIN)
+        try:
+            poller.poll(int(wait_time * 1000))
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+
+    def _launch(self, process):
+        try:
+            target = process._start()
+        except Exception as e:
+            self._logger_error("Failed to start {0}: {1}".format(process.name, e))
+            target = None
+        if target:
+            process.attach(target, self._proc_root)
+            self._logger_log("Started {0} (pid {1})".format(process.name, process.pid))
+        else:
+            # A failed start counts as a quick exit, so that it's retried with backoff
+            process._started_at = time.time()
+            process.pid = None
+            self._handle_exit(process, time.time(), started=False)
+
+    def _handle_exit(self, process, now, started=True):
+        uptime = now - process._started_at
+        if started:
+            self._logger_log("{0} (pid {1}) exited with code {2} after {3} seconds".format(
+                process.name, process.pid, process.returncode, int(uptime)))
+            process.detach()
+            if process._on_exit:
+                process._on_exit(process, uptime)
+
+        if started and uptime >= process.stable_uptime:
+            process.quick_exits = 0
+        else:
+            process.quick_exits += 1
+
+        if process.max_restarts is not None and process.quick_exits > process.max_restarts:
+            process.given_up = True
+            self._logger_error("{0} exited quickly {1} consecutive times. Giving up restarting it.".format(
+                process.name, process.quick_exits))
+            return
+
+        backoff = 0
+        if process.quick_exits:
+            backoff = min(process.max_backoff, process.min_backoff * 2 ** (process.quick_exits - 1))
+        process.restart_time = now + backoff
+        self._logger_log("Restarting {0} in {1} seconds (consecutive quick exits: {2})".format(
+            process.name, backoff, process.quick_exits))
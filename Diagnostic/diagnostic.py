@@ -50,10 +50,13 @@ try:
     from Utils.misc_helpers import *
     import lad_config_all as lad_cfg
     from Utils.imds_util import ImdsLogger
+    from Utils.process_supervisor import ProcessSupervisor, SupervisedProcess
+    from Utils.log_watcher import IncrementalLogReader
     import Utils.omsagent_util as oms
     import telegraf_utils.telegraf_config_handler as telhandler
     import metrics_ext_utils.metrics_ext_handler as me_handler
     import metrics_ext_utils.metrics_constants as metrics_constants
+    from metrics_ext_utils.proc_util import find_pid_by_executable
 
 
 
@@ -76,6 +79,7 @@ g_lad_pids_filepath = ''  # LAD process IDs (diagnostic.py, mdsd) file path. g_e
 g_ext_op_type = None  # Extension operation type (e.g., Install, Enable, HeartBeat, ...)
 g_mdsd_bin_path = '/usr/local/lad/bin/mdsd'  # mdsd binary path. Fixed w/ lad-mdsd-*.{deb,rpm} pkgs
 g_diagnostic_py_filepath = ''  # Full path of this script. g_ext_dir + '/diagnostic.py'
+g_status_report_lock = threading.Lock()  # Serializes the status reports of the main and watcher threads
 # Only 2 globals not following 'g_...' naming convention, for legacy readability...
 RunGetOutput = None  # External command executor callable
 hutil = None  # Handler util object
@@ -84,6 +88,15 @@ me_msi_token_expiry_epoch = None
 
 
 
+def do_status_report(operation, status, status_code, message):
+    """
+    Write the extension status. The main loop and the watcher thread (reporting new mdsd.err lines) both report
+    status, so the status file is written by one of them at a time.
+    """
+    with g_status_report_lock:
+        hutil.do_status_report(operation, status, status_code, message)
+
+
 def init_distro_specific_actions():
     """
     Identify the specific Linux distribution in use. Set the global distConfig to point to the corresponding
@@ -149,7 +162,7 @@ def init_globals():
     g_mdsd_file_resources_prefix = os.path.join(g_mdsd_file_resources_dir, g_mdsd_role_name)
     g_lad_pids_filepath = os.path.join(g_ext_dir, 'lad.pids')
     g_diagnostic_py_filepath = os.path.join(os.getcwd(), __file__)
-    g_lad_log_helper = LadLogHelper(hutil.log, hutil.error, waagent.AddExtensionEvent, hutil.do_status_report,
+    g_lad_log_helper = LadLogHelper(hutil.log, hutil.error, waagent.AddExtensionEvent, do_status_report,
                                     hutil.get_name(), hutil.get_extension_version())
 
 
@@ -258,14 +271,14 @@ def check_for_supported_waagent_and_distro_version():
                                              should_log=False)
         if code == 0 and str_ret.find(notsupport) > -1:
             hutil.log("cannot run this extension on  " + notsupport)
-            hutil.do_status_report(g_ext_op_type, "error", '1', "cannot run this extension on  " + notsupport)
+            do_status_report(g_ext_op_type, "error", '1', "cannot run this extension on  " + notsupport)
             return False
 
     if g_dist_config is None:
         msg = ("LAD does not support distro/version ({0}); not installed. This extension install/enable operation is "
                "still considered a success as it's an external error.").format(str(platform.dist()))
         hutil.log(msg)
-        hutil.do_status_report(g_ext_op_type, "success", '0', msg)
+        do_status_report(g_ext_op_type, "success", '0', msg)
         waagent.AddExtensionEvent(name=hutil.get_name(),
                                   op=g_ext_op_type,
                                   isSuccess=True,
@@ -311,7 +324,7 @@ def main(command):
             else:
                 hutil.error(me_msg)
 
-            hutil.do_status_report(g_ext_op_type, "success", '0', "Disable succeeded")
+            do_status_report(g_ext_op_type, "success", '0', "Disable succeeded")
 
         elif g_ext_op_type is waagent.WALAEventOperation.Uninstall:
             if g_dist_config.use_systemd():
@@ -352,7 +365,7 @@ def main(command):
             else:
                 hutil.error(me_rm_msg)
 
-            hutil.do_status_report(g_ext_op_type, "success", '0', "Uninstall succeeded")
+            do_status_report(g_ext_op_type, "success", '0', "Uninstall succeeded")
 
         elif g_ext_op_type is waagent.WALAEventOperation.Install:
             # Install dependencies (omsagent, which includes omi, scx).
@@ -360,7 +373,7 @@ def main(command):
             dependencies_err, dependencies_msg = setup_dependencies_and_mdsd(configurator)
             if dependencies_err != 0:
                 g_lad_log_helper.report_mdsd_dependency_setup_failure(waagent_ext_event_type, dependencies_msg)
-                hutil.do_status_report(g_ext_op_type, "error", '-1', "Install failed")
+                do_status_report(g_ext_op_type, "error", '-1', "Install failed")
                 return
 
             #Start the Telegraf and ME services on Enable after installation is complete
@@ -384,78 +397,69 @@ def main(command):
                 else:
                     hutil.error(log_messages)
 
+            if configurator:
+                configurator.commit_config_hashes()
             if g_dist_config.use_systemd():
                 install_lad_as_systemd_service()
-            hutil.do_status_report(g_ext_op_type, "success", '0', "Install succeeded")
+            do_status_report(g_ext_op_type, "success", '0', "Install succeeded")
 
         elif g_ext_op_type is waagent.WALAEventOperation.Enable:
+            # Whether the daemon (mdsd) needs a restart for a new config. Only if mdsd's config actually changed.
+            restart_daemon_for_new_config = False
             if hutil.is_current_config_seq_greater_inused():
                 configurator = create_core_components_configs()
                 dependencies_err, dependencies_msg = setup_dependencies_and_mdsd(configurator)
                 if dependencies_err != 0:
                     g_lad_log_helper.report_mdsd_dependency_setup_failure(waagent_ext_event_type, dependencies_msg)
-                    hutil.do_status_report(g_ext_op_type, "error", '-1', "Enabled failed")
+                    do_status_report(g_ext_op_type, "error", '-1', "Enabled failed")
                     return
-
-                #Start the Telegraf and ME services on Enable after installation is complete
-                start_telegraf_out, log_messages = telhandler.start_telegraf(is_lad=True)
-                if start_telegraf_out:
-                    hutil.log("Successfully started metrics-sourcer.")
+                restart_daemon_for_new_config = configurator is None or configurator.has_config_changed('mdsd')
+
+                #Start the Telegraf and ME services on Enable after installation is complete,
+                #unless they are running with an unchanged config already
+                if configurator is None or configurator.has_config_changed('telegraf') \
+                        or not telhandler.is_running(is_lad=True):
+                    # Reloads telegraf rather than restarting it when only settings of its plugins changed
+                    start_telegraf_out, log_messages = telhandler.apply_config_changes(is_lad=True)
+                    if start_telegraf_out:
+                        hutil.log("Successfully applied the metrics-sourcer config.")
+                    else:
+                        hutil.error(log_messages)
                 else:
-                    hutil.error(log_messages)
+                    hutil.log("metrics-sourcer config is unchanged. Not restarting it.")
 
                 if enable_metrics_ext:
                     # Generate/regenerate MSI Token required by ME
-                    generate_token = False
-                    me_token_path = g_ext_dir + "/metrics_configs/AuthToken-MSI.json"
-
-                    if me_msi_token_expiry_epoch is None or me_msi_token_expiry_epoch == "":
-                        if os.path.isfile(me_token_path):
-                            with open(me_token_path, "r") as f:
-                                authtoken_content = f.read()
-                                if authtoken_content and "expires_on" in authtoken_content:
-                                    me_msi_token_expiry_epoch = authtoken_content["expires_on"]
-                                else:
-                                    generate_token = True
-                        else:
-                            generate_token = True
-
-                    if me_msi_token_expiry_epoch:
-                        currentTime = datetime.datetime.now()
-                        token_expiry_time = datetime.datetime.fromtimestamp(me_msi_token_expiry_epoch)
-                        if token_expiry_time - currentTime < datetime.timedelta(minutes=30):
-                            # The MSI Token will expire within 30 minutes. We need to refresh the token
-                            generate_token = True
-
-                    if generate_token:
-                        generate_token = False
-                        msi_token_generated, me_msi_token_expiry_epoch, log_messages = me_handler.generate_MSI_token()
-                        if msi_token_generated:
-                            hutil.log("Successfully refreshed metrics-extension MSI Auth token.")
+                    refresh_me_msi_token_if_expiring()
+
+                    if configurator is None or configurator.has_config_changed('me') \
+                            or not me_handler.is_running(is_lad=True):
+                        start_metrics_out, log_messages = me_handler.start_metrics(is_lad=True)
+                        if start_metrics_out:
+                            hutil.log("Successfully started metrics-extension.")
                         else:
                             hutil.error(log_messages)
-
-                    start_metrics_out, log_messages = me_handler.start_metrics(is_lad=True)
-                    if start_metrics_out:
-                        hutil.log("Successfully started metrics-extension.")
                     else:
-                        hutil.error(log_messages)
+                        hutil.log("metrics-extension config is unchanged. Not restarting it.")
+
+                if configurator:
+                    configurator.commit_config_hashes()
 
             if g_dist_config.use_systemd():
                 install_lad_as_systemd_service()
                 RunGetOutput('systemctl enable mdsd-lde')
                 mdsd_lde_active = RunGetOutput('systemctl status mdsd-lde')[0] is 0
-                if not mdsd_lde_active or hutil.is_current_config_seq_greater_inused():
+                if not mdsd_lde_active or restart_daemon_for_new_config:
                     RunGetOutput('systemctl restart mdsd-lde')
             else:
                 # if daemon process not runs
                 lad_pids = get_lad_pids()
                 hutil.log("get pids:" + str(lad_pids))
-                if len(lad_pids) != 2 or hutil.is_current_config_seq_greater_inused():
+                if len(lad_pids) != 2 or restart_daemon_for_new_config:
                     stop_mdsd()
                     start_daemon()
             hutil.set_inused_config_seq(hutil.get_seq_no())
-            hutil.do_status_report(g_ext_op_type, "success", '0', "Enable succeeded, extension daemon started")
+            do_status_report(g_ext_op_type, "success", '0', "Enable succeeded, extension daemon started")
             # If the -daemon detects a problem, e.g. bad configuration, it will overwrite this status with a more
             # informative one. If it succeeds, all is well.
 
@@ -465,12 +469,12 @@ def main(command):
                 start_mdsd(configurator)
 
         elif g_ext_op_type is waagent.WALAEventOperation.Update:
-            hutil.do_status_report(g_ext_op_type, "success", '0', "Update succeeded")
+            do_status_report(g_ext_op_type, "success", '0', "Update succeeded")
 
     except Exception as e:
         hutil.error("Failed to perform extension operation {0} with error:{1}, {2}".format(g_ext_op_type, e,
                                                                                            traceback.format_exc()))
-        hutil.do_status_report(g_ext_op_type, 'error', '0',
+        do_status_report(g_ext_op_type, 'error', '0',
                                'Extension operation {0} failed:{1}'.format(g_ext_op_type, e))
 
 
@@ -486,18 +490,29 @@ def start_daemon():
     subprocess.Popen(args, stdout=log, stderr=log)
 
 
-def start_watcher_thread():
+def start_watcher_thread(err_file_path):
     """
-    Start watcher thread that performs periodic monitoring activities (other than mdsd)
+    Start watcher thread that performs monitoring activities (other than mdsd): validating /etc/fstab when it changes,
+    reporting new mdsd.err lines as soon as they're written and periodic IMDS data logging.
+    :param err_file_path: Path of the mdsd.err file. Only lines written after this call are reported.
     :return: None
     """
     # Create monitor object that encapsulates monitoring activities
-    watcher = watcherutil.Watcher(hutil.error, hutil.log, log_to_console=True)
+    watcher = watcherutil.Watcher(hutil.error, hutil.log, log_to_console=True, file_poll_interval=30)
     # Create an IMDS data logger and set it to the monitor object
     imds_logger = ImdsLogger(hutil.get_name(), hutil.get_extension_version(),
                              waagent.WALAEventOperation.HeartBeat, waagent.AddExtensionEvent)
     watcher.set_imds_logger(imds_logger)
-    # Start a thread to perform periodic monitoring activity (e.g., /etc/fstab watcher, IMDS data logging)
+
+    err_reader = IncrementalLogReader(err_file_path)
+
+    def report_mdsd_err_changes():
+        new_error_lines = err_reader.read_new_lines()
+        if new_error_lines:
+            report_new_mdsd_errors(new_error_lines)
+    watcher.watch_file(err_file_path, report_mdsd_err_changes)
+
+    # Start a thread to perform the monitoring activities
     thread_obj = threading.Thread(target=watcher.watch)
     thread_obj.daemon = True
     thread_obj.start()
@@ -554,7 +569,7 @@ def start_mdsd(configurator):
     update_selinux_settings_for_rsyslogomazuremds(RunGetOutput, g_ext_dir)
 
     mdsd_stdout_redirect_path = os.path.join(g_ext_dir, "mdsd.log")
-    mdsd_stdout_stream = None
+    mdsd_state = {'stdout_stream': None, 'crash_msg': ''}
 
     g_dist_config.extend_environment(copy_env)
 
@@ -574,149 +589,82 @@ def start_mdsd(configurator):
         g_ext_settings.get_mdsd_trace_option(),
         eh_spool_path).split(" ")
 
-    try:
-        start_watcher_thread()
-
-        num_quick_consecutive_crashes = 0
-        mdsd_crash_msg = ''
-
-        while num_quick_consecutive_crashes < 3:  # We consider only quick & consecutive crashes for retries
-
-            RunGetOutput('rm -f ' + g_mdsd_file_resources_prefix + '.pidport')  # Must delete any existing port num file
-            mdsd_stdout_stream = open(mdsd_stdout_redirect_path, "w")
-            hutil.log("Start mdsd " + str(command))
-            mdsd = subprocess.Popen(command,
-                                    cwd=g_ext_dir,
-                                    stdout=mdsd_stdout_stream,
-                                    stderr=mdsd_stdout_stream,
-                                    env=copy_env)
-
-            write_lad_pids_to_file(g_lad_pids_filepath, os.getpid(), mdsd.pid)
-
-            last_mdsd_start_time = datetime.datetime.now()
-            last_error_time = last_mdsd_start_time
-            omi_installed = True  # Remembers if OMI is installed at each iteration
-            telegraf_restart_retries = 0
-            me_restart_retries = 0
-            max_restart_retries = 10
-            # Continuously monitors mdsd process
-            while True:
-                time.sleep(30)
-                if " ".join(get_lad_pids()).find(str(mdsd.pid)) < 0 and len(get_lad_pids()) >= 2:
-                    mdsd.kill()
-                    hutil.log("Another process is started, now exit")
-                    return
-                if mdsd.poll() is not None:  # if mdsd has terminated
-                    time.sleep(60)
-                    mdsd_stdout_stream.flush()
-                    break
-
-                # mdsd is now up for at least 30 seconds. Do some monitoring activities.
-                # 1. Mitigate if memory leak is suspected.
-                mdsd_memory_leak_suspected, mdsd_memory_usage_in_KB = check_suspected_memory_leak(mdsd.pid, hutil.error)
-                if mdsd_memory_leak_suspected:
-                    g_lad_log_helper.log_suspected_memory_leak_and_kill_mdsd(mdsd_memory_usage_in_KB, mdsd,
-                                                                             waagent_ext_event_type)
-                    break
-                # 2. Restart OMI if it crashed (Issue #128)
-                omi_installed = restart_omi_if_crashed(omi_installed, mdsd)
-                # 3. Check if there's any new logs in mdsd.err and report
-                last_error_time = report_new_mdsd_errors(err_file_path, last_error_time)
-                # 4. Check if telegraf is running, if not, then restart
-                if not telhandler.is_running(is_lad=True):
-                    if telegraf_restart_retries < max_restart_retries:
-                        telegraf_restart_retries += 1
-                        hutil.log("Telegraf binary process is not running. Restarting telegraf now. Retry count - {0}".format(telegraf_restart_retries))
-                        tel_out, tel_msg = telhandler.stop_telegraf_service(is_lad=True)
-                        if tel_out:
-                            hutil.log(tel_msg)
-                        else:
-                            hutil.error(tel_msg)
-                        start_telegraf_out, log_messages = telhandler.start_telegraf(is_lad=True)
-                        if start_telegraf_out:
-                            hutil.log("Successfully started metrics-sourcer.")
-                        else:
-                            hutil.error(log_messages)
-                    else:
-                        hutil.error("Telegraf binary process is not running. Failed to restart after {0} retries. Please check telegraf.log at {1}".format(max_restart_retries, log_dir))
-                else:
-                    telegraf_restart_retries = 0
-                # 5. Check if ME is running, if not, then restart
-                if enable_metrics_ext:
-                    if not me_handler.is_running(is_lad=True):
-                        if me_restart_retries < max_restart_retries:
-                            me_restart_retries += 1
-                            hutil.log("MetricsExtension binary process is not running. Restarting MetricsExtension now. Retry count - {0}".format(me_restart_retries))
-                            me_out, me_msg = me_handler.stop_metrics_service(is_lad=True)
-                            if me_out:
-                                hutil.log(me_msg)
-                            else:
-                                hutil.error(me_msg)
-                            start_metrics_out, log_messages = me_handler.start_metrics(is_lad=True)
-                            if start_metrics_out:
-                                hutil.log("Successfully started metrics-extension.")
-                            else:
-                                hutil.error(log_messages)
-                        else:
-                            hutil.error("MetricsExtension binary process is not running. Failed to restart after {0} retries. Please check /var/log/syslog for ME logs".format(max_restart_retries))
-                    else:
-                        me_restart_retries = 0
-                    # 6. Regenerate the MSI auth token required for ME if it is nearing expiration
-                    # Generate/regenerate MSI Token required by ME
-                    global me_msi_token_expiry_epoch
-                    generate_token = False
-                    me_token_path = g_ext_dir + "/config/metrics_configs/AuthToken-MSI.json"
-
-                    if me_msi_token_expiry_epoch is None  or me_msi_token_expiry_epoch == "":
-                        if os.path.isfile(me_token_path):
-                            with open(me_token_path, "r") as f:
-                                authtoken_content = json.loads(f.read())
-                                if authtoken_content and "expires_on" in authtoken_content:
-                                    me_msi_token_expiry_epoch = authtoken_content["expires_on"]
-                                else:
-                                    generate_token = True
-                        else:
-                            generate_token = True
-
-                    if me_msi_token_expiry_epoch:
-                        currentTime = datetime.datetime.now()
-                        token_expiry_time = datetime.datetime.fromtimestamp(float(me_msi_token_expiry_epoch))
-                        if token_expiry_time - currentTime < datetime.timedelta(minutes=30):
-                            # The MSI Token will expire within 30 minutes. We need to refresh the token
-                            generate_token = True
-
-                    if generate_token:
-                        generate_token = False
-                        msi_token_generated, me_msi_token_expiry_epoch, log_messages = me_handler.generate_MSI_token()
-                        if msi_token_generated:
-                            hutil.log("Successfully refreshed metrics-extension MSI Auth token.")
-                        else:
-                            hutil.error(log_messages)
+    def launch_mdsd():
+        RunGetOutput('rm -f ' + g_mdsd_file_resources_prefix + '.pidport')  # Must delete any existing port num file
+        mdsd_state['stdout_stream'] = open(mdsd_stdout_redirect_path, "w")
+        hutil.log("Start mdsd " + str(command))
+        mdsd = subprocess.Popen(command,
+                                cwd=g_ext_dir,
+                                stdout=mdsd_state['stdout_stream'],
+                                stderr=mdsd_state['stdout_stream'],
+                                env=copy_env)
+        write_lad_pids_to_file(g_lad_pids_filepath, os.getpid(), mdsd.pid)
+        return mdsd
+
+    def on_mdsd_exit(process, uptime):
+        if mdsd_state['stdout_stream']:
+            mdsd_state['stdout_stream'].close()
+            mdsd_state['stdout_stream'] = None
+
+        # We consider a crash quick if it's within 30 minutes (stable_uptime) from the start time.
+        mdsd_up_time = datetime.timedelta(seconds=int(uptime))
+        if uptime >= process.stable_uptime:
+            hutil.log("MDSD terminated after " + str(mdsd_up_time) + ". "
+                      + tail(mdsd_stdout_redirect_path) + tail(err_file_path))
+            return
+
+        mdsd_state['crash_msg'] = "MDSD crash(uptime=" + str(mdsd_up_time) + "):" \
+                                  + tail(mdsd_stdout_redirect_path) + tail(err_file_path)
+        hutil.error("MDSD crashed:" + mdsd_state['crash_msg'])
+
+    # mdsd, telegraf and ME are restarted by the supervisor as soon as they exit. We consider only quick & consecutive
+    # crashes of mdsd for giving up (3 allowed).
+    supervisor = ProcessSupervisor(hutil.log, hutil.error)
+    mdsd_process = SupervisedProcess('mdsd', launch_mdsd, on_exit=on_mdsd_exit, max_restarts=2,
+                                     min_backoff=15, max_backoff=120, stable_uptime=30 * 60)
+    supervisor.add(mdsd_process)
+    supervisor.add(SupervisedProcess('telegraf', restart_telegraf,
+                                     find_pid=lambda: find_pid_by_executable(metrics_constants.lad_telegraf_bin),
+                                     max_restarts=10, min_backoff=5))
+    if enable_metrics_ext:
+        supervisor.add(SupervisedProcess('MetricsExtension', restart_metrics_extension,
+                                         find_pid=lambda: find_pid_by_executable(
+                                             metrics_constants.lad_metrics_extension_bin),
+                                         max_restarts=10, min_backoff=5))
 
-            # Out of the inner while loop: mdsd terminated.
-            if mdsd_stdout_stream:
-                mdsd_stdout_stream.close()
-                mdsd_stdout_stream = None
-
-            # Check if this is NOT a quick crash -- we consider a crash quick
-            # if it's within 30 minutes from the start time. If it's not quick,
-            # we just continue by restarting mdsd.
-            mdsd_up_time = datetime.datetime.now() - last_mdsd_start_time
-            if mdsd_up_time > datetime.timedelta(minutes=30):
-                mdsd_terminated_msg = "MDSD terminated after " + str(mdsd_up_time) + ". "\
-                                      + tail(mdsd_stdout_redirect_path) + tail(err_file_path)
-                hutil.log(mdsd_terminated_msg)
-                num_quick_consecutive_crashes = 0
+    try:
+        start_watcher_thread(err_file_path)
+        supervisor.start()
+
+        omi_installed = True  # Remembers if OMI is installed at each iteration
+        memory_leak_detector = MemoryLeakDetector(hutil.error, g_ext_settings.get_mdsd_memory_leak_policy())
+        # Continuously monitors mdsd process
+        while not mdsd_process.given_up:
+            supervisor.wait(30)
+            lad_pids = get_lad_pids()
+            if mdsd_process.pid is not None and str(mdsd_process.pid) not in lad_pids and len(lad_pids) >= 2:
+                mdsd_process.popen.kill()
+                hutil.log("Another process is started, now exit")
+                return
+            if mdsd_process.pid is None:  # mdsd is waiting to be restarted
                 continue
 
-            # It's a quick crash. Log error and add an extension event.
-            num_quick_consecutive_crashes += 1
-
-            mdsd_crash_msg = "MDSD crash(uptime=" + str(mdsd_up_time) + "):" + tail(mdsd_stdout_redirect_path) + tail(err_file_path)
-            hutil.error("MDSD crashed:" + mdsd_crash_msg)
+            # mdsd is now up. Do some monitoring activities.
+            # 1. Mitigate if memory leak is suspected. The supervisor restarts mdsd after it's killed.
+            mdsd_memory_leak_suspected, mdsd_memory_usage_in_KB, memory_leak_evidence = \
+                memory_leak_detector.check(mdsd_process.pid)
+            if mdsd_memory_leak_suspected:
+                g_lad_log_helper.log_suspected_memory_leak_and_kill_mdsd(mdsd_memory_usage_in_KB, mdsd_process.popen,
+                                                                         waagent_ext_event_type, memory_leak_evidence)
+                continue
+            # 2. Restart OMI if it crashed (Issue #128)
+            omi_installed = restart_omi_if_crashed(omi_installed, mdsd_process.popen)
+            # 3. Regenerate the MSI auth token required for ME if it is nearing expiration
+            if enable_metrics_ext:
+                refresh_me_msi_token_if_expiring()
 
         # mdsd all 3 allowed quick/consecutive crashes exhausted
-        hutil.do_status_report(waagent_ext_event_type, "error", '1', "mdsd stopped: " + mdsd_crash_msg)
+        do_status_report(waagent_ext_event_type, "error", '1', "mdsd stopped: " + mdsd_state['crash_msg'])
         # Need to tear down omsagent setup for LAD before returning/exiting if it was set up earlier
         oms.tear_down_omsagent_for_lad(RunGetOutput, False)
         try:
@@ -724,48 +672,96 @@ def start_mdsd(configurator):
                                       op=waagent_ext_event_type,
                                       isSuccess=False,
                                       version=hutil.get_extension_version(),
-                                      message=mdsd_crash_msg)
+                                      message=mdsd_state['crash_msg'])
         except Exception:
             pass
 
     except Exception as e:
-        if mdsd_stdout_stream:
+        if mdsd_state['stdout_stream']:
             hutil.error("Error :" + tail(mdsd_stdout_redirect_path))
         errmsg = "Failed to launch mdsd with error: {0}, traceback: {1}".format(e, traceback.format_exc())
         hutil.error(errmsg)
-        hutil.do_status_report(waagent_ext_event_type, 'error', '1', errmsg)
+        do_status_report(waagent_ext_event_type, 'error', '1', errmsg)
         waagent.AddExtensionEvent(name=hutil.get_name(),
                                   op=waagent_ext_event_type,
                                   isSuccess=False,
                                   version=hutil.get_extension_version(),
                                   message=errmsg)
     finally:
-        if mdsd_stdout_stream:
-            mdsd_stdout_stream.close()
-
-
-def report_new_mdsd_errors(err_file_path, last_error_time):
-    """
-    Monitors if there's any new stuff in mdsd.err and report it if any through the agent/ext status report mechanism.
-    :param err_file_path: Path of the mdsd.err file
-    :param last_error_time: Time when last error was reported.
-    :return: Time when the last error was reported. Same as the argument if there's no error reported in this call.
-             A new time (error file ctime) if a new error is reported.
-    """
-    if not os.path.exists(err_file_path):
-        return last_error_time
-    err_file_ctime = datetime.datetime.strptime(time.ctime(int(os.path.getctime(err_file_path))), "%a %b %d %H:%M:%S %Y")
-    if last_error_time >= err_file_ctime:
-        return last_error_time
-    # No new error above. A new error below.
-    last_error_time = err_file_ctime
-    last_error = tail(err_file_path)
-    if len(last_error) > 0 and (datetime.datetime.now() - last_error_time) < datetime.timedelta(minutes=30):
-        # Only recent error logs (within 30 minutes) are reported.
-        hutil.log("Error in MDSD:" + last_error)
-        hutil.do_status_report(g_ext_op_type, "success", '1',
-                               "message in mdsd.err:" + str(last_error_time) + ":" + last_error)
-    return last_error_time
+        supervisor.close()
+        if mdsd_state['stdout_stream']:
+            mdsd_state['stdout_stream'].close()
+
+
+def restart_telegraf():
+    """
+    Restart telegraf (metrics-sourcer). Called by the process supervisor when telegraf is not running. With systemd,
+    telegraf is restarted by systemd after a failure, so only the restart done by systemd is waited for then.
+    :return: pid of the restarted telegraf process, or None if it failed to start
+    """
+    telegraf_pid = telhandler.wait_for_systemd_restart(is_lad=True)
+    if telegraf_pid is not None:
+        hutil.log("metrics-sourcer was restarted by systemd.")
+        return telegraf_pid
+    tel_out, tel_msg = telhandler.stop_telegraf_service(is_lad=True)
+    if tel_out:
+        hutil.log(tel_msg)
+    else:
+        hutil.error(tel_msg)
+    start_telegraf_out, log_messages = telhandler.start_telegraf(is_lad=True)
+    if not start_telegraf_out:
+        hutil.error(log_messages)
+        return None
+    hutil.log("Successfully started metrics-sourcer.")
+    return find_pid_by_executable(metrics_constants.lad_telegraf_bin)
+
+
+def restart_metrics_extension():
+    """
+    Restart MetricsExtension. Called by the process supervisor when ME is not running.
+    :return: pid of the restarted MetricsExtension process, or None if it failed to start
+    """
+    me_out, me_msg = me_handler.stop_metrics_service(is_lad=True)
+    if me_out:
+        hutil.log(me_msg)
+    else:
+        hutil.error(me_msg)
+    start_metrics_out, log_messages = me_handler.start_metrics(is_lad=True)
+    if not start_metrics_out:
+        hutil.error(log_messages)
+        return None
+    hutil.log("Successfully started metrics-extension.")
+    return find_pid_by_executable(metrics_constants.lad_metrics_extension_bin)
+
+
+def refresh_me_msi_token_if_expiring():
+    """
+    Generate/regenerate the MSI auth token required by ME if there's none yet or it's about to expire. The token comes
+    from the MSI token cache shared with the other processes, so this only queries IMDS when the token needs a refresh.
+    :return: None
+    """
+    global me_msi_token_expiry_epoch
+    msi_token_generated, expiry_epoch, log_messages = me_handler.generate_MSI_token()
+    if not msi_token_generated:
+        hutil.error(log_messages)
+    elif expiry_epoch != me_msi_token_expiry_epoch:
+        me_msi_token_expiry_epoch = expiry_epoch
+        hutil.log("Successfully refreshed metrics-extension MSI Auth token.")
+
+
+def report_new_mdsd_errors(new_error_lines):
+    """
+    Report new lines in mdsd.err through the agent/ext status report mechanism. Called from the watcher thread as soon
+    as mdsd writes them.
+    :param new_error_lines: Lines appended to mdsd.err since the last call
+    :return: None
+    """
+    last_error = '\n'.join(new_error_lines).strip()[-1024:].decode("ascii", "ignore")
+    if not last_error:
+        return
+    hutil.log("Error in MDSD:" + last_error)
+    do_status_report(g_ext_op_type, "success", '1',
+                           "message in mdsd.err:" + str(datetime.datetime.now()) + ":" + last_error)
 
 
 def stop_mdsd():
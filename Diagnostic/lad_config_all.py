@@ -17,11 +17,12 @@
 #  OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
 #  OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import hashlib
+import json
 import os
 import traceback
 import xml.etree.ElementTree as ET
 
-import Providers.Builtin as BuiltIn
 import Utils.ProviderUtil as ProvUtil
 import Utils.LadDiagnosticUtil as LadUtil
 import Utils.XmlUtil as XmlUtil
@@ -47,7 +48,13 @@ class LadConfigAll:
        The content should be appended to the corresponding file, not overwritten. After that, the file should be
        processed so that the '%SYSLOG_PORT%' pattern is replaced with the assigned TCP port number.
     - /etc/syslog-ng.conf: syslog-ng config for LAD's syslog settings. The content should be appended, not overwritten.
+
+    The inputs of each component's config are hashed, and the hashes of the configs that were last applied are kept
+    in lad_config_hashes.json in the extension directory, so that unchanged configs aren't rewritten and only the
+    daemons whose configs changed are restarted (see has_config_changed() and commit_config_hashes()).
     """
+    # Components whose config changes are tracked by hash
+    config_components = ('mdsd', 'syslog', 'fluentd', 'telegraf', 'me')
     _default_perf_cfgs = [
         {"query": "SELECT PercentAvailableMemory, AvailableMemory, UsedMemory, PercentUsedSwap "
                   "FROM SCX_MemoryStatisticalInformation",
@@ -95,7 +102,12 @@ class LadConfigAll:
         self._telegraf_config = None
         self._telegraf_namespaces = None
 
-        self._mdsd_config_xml_tree = ET.ElementTree(ET.fromstring(mxt.entire_xml_cfg_tmpl))
+        # Hashes of the config inputs generated now, and of the ones last applied (from lad_config_hashes.json)
+        self._config_hashes_path = os.path.join(ext_dir, 'lad_config_hashes.json')
+        self._config_hashes = {}
+        self._applied_config_hashes = self._load_config_hashes()
+
+        self._mdsd_config_xml_tree = XmlUtil.IndexedXmlTree(ET.fromstring(mxt.entire_xml_cfg_tmpl))
         self._sink_configs = LadUtil.SinkConfiguration()
         self._sink_configs.insert_from_config(self._ext_settings.read_protected_config('sinksConfig'))
         # If we decide to also read sinksConfig from ladCfg, do it first, so that private settings override
@@ -123,6 +135,53 @@ class LadConfigAll:
     def _ladCfg(self):
         return self._ext_settings.read_public_config('ladCfg')
 
+    @staticmethod
+    def _hash_config_inputs(*inputs):
+        """
+        Hash JSON-serializable config inputs. Dictionaries are serialized with sorted keys, so that the hash is stable.
+        :rtype: str
+        :return: SHA-256 hex digest of the inputs
+        """
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True)).hexdigest()
+
+    def _load_config_hashes(self):
+        """
+        Load the hashes of the configs that were last applied.
+        :rtype: dict
+        :return: Component name -> hash dictionary. Empty if no config was applied yet (or the file is unreadable).
+        """
+        try:
+            with open(self._config_hashes_path) as f:
+                hashes = json.load(f)
+            return hashes if isinstance(hashes, dict) else {}
+        except (IOError, ValueError):
+            return {}
+
+    def has_config_changed(self, component):
+        """
+        Determine if the config of a component generated by generate_all_configs() differs from the one last applied,
+        i.e., whether the component needs to be reconfigured and restarted.
+        :param str component: One of LadConfigAll.config_components
+        :rtype: bool
+        :return: True if the config changed or was never applied.
+        """
+        return self._config_hashes.get(component) != self._applied_config_hashes.get(component)
+
+    def commit_config_hashes(self):
+        """
+        Record the configs generated by generate_all_configs() as applied. Should be called once the components
+        were (re)configured with them, so that a failure in between is retried on the next enable.
+        :return: None
+        """
+        if not self._config_hashes or self._config_hashes == self._applied_config_hashes:
+            return
+        tmp_path = self._config_hashes_path + '.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self._config_hashes, f, sort_keys=True)
+        os.rename(tmp_path, self._config_hashes_path)
+        self._applied_config_hashes = dict(self._config_hashes)
+
     @staticmethod
     def _wad_table_name(interval):
         """
@@ -161,10 +220,11 @@ class LadConfigAll:
         :param str store_type: The storage type of the destination table, e.g. Local, Central, JsonBlob
         :param bool add_lad_query: True if a <LadQuery> subelement should be added to this <DerivedEvent> element
         """
-        derived_event = mxt.derived_event.format(interval=interval, source=source, target=event_name, type=store_type)
-        element = ET.fromstring(derived_event)
+        element = ET.Element('DerivedEvent', {'duration': interval, 'eventName': event_name, 'isFullName': 'true',
+                                              'source': source, 'storeType': store_type})
         if add_lad_query:
-            XmlUtil.addElement(element, ".", ET.fromstring(mxt.lad_query))
+            ET.SubElement(element, 'LADQuery', {'columnName': 'CounterName', 'columnValue': 'Average',
+                                                'partitionKey': ''})
         self._add_element_from_element('Events/DerivedEvents', element)
 
     def _add_obo_field(self, name, value):
@@ -173,7 +233,8 @@ class LadConfigAll:
         :param name: Name of the field
         :param value: Value for the field
         """
-        self._add_element_from_string('Management', mxt.obo_field.format(name=name, value=value))
+        self._add_element_from_element('Management', ET.Element('OboDirectPartitionField',
+                                                                {'name': name, 'value': value}))
 
     def _update_metric_collection_settings(self, ladCfg, namespaces):
         """
@@ -327,9 +388,14 @@ class LadConfigAll:
         The rsyslog/syslog-ng and fluentd configs are not yet saved to files. They are available through
         the corresponding getter methods of this class (get_fluentd_*_config(), get_*syslog*_config()).
 
+        xmlCfg.xml and the telegraf/MetricsExtension configs are rewritten only if their inputs changed since
+        they were last applied (see has_config_changed()).
+
         Returns (True, '') if config was valid and proper xmlCfg.xml was generated.
         Returns (False, '...') if config was invalid and the error message.
         """
+        settings_hash = LadConfigAll._hash_config_inputs(self._ext_settings.get_handler_settings(),
+                                                         self._deployment_id)
 
         # 1. Add DeploymentId (if available) to identity columns
         if self._deployment_id:
@@ -356,8 +422,26 @@ class LadConfigAll:
             self._fluentd_out_mdsd_config = lad_logging_config_helper.get_fluentd_out_mdsd_config()
             self._rsyslog_config = lad_logging_config_helper.get_rsyslog_config()
             self._syslog_ng_config = lad_logging_config_helper.get_syslog_ng_config()
+            self._config_hashes['syslog'] = LadConfigAll._hash_config_inputs(self._fluentd_syslog_src_config,
+                                                                             self._rsyslog_config,
+                                                                             self._syslog_ng_config)
+            self._config_hashes['fluentd'] = LadConfigAll._hash_config_inputs(self._fluentd_tail_src_config,
+                                                                              self._fluentd_out_mdsd_config)
             parsed_perf_settings = lad_logging_config_helper.parse_lad_perf_settings(lad_cfg)
-            self._telegraf_config, self._telegraf_namespaces = telhandler.handle_config(parsed_perf_settings, self._telegraf_me_url, self._telegraf_mdsd_url, True)
+            self._config_hashes['telegraf'] = LadConfigAll._hash_config_inputs(parsed_perf_settings,
+                                                                               self._telegraf_me_url,
+                                                                               self._telegraf_mdsd_url)
+            applied_namespaces = self._applied_config_hashes.get('telegraf_namespaces')
+            if not self.has_config_changed('telegraf') and applied_namespaces is not None:
+                # The telegraf configs on disk were generated from the same inputs. Leave them untouched.
+                self._telegraf_config, self._telegraf_namespaces = True, applied_namespaces
+            else:
+                self._telegraf_config, self._telegraf_namespaces = telhandler.handle_config(parsed_perf_settings, self._telegraf_me_url, self._telegraf_mdsd_url, True)
+            if self._telegraf_config:
+                self._config_hashes['telegraf_namespaces'] = self._telegraf_namespaces
+            else:
+                # Not applied, so that it's retried on the next enable
+                del self._config_hashes['telegraf']
 
             #Handle the EH, JsonBlob and AzMonSink logic
             self._update_metric_collection_settings(lad_cfg, self._telegraf_namespaces)
@@ -383,7 +467,9 @@ class LadConfigAll:
 
             #Only enable Metrics if AzMonSink is in the config
             if self._enable_metrics_extension:
-                me_handler.setup_me(True)
+                self._config_hashes['me'] = settings_hash
+                if self.has_config_changed('me'):
+                    me_handler.setup_me(True)
 
         except Exception as e:
             self._logger_error("Failed to create omsagent (fluentd), rsyslog/syslog-ng configs, telegraf config or to update "
@@ -418,8 +504,14 @@ class LadConfigAll:
         # 5. Update mdsd config XML's eventVolume attribute based on the logic specified in the helper.
         self._set_event_volume(lad_cfg)
 
-        # 6. Finally generate mdsd config XML file out of the constructed XML tree object.
-        self._mdsd_config_xml_tree.write(os.path.join(self._ext_dir, 'xmlCfg.xml'))
+        # 6. Finally generate mdsd config XML file out of the constructed XML tree object. Secrets are encrypted
+        #    differently on each generation, so the XML is rewritten only if its inputs changed (or it's missing).
+        xml_cfg_path = os.path.join(self._ext_dir, 'xmlCfg.xml')
+        self._config_hashes['mdsd'] = LadConfigAll._hash_config_inputs(settings_hash, self._telegraf_namespaces,
+                                                                       uuid_for_instance_id)
+        if self.has_config_changed('mdsd') or not os.path.exists(xml_cfg_path):
+            self._mdsd_config_xml_tree.write(xml_cfg_path)
+            self._applied_config_hashes.pop('mdsd', None)
 
         return True, ""
 
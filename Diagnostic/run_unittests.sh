@@ -1,6 +1,8 @@
 #!/bin/bash
 
 for test in watchertests test_commonActions test_lad_logging_config test_lad_config_all test_LadDiagnosticUtil \
-                test_builtin test_lad_ext_settings; do
+                test_builtin test_lad_ext_settings test_process_supervisor test_log_watcher \
+                test_memory_leak_detector test_xml_util test_telegraf_config_handler \
+                test_msi_token_cache test_metrics_config_watcher; do
     python -m tests.$test
 done
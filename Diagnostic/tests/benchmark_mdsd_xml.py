@@ -0,0 +1,100 @@
+"""
+Benchmark of the mdsd config XML assembly with a config of thousands of counters: the OMI queries of the Builtin
+provider, plus a derived event per counter group as lad_config_all.py adds them, with the XmlUtil updates that follow.
+Compares building elements directly into the indexed tree (XmlUtil.IndexedXmlTree) against formatting XML strings
+and parsing them back into a plain ElementTree, as it used to be done.
+
+Run from the Diagnostic directory: python -m tests.benchmark_mdsd_xml [number of counters]
+"""
+import sys
+import timeit
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import quoteattr
+
+import Providers.Builtin as BProvider
+import Utils.XmlUtil as XmlUtil
+import Utils.mdsd_xml_templates as mxt
+
+# The templates lad_config_all.py used to format the derived events from
+derived_event_tmpl = """
+<DerivedEvent duration="{interval}" eventName="{target}" isFullName="true" source="{source}" storeType="{type}"/>
+"""
+lad_query_tmpl = '<LADQuery columnName="CounterName" columnValue="Average" partitionKey="" />'
+
+
+def add_counters(count):
+    classes = sorted(BProvider._builtIns.keys())
+    for i in range(count):
+        class_name = classes[i % len(classes)]
+        counters = sorted(BProvider._builtIns[class_name].keys())
+        BProvider.AddMetric({
+            'type': 'builtin',
+            'class': class_name,
+            'counter': counters[i % len(counters)],
+            'counterSpecifier': '/builtin/{0}/counter{1}'.format(class_name, i),
+            'condition': 'Name="instance{0}"'.format(i // 4),
+            'sampleRate': 'PT{0}S'.format(15 * (1 + i % 4)),
+        })
+
+
+def string_update_xml(doc):
+    for group in BProvider._metrics:
+        (class_name, condition_clause, sample_rate) = group
+        columns = [metric.counter_name() for metric in BProvider._metrics[group]]
+        mappings = ['<MapName name="{0}">{1}</MapName>'.format(metric.counter_name(), metric.label())
+                    for metric in BProvider._metrics[group]]
+        query = '''
+<OMIQuery cqlQuery={qry} eventName={evname} omiNamespace="root/scx" sampleRateInSeconds="{rate}" storeType="local">
+  <Unpivot columnName="CounterName" columnValue="Value" columns={columns}>
+    {mappings}
+  </Unpivot>
+</OMIQuery>'''.format(qry=quoteattr("SELECT {0} FROM {1} WHERE {2}".format(','.join(columns),
+                                                                          BProvider._omiClassName[class_name],
+                                                                          condition_clause)),
+                      evname=quoteattr(BProvider._eventNames[group]), columns=quoteattr(','.join(columns)),
+                      rate=sample_rate, mappings='\n    '.join(mappings))
+        XmlUtil.addElement(doc, 'Events/OMI', ET.fromstring(query))
+
+
+def string_derived_event(event_name, i):
+    element = ET.fromstring(derived_event_tmpl.format(interval='PT1M', source=event_name,
+                                                      target='WADMetrics{0}'.format(i), type='Central'))
+    XmlUtil.addElement(element, '.', ET.fromstring(lad_query_tmpl))
+    return element
+
+
+def direct_derived_event(event_name, i):
+    element = ET.Element('DerivedEvent', {'duration': 'PT1M', 'eventName': 'WADMetrics{0}'.format(i),
+                                          'isFullName': 'true', 'source': event_name, 'storeType': 'Central'})
+    ET.SubElement(element, 'LADQuery', {'columnName': 'CounterName', 'columnValue': 'Average', 'partitionKey': ''})
+    return element
+
+
+def build(tree, update_xml, derived_event):
+    XmlUtil.addElement(tree, 'Events', ET.Element('OMI'))  # No longer in the template
+    update_xml(tree)
+    for i, event_name in enumerate(sorted(BProvider._eventNames.values())):
+        XmlUtil.addElement(tree, 'Events/DerivedEvents', derived_event(event_name, i), addOnlyOnce=True)
+    XmlUtil.setXmlValue(tree, 'Events/DerivedEvents/DerivedEvent/LADQuery', 'partitionKey', 'resourceId')
+    XmlUtil.removeElement(tree, 'Accounts', 'Account')
+    return ET.tostring(tree.getroot())
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    add_counters(count)
+    print('{0} counters in {1} OMI queries'.format(count, len(BProvider._eventNames)))
+    variants = (('strings, ElementTree', ET.ElementTree, string_update_xml, string_derived_event),
+                ('elements, IndexedXmlTree', XmlUtil.IndexedXmlTree, BProvider.UpdateXML, direct_derived_event))
+    sizes = []
+    for name, tree_class, update_xml, derived_event in variants:
+        def run():
+            xml = build(tree_class(ET.fromstring(mxt.entire_xml_cfg_tmpl)), update_xml, derived_event)
+            sizes.append(len(ET.fromstring(xml).findall('.//MapName')))
+        timer = timeit.Timer(run)
+        print('{0:>25}: {1:.3f}s'.format(name, min(timer.repeat(repeat=3, number=1))))
+    assert len(set(sizes)) == 1 and sizes[0] == count
+
+
+if __name__ == '__main__':
+    main()
@@ -167,6 +167,91 @@ class TestMakeXML(unittest.TestCase):
         # xml_string = ET.tostring(doc.getroot())
         # print xml_string
 
+    def test_query_elements(self):
+        spec = {
+            "type": "builtin",
+            "class": "Memory",
+            "counter": "AvailableMemory",
+            "counterSpecifier": "/builtin/Memory/Available<Memory>",
+            "condition": 'Name="a&b"',
+            "sampleRate": "PT45S",
+        }
+        event_name = BProvider.AddMetric(spec)
+
+        doc = ET.ElementTree(ET.fromstring(self.base_xml))
+        ET.SubElement(doc.find('Events'), 'OMI')  # No longer in the template
+        BProvider.UpdateXML(doc)
+        # Round trip through the serialized document, which must be well-formed
+        doc = ET.ElementTree(ET.fromstring(ET.tostring(doc.getroot())))
+        query = doc.find('Events/OMI/OMIQuery[@eventName="{0}"]'.format(event_name))
+        self.assertIsNotNone(query)
+        self.assertEqual(query.get('cqlQuery'),
+                         'SELECT AvailableMemory FROM SCX_MemoryStatisticalInformation WHERE Name="a&b"')
+        self.assertEqual(query.get('sampleRateInSeconds'), '45')
+        mapping = query.find('Unpivot/MapName')
+        self.assertEqual(mapping.get('name'), 'AvailableMemory')
+        self.assertEqual(mapping.get('scaleUp'), '1048576')
+        self.assertEqual(mapping.text, '/builtin/Memory/Available<Memory>')
+
+
+class TestQueryGroups(unittest.TestCase):
+    def setUp(self):
+        BProvider._metrics.clear()
+        BProvider._eventNames.clear()
+
+    @staticmethod
+    def _spec(counter, rate, condition=None, class_name='Processor'):
+        spec = {
+            "type": "builtin",
+            "class": class_name,
+            "counter": counter,
+            "counterSpecifier": "/builtin/{0}/{1}".format(class_name, counter),
+            "sampleRate": rate,
+        }
+        if condition is not None:
+            spec["condition"] = condition
+        return spec
+
+    def _update_xml(self):
+        doc = ET.ElementTree(ET.fromstring(entire_xml_cfg_tmpl))
+        ET.SubElement(doc.find('Events'), 'OMI')  # No longer in the template
+        BProvider.UpdateXML(doc)
+        return doc
+
+    def test_normalized_condition(self):
+        self.assertEqual(BProvider.normalized_condition('processor', None), 'IsAggregate=TRUE')
+        self.assertEqual(BProvider.normalized_condition('memory', ''), '')
+        self.assertEqual(BProvider.normalized_condition('disk', ' Name = "sd a"  AND  IsAggregate=FALSE '),
+                         'Name="sd a" AND IsAggregate=FALSE')
+
+    def test_equivalent_conditions_share_a_query(self):
+        first = BProvider.AddMetric(self._spec("PercentIdleTime", "PT15S"))
+        second = BProvider.AddMetric(self._spec("PercentUserTime", "PT15S", condition="IsAggregate = TRUE"))
+        self.assertEqual(first, second)
+        self.assertEqual(len(self._update_xml().findall('Events/OMI/OMIQuery')), 1)
+
+    def test_each_rate_has_its_own_query(self):
+        names = [BProvider.AddMetric(self._spec(counter, rate))
+                 for rate in ("PT15S", "PT1M", "PT45S")
+                 for counter in ("PercentIdleTime", "PercentUserTime")]
+        doc = self._update_xml()
+
+        queries = dict((query.get('eventName'), query) for query in doc.findall('Events/OMI/OMIQuery'))
+        self.assertEqual(sorted(queries.keys()), sorted(set(names)))
+        self.assertEqual(queries[names[0]].get('sampleRateInSeconds'), '15')
+        self.assertEqual(queries[names[2]].get('sampleRateInSeconds'), '60')
+        self.assertEqual(queries[names[4]].get('sampleRateInSeconds'), '45')
+        self.assertEqual(doc.findall('Events/DerivedEvents/DerivedEvent'), [])
+
+    def test_groups_are_not_merged(self):
+        BProvider.AddMetric(self._spec("PercentIdleTime", "PT15S"))
+        BProvider.AddMetric(self._spec("PercentIdleTime", "PT20S"))
+        BProvider.AddMetric(self._spec("PercentIdleTime", "PT30S", condition='Name="0"'))
+        BProvider.AddMetric(self._spec("PercentUserTime", "PT60S"))  # Other counters
+        doc = self._update_xml()
+        self.assertEqual(len(doc.findall('Events/OMI/OMIQuery')), 4)
+        self.assertEqual(doc.findall('Events/DerivedEvents/DerivedEvent'), [])
+
 
 class Lad2_3CompatiblePortalPublicSettingsGenerator(unittest.TestCase):
 
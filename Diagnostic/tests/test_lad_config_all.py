@@ -29,6 +29,7 @@ from Utils.lad_ext_settings import *
 # Also, if you're trying to execute this test on a Windows system rather than under Linux, the waagent code relies on
 # three Linux-only modules you'll need to mock out: crypt(crypt()), pwd(getpwnam()), and fcntl(ioctl()).
 from lad_config_all import *
+import telegraf_utils.telegraf_config_handler as telhandler
 
 # Mocked waagent/LAD dir/files
 test_waagent_dir = os.path.join(os.path.dirname(__file__), 'var_lib_waagent')
@@ -74,16 +75,19 @@ def mock_log_error(msg):
     print 'ERROR:', msg
 
 
-def load_test_config(filename):
+def load_test_config(filename, update_settings=None):
     """
     Load a test configuration into a LadConfigAll object
     :param filename: Name of config file
+    :param update_settings: Function modifying the loaded handler settings, if any
     :rtype: LadConfigAll
     :return: Loaded configuration
     """
     with open(filename) as f:
         handler_settings = json.loads(f.read())['runtimeSettings'][0]['handlerSettings']
     decrypt_protected_settings(handler_settings)
+    if update_settings:
+        update_settings(handler_settings)
     lad_settings = LadExtSettings(handler_settings)
 
     return LadConfigAll(lad_settings, test_lad_dir, '', 'test_lad_deployment_id', mock_fetch_uuid,
@@ -296,5 +300,51 @@ class LadConfigAllTest(unittest.TestCase, XmlTestMixin):
         configurator._update_metric_collection_settings(test_config)
         print ET.tostring(configurator._mdsd_config_xml_tree.getroot())
 
+    def test_unchanged_configs_are_not_regenerated(self):
+        """
+        Regenerating configs from the same settings after they were applied shouldn't rewrite xmlCfg.xml, the telegraf
+        configs or report any component as changed, while different settings should.
+        """
+        config_hashes_path = os.path.join(test_lad_dir, 'lad_config_hashes.json')
+        xml_cfg_path = os.path.join(test_lad_dir, 'xmlCfg.xml')
+        self.addCleanup(lambda: os.path.exists(config_hashes_path) and os.remove(config_hashes_path))
+
+        # handle_config writes the telegraf configs (and queries IMDS for their dimensions): record its calls instead
+        handle_config_calls = []
+
+        def mock_handle_config(*args):
+            handle_config_calls.append(args)
+            return True, ['ladtest_namespace']
+
+        original_handle_config = telhandler.handle_config
+        telhandler.handle_config = mock_handle_config
+        self.addCleanup(setattr, telhandler, 'handle_config', original_handle_config)
+
+        configurator = load_test_config(test_lad_settings_metric_json_file)
+        result, msg = configurator.generate_all_configs()
+        self.assertTrue(result, 'Config generation failed: ' + msg)
+        self.assertEqual(len(handle_config_calls), 1)
+        for component in ('mdsd', 'syslog', 'fluentd', 'telegraf'):
+            self.assertTrue(configurator.has_config_changed(component), component)
+        configurator.commit_config_hashes()
+        os.utime(xml_cfg_path, (0, 0))
+
+        configurator = load_test_config(test_lad_settings_metric_json_file)
+        result, msg = configurator.generate_all_configs()
+        self.assertTrue(result, 'Config generation failed: ' + msg)
+        for component in LadConfigAll.config_components:
+            self.assertFalse(configurator.has_config_changed(component), component)
+        self.assertEqual(os.path.getmtime(xml_cfg_path), 0)
+        self.assertEqual(len(handle_config_calls), 1)
+
+        def update_sample_rate(handler_settings):
+            handler_settings['publicSettings']['sampleRateInSeconds'] += 15
+
+        configurator = load_test_config(test_lad_settings_metric_json_file, update_sample_rate)
+        result, msg = configurator.generate_all_configs()
+        self.assertTrue(result, 'Config generation failed: ' + msg)
+        self.assertTrue(configurator.has_config_changed('mdsd'))
+        self.assertNotEqual(os.path.getmtime(xml_cfg_path), 0)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,84 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from Utils.log_watcher import IncrementalLogReader
+
+
+class IncrementalLogReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.log_dir, 'mdsd.err')
+        self._append('old error\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.log_dir)
+
+    def _append(self, data, path=None):
+        with open(path or self.path, 'a') as f:
+            f.write(data)
+
+    def test_only_new_lines_are_read(self):
+        reader = IncrementalLogReader(self.path)
+        self.assertEqual(reader.read_new_lines(), [])
+
+        self._append('error 1\nerror 2\n')
+        self.assertEqual(reader.read_new_lines(), ['error 1', 'error 2'])
+        self.assertEqual(reader.read_new_lines(), [])
+
+    def test_partial_line_is_held_back(self):
+        reader = IncrementalLogReader(self.path)
+        self._append('error 1\nerr')
+        self.assertEqual(reader.read_new_lines(), ['error 1'])
+        self._append('or 2\n')
+        self.assertEqual(reader.read_new_lines(), ['error 2'])
+
+    def test_truncation(self):
+        reader = IncrementalLogReader(self.path)
+        open(self.path, 'w').close()
+        self._append('new\n')
+        self.assertEqual(reader.read_new_lines(), ['new'])
+
+    def test_rotation_drains_old_file(self):
+        reader = IncrementalLogReader(self.path)
+        self._append('before rotation\n')
+        os.rename(self.path, self.path + '.1')
+        self._append('after rotation\n')
+        self.assertEqual(reader.read_new_lines(), ['before rotation', 'after rotation'])
+
+        self._append('more\n')
+        self.assertEqual(reader.read_new_lines(), ['more'])
+
+    def test_rotation_with_partial_last_line(self):
+        reader = IncrementalLogReader(self.path, max_read_size=10)
+        self._append('error 1\nerr')
+        self.assertEqual(reader.read_new_lines(), ['error 1'])
+        self._append('or 2\n0123456789abcdef\nunterminated')
+        os.rename(self.path, self.path + '.1')
+        self._append('after rotation\n')
+
+        # The old file is drained past max_read_size, and its partial last line isn't lost
+        self.assertEqual(reader.read_new_lines(), ['error 2', '0123456789abcdef', 'unterminated'])
+        self.assertEqual(reader.read_new_lines(), ['after rotation'])
+        self.assertEqual(reader.read_new_lines(), [])
+
+    def test_file_created_later(self):
+        os.remove(self.path)
+        reader = IncrementalLogReader(self.path)
+        self.assertEqual(reader.read_new_lines(), [])
+
+        self._append('first\n')
+        self.assertEqual(reader.read_new_lines(), ['first'])
+
+    def test_large_burst_is_read_in_pieces(self):
+        reader = IncrementalLogReader(self.path, max_read_size=10)
+        self._append('0123456789abcdef\n')
+        self.assertEqual(reader.read_new_lines(), [])
+        self.assertEqual(reader.read_new_lines(), ['0123456789abcdef'])
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+# misc_helpers.py imports waagent. See the comments in test_lad_config_all.py for how to run this on a non-Azure VM.
+from Utils.misc_helpers import MemoryLeakDetector, read_process_memory_usage_in_KB
+
+MB = 1024  # in KB
+TOTAL_MEMORY = 8192 * MB
+
+
+class MemoryLeakDetectorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.proc_root = tempfile.mkdtemp()
+        self.errors = []
+        with open(os.path.join(self.proc_root, 'meminfo'), 'w') as f:
+            f.write('MemTotal:        {0} kB\nMemFree:          100000 kB\n'.format(TOTAL_MEMORY))
+        self._set_usage(100, 100 * MB)
+
+    def tearDown(self):
+        shutil.rmtree(self.proc_root)
+
+    def _set_usage(self, pid, usage_in_KB, pss=True):
+        pid_dir = os.path.join(self.proc_root, str(pid))
+        if not os.path.isdir(pid_dir):
+            os.mkdir(pid_dir)
+        with open(os.path.join(pid_dir, 'status'), 'w') as f:
+            f.write('Name:\tmdsd\nVmRSS:\t{0} kB\n'.format(usage_in_KB + 50 * MB))
+        smaps_rollup = os.path.join(pid_dir, 'smaps_rollup')
+        if pss:
+            with open(smaps_rollup, 'w') as f:
+                f.write('Rss:               {0} kB\nPss:               {1} kB\n'.format(usage_in_KB + 50 * MB,
+                                                                                     usage_in_KB))
+        elif os.path.exists(smaps_rollup):
+            os.remove(smaps_rollup)
+
+    def _detector(self, policy=None):
+        return MemoryLeakDetector(self.errors.append, policy, proc_root=self.proc_root)
+
+    def _run(self, detector, usages, interval=30, pid=100):
+        result = None
+        for i, usage in enumerate(usages):
+            self._set_usage(pid, usage)
+            result = detector.check(pid, now=i * interval)
+        return result
+
+    def test_pss_preferred_over_rss(self):
+        self.assertEqual(read_process_memory_usage_in_KB(100, self.proc_root), (100 * MB, 'Pss'))
+        self._set_usage(100, 100 * MB, pss=False)
+        self.assertEqual(read_process_memory_usage_in_KB(100, self.proc_root), (150 * MB, 'VmRSS'))
+
+    def test_threshold_relative_to_total_memory(self):
+        suspected, usage, evidence = self._run(self._detector(), [2500 * MB])
+        self.assertTrue(suspected)
+        self.assertEqual(usage, 2500 * MB)
+        self.assertIn('exceeds 30', evidence)
+
+        # The same usage is fine on a VM with more memory, or with a higher limit
+        suspected, _, evidence = self._run(self._detector({'maxMemoryPercent': 50}), [2500 * MB])
+        self.assertFalse(suspected)
+        self.assertEqual(evidence, '')
+
+    def test_sustained_growth(self):
+        # 1GB to 1.5GB in an hour: ~6% of 8GB per hour
+        usages = [1024 * MB + i * 512 * MB // 120 for i in range(121)]
+        suspected, usage, evidence = self._run(self._detector(), usages)
+        self.assertTrue(suspected)
+        self.assertIn('Pss', evidence)
+        self.assertIn('121 samples', evidence)
+        self.assertIn('MB/hour', evidence)
+
+    def test_growth_needs_full_window(self):
+        usages = [1024 * MB + i * 512 * MB // 120 for i in range(100)]
+        self.assertFalse(self._run(self._detector(), usages)[0])
+
+    def test_growth_window_longer_than_two_hours(self):
+        # 1GB to 2GB in 3 hours (~4% of 8GB per hour), with a 3 hour window checked every 30 seconds
+        usages = [1024 * MB + i * 1024 * MB // 360 for i in range(361)]
+        policy = {'growthWindowInMinutes': 180, 'maxGrowthPercentPerHour': 3}
+        suspected, _, evidence = self._run(self._detector(policy), usages)
+        self.assertTrue(suspected)
+        self.assertIn('over the last 180 minutes (361 samples)', evidence)
+
+    def test_growth_fitted_over_window_only(self):
+        # Flat for an hour, then a leak in the last hour: the flat hour must not dilute the growth
+        usages = [1024 * MB] * 120 + [1024 * MB + i * 512 * MB // 120 for i in range(121)]
+        suspected, _, evidence = self._run(self._detector(), usages)
+        self.assertTrue(suspected)
+        self.assertIn('over the last 60 minutes (121 samples)', evidence)
+
+        # A leak that stopped an hour ago is no longer reported
+        usages = [1024 * MB + i * 512 * MB // 120 for i in range(121)] + [1536 * MB] * 120
+        self.assertFalse(self._run(self._detector(), usages)[0])
+
+    def test_noisy_usage_is_not_a_leak(self):
+        # Big swings up and down (e.g., bursts of events being uploaded) with no steady trend
+        usages = [1024 * MB + (i % 2) * 600 * MB for i in range(121)]
+        self.assertFalse(self._run(self._detector(), usages)[0])
+
+    def test_samples_reset_on_restart(self):
+        detector = self._detector()
+        usages = [1024 * MB + i * 512 * MB // 120 for i in range(100)]
+        self._run(detector, usages, pid=100)
+        self._set_usage(101, 1600 * MB)
+        self.assertFalse(self._run(detector, [1600 * MB] * 30, pid=101)[0])
+
+    def test_disabled_policy_and_invalid_settings(self):
+        detector = self._detector({'enabled': False, 'maxGrowthPercentPerHour': 'fast', 'unknown': 1})
+        self.assertFalse(self._run(detector, [4000 * MB])[0])
+        self.assertEqual(len(self.errors), 2)
+
+    def test_boolean_settings_parsed_from_strings(self):
+        self.assertFalse(self._run(self._detector({'enabled': 'false'}), [4000 * MB])[0])
+        self.assertTrue(self._run(self._detector({'enabled': 'True'}), [4000 * MB])[0])
+        self.assertEqual(self.errors, [])
+
+        # Not a boolean: keep the default (enabled) and log
+        self.assertTrue(self._run(self._detector({'enabled': 'no way'}), [4000 * MB])[0])
+        self.assertEqual(len(self.errors), 1)
+
+    def test_missing_process(self):
+        self.assertEqual(self._detector().check(999), (False, 0, ''))
+        self.assertEqual(len(self.errors), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
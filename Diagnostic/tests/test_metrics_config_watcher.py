@@ -0,0 +1,91 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+# metrics_ext_utils is shared with AMA (azure-linux-extensions/LAD-AMA-Common) and copied into the LAD package when
+# it's built. To run this test from the source tree, include "azure-linux-extensions/LAD-AMA-Common" in PYTHONPATH.
+from metrics_ext_utils.metrics_config_watcher import MetricsConfigWatcher
+
+
+class MetricsConfigWatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.config_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.config_dir, 'metricCounters.json')
+        with open(self.path, 'w') as f:
+            f.write('{}')
+        self.watcher = MetricsConfigWatcher(self.path, debounce=0.3, max_debounce=2, poll_interval=0.2)
+
+    def tearDown(self):
+        self.watcher.close()
+        shutil.rmtree(self.config_dir)
+
+    def _write_later(self, path, chunks, delay=0.1, interval=0.1):
+        def write():
+            time.sleep(delay)
+            with open(path, 'w') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    f.flush()
+                    time.sleep(interval)
+        thread = threading.Thread(target=write)
+        thread.start()
+        return thread
+
+    def test_burst_of_writes_is_one_change(self):
+        if not self.watcher.uses_inotify():
+            self.skipTest('inotify is not available')
+
+        thread = self._write_later(self.path, ['{"a":', ' 1', '}'])
+        start = time.time()
+        self.assertTrue(self.watcher.wait(10))
+        thread.join()
+
+        # Reported after the last write settled, well before the timeout
+        self.assertLess(time.time() - start, 3)
+        with open(self.path) as f:
+            self.assertEqual(f.read(), '{"a": 1}')
+        self.assertFalse(self.watcher.wait(0.5))
+
+    def test_other_files_do_not_wake_up(self):
+        if not self.watcher.uses_inotify():
+            self.skipTest('inotify is not available')
+
+        thread = self._write_later(os.path.join(self.config_dir, 'other.json'), ['{}'])
+        start = time.time()
+        self.assertFalse(self.watcher.wait(0.5))
+        thread.join()
+        self.assertGreaterEqual(time.time() - start, 0.5)
+
+    def test_replaced_file(self):
+        if not self.watcher.uses_inotify():
+            self.skipTest('inotify is not available')
+
+        tmp_path = os.path.join(self.config_dir, '.metricCounters.json.tmp')
+        with open(tmp_path, 'w') as f:
+            f.write('{"b": 2}')
+        self.assertFalse(self.watcher.wait(0.5))
+        os.rename(tmp_path, self.path)
+        self.assertTrue(self.watcher.wait(1))
+
+    def test_polling_when_directory_is_missing(self):
+        missing_dir = os.path.join(self.config_dir, 'config-cache')
+        watcher = MetricsConfigWatcher(os.path.join(missing_dir, 'metricCounters.json'), debounce=0.1,
+                                       poll_interval=0.1)
+        try:
+            self.assertFalse(watcher.uses_inotify())
+            self.assertFalse(watcher.wait(0.1))
+
+            # Switches to inotify once the directory exists
+            os.mkdir(missing_dir)
+            self.assertFalse(watcher.wait(0.1))
+            self.assertTrue(watcher.uses_inotify())
+        finally:
+            watcher.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
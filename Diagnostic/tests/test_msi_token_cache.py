@@ -0,0 +1,162 @@
+import BaseHTTPServer
+import json
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import unittest
+import urlparse
+
+# metrics_ext_utils is shared with AMA (azure-linux-extensions/LAD-AMA-Common) and copied into the LAD package when
+# it's built. To run this test from the source tree, include "azure-linux-extensions/LAD-AMA-Common" in PYTHONPATH.
+from metrics_ext_utils.msi_token_cache import MsiTokenCache
+
+RESOURCE = "https://ingestion.monitor.azure.com/"
+HOUR = 3600
+
+
+class FakeImds(BaseHTTPServer.HTTPServer):
+    """
+    Local stand-in for the IMDS token endpoint. Serves the queued responses (dicts, or HTTP status codes) in order,
+    repeating the last one.
+    """
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            server = self.server
+            query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+            server.requests.append((query, self.headers.get('Metadata')))
+            response = server.responses[0] if len(server.responses) == 1 else server.responses.pop(0)
+            if isinstance(response, int):
+                self.send_response(response)
+                self.end_headers()
+                return
+            body = json.dumps(response)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), FakeImds.Handler)
+        self.requests = []
+        self.responses = [500]
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def endpoint(self):
+        return "http://127.0.0.1:{0}/metadata/identity/oauth2/token".format(self.server_address[1])
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def make_token(name, expires_on):
+    return {"access_token": name, "expires_on": str(int(expires_on)), "resource": RESOURCE}
+
+
+class MsiTokenCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.tmp_dir, 'msi', 'token.json')
+        self.imds = FakeImds()
+        self.now = 1000000.0
+        self.sleeps = []
+
+    def tearDown(self):
+        self.imds.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def _cache(self):
+        # Each instance stands for another process sharing the cache file
+        return MsiTokenCache(self.cache_path, RESOURCE, endpoint=self.imds.endpoint(), timeout=5,
+                             clock=lambda: self.now, sleep=self.sleeps.append)
+
+    def test_token_is_fetched_once_and_shared(self):
+        self.imds.responses = [make_token('t1', self.now + 24 * HOUR)]
+        token, _ = self._cache().get_token()
+        self.assertEqual(token['access_token'], 't1')
+
+        # Another process gets it from the cache, without querying IMDS
+        token, _ = self._cache().get_token()
+        self.assertEqual(token['access_token'], 't1')
+        self.assertEqual(len(self.imds.requests), 1)
+
+        query, metadata_header = self.imds.requests[0]
+        self.assertEqual(query['resource'], [RESOURCE])
+        self.assertEqual(metadata_header, 'true')
+        self.assertEqual(stat.S_IMODE(os.stat(self.cache_path).st_mode), 0o600)
+        self.assertEqual(stat.S_IMODE(os.stat(os.path.dirname(self.cache_path)).st_mode), 0o700)
+
+    def test_token_is_refreshed_before_expiry(self):
+        self.imds.responses = [make_token('t1', self.now + HOUR), make_token('t2', self.now + 25 * HOUR)]
+        cache = self._cache()
+        cache.get_token()
+
+        self.now += 20 * 60
+        self.assertEqual(cache.get_token()[0]['access_token'], 't1')
+        self.now += 20 * 60  # 20 minutes left
+        self.assertEqual(cache.get_token()[0]['access_token'], 't2')
+        self.assertEqual(len(self.imds.requests), 2)
+
+    def test_failed_refresh_serves_valid_token_and_backs_off(self):
+        self.imds.responses = [make_token('t1', self.now + 20 * 60), 500]
+        cache = self._cache()
+        cache.get_token()
+
+        token, log_messages = cache.get_token()
+        self.assertEqual(token['access_token'], 't1')
+        self.assertIn('Failed to fetch', log_messages)
+        self.assertEqual(len(self.imds.requests), 2)
+        self.assertEqual(self.sleeps, [])  # A single attempt, as a valid token is available
+
+        # No other attempt (from any process) until the backoff elapsed
+        self.now += 10
+        self.assertEqual(self._cache().get_token()[0]['access_token'], 't1')
+        self.assertEqual(len(self.imds.requests), 2)
+        self.now += 60
+        self.imds.responses = [make_token('t2', self.now + 24 * HOUR)]
+        self.assertEqual(self._cache().get_token()[0]['access_token'], 't2')
+        self.assertEqual(len(self.imds.requests), 3)
+
+    def test_same_token_from_imds_backs_off(self):
+        # IMDS keeps returning its cached token until it's about to expire
+        self.imds.responses = [make_token('t1', self.now + 20 * 60)]
+        cache = self._cache()
+        cache.get_token()
+        token, log_messages = cache.get_token()
+        self.assertEqual(token['access_token'], 't1')
+        self.assertIn("isn't newer", log_messages)
+        self.assertEqual(len(self.imds.requests), 2)
+
+        cache.get_token()
+        self.assertEqual(len(self.imds.requests), 2)
+
+    def test_no_token_retries_with_backoff(self):
+        token, log_messages = self._cache().get_token()
+        self.assertIsNone(token)
+        self.assertEqual(len(self.imds.requests), 3)
+        self.assertEqual(len(self.sleeps), 2)
+        self.assertTrue(15 <= self.sleeps[0] <= 30)
+        self.assertTrue(30 <= self.sleeps[1] <= 60)
+        self.assertEqual(log_messages.count('Failed to fetch'), 3)
+
+    def test_untrusted_cache_file_is_ignored(self):
+        self.imds.responses = [make_token('t1', self.now + 24 * HOUR)]
+        self._cache().get_token()
+        os.chmod(self.cache_path, 0o644)
+        self.imds.responses = [make_token('t2', self.now + 24 * HOUR)]
+        self.assertEqual(self._cache().get_token()[0]['access_token'], 't2')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+
+from Utils.process_supervisor import *
+
+
+class ProcessSupervisorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.logs = []
+        self.errors = []
+        self.launched = []
+        self.exits = []
+        self.supervisor = ProcessSupervisor(self.logs.append, self.errors.append, poll_interval=0.05)
+
+    def tearDown(self):
+        self.supervisor.close()
+        for proc in self.launched:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+
+    def _launcher(self, cmd):
+        def launch():
+            proc = subprocess.Popen(cmd)
+            self.launched.append(proc)
+            return proc
+        return launch
+
+    def _on_exit(self, process, uptime):
+        self.exits.append((process.name, process.returncode))
+
+    def test_exited_child_is_restarted_immediately(self):
+        process = SupervisedProcess('dummy', self._launcher(['sleep', '0.2']), on_exit=self._on_exit,
+                                    min_backoff=0.01, stable_uptime=0.1)
+        self.supervisor.add(process)
+        self.supervisor.start()
+        first_pid = process.pid
+
+        self.supervisor.wait(0.5)
+
+        self.assertGreaterEqual(len(self.launched), 2)
+        self.assertNotEqual(process.pid, first_pid)
+        self.assertEqual(self.exits[0], ('dummy', 0))
+        self.assertEqual(process.quick_exits, 0)
+        self.assertFalse(process.given_up)
+
+    def test_gives_up_after_consecutive_quick_exits(self):
+        process = SupervisedProcess('failing', self._launcher(['false']), on_exit=self._on_exit, max_restarts=2,
+                                    min_backoff=0.01, stable_uptime=60)
+        self.supervisor.add(process)
+        self.supervisor.start()
+
+        start = time.time()
+        self.supervisor.wait(10)
+
+        self.assertLess(time.time() - start, 5)  # wait() returns once everything is given up
+        self.assertTrue(process.given_up)
+        self.assertEqual(len(self.launched), 3)
+        self.assertEqual(self.exits, [('failing', 1)] * 3)
+        self.assertEqual(len(self.errors), 1)
+
+    def test_backoff_grows_on_quick_exits(self):
+        process = SupervisedProcess('failing', self._launcher(['false']), min_backoff=0.2, stable_uptime=60)
+        self.supervisor.add(process)
+        self.supervisor.start()
+
+        self.supervisor.wait(0.5)
+
+        # Restarted at about 0.2s, then again 0.4s later, so only 2 starts fit in 0.5s
+        self.assertEqual(len(self.launched), 2)
+        self.assertEqual(process.quick_exits, 2)
+
+    def test_failed_start_is_retried(self):
+        attempts = []
+
+        def failing_start():
+            attempts.append(1)
+            return None
+
+        process = SupervisedProcess('broken', failing_start, max_restarts=3, min_backoff=0.01)
+        self.supervisor.add(process)
+        self.supervisor.start()
+        self.supervisor.wait(1)
+
+        self.assertEqual(len(attempts), 4)
+        self.assertTrue(process.given_up)
+
+    def test_adopted_process_is_watched_through_proc(self):
+        adopted = subprocess.Popen(['sleep', '30'])
+        self.launched.append(adopted)
+        process = SupervisedProcess('adopted', self._launcher(['sleep', '30']), find_pid=lambda: adopted.pid,
+                                    on_exit=self._on_exit, min_backoff=0.01)
+        self.supervisor.add(process)
+        self.supervisor.start()
+
+        self.assertEqual(process.pid, adopted.pid)
+        self.assertIsNone(process.popen)
+        self.assertTrue(process.is_alive())
+        self.assertGreater(process.get_rss_kb(), 0)
+
+        adopted.kill()
+        self.supervisor.wait(0.3)
+
+        self.assertEqual(self.exits, [('adopted', -9)])
+        self.assertEqual(len(self.launched), 2)
+        self.assertEqual(process.pid, self.launched[1].pid)
+
+
+class ProcReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.proc_root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.proc_root)
+
+    def _add_process(self, pid, cmdline, state='S', start_time=1000):
+        pid_dir = os.path.join(self.proc_root, str(pid))
+        os.mkdir(pid_dir)
+        with open(os.path.join(pid_dir, 'cmdline'), 'w') as f:
+            f.write('\0'.join(cmdline) + '\0')
+        with open(os.path.join(pid_dir, 'stat'), 'w') as f:
+            f.write('{0} (a (b) c) {1} 1 {0} {0} 0 -1 4194560 100 0 0 0 5 3 0 0 20 0 8 0 {2} 1000 200\n'.format(
+                pid, state, start_time))
+        with open(os.path.join(pid_dir, 'status'), 'w') as f:
+            f.write('Name:\ttelegraf\nVmRSS:\t   33904 kB\n')
+
+    def test_read_proc_stat(self):
+        self._add_process(42, ['/usr/sbin/telegraf'], state='Z', start_time=123456)
+        self.assertEqual(read_proc_stat(42, self.proc_root), ('Z', 123456))
+        self.assertIsNone(read_proc_stat(43, self.proc_root))
+        self.assertEqual(get_process_rss_kb(42, self.proc_root), 33904)
+
+    def test_find_pid_by_executable_skips_zombies(self):
+        self._add_process(10, ['/usr/sbin/telegraf', '--config', 'a.conf'], state='Z')
+        self._add_process(11, ['grep', '/usr/sbin/telegraf'])
+        self._add_process(12, ['/usr/sbin/telegraf', '--config', 'a.conf'])
+        os.mkdir(os.path.join(self.proc_root, 'self'))
+        self.assertEqual(find_pid_by_executable('/usr/sbin/telegraf', self.proc_root), 12)
+        self.assertIsNone(find_pid_by_executable('/usr/sbin/mdsd', self.proc_root))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+# telegraf_utils is shared with AMA (azure-linux-extensions/LAD-AMA-Common) and copied into the LAD package when it's
+# built. To run this test from the source tree, include "azure-linux-extensions/LAD-AMA-Common" in PYTHONPATH.
+import telegraf_utils.telegraf_config_handler as telhandler
+
+
+class ParseConfigTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data = [
+            {"displayName": "network->packets sent", "interval": "15s"},
+            {"displayName": "network->packets received", "interval": "30s"},
+            {"displayName": "processor->cpu user time", "interval": "60s"},
+            {"displayName": "filesystem->filesystem reads/sec", "interval": "60s"},
+        ]
+
+    def _parse(self, data, me_url="udp://127.0.0.1:13459"):
+        output, namespaces = telhandler.parse_config(data, me_url, "unix:///var/run/mdsd/lad_mdsd_influx.socket",
+                                                     True, "/subscriptions/sub/resourceGroups/rg/vm", "sub", "rg",
+                                                     "eastus", "")
+        return dict((f["filename"], f["data"]) for f in output), namespaces
+
+    def test_output_is_stable(self):
+        files, namespaces = self._parse(self.data)
+        self.assertEqual(self._parse(list(reversed(self.data))), (files, namespaces))
+        self.assertEqual(sorted(files.keys()),
+                         ["filesystem.conf", "intermediate.json", "network.conf", "processor.conf", "telegraf.conf"])
+
+        network = files["network.conf"]
+        self.assertIn('[[inputs.net]]\n  fieldpass = ["packets_recv", "packets_sent"]\n  interval = "15s"\n', network)
+        self.assertIn('[[processors.rename.replace]]\n    field = "packets_sent"\n'
+                      '    dest = "/builtin/network/packetstransmitted"\n', network)
+        self.assertIn('  period = "60s"\n  drop_original = true\n', network)
+        self.assertIn('  "microsoft.resourceId" = "/subscriptions/sub/resourceGroups/rg/vm"\n', files["telegraf.conf"])
+
+    def test_values_are_escaped(self):
+        table = telhandler.TomlTable("global_tags", is_array=False).set("a.b", 'say "hi"\\').set("n", [1, True])
+        self.assertEqual(table.render(), '[global_tags]\n  "a.b" = "say \\"hi\\"\\\\"\n  n = [1, true]')
+
+    def test_plugin_signature(self):
+        files, _ = self._parse(self.data)
+        self.assertEqual(telhandler.get_plugin_signature(files.values()),
+                         ["inputs.cpu", "inputs.diskio", "inputs.net", "outputs.influxdb", "outputs.socket_writer"])
+
+
+class WriteConfigsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.conf_dir = os.path.join(self.dir, "telegraf_configs/")
+        self.d_conf_dir = os.path.join(self.conf_dir, "telegraf.d/")
+        self.data = [{"displayName": "network->packets sent", "interval": "15s"},
+                     {"displayName": "processor->cpu user time", "interval": "15s"}]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _write(self, data, me_url="udp://127.0.0.1:13459"):
+        output, _ = telhandler.parse_config(data, me_url, "unix:///var/run/mdsd/lad_mdsd_influx.socket",
+                                            True, "/subscriptions/sub/vm", "sub", "rg", "eastus", "")
+        return telhandler.write_configs(output, self.conf_dir, self.d_conf_dir)
+
+    def test_changes_are_classified(self):
+        self.assertEqual(self._write(self.data), "restart")  # Nothing deployed yet
+        self.assertTrue(os.path.isfile(self.d_conf_dir + "network.conf"))
+        self.assertIsNone(self._write(self.data))
+
+        # Settings only
+        self.data[0]["interval"] = "30s"
+        self.assertEqual(self._write(self.data), "reload")
+        self.assertEqual(self._write(self.data, me_url="udp://127.0.0.1:13460"), "reload")
+
+        # One less input plugin: its file is removed
+        self.assertEqual(self._write(self.data[:1], me_url="udp://127.0.0.1:13460"), "restart")
+        self.assertFalse(os.path.exists(self.d_conf_dir + "processor.conf"))
+
+    def test_unchanged_files_are_not_rewritten(self):
+        self._write(self.data)
+        network_conf = self.d_conf_dir + "network.conf"
+        inode = os.stat(network_conf).st_ino
+        self.data[1]["interval"] = "30s"
+        self.assertEqual(self._write(self.data), "reload")
+        self.assertEqual(os.stat(network_conf).st_ino, inode)
+
+
+class ReadinessTest(unittest.TestCase):
+
+    def test_exited_process_is_not_ready(self):
+        proc = subprocess.Popen(["false"])
+        self.assertFalse(telhandler._wait_for_telegraf_ready(proc.pid, is_alive=lambda: proc.poll() is None))
+
+    def test_process_with_sockets_is_ready(self):
+        proc = subprocess.Popen(["python", "-c", "import socket, time; s = socket.socket(); time.sleep(5)"])
+        try:
+            self.assertTrue(telhandler._wait_for_telegraf_ready(proc.pid, timeout=3,
+                                                                is_alive=lambda: proc.poll() is None))
+            self.assertTrue(telhandler._get_socket_inodes(proc.pid))
+        finally:
+            proc.kill()
+            proc.wait()
+
+    def test_pid_is_polled_after_start(self):
+        # The pid shows up only on the third check, as when systemctl returns before telegraf is exec'ed
+        pids = [None, None, 1234]
+        get_telegraf_pid = telhandler.get_telegraf_pid
+        telhandler.get_telegraf_pid = lambda is_lad: pids.pop(0) if len(pids) > 1 else pids[0]
+        try:
+            self.assertEqual(telhandler._wait_for_telegraf_pid(True, timeout=3), 1234)
+            pids[:] = [None]
+            self.assertIsNone(telhandler._wait_for_telegraf_pid(True, timeout=0.3))
+        finally:
+            telhandler.get_telegraf_pid = get_telegraf_pid
+
+
+if __name__ == '__main__':
+    unittest.main()
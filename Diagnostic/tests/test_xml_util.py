@@ -0,0 +1,57 @@
+import unittest
+import xml.etree.ElementTree as ET
+
+import Utils.XmlUtil as XmlUtil
+from Utils.mdsd_xml_templates import entire_xml_cfg_tmpl
+
+
+class IndexedXmlTreeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tree = XmlUtil.IndexedXmlTree(ET.fromstring(entire_xml_cfg_tmpl))
+        self.plain_tree = ET.ElementTree(ET.fromstring(entire_xml_cfg_tmpl))
+
+    def _both(self, action):
+        action(self.tree)
+        action(self.plain_tree)
+        self.assertEqual(ET.tostring(self.tree.getroot()), ET.tostring(self.plain_tree.getroot()))
+
+    def test_find_matches_element_tree(self):
+        for path in ['Accounts', 'Accounts/SharedAccessSignature', 'Events/DerivedEvents', './Management',
+                     'Events/*', 'Accounts/SharedAccessSignature[@isDefault="true"]', 'NoSuchElement']:
+            self.assertEqual([ET.tostring(e) for e in self.tree.findall(path)],
+                             [ET.tostring(e) for e in self.plain_tree.findall(path)], path)
+            self.assertEqual(self.tree.find(path) is None, self.plain_tree.find(path) is None, path)
+
+    def test_add_set_and_remove(self):
+        def build(tree):
+            for i in range(5):
+                event = ET.Element('DerivedEvent', {'eventName': 'event{0}'.format(i)})
+                ET.SubElement(event, 'LADQuery', {'partitionKey': ''})
+                XmlUtil.addElement(tree, 'Events/DerivedEvents', event)
+            XmlUtil.setXmlValue(tree, 'Events/DerivedEvents/DerivedEvent/LADQuery', 'partitionKey', 'key')
+            XmlUtil.setXmlValue(tree, 'Accounts/SharedAccessSignature', 'account', 'name', ['isDefault', 'true'])
+            XmlUtil.removeElement(tree, 'Accounts', 'Account')
+        self._both(build)
+
+        self.assertEqual(len(self.tree.findall('Events/DerivedEvents/DerivedEvent/LADQuery')), 5)
+        self.assertEqual(self.tree.findall('Accounts/Account'), [])
+        self.assertEqual(XmlUtil.getXmlValue(self.tree, 'Accounts/SharedAccessSignature', 'account'), 'name')
+
+    def test_remove_and_append_keeping_the_count(self):
+        def edit(tree):
+            for name in ('a', 'b'):
+                XmlUtil.addElement(tree, 'Events/DerivedEvents', ET.Element('DerivedEvent', {'eventName': name}))
+            tree.findall('Events/DerivedEvents/DerivedEvent')  # Index the children
+            XmlUtil.removeElement(tree, 'Events/DerivedEvents', 'DerivedEvent[@eventName="a"]')
+            XmlUtil.addElement(tree, 'Events/DerivedEvents', ET.Element('LADQuery'))
+        self._both(edit)
+
+        self.assertEqual([e.get('eventName') for e in self.tree.findall('Events/DerivedEvents/DerivedEvent')], ['b'])
+        self.assertEqual(len(self.tree.findall('Events/DerivedEvents/LADQuery')), 1)
+
+        XmlUtil.removeElement(self.tree, 'Events/DerivedEvents', 'DerivedEvent')
+        self.assertEqual(self.tree.findall('Events/DerivedEvents/DerivedEvent'), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,6 +4,10 @@ import sys
 import subprocess
 import os
 import errno
+import shutil
+import tempfile
+import threading
+import time
 import watcherutil
 
 
@@ -68,6 +72,154 @@ class FStabUnitTests(unittest.TestCase):
         self.assertEqual(self._watcher.handle_fstab(ignore_time=True), 0)
 
 
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TimerQueueTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.timers = watcherutil.TimerQueue(self.clock)
+        self.calls = []
+
+    def _callback(self, name):
+        return lambda: self.calls.append(name)
+
+    def test_periodic_and_one_shot(self):
+        self.assertIsNone(self.timers.time_until_next())
+        self.timers.schedule('periodic', 0, self._callback('periodic'), interval=60)
+        self.timers.schedule('once', 30, self._callback('once'))
+        self.timers.run_due()
+        self.assertEqual(self.calls, ['periodic'])
+        self.assertEqual(self.timers.time_until_next(), 30)
+
+        self.clock.now += 60
+        self.timers.run_due()
+        self.assertEqual(self.calls, ['periodic', 'once', 'periodic'])
+        self.clock.now += 120
+        self.timers.run_due()
+        self.assertEqual(self.calls, ['periodic', 'once', 'periodic', 'periodic'])
+
+    def test_reschedule_replaces_timer(self):
+        self.timers.schedule('debounced', 10, self._callback('debounced'))
+        self.clock.now += 5
+        self.timers.schedule('debounced', 10, self._callback('debounced'))
+        self.clock.now += 6
+        self.timers.run_due()
+        self.assertEqual(self.calls, [])
+        self.clock.now += 4
+        self.timers.run_due()
+        self.assertEqual(self.calls, ['debounced'])
+        self.assertIsNone(self.timers.time_until_next())
+
+    def test_errors_are_reported(self):
+        errors = []
+
+        def fail():
+            raise ValueError('boom')
+        self.timers.schedule('failing', 0, fail, interval=10)
+        self.timers.run_due(lambda name, e: errors.append(name))
+        self.assertEqual(errors, ['failing'])
+        self.assertEqual(self.timers.time_until_next(), 10)
+
+
+class WatchFileTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.fstab = os.path.join(self.dir, 'fstab')
+        open(self.fstab, 'w').close()
+        self.errors = []
+        self.watcher = watcherutil.Watcher(self.errors.append, lambda msg: None, fstab_path=self.fstab,
+                                           file_poll_interval=1)
+        self.changes = []
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _write_later(self, path, data, delay=0.1):
+        def write():
+            time.sleep(delay)
+            with open(path, 'a') as f:
+                f.write(data)
+        thread = threading.Thread(target=write)
+        thread.start()
+        return thread
+
+    def test_change_detected_and_debounced(self):
+        path = os.path.join(self.dir, 'mdsd.err')
+        self.watcher.watch_file(path, lambda: self.changes.append(time.time()), settle_time=0.3)
+        start = time.time()
+        for i in range(3):
+            self._write_later(path, 'error\n', delay=0).join()
+            self.watcher.run_once(max_wait=0.1)
+        while not self.changes and time.time() - start < 3:
+            self.watcher.run_once(max_wait=0.05)
+
+        self.assertEqual(len(self.changes), 1)
+        self.assertLess(self.changes[0] - start, 1)  # Well before the poll interval
+        self.assertEqual(self.errors, [])
+
+    def test_unchanged_file_is_not_reported(self):
+        self.watcher.watch_file(self.fstab, lambda: self.changes.append(1))
+        os.chmod(self.fstab, 0o600)
+        start = time.time()
+        while time.time() - start < 1.5:
+            self.watcher.run_once(max_wait=0.1)
+        self.assertEqual(self.changes, [])
+
+    def test_writes_to_other_files_are_ignored(self):
+        if not self.watcher._inotify:
+            self.skipTest('inotify is not available')
+        path = os.path.join(self.dir, 'mdsd.err')
+        open(path, 'w').close()
+        self.watcher.watch_file(path, lambda: self.changes.append(1))
+        woken = []
+        file_changed = self.watcher._file_changed
+        self.watcher._file_changed = lambda changed: (woken.append(changed), file_changed(changed))
+        other = os.path.join(self.dir, 'mdsd.info')
+        open(other, 'w').close()
+        self.watcher.run_once(max_wait=0.1)
+        del woken[:]
+
+        for i in range(3):
+            self._write_later(other, 'info\n', delay=0).join()
+            self.watcher.run_once(max_wait=0.1)
+        self.assertEqual(woken, [])
+
+        self._write_later(path, 'error\n', delay=0).join()
+        self.watcher.run_once(max_wait=0.1)
+        self.assertEqual(set(woken), set([path]))
+
+    def test_rotated_file_is_followed(self):
+        path = os.path.join(self.dir, 'mdsd.err')
+        self._write_later(path, 'error\n', delay=0).join()
+        self.watcher.watch_file(path, lambda: self.changes.append(1))
+        os.rename(path, path + '.1')
+        self._write_later(path, 'new error\n', delay=0).join()
+        self.watcher.run_once(max_wait=0.1)
+        self.assertEqual(len(self.changes), 1)
+
+        # The writes to the new file are seen as well
+        self._write_later(path, 'another error\n', delay=0).join()
+        start = time.time()
+        while len(self.changes) < 2 and time.time() - start < 0.5:
+            self.watcher.run_once(max_wait=0.1)
+        self.assertEqual(len(self.changes), 2)
+
+    def test_periodic_task_errors_are_logged(self):
+        def fail():
+            raise ValueError('boom')
+        self.watcher.add_periodic_task('failing', 60, fail)
+        self.watcher.run_once(max_wait=0)
+        self.assertEqual(len(self.errors), 1)
+        self.assertIn('failing', self.errors[0])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -20,27 +20,116 @@
 import subprocess
 import os
 import datetime
+import heapq
+import itertools
 import time
 import string
 import traceback
 
+from metrics_ext_utils.inotify_util import Inotify, IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE, IN_CREATE, IN_MOVED_FROM, \
+    IN_MOVED_TO, IN_DELETE
+
+
+class TimerQueue:
+    """
+    Timers of the watcher loop, ordered by deadline in a heap. A timer is identified by a name, so that it can be
+    rescheduled (e.g., to debounce a burst of file change events) without having to find and remove the old entry.
+    """
+
+    def __init__(self, clock=time.time):
+        """
+        Constructor
+        :param clock: Function returning the current time in seconds
+        """
+        self._clock = clock
+        self._heap = []  # (deadline, sequence number, name)
+        self._timers = {}  # name -> (sequence number, interval or None if one-shot, callback)
+        self._sequence = itertools.count()
+
+    def schedule(self, name, delay, callback, interval=None):
+        """
+        Schedule a timer, replacing the timer of the same name if any.
+        :param str name: Name of the timer
+        :param delay: Seconds until the first call
+        :param callback: Function to call, without arguments
+        :param interval: Seconds between calls for a periodic timer; None for a one-shot timer
+        :return: None
+        """
+        sequence = next(self._sequence)
+        self._timers[name] = (sequence, interval, callback)
+        heapq.heappush(self._heap, (self._clock() + delay, sequence, name))
+
+    def cancel(self, name):
+        self._timers.pop(name, None)
+
+    def _discard_stale(self):
+        while self._heap and self._timers.get(self._heap[0][2], (None,))[0] != self._heap[0][1]:
+            heapq.heappop(self._heap)
+
+    def time_until_next(self):
+        """
+        :return: Seconds until the next timer is due (0 if one is overdue), or None if there's no timer
+        """
+        self._discard_stale()
+        if not self._heap:
+            return None
+        return max(self._heap[0][0] - self._clock(), 0)
+
+    def run_due(self, on_error=None):
+        """
+        Call the callbacks of the timers that are due. Periodic timers are rescheduled from their deadline, or from now
+        if they fell behind by more than one interval (e.g., after the system was suspended).
+        :param on_error: Function called with the timer name and the exception when a callback raises
+        :return: None
+        """
+        now = self._clock()
+        while True:
+            self._discard_stale()
+            if not self._heap or self._heap[0][0] > now:
+                return
+            deadline, sequence, name = heapq.heappop(self._heap)
+            _, interval, callback = self._timers[name]
+            if interval is None:
+                del self._timers[name]
+            else:
+                next_deadline = deadline + interval
+                if next_deadline <= now:
+                    next_deadline = now + interval
+                heapq.heappush(self._heap, (next_deadline, sequence, name))
+            try:
+                callback()
+            except Exception as e:
+                if on_error:
+                    on_error(name, e)
+
 
 class Watcher:
     """
     A class that handles periodic monitoring activities that are requested for LAD to perform.
     The first such activity is to watch /etc/fstab and report (log to console) if there's anything
     wrong with that. There might be other such monitoring activities that will be added later.
+
+    All the activities are served by a single loop (watch()): changes of watched files are reported by inotify, and
+    periodic activities (e.g., IMDS data logging) are timers of the same loop. Watched files are also polled at a
+    low rate, in case an inotify event was missed or inotify isn't available.
     """
 
-    def __init__(self, hutil_error, hutil_log, log_to_console=False):
+    def __init__(self, hutil_error, hutil_log, log_to_console=False, fstab_path='/etc/fstab',
+                 fstab_settle_time=10, file_poll_interval=60 * 5):
         """
         Constructor.
         :param hutil_error: Error logging function (e.g., hutil.error). This is not a stream.
         :param hutil_log: Normal logging function (e.g., hutil.log). This is not a stream.
         :param log_to_console: Indicates whether to log any issues to /dev/console or not.
+        :param fstab_path: Path of the fstab file to validate when it changes.
+        :param fstab_settle_time: Seconds without any further change of fstab before validating it, so that a file
+                                  that's still being edited isn't reported.
+        :param file_poll_interval: Seconds between polls of the watched files.
         """
         # This is only for the /etc/fstab watcher feature.
-        self._fstab_last_mod_time = os.path.getmtime('/etc/fstab')
+        self._fstab_path = fstab_path
+        self._fstab_settle_time = fstab_settle_time
+        self._fstab_last_mod_time = os.path.getmtime(fstab_path)
 
         self._hutil_error = hutil_error
         self._hutil_log = hutil_log
@@ -48,6 +137,14 @@ class Watcher:
 
         self._imds_logger = None
 
+        self._timers = TimerQueue()
+        self._file_poll_interval = file_poll_interval
+        self._watched_files = {}  # path -> (on_change, settle time, last seen (inode, size, mtime))
+        self._watched_names = {}  # (watched directory, file name) or (watched file, '') -> path
+        self._inotify = Inotify.create()
+        self._timers.schedule('file poll', file_poll_interval, self._poll_files, interval=file_poll_interval)
+        self.watch_file(fstab_path, self._handle_fstab_change, fstab_settle_time)
+
     def _do_log_to_console_if_enabled(self, message):
         """
         Write 'message' to console. Stolen from waagent LogToCon().
@@ -62,23 +159,23 @@ class Watcher:
 
     def handle_fstab(self, ignore_time=False):
         """
-        Watches if /etc/fstab is modified and verifies if it's OK. Otherwise, report it in logs or to /dev/console.
-        :param ignore_time: Disable the default logic of delaying /etc/fstab verification by 1 minute.
-                            This is to allow any test code to avoid waiting 1 minute unnecessarily.
+        Verifies if /etc/fstab is OK when it was modified. Otherwise, report it in logs or to /dev/console.
+        :param ignore_time: Disable the default logic of delaying /etc/fstab verification until it hasn't changed
+                            for the settle time. This is to allow any test code to avoid waiting unnecessarily.
         :return: None
         """
         try_mount = False
         if ignore_time:
             try_mount = True
         else:
-            current_mod_time = os.path.getmtime('/etc/fstab')
+            current_mod_time = os.path.getmtime(self._fstab_path)
             current_mod_date_time = datetime.datetime.fromtimestamp(current_mod_time)
 
-            # Only try to mount if it's been at least 1 minute since the 
+            # Only try to mount if it's been at least the settle time since the
             # change to fstab was done, to prevent spewing out erroneous spew
             if (current_mod_time != self._fstab_last_mod_time and
-                datetime.datetime.now() > current_mod_date_time +
-                    datetime.timedelta(minutes=1)):
+                datetime.datetime.now() >= current_mod_date_time +
+                    datetime.timedelta(seconds=self._fstab_settle_time)):
                 try_mount = True
                 self._fstab_last_mod_time = current_mod_time
 
@@ -95,27 +192,116 @@ class Watcher:
                 self._hutil_log('fstab modification passed mount validation')
         return ret
 
+    def _handle_fstab_change(self):
+        """
+        Called by the watcher loop once fstab didn't change for the settle time.
+        """
+        current_mod_time = os.path.getmtime(self._fstab_path)
+        if current_mod_time != self._fstab_last_mod_time:
+            self._fstab_last_mod_time = current_mod_time
+            self.handle_fstab(ignore_time=True)
+
     def set_imds_logger(self, imds_logger):
         self._imds_logger = imds_logger
+        # The IMDS logger decides by itself whether it's the right time, so checking every 5 minutes is enough.
+        self.add_periodic_task('IMDS probe', 60 * 5, imds_logger.log_imds_data_if_right_time)
+
+    def add_periodic_task(self, name, interval, task, first_delay=0):
+        """
+        Run a task periodically from the watcher loop.
+        :param str name: Name of the task, for logging
+        :param interval: Seconds between runs
+        :param task: Function to call, without arguments
+        :param first_delay: Seconds until the first run
+        :return: None
+        """
+        self._timers.schedule(name, first_delay, task, interval=interval)
+
+    @staticmethod
+    def _file_state(path):
+        try:
+            stat = os.stat(path)
+            return stat.st_ino, stat.st_size, stat.st_mtime
+        except OSError:
+            return None
+
+    def watch_file(self, path, on_change, settle_time=0):
+        """
+        Call back when a file changes. The file doesn't need to exist yet.
+        :param str path: Path of the file to watch
+        :param on_change: Function to call, without arguments
+        :param settle_time: Seconds without any further change before calling back. A burst of changes results
+                            in a single call.
+        :return: None
+        """
+        self._watched_files[path] = (on_change, settle_time, Watcher._file_state(path))
+        if self._inotify:
+            # The content is watched on the file itself, so that writes to the other files of the directory (e.g.,
+            # the other LAD logs next to mdsd.err) don't wake the watcher up. The directory is watched only for
+            # files appearing or disappearing, to see the file created, rotated or replaced by a rename.
+            directory = os.path.dirname(os.path.abspath(path))
+            if self._inotify.add_watch(directory, IN_CREATE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE) is None:
+                self._hutil_error('Cannot watch {0} with inotify; polling it every {1} seconds instead'
+                                  .format(path, self._file_poll_interval))
+            self._watched_names[(directory, os.path.basename(path))] = path
+            self._watch_file_content(path)
+
+    def _watch_file_content(self, path):
+        """
+        Watch the writes to the current file at path. Fails silently if there's no such file yet: it's watched once
+        the directory reports it.
+        """
+        abs_path = os.path.abspath(path)
+        self._watched_names[(abs_path, '')] = path
+        self._inotify.add_watch(abs_path, IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE)
+
+    def _file_changed(self, path):
+        on_change, settle_time, last_state = self._watched_files[path]
+        state = Watcher._file_state(path)
+        if state == last_state or state is None:
+            return
+        self._watched_files[path] = (on_change, settle_time, state)
+        # Reschedule on every change, so that it's called only once the file has settled
+        self._timers.schedule('change of ' + path, settle_time, on_change)
+
+    def _poll_files(self):
+        for path, (_, _, last_state) in self._watched_files.items():
+            if Watcher._file_state(path) != last_state:
+                self._file_changed(path)
+
+    def _log_task_error(self, name, e):
+        self._hutil_error('Watcher task "{0}" exception: {1}\nStacktrace: {2}'.format(name, e,
+                                                                                     traceback.format_exc()))
+
+    def run_once(self, max_wait=None):
+        """
+        Wait for the next file change or timer (at most max_wait seconds) and handle what's due.
+        :param max_wait: Seconds to wait at most; no limit if None
+        :return: None
+        """
+        wait = self._timers.time_until_next()
+        if max_wait is not None:
+            wait = max_wait if wait is None else min(wait, max_wait)
+        if self._inotify:
+            for watched, mask, name in self._inotify.wait(wait):
+                path = self._watched_names.get((watched, name))
+                if path:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        self._watch_file_content(path)
+                    self._file_changed(path)
+        elif wait:
+            time.sleep(wait)
+        self._timers.run_due(self._log_task_error)
 
     def watch(self):
         """
-        Main loop performing various monitoring activities periodically.
-        Currently iterates every 5 minutes, and other periodic activities might be
-        added in the loop later.
+        Main loop performing the monitoring activities: reacts to changes of the watched files and runs the
+        periodic tasks when they're due.
         :return: None
         """
         while True:
-            # /etc/fstab watcher
-            self.handle_fstab()
-
-            # IMDS probe (only sporadically, inside the function)
-            if self._imds_logger:
-                try:
-                    self._imds_logger.log_imds_data_if_right_time()
-                except Exception as e:
-                    self._hutil_error('ImdsLogger exception: {0}\nStacktrace: {1}'.format(e, traceback.format_exc()))
-
-            # Sleep 5 minutes
-            time.sleep(60 * 5)
-        pass
+            try:
+                self.run_once()
+            except Exception as e:
+                self._hutil_error('Watcher exception: {0}\nStacktrace: {1}'.format(e, traceback.format_exc()))
+                time.sleep(10)
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+#
+# Azure Linux extension
+#
+# Copyright (c) Microsoft Corporation
+# All rights reserved.
+# MIT License
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the ""Software""), to deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+# Software.
+# THE SOFTWARE IS PROVIDED *AS IS*, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import ctypes
+import errno
+import os
+import select
+import struct
+
+# Event masks from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_IGNORED = 0x00008000
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+_EVENT_HEADER = struct.Struct('iIII')  # struct inotify_event: wd, mask, cookie, len, followed by name[len]
+
+
+class Inotify(object):
+    """
+    Minimal ctypes binding of inotify(7), shared by LAD and AMA. Python 2 has no inotify module and pyinotify isn't
+    shipped with the extensions.
+    Use Inotify.create() to get an instance, which returns None where inotify isn't available so that callers
+    can fall back to polling.
+    """
+
+    def __init__(self, libc, fd):
+        self._libc = libc
+        self._fd = fd
+        self._watches = {}  # wd -> watched path
+
+    @staticmethod
+    def create():
+        """
+        :return Inotify: A new inotify instance, or None if inotify isn't available on this system
+        """
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except Exception:
+            return None
+        if fd < 0:
+            return None
+        return Inotify(libc, fd)
+
+    def fileno(self):
+        return self._fd
+
+    def add_watch(self, path, mask):
+        """
+        Watch a file or a directory.
+        :param str path: Path to watch
+        :param int mask: Events to watch (e.g., IN_MODIFY | IN_CREATE)
+        :return int: Watch descriptor, or None if the path can't be watched (e.g., it doesn't exist)
+        """
+        wd = self._libc.inotify_add_watch(self._fd, ctypes.c_char_p(path.encode('utf-8')), ctypes.c_uint32(mask))
+        if wd < 0:
+            return None
+        self._watches[wd] = path
+        return wd
+
+    def wait(self, timeout):
+        """
+        Wait for events and return them.
+        :param timeout: Seconds to wait at most
+        :return list: (watched path, mask, name) tuples. Empty when the timeout expired.
+        """
+        try:
+            readable = select.select([self._fd], [], [], timeout)[0]
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return []
+        return self.read_events() if readable else []
+
+    def read_events(self):
+        """
+        Read all pending events without blocking.
+        :return list: (watched path, mask, name) tuples
+        """
+        events = []
+        while True:
+            try:
+                buf = os.read(self._fd, 64 * 1024)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    return events
+                raise
+            if not buf:
+                return events
+            offset = 0
+            while offset + _EVENT_HEADER.size <= len(buf):
+                wd, mask, cookie, name_len = _EVENT_HEADER.unpack_from(buf, offset)
+                offset += _EVENT_HEADER.size
+                name = buf[offset:offset + name_len].rstrip(b'\0').decode('utf-8', 'replace')
+                offset += name_len
+                if mask & IN_IGNORED:
+                    self._watches.pop(wd, None)
+                    continue
+                events.append((self._watches.get(wd), mask, name))
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+#
+# Azure Linux extension
+#
+# Copyright (c) Microsoft Corporation
+# All rights reserved.
+# MIT License
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the ""Software""), to deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+# Software.
+# THE SOFTWARE IS PROVIDED *AS IS*, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# This File contains the watcher of the metric counters config (written by mdsd for the Azure Monitor Extension), which
+# wakes up the metrics watcher as soon as the config changes
+
+import os
+import time
+
+from metrics_ext_utils.inotify_util import Inotify, IN_MODIFY, IN_CLOSE_WRITE, IN_CREATE, IN_MOVED_TO, \
+    IN_MOVED_FROM, IN_DELETE
+
+
+def _create_inotify(directory):
+    """
+    Create an inotify instance watching the files of a directory.
+    :return Inotify: The inotify instance, or None if inotify isn't available or the directory can't be watched
+    """
+    inotify = Inotify.create()
+    if inotify is None:
+        return None
+    mask = IN_MODIFY | IN_CLOSE_WRITE | IN_CREATE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE
+    if inotify.add_watch(directory, mask) is None:
+        inotify.close()
+        return None
+    return inotify
+
+
+class MetricsConfigWatcher(object):
+    """
+    Waits for changes of a config file through inotify, and reports a burst of writes (e.g., the file being rewritten
+    in several chunks, or replaced) as a single change once it's over. Where inotify isn't available, or the directory
+    doesn't exist yet, the file is polled instead.
+    """
+
+    def __init__(self, path, debounce=1, max_debounce=10, poll_interval=30):
+        """
+        Constructor
+        :param str path: Path of the config file (e.g., /etc/mdsd.d/config-cache/metricCounters.json)
+        :param debounce: Seconds without any further write after which a change is reported
+        :param max_debounce: Max seconds a change can be held back by further writes
+        :param poll_interval: Seconds between stats of the file when inotify isn't available
+        """
+        self._path = path
+        self._name = os.path.basename(path)
+        self._directory = os.path.dirname(os.path.abspath(path))
+        self._debounce = debounce
+        self._max_debounce = max_debounce
+        self._poll_interval = poll_interval
+        self._inotify = _create_inotify(self._directory)
+        self._last_state = self._get_state()
+
+    def uses_inotify(self):
+        return self._inotify is not None
+
+    def _get_state(self):
+        try:
+            st = os.stat(self._path)
+        except OSError:
+            return None
+        return st.st_ino, st.st_size, st.st_mtime
+
+    def _wait_for_events(self, timeout):
+        """
+        :return bool: Whether an event about the config file was received before the timeout
+        """
+        deadline = time.time() + timeout
+        while True:
+            events = self._inotify.wait(max(deadline - time.time(), 0))
+            if any(name == self._name for _, _, name in events):
+                return True
+            if time.time() >= deadline:
+                return False
+
+    def wait(self, timeout):
+        """
+        Wait for the config file to change (once the writes to it settled), or for the timeout.
+        :param timeout: Seconds to wait at most
+        :return bool: Whether the file was written to (or, when polling, its size or mtime changed)
+        """
+        if self._inotify is None:
+            if self._directory and os.path.isdir(self._directory):
+                # The directory was created since: switch to inotify
+                self._inotify = _create_inotify(self._directory)
+            if self._inotify is None:
+                time.sleep(min(timeout, self._poll_interval))
+                return self._check_state()
+
+        if not self._wait_for_events(timeout):
+            return self._check_state()
+        settle_deadline = time.time() + self._max_debounce
+        while time.time() < settle_deadline and \
+                self._wait_for_events(min(self._debounce, max(settle_deadline - time.time(), 0))):
+            pass
+        self._check_state()
+        return True
+
+    def _check_state(self):
+        state = self._get_state()
+        changed = state != self._last_state
+        self._last_state = state
+        return changed
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
@@ -28,4 +28,6 @@ lad_metrics_extension_udp_port = "13459"
 ama_metrics_extension_udp_port = "17659"
 lad_metrics_extension_influx_udp_url = "udp://127.0.0.1:" + lad_metrics_extension_udp_port
 telegraf_influx_url = "unix:///var/run/mdsd/lad_mdsd_influx.socket"
-metrics_extension_namespace = "Azure.VM.Linux.GuestMetrics"
\ No newline at end of file
+metrics_extension_namespace = "Azure.VM.Linux.GuestMetrics"
+msi_token_cache_path = "/var/run/azure-monitor-msi/ingestion-token.json"
+metrics_extension_msi_resource = "https://ingestion.monitor.azure.com/"
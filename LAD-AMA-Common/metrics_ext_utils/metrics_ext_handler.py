@@ -26,6 +26,12 @@ import metrics_ext_utils.metrics_constants as metrics_constants
 import subprocess
 import time
 import signal
+from metrics_ext_utils.msi_token_cache import MsiTokenCache
+from metrics_ext_utils.proc_util import find_pid_by_executable, get_process_executable, is_process_alive
+
+_msi_token_cache = MsiTokenCache(metrics_constants.msi_token_cache_path,
+                                 metrics_constants.metrics_extension_msi_resource)
+
 
 def is_systemd():
     """
@@ -35,22 +41,35 @@ def is_systemd():
     check_systemd = os.system("pidof systemd 1>/dev/null 2>&1")
     return check_systemd == 0
 
-def is_running(is_lad):
+_last_metrics_pid = None
+
+
+def get_metrics_pid(is_lad):
     """
-    This method is used to check if metrics binary is currently running on the system or not.
-    In order to check whether it needs to be restarted from the watcher daemon
+    Find the running MetricsExtension process in /proc, rather than parsing the output of ps. The pid found last is
+    checked first, so that the common case is a couple of reads in /proc/<pid>.
+    :param is_lad: boolean whether the extension is LAD or not (AMA)
+    :return: The pid of the MetricsExtension process, or None if it isn't running
     """
+    global _last_metrics_pid
     if is_lad:
         metrics_bin = metrics_constants.lad_metrics_extension_bin
     else:
         metrics_bin = metrics_constants.ama_metrics_extension_bin
 
-    proc = subprocess.Popen(["ps  aux | grep MetricsExtension | grep -v grep"], stdout=subprocess.PIPE, shell=True)
-    output = proc.communicate()[0]
-    if metrics_bin in output:
-        return True
-    else:
-        return False
+    if _last_metrics_pid is not None and get_process_executable(_last_metrics_pid) == metrics_bin \
+            and is_process_alive(_last_metrics_pid):
+        return _last_metrics_pid
+    _last_metrics_pid = find_pid_by_executable(metrics_bin)
+    return _last_metrics_pid
+
+
+def is_running(is_lad):
+    """
+    This method is used to check if metrics binary is currently running on the system or not.
+    In order to check whether it needs to be restarted from the watcher daemon
+    """
+    return get_metrics_pid(is_lad) is not None
 
 
 def stop_metrics_service(is_lad):
@@ -90,9 +109,7 @@ def stop_metrics_service(is_lad):
                 pid = f.read()
             if pid != "":
                 # Check if the process running is indeed MetricsExtension, ignore if the process output doesn't contain MetricsExtension
-                proc = subprocess.Popen(["ps -o cmd= {0}".format(pid)], stdout=subprocess.PIPE, shell=True)
-                output = proc.communicate()[0]
-                if metrics_ext_bin in output:
+                if get_process_executable(pid.strip()) == metrics_ext_bin:
                     os.kill(int(pid), signal.SIGKILL)
                 else:
                     return False, "Found a different process running with PID {0}. Failed to stop MetricsExtension.".format(pid)
@@ -129,8 +146,10 @@ def remove_metrics_service(is_lad):
 
 def generate_MSI_token():
     """
-    This method is used to query the metdadata service to get the MSI Auth token for the VM and write it to the ME config location
-    This is called from the main extension code after config setup is complete
+    This method is used to get the MSI Auth token for the VM and write it to the ME config location
+    This is called from the main extension code after config setup is complete, and periodically from the monitor loops.
+    The token comes from the MSI token cache shared by all the LAD/AMA processes, which queries the metadata service
+    only when the token is about to expire, so calling this often is cheap.
     """
 
     _, configFolder = get_handler_vars()
@@ -138,42 +157,27 @@ def generate_MSI_token():
     me_auth_file_path = me_config_dir + "AuthToken-MSI.json"
     expiry_epoch_time = ""
     log_messages = ""
-    retries = 1
-    max_retries = 3
-    sleep_time = 5
 
     if not os.path.exists(me_config_dir):
         log_messages += "Metrics extension config directory - {0} does not exist. Failed to generate MSI auth token fo ME.\n".format(me_config_dir)
         return False, expiry_epoch_time, log_messages
     try:
-        data = None
-        while retries <= max_retries:
-            msiauthurl = "http://169.254.169.254/metadata/identity/oauth2/token?api-version=2018-02-01&resource=https://ingestion.monitor.azure.com/"
-            req = urllib2.Request(msiauthurl, headers={'Metadata':'true', 'Content-Type':'application/json'})
-            res = urllib2.urlopen(req)
-            data = json.loads(res.read())
-
-            if not data or "access_token" not in data:
-                retries += 1
-            else:
-                break
-
-            log_messages += "Failed to fetch MSI Auth url. Retrying in {2} seconds. Retry Count - {0} out of Mmax Retries - {1}\n".format(retries, max_retries, sleep_time)
-            time.sleep(sleep_time)
-
-
-        if retries > max_retries:
+        data, log_messages = _msi_token_cache.get_token()
+        if data is None:
             log_messages += "Unable to generate a valid MSI auth token at {0}.\n".format(me_auth_file_path)
             return False, expiry_epoch_time, log_messages
 
-        with open(me_auth_file_path, "w") as f:
-            f.write(json.dumps(data))
-
-        if "expires_on" in data:
-            expiry_epoch_time  = data["expires_on"]
-        else:
-            log_messages += "Error parsing the msi token at {0} for the token expiry time. Failed to generate the correct token\n".format(me_auth_file_path)
-            return False, expiry_epoch_time, log_messages
+        # Rewrite the token only when it changed, so that ME isn't made to reload the same token
+        token_content = json.dumps(data)
+        current_content = None
+        if os.path.isfile(me_auth_file_path):
+            with open(me_auth_file_path, "r") as f:
+                current_content = f.read()
+        if current_content != token_content:
+            with open(me_auth_file_path, "w") as f:
+                f.write(token_content)
+
+        expiry_epoch_time = data["expires_on"]
 
     except Exception as e:
         log_messages += "Failed to get msi auth token. Please check if VM's system assigned Identity is enabled Failed with error {0}\n".format(e)
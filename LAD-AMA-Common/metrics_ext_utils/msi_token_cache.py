@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+#
+# Azure Linux extension
+#
+# Copyright (c) Microsoft Corporation
+# All rights reserved.
+# MIT License
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the ""Software""), to deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+# Software.
+# THE SOFTWARE IS PROVIDED *AS IS*, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# This File contains the MSI token cache shared by all the processes of LAD and the Azure Monitor Extension that need
+# an MSI auth token from IMDS
+
+import errno
+import fcntl
+import json
+import os
+import random
+import stat
+import tempfile
+import time
+import urllib
+import urllib2
+
+imds_token_endpoint = "http://169.254.169.254/metadata/identity/oauth2/token"
+
+
+class MsiTokenCache(object):
+    """
+    Cross-process cache of an MSI auth token, kept in a root-only file. The token is refreshed from IMDS before it
+    expires by the first process that needs it, under a file lock, so that the other processes just read the file.
+    Failed (or premature) refreshes are retried with a jittered exponential backoff shared by all the processes, and
+    a token that is still valid keeps being served meanwhile, so a refresh never blocks its callers for long.
+    """
+
+    def __init__(self, cache_path, resource, endpoint=imds_token_endpoint, refresh_before=30 * 60,
+                 min_validity=60, min_backoff=30, max_backoff=10 * 60, max_attempts=3, timeout=10,
+                 clock=time.time, sleep=time.sleep):
+        """
+        Constructor
+        :param str cache_path: Path of the cache file. Its directory is created (root-only) if it doesn't exist.
+        :param str resource: Resource the token is requested for (e.g., https://ingestion.monitor.azure.com/)
+        :param str endpoint: IMDS token endpoint
+        :param refresh_before: Seconds before the token expiry from which it is refreshed
+        :param min_validity: Seconds for which a cached token must still be valid to be served when it can't be
+                             refreshed. Without such a token, get_token() retries up to max_attempts times.
+        :param min_backoff: Seconds to wait after the first failed refresh before the next one
+        :param max_backoff: Max seconds between two refreshes
+        :param max_attempts: Max number of requests to IMDS in a get_token() call when there's no valid token
+        :param timeout: Seconds to wait at most for an IMDS response
+        """
+        self._cache_path = cache_path
+        self._lock_path = cache_path + ".lock"
+        self._resource = resource
+        self._endpoint = endpoint
+        self._refresh_before = refresh_before
+        self._min_validity = min_validity
+        self._min_backoff = min_backoff
+        self._max_backoff = max_backoff
+        self._max_attempts = max_attempts
+        self._timeout = timeout
+        self._clock = clock
+        self._sleep = sleep
+
+    @staticmethod
+    def get_expiry(token):
+        """
+        :param dict token: Token as returned by IMDS
+        :return int: Expiry time (epoch) of the token, or 0 if it doesn't have a valid one
+        """
+        try:
+            return int(token["expires_on"])
+        except (KeyError, TypeError, ValueError):
+            return 0
+
+    def _backoff(self, failures):
+        delay = min(self._min_backoff * 2 ** max(failures - 1, 0), self._max_backoff)
+        # Jitter, so that the VMs (and processes) that failed together don't all retry together
+        return random.uniform(delay / 2.0, delay)
+
+    def _read(self):
+        """
+        :return dict: Content of the cache file, or an empty dict if there's none or it can't be trusted
+        """
+        try:
+            fd = os.open(self._cache_path, os.O_RDONLY)
+        except OSError:
+            return {}
+        try:
+            st = os.fstat(fd)
+            if st.st_uid != os.geteuid() or st.st_mode & (stat.S_IRWXG | stat.S_IRWXO):
+                # Not written by us: don't serve a token that anybody else could have planted or read
+                return {}
+            with os.fdopen(os.dup(fd), "r") as f:
+                content = json.loads(f.read())
+            return content if isinstance(content, dict) else {}
+        except (OSError, IOError, ValueError):
+            return {}
+        finally:
+            os.close(fd)
+
+    def _write(self, content):
+        cache_dir = os.path.dirname(self._cache_path)
+        # mkstemp creates the file with mode 0600. Renaming makes the new content visible atomically to readers.
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix=".msi_token")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(json.dumps(content))
+            os.rename(tmp_path, self._cache_path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+    def _open_lock(self):
+        cache_dir = os.path.dirname(self._cache_path)
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir, 0o700)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        return os.open(self._lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+
+    def _fetch(self):
+        query = urllib.urlencode({"api-version": "2018-02-01", "resource": self._resource})
+        req = urllib2.Request(self._endpoint + "?" + query, headers={'Metadata': 'true'})
+        res = urllib2.urlopen(req, timeout=self._timeout)
+        try:
+            data = json.loads(res.read())
+        finally:
+            res.close()
+        if not isinstance(data, dict) or "access_token" not in data or not self.get_expiry(data):
+            raise ValueError("IMDS response has no access_token or expires_on")
+        return data
+
+    def _is_fresh(self, content, now):
+        expiry = self.get_expiry(content.get("token"))
+        if expiry - now > self._refresh_before:
+            return True
+        # Due for a refresh, but another one was tried recently: keep serving the token meanwhile
+        return expiry - now > self._min_validity and now < content.get("next_attempt", 0)
+
+    def get_token(self):
+        """
+        Get the token from the cache, refreshing it from IMDS if it's expiring.
+        :return: (token, log_messages). token is the dict returned by IMDS (access_token, expires_on, ...), or None if
+                 no valid token could be obtained.
+        """
+        now = self._clock()
+        content = self._read()
+        if self._is_fresh(content, now):
+            return content["token"], ""
+
+        lock_fd = self._open_lock()
+        try:
+            usable = self.get_expiry(content.get("token")) - now > self._min_validity
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                if usable:
+                    # Another process is refreshing it already
+                    return content["token"], ""
+                fcntl.flock(lock_fd, fcntl.LOCK_EX)
+
+            # Another process may have refreshed the token while we were waiting for the lock
+            now = self._clock()
+            content = self._read()
+            if self._is_fresh(content, now):
+                return content["token"], ""
+            return self._refresh(content, now)
+        finally:
+            os.close(lock_fd)
+
+    def _refresh(self, content, now):
+        token = content.get("token")
+        expiry = self.get_expiry(token)
+        usable = expiry - now > self._min_validity
+        failures = content.get("failures", 0)
+        log_messages = ""
+
+        # With a usable token, a single request: the next attempt is left to a later call, after the backoff
+        attempts = 1 if usable else self._max_attempts
+        for attempt in range(1, attempts + 1):
+            try:
+                new_token = self._fetch()
+                if self.get_expiry(new_token) > expiry:
+                    self._write({"token": new_token, "failures": 0, "next_attempt": 0})
+                    return new_token, log_messages
+                # IMDS caches tokens too, and keeps returning the same one until it's about to expire
+                log_messages += "IMDS returned an MSI token that isn't newer than the cached one.\n"
+                token = new_token
+                usable = True
+                break
+            except Exception as e:
+                failures += 1
+                log_messages += "Failed to fetch MSI auth token from IMDS (attempt {0} of {1}): {2}\n".format(
+                    attempt, attempts, e)
+            if attempt < attempts:
+                self._sleep(self._backoff(failures))
+
+        next_attempt = self._clock() + self._backoff(max(failures, 1))
+        self._write({"token": token, "failures": failures, "next_attempt": next_attempt})
+        if usable:
+            return token, log_messages
+        return None, log_messages
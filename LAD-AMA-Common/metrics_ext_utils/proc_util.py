@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+#
+# Azure Linux extension
+#
+# Copyright (c) Microsoft Corporation
+# All rights reserved.
+# MIT License
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the ""Software""), to deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+# Software.
+# THE SOFTWARE IS PROVIDED *AS IS*, WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# This File contains the helpers reading the state of processes from /proc, shared by the LAD process supervisor and
+# the telegraf and MetricsExtension handlers
+
+import os
+
+
+def read_proc_stat(pid, proc_root='/proc'):
+    """
+    Read the state and the start time of a process from /proc/<pid>/stat.
+    :param int pid: ID of the process
+    :param str proc_root: Mount point of procfs (overridable for tests)
+    :return (str, int): Process state letter (e.g., 'S', 'Z') and start time in clock ticks after boot,
+                        or None if the process doesn't exist
+    """
+    try:
+        with open(os.path.join(proc_root, str(pid), 'stat')) as stat_file:
+            stat = stat_file.read()
+    except (IOError, OSError):
+        return None
+    # comm (2nd field) may contain spaces and parentheses, so split what comes after its closing parenthesis
+    fields = stat[stat.rindex(')') + 2:].split()
+    return fields[0], int(fields[19])
+
+
+def is_process_alive(pid, proc_root='/proc'):
+    """
+    :return bool: Whether the process exists and isn't a zombie
+    """
+    stat = read_proc_stat(pid, proc_root)
+    return stat is not None and stat[0] not in ('Z', 'X')
+
+
+def get_process_executable(pid, proc_root='/proc'):
+    """
+    :return str: argv[0] of the process from /proc/<pid>/cmdline, or None if the process doesn't exist
+    """
+    try:
+        with open(os.path.join(proc_root, str(pid), 'cmdline')) as cmdline_file:
+            cmdline = cmdline_file.read()
+    except (IOError, OSError):
+        return None
+    if not cmdline:
+        return None
+    return cmdline.split('\0', 1)[0]
+
+
+def find_pid_by_executable(executable, proc_root='/proc'):
+    """
+    Find a running process whose argv[0] is the given executable path, by scanning /proc/*/cmdline.
+    :param str executable: Full path of the executable (e.g., metrics_constants.lad_telegraf_bin)
+    :param str proc_root: Mount point of procfs (overridable for tests)
+    :return int: ID of the first matching live process, or None if there's none
+    """
+    for entry in os.listdir(proc_root):
+        if entry.isdigit() and get_process_executable(entry, proc_root) == executable and \
+                is_process_alive(entry, proc_root):
+            return int(entry)
+    return None
@@ -18,13 +18,18 @@
 
 import json
 import os
+import re
 from telegraf_utils.telegraf_name_map import name_map
 import subprocess
 import signal
 import urllib2
-from shutil import copyfile
 import time
 import metrics_ext_utils.metrics_constants as metrics_constants
+from metrics_ext_utils.proc_util import find_pid_by_executable, get_process_executable, is_process_alive
+
+# Change of the telegraf config written by the last handle_config() call (None, "reload" or "restart"), applied to the
+# running telegraf by apply_config_changes()
+_pending_config_change = None
 
 
 
@@ -49,6 +54,109 @@ def is_systemd():
     check_systemd = os.system("pidof systemd 1>/dev/null 2>&1")
     return check_systemd == 0
 
+
+def _toml_key(key):
+    if re.match(r'^[A-Za-z0-9_-]+$', key):
+        return key
+    return json.dumps(key)
+
+
+def _toml_value(value):
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (int, long, float)):
+        return str(value)
+    if isinstance(value, (list, tuple)):
+        return "[" + ", ".join(_toml_value(item) for item in value) + "]"
+    return json.dumps(value)
+
+
+class TomlTable:
+    """
+    A TOML table (e.g., [agent]) or an element of an array of tables (e.g., [[inputs.cpu]]). Keys and sub-tables
+    (e.g., [[processors.rename.replace]]) are rendered in the order they were added, so that the same config
+    always renders to the same text and can be compared with the deployed one.
+    """
+
+    def __init__(self, name, is_array=True, comment=None):
+        """
+        Constructor
+        :param str name: Full name of the table (e.g., "inputs.cpu")
+        :param bool is_array: Whether the table is an element of an array of tables ([[name]]) or not ([name])
+        :param str comment: Comment rendered before the table, if any
+        """
+        self.name = name
+        self.is_array = is_array
+        self.comment = comment
+        self._items = []
+        self._sub_tables = []
+
+    def set(self, key, value):
+        """
+        Add a key. Strings, booleans, numbers and lists of those are supported.
+        :return TomlTable: This table, so that calls can be chained
+        """
+        self._items.append((key, value))
+        return self
+
+    def add_table(self, name, is_array=True):
+        """
+        Add a sub-table.
+        :param str name: Name of the sub-table, relative to this table (e.g., "replace")
+        :return TomlTable: The sub-table
+        """
+        table = TomlTable(self.name + "." + name, is_array)
+        self._sub_tables.append(table)
+        return table
+
+    def render(self, indent=0):
+        lines = []
+        if self.comment:
+            lines.append("# " + self.comment)
+        lines.append(" " * indent + ("[[{0}]]" if self.is_array else "[{0}]").format(self.name))
+        for key, value in self._items:
+            lines.append(" " * (indent + 2) + "{0} = {1}".format(_toml_key(key), _toml_value(value)))
+        for table in self._sub_tables:
+            lines.append("")
+            lines.append(table.render(indent + 2))
+        return "\n".join(lines)
+
+
+class TomlDocument:
+    """
+    A telegraf config file made of TomlTables, rendered in the order they were added.
+    """
+
+    def __init__(self):
+        self._parts = []
+
+    def add(self, table):
+        self._parts.append(table)
+        return table
+
+    def add_table(self, name, is_array=True, comment=None):
+        return self.add(TomlTable(name, is_array, comment))
+
+    def add_comment(self, text):
+        self._parts.append("\n".join("# " + line for line in text.split("\n")))
+
+    def render(self):
+        return "\n\n".join(part if isinstance(part, str) else part.render() for part in self._parts) + "\n"
+
+
+def get_plugin_signature(config_texts):
+    """
+    Get the input and output plugins configured by telegraf config files. Telegraf is restarted when they change;
+    other changes (e.g., fields, intervals, renames, aggregators or tags) are applied by reloading its config.
+    :param config_texts: Contents of the config files
+    :return list: Sorted table names of the input and output plugins (e.g., "inputs.cpu"), with repetitions
+    """
+    plugins = []
+    for text in config_texts:
+        plugins.extend(re.findall(r'^\s*\[\[((?:inputs|outputs)\.[^\]]+)\]\]', text, re.M))
+    return sorted(plugins)
+
+
 def parse_config(data, me_url, mdsd_url, is_lad, az_resource_id, subscription_id, resource_group, region, virtual_machine_name):
     """
     Main parser method to convert Metrics config from extension configuration to telegraf configuration
@@ -63,7 +171,6 @@ def parse_config(data, me_url, mdsd_url, is_lad, az_resource_id, subscription_id
     :param virtual_machine_name: Azure Virtual Machine Name value (Only in the case for VMSS) for the VM
     """
     storage_namepass_list = []
-    storage_namepass_str = ""
 
     MetricsExtensionNamepsace = metrics_constants.metrics_extension_namespace
 
@@ -135,237 +242,207 @@ def parse_config(data, me_url, mdsd_url, is_lad, az_resource_id, subscription_id
         return []
 
     excess_diskio_plugin_list_lad = ["total_transfers_filesystem", "read_bytes_filesystem", "total_bytes_filesystem", "write_bytes_filesystem", "reads_filesystem", "writes_filesystem"]
-    excess_diskio_field_drop_list_str = ""
+    excess_diskio_field_drop_list = []
 
 
-    int_file = {"filename":"intermediate.json", "data": json.dumps(telegraf_json)}
+    int_file = {"filename":"intermediate.json", "data": json.dumps(telegraf_json, sort_keys=True)}
     output = []
     output.append(int_file)
 
-    for omiclass in telegraf_json:
-        input_str = ""
-        ama_rename_str = ""
-        metricsext_rename_str = ""
-        lad_specific_rename_str = ""
-        rate_specific_aggregator_str = ""
-        aggregator_str = ""
-        for plugin in telegraf_json[omiclass]:
-            config_file = {"filename" : omiclass+".conf"}
-            # Arbitrary max value for finding min
-            min_interval = "999999999s"
-            input_str += "[[inputs." + plugin + "]]\n"
-            # input_str += " "*2 + "name_override = \"" + omiclass + "\"\n"
-
-            # If it's a lad config then add the namepass fields for sending totals to storage
+    # Classes, plugins and fields are sorted, so that the same metrics config always results in the same files
+    for omiclass in sorted(telegraf_json):
+        inputs = []
+        ama_renames = []
+        metricsext_renames = []
+        lad_specific_renames = []
+        aggregators = []
+        for plugin in sorted(telegraf_json[omiclass]):
+            plugin_fields = telegraf_json[omiclass][plugin]
+            fields = sorted(plugin_fields)
+
+            #Use the shortest interval time for the whole plugin
+            min_interval = min((plugin_fields[field]["interval"] for field in fields), key=lambda interval: int(interval[:-1]))
+
+            #Aggregation perdiod needs to be double of interval/polling period for metrics for rate aggegation to work properly
+            if int(min_interval[:-1]) > 30:
+                min_agg_period = str(int(min_interval[:-1])*2)  #if the min interval is greater than 30, use the double value
+            else:
+                min_agg_period = "60"   #else use 60 as mininum so that we can maintain 1 event per minute
+
+            input_table = TomlTable("inputs." + plugin).set("fieldpass", fields)
+            if plugin == "cpu":
+                input_table.set("report_active", True)
+            input_table.set("interval", min_interval)
+            inputs.append(input_table)
+
+            # Add the namepass fields for sending totals to storage, with the rename processor based on the
+            # displayname (AMA) or on the lad table key (LAD)
+            total_plugin_name = plugin + "_total"
+            storage_rename = TomlTable("processors.rename").set("namepass", [total_plugin_name])
             if is_lad:
-                lad_plugin_name = plugin + "_total"
-                lad_specific_rename_str += "\n[[processors.rename]]\n"
-                lad_specific_rename_str += " "*2 + "namepass = [\"" + lad_plugin_name + "\"]\n"
-                if lad_plugin_name not in storage_namepass_list:
-                    storage_namepass_list.append(lad_plugin_name)
+                lad_specific_renames.append(storage_rename)
             else:
-                ama_plugin_name = plugin + "_total"
-                ama_rename_str += "\n[[processors.rename]]\n"
-                ama_rename_str += " "*2 + "namepass = [\"" + ama_plugin_name + "\"]\n"
-                if ama_plugin_name not in storage_namepass_list:
-                    storage_namepass_list.append(ama_plugin_name)
-
-            metricsext_rename_str += "\n[[processors.rename]]\n"
-            metricsext_rename_str += " "*2 + "namepass = [\"" + plugin + "\"]\n"
-            metricsext_rename_str += "\n" + " "*2 + "[[processors.rename.replace]]\n"
-            metricsext_rename_str += " "*4 + "measurement = \"" + plugin + "\"\n"
-            metricsext_rename_str += " "*4 + "dest = \"" + MetricsExtensionNamepsace + "\"\n"
-
-
-
-            fields = ""
-            ops_fields = ""
-            non_ops_fields = ""
-            non_rate_aggregate = False
-            ops = ""
-            min_agg_period = ""
-            rate_aggregate = False
-            for field in telegraf_json[omiclass][plugin]:
-                fields += "\"" + field + "\", "
+                ama_renames.append(storage_rename)
+            if total_plugin_name not in storage_namepass_list:
+                storage_namepass_list.append(total_plugin_name)
+
+            metricsext_rename = TomlTable("processors.rename").set("namepass", [plugin])
+            metricsext_rename.add_table("replace").set("measurement", plugin).set("dest", MetricsExtensionNamepsace)
+            metricsext_renames.append(metricsext_rename)
 
-                #Use the shortest interval time for the whole plugin
-                new_interval = telegraf_json[omiclass][plugin][field]["interval"]
-                if int(new_interval[:-1]) < int(min_interval[:-1]):
-                    min_interval = new_interval
+            ops_fields = []
+            non_ops_fields = []
+            rate_aggregate = False
+            for field in fields:
+                counter_name = plugin_fields[field]["ladtablekey"] if is_lad else plugin_fields[field]["displayName"]
 
                 #compute values for aggregator options
-                if "op" in telegraf_json[omiclass][plugin][field]:
-                    if telegraf_json[omiclass][plugin][field]["op"] == "rate":
+                if "op" in plugin_fields[field]:
+                    if plugin_fields[field]["op"] == "rate":
                         rate_aggregate = True
-                        ops = "\"rate\", \"rate_min\", \"rate_max\", \"rate_count\", \"rate_sum\", \"rate_mean\""
-                    if is_lad:
-                        ops_fields += "\"" +  telegraf_json[omiclass][plugin][field]["ladtablekey"] + "\", "
-                    else:
-                        ops_fields += "\"" +  telegraf_json[omiclass][plugin][field]["displayName"] + "\", "
-                else:
-                    non_rate_aggregate = True
-                    if is_lad:
-                        non_ops_fields += "\"" +  telegraf_json[omiclass][plugin][field]["ladtablekey"] + "\", "
-                    else:
-                        non_ops_fields += "\"" +  telegraf_json[omiclass][plugin][field]["displayName"] + "\", "
-
-                #Aggregation perdiod needs to be double of interval/polling period for metrics for rate aggegation to work properly
-                if int(min_interval[:-1]) > 30:
-                    min_agg_period = str(int(min_interval[:-1])*2)  #if the min interval is greater than 30, use the double value
+                    ops_fields.append(counter_name)
                 else:
-                    min_agg_period = "60"   #else use 60 as mininum so that we can maintain 1 event per minute
+                    non_ops_fields.append(counter_name)
 
-                #Add respective rename processor plugin based on the displayname
-                if is_lad:
-                    lad_specific_rename_str += "\n" + " "*2 + "[[processors.rename.replace]]\n"
-                    lad_specific_rename_str += " "*4 + "field = \"" + field + "\"\n"
-                    lad_specific_rename_str += " "*4 + "dest = \"" + telegraf_json[omiclass][plugin][field]["ladtablekey"] + "\"\n"
-                else:
-                    ama_rename_str += "\n" + " "*2 + "[[processors.rename.replace]]\n"
-                    ama_rename_str += " "*4 + "field = \"" + field + "\"\n"
-                    ama_rename_str += " "*4 + "dest = \"" + telegraf_json[omiclass][plugin][field]["displayName"] + "\"\n"
+                storage_rename.add_table("replace").set("field", field).set("dest", counter_name)
 
                 # Avoid adding the rename logic for the redundant *_filesystem fields for diskio which were added specifically for OMI parity in LAD
                 # Had to re-use these six fields to avoid renaming issues since both Filesystem and Disk in OMI-LAD use them
                 # AMA only uses them once so only need this for LAD
-                if is_lad:
-                    if field in excess_diskio_plugin_list_lad:
-                        excess_diskio_field_drop_list_str += "\"" + field + "\", "
-                    else:
-                        metricsext_rename_str += "\n" + " "*2 + "[[processors.rename.replace]]\n"
-                        metricsext_rename_str += " "*4 + "field = \"" + field + "\"\n"
-                        metricsext_rename_str += " "*4 + "dest = \"" + plugin + "/" + field + "\"\n"
+                if is_lad and field in excess_diskio_plugin_list_lad:
+                    if field not in excess_diskio_field_drop_list:
+                        excess_diskio_field_drop_list.append(field)
                 else:
-                    metricsext_rename_str += "\n" + " "*2 + "[[processors.rename.replace]]\n"
-                    metricsext_rename_str += " "*4 + "field = \"" + field + "\"\n"
-                    metricsext_rename_str += " "*4 + "dest = \"" + plugin + "/" + field + "\"\n"
+                    metricsext_rename.add_table("replace").set("field", field).set("dest", plugin + "/" + field)
 
             #Add respective operations for aggregators
-            # if is_lad:
             if rate_aggregate:
-                aggregator_str += "[[aggregators.basicstats]]\n"
-                aggregator_str += " "*2 + "namepass = [\"" + plugin + "_total\"]\n"
-                aggregator_str += " "*2 + "period = \"" + min_agg_period + "s\"\n"
-                aggregator_str += " "*2 + "drop_original = true\n"
-                aggregator_str += " "*2 + "fieldpass = [" + ops_fields[:-2] + "]\n" #-2 to strip the last comma and space
-                aggregator_str += " "*2 + "stats = [" + ops + "]\n"
-                aggregator_str += " "*2 + "rate_period = \"" + min_agg_period + "s\"\n\n"
-
-            if non_rate_aggregate:
-                aggregator_str += "[[aggregators.basicstats]]\n"
-                aggregator_str += " "*2 + "namepass = [\"" + plugin + "_total\"]\n"
-                aggregator_str += " "*2 + "period = \"" + min_agg_period + "s\"\n"
-                aggregator_str += " "*2 + "drop_original = true\n"
-                aggregator_str += " "*2 + "fieldpass = [" + non_ops_fields[:-2] + "]\n" #-2 to strip the last comma and space
-                aggregator_str += " "*2 + "stats = [\"mean\", \"max\", \"min\", \"sum\", \"count\"]\n\n"
-
-
-
-
-            if is_lad:
-                lad_specific_rename_str += "\n"
-            else:
-                ama_rename_str += "\n"
-
-            # Using fields[: -2] here to get rid of the last ", " at the end of the string
-            input_str += " "*2 + "fieldpass = ["+fields[:-2]+"]\n"
-            if plugin == "cpu":
-                input_str += " "*2 + "report_active = true\n"
-            input_str += " "*2 + "interval = " + "\"" + min_interval + "\"\n\n"
-
-            config_file["data"] = input_str + "\n" +  metricsext_rename_str + "\n" + ama_rename_str + "\n" + lad_specific_rename_str + "\n"  +aggregator_str
-
-            output.append(config_file)
-            config_file = {}
+                aggregators.append(TomlTable("aggregators.basicstats")
+                                   .set("namepass", [total_plugin_name])
+                                   .set("period", min_agg_period + "s")
+                                   .set("drop_original", True)
+                                   .set("fieldpass", ops_fields)
+                                   .set("stats", ["rate", "rate_min", "rate_max", "rate_count", "rate_sum", "rate_mean"])
+                                   .set("rate_period", min_agg_period + "s"))
+
+            if non_ops_fields:
+                aggregators.append(TomlTable("aggregators.basicstats")
+                                   .set("namepass", [total_plugin_name])
+                                   .set("period", min_agg_period + "s")
+                                   .set("drop_original", True)
+                                   .set("fieldpass", non_ops_fields)
+                                   .set("stats", ["mean", "max", "min", "sum", "count"]))
+
+        config = TomlDocument()
+        for table in inputs + metricsext_renames + ama_renames + lad_specific_renames + aggregators:
+            config.add(table)
+        output.append({"filename" : omiclass+".conf", "data": config.render()})
 
     """
     Sample telegraf TOML file output
 
     [[inputs.net]]
+      fieldpass = ["bytes_sent", "err_out", "packets_recv"]
+      interval = "15s"
 
-    fieldpass = ["err_out", "packets_sent", "err_in", "bytes_sent", "packets_recv"]
-    interval = "5s"
+    [[processors.rename]]
+      namepass = ["net"]
 
-    [[inputs.cpu]]
+      [[processors.rename.replace]]
+        measurement = "net"
+        dest = "Azure.VM.Linux.GuestMetrics"
 
-    fieldpass = ["usage_nice", "usage_user", "usage_idle", "usage_active", "usage_irq", "usage_system"]
-    interval = "15s"
+      [[processors.rename.replace]]
+        field = "bytes_sent"
+        dest = "net/bytes_sent"
 
     [[processors.rename]]
+      namepass = ["net_total"]
 
-    [[processors.rename.replace]]
-        measurement = "net"
-        dest = "network"
-
-    [[processors.rename.replace]]
-        field = "err_out"
-        dest = "Packets sent errors"
+      [[processors.rename.replace]]
+        field = "bytes_sent"
+        dest = "/builtin/network/bytestransmitted"
 
     [[aggregators.basicstats]]
-    period = "30s"
-    drop_original = false
-    fieldpass = ["Disk reads", "Disk writes", "Filesystem write bytes/sec"]
-    stats = ["rate"]
+      namepass = ["net_total"]
+      period = "60s"
+      drop_original = true
+      fieldpass = ["/builtin/network/bytestransmitted", "/builtin/network/totalrxerrors"]
+      stats = ["mean", "max", "min", "sum", "count"]
 
     """
 
     ## Get the log folder directory from HandlerEnvironment.json and use that for the telegraf default logging
     logFolder, _ = get_handler_vars()
-    for measurement in storage_namepass_list:
-        storage_namepass_str += "\"" + measurement + "\", "
-
 
     # Telegraf basic agent and output config
-    agentconf = "[agent]\n"
-    agentconf += "  interval = \"10s\"\n"
-    agentconf += "  round_interval = true\n"
-    agentconf += "  metric_batch_size = 1000\n"
-    agentconf += "  metric_buffer_limit = 1000000\n"
-    agentconf += "  collection_jitter = \"0s\"\n"
-    agentconf += "  flush_interval = \"10s\"\n"
-    agentconf += "  flush_jitter = \"0s\"\n"
-    agentconf += "  logtarget = \"file\"\n"
-    agentconf += "  quiet = true\n"
-    agentconf += "  logfile = \"" + logFolder + "/telegraf.log\"\n"
-    agentconf += "  logfile_rotation_max_size = \"100MB\"\n"
-    agentconf += "  logfile_rotation_max_archives = 5\n"
-    agentconf += "\n# Configuration for adding gloabl tags\n"
-    agentconf += "[global_tags]\n"
-    agentconf += "  DeploymentId= \"${DeploymentId}\"\n"
-    agentconf += "  \"microsoft.subscriptionId\"= \"" + subscription_id + "\"\n"
-    agentconf += "  \"microsoft.resourceGroupName\"= \"" + resource_group + "\"\n"
-    agentconf += "  \"microsoft.regionName\"= \"" + region + "\"\n"
-    agentconf += "  \"microsoft.resourceId\"= \"" + az_resource_id + "\"\n"
+    agentconf = TomlDocument()
+    agentconf.add_table("agent", is_array=False) \
+        .set("interval", "10s") \
+        .set("round_interval", True) \
+        .set("metric_batch_size", 1000) \
+        .set("metric_buffer_limit", 1000000) \
+        .set("collection_jitter", "0s") \
+        .set("flush_interval", "10s") \
+        .set("flush_jitter", "0s") \
+        .set("logtarget", "file") \
+        .set("quiet", True) \
+        .set("logfile", logFolder + "/telegraf.log") \
+        .set("logfile_rotation_max_size", "100MB") \
+        .set("logfile_rotation_max_archives", 5)
+    global_tags = agentconf.add_table("global_tags", is_array=False, comment="Configuration for adding gloabl tags") \
+        .set("DeploymentId", "${DeploymentId}") \
+        .set("microsoft.subscriptionId", subscription_id) \
+        .set("microsoft.resourceGroupName", resource_group) \
+        .set("microsoft.regionName", region) \
+        .set("microsoft.resourceId", az_resource_id)
     if virtual_machine_name != "":
-        agentconf += "  \"virtualMachine\"= \"" + virtual_machine_name + "\"\n"
-    agentconf += "\n# Configuration for sending metrics to MetricsExtension\n"
-    agentconf += "[[outputs.influxdb]]\n"
-    agentconf += "  namedrop = [" + storage_namepass_str[:-2] + "]\n"
+        global_tags.set("virtualMachine", virtual_machine_name)
+    me_output = agentconf.add_table("outputs.influxdb", comment="Configuration for sending metrics to MetricsExtension")
+    me_output.set("namedrop", storage_namepass_list)
     if is_lad:
-        agentconf += "  fielddrop = [" + excess_diskio_field_drop_list_str[:-2] + "]\n"
-    agentconf += "  urls = [\"" + str(me_url) + "\"]\n\n"
-    agentconf += "\n# Configuration for sending metrics to MDSD\n"
-    agentconf += "[[outputs.socket_writer]]\n"
-    agentconf += "  namepass = [" + storage_namepass_str[:-2] + "]\n"
-    agentconf += "  data_format = \"influx\"\n\n"
-    agentconf += "  address = \"" + str(mdsd_url) + "\"\n\n"
-    agentconf += "\n# Configuration for outputing metrics to file. Uncomment to enable.\n"
-    agentconf += "#[[outputs.file]]\n"
-    agentconf += "#  files = [\"./metrics_to_file.out\"]\n\n"
-
-    agent_file = {"filename":"telegraf.conf", "data": agentconf}
+        me_output.set("fielddrop", excess_diskio_field_drop_list)
+    me_output.set("urls", [str(me_url)])
+    agentconf.add_table("outputs.socket_writer", comment="Configuration for sending metrics to MDSD") \
+        .set("namepass", storage_namepass_list) \
+        .set("data_format", "influx") \
+        .set("address", str(mdsd_url))
+    agentconf.add_comment("Configuration for outputing metrics to file. Uncomment to enable.\n"
+                          "[[outputs.file]]\n"
+                          "  files = [\"./metrics_to_file.out\"]")
+
+    agent_file = {"filename":"telegraf.conf", "data": agentconf.render()}
     output.append(agent_file)
 
 
     return output, storage_namepass_list
 
 
+def _read_file(path):
+    try:
+        with open(path, "r") as f:
+            return f.read()
+    except IOError:
+        return None
+
+
+def _write_file_atomically(path, data):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(data)
+    os.rename(tmp_path, path)
+
+
 def write_configs(configs, telegraf_conf_dir, telegraf_d_conf_dir):
     """
-    Write the telegraf config created by config parser method to disk at the telegraf config location
+    Write the telegraf config created by config parser method to disk at the telegraf config location.
+    The config is compared with the deployed one: only the files whose content changed are (atomically) rewritten, and
+    the files of telegraf_d_conf_dir that are no longer generated are removed.
     :param configs: Telegraf config data parsed by the parse_config method above
     :param telegraf_conf_dir: Path where the telegraf.conf is written to on the disk
     :param telegraf_d_conf_dir: Path where the individual module telegraf configs are written to on the disk
+    :return: None if the telegraf config didn't change, "reload" if telegraf needs to reload its config, or "restart"
+             if the input or output plugins changed
     """
 
     if not os.path.exists(telegraf_conf_dir):
@@ -374,14 +451,34 @@ def write_configs(configs, telegraf_conf_dir, telegraf_d_conf_dir):
     if not os.path.exists(telegraf_d_conf_dir):
         os.mkdir(telegraf_d_conf_dir)
 
+    generated = {}
     for configfile in configs:
         if configfile["filename"] == "telegraf.conf" or configfile["filename"] == "intermediate.json":
             path = telegraf_conf_dir + configfile["filename"]
         else:
             path = telegraf_d_conf_dir + configfile["filename"]
-        with open(path, "w") as f:
-            f.write(configfile["data"])
-
+        generated[path] = configfile["data"]
+
+    # Config files read by telegraf: telegraf.conf and telegraf.d/*.conf
+    telegraf_paths = set([telegraf_conf_dir + "telegraf.conf"])
+    telegraf_paths.update(telegraf_d_conf_dir + name for name in os.listdir(telegraf_d_conf_dir) if name.endswith(".conf"))
+    telegraf_paths.update(path for path in generated if path.endswith(".conf"))
+    deployed = dict((path, _read_file(path)) for path in telegraf_paths)
+
+    for path, data in generated.items():
+        if _read_file(path) != data:
+            _write_file_atomically(path, data)
+    for path in telegraf_paths:
+        if path not in generated and deployed[path] is not None:
+            os.remove(path)
+
+    old_texts = [text for text in deployed.values() if text is not None]
+    new_texts = [generated[path] for path in telegraf_paths if path in generated]
+    if sorted(old_texts) == sorted(new_texts):
+        return None
+    if get_plugin_signature(old_texts) != get_plugin_signature(new_texts):
+        return "restart"
+    return "reload"
 
 
 def get_handler_vars():
@@ -406,22 +503,111 @@ def get_handler_vars():
     return logFolder, configFolder
 
 
-def is_running(is_lad):
+def get_telegraf_pid(is_lad):
     """
-    This method is used to check if telegraf binary is currently running on the system or not.
-    In order to check whether it needs to be restarted from the watcher daemon
+    Find the running telegraf process in /proc, rather than parsing the output of ps.
+    :param is_lad: boolean whether the extension is LAD or not (AMA)
+    :return: The pid of the telegraf process, or None if it isn't running
     """
     if is_lad:
         telegraf_bin = metrics_constants.lad_telegraf_bin
     else:
         telegraf_bin = metrics_constants.ama_telegraf_bin
 
-    proc = subprocess.Popen(["ps  aux | grep telegraf | grep -v grep"], stdout=subprocess.PIPE, shell=True)
-    output = proc.communicate()[0]
-    if telegraf_bin in output:
-        return True
-    else:
-        return False
+    return find_pid_by_executable(telegraf_bin)
+
+
+def _get_socket_inodes(pid):
+    """
+    Get the sockets opened by a process, from the links in /proc/<pid>/fd (e.g., "socket:[12345]").
+    """
+    sockets = set()
+    fd_dir = "/proc/{0}/fd".format(pid)
+    try:
+        fds = os.listdir(fd_dir)
+    except OSError:
+        return sockets
+    for fd in fds:
+        try:
+            link = os.readlink(os.path.join(fd_dir, fd))
+        except OSError:
+            continue
+        if link.startswith("socket:"):
+            sockets.add(link)
+    return sockets
+
+
+def _wait_for_telegraf_ready(pid, previous_sockets=frozenset(), timeout=10, is_alive=None):
+    """
+    Wait until telegraf has loaded its config and connected its outputs, i.e., until it has sockets other than the
+    ones it had before (previous_sockets) being started or reloaded. Telegraf exits if its config is invalid.
+    :param pid: pid of the telegraf process
+    :param previous_sockets: Sockets of the process before it was signalled to reload its config
+    :param timeout: Max seconds to wait. Telegraf is considered running if it's still alive by then.
+    :param is_alive: Function telling whether the process is alive; defaults to a /proc check
+    :return bool: False if telegraf exited
+    """
+    is_alive = is_alive or (lambda: is_process_alive(pid))
+    deadline = time.time() + timeout
+    while is_alive():
+        sockets = _get_socket_inodes(pid)
+        if sockets and sockets != previous_sockets or time.time() >= deadline:
+            return True
+        time.sleep(0.1)
+    return False
+
+
+def _wait_for_telegraf_pid(is_lad, timeout=10):
+    """
+    Wait for telegraf to show up in /proc. "systemctl restart" can return before the service process has exec'ed the
+    telegraf binary.
+    :param is_lad: boolean whether the extension is LAD or not (AMA)
+    :param timeout: Max seconds to wait
+    :return: The pid of the telegraf process, or None if it isn't running by then
+    """
+    deadline = time.time() + timeout
+    while True:
+        telegraf_pid = get_telegraf_pid(is_lad)
+        if telegraf_pid is not None or time.time() >= deadline:
+            return telegraf_pid
+        time.sleep(0.1)
+
+
+def _get_telegraf_service_state():
+    """
+    Get the state of the metrics-sourcer service, e.g. "active", "activating" (also while systemd waits to restart
+    it after a failure), "failed" (systemd gave up restarting it) or "inactive".
+    """
+    try:
+        proc = subprocess.Popen(["systemctl", "is-active", "metrics-sourcer"], stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        out, _ = proc.communicate()
+    except OSError:
+        return ""
+    return out.strip()
+
+
+def wait_for_systemd_restart(is_lad):
+    """
+    With systemd, telegraf is restarted by systemd when it fails (Restart=on-failure in metrics-sourcer.service).
+    Callers that also keep telegraf running (the LAD process supervisor) wait for that restart instead of racing it
+    with one of their own.
+    :param is_lad: boolean whether the extension is LAD or not (AMA)
+    :return: The pid of the telegraf restarted by systemd, or None if systemd isn't restarting it (no systemd,
+             telegraf exited cleanly, or systemd gave up), in which case the caller has to start it
+    """
+    if not is_systemd() or _get_telegraf_service_state() not in ("active", "activating", "reloading"):
+        return None
+    return _wait_for_telegraf_pid(is_lad)
+
+
+def is_running(is_lad):
+    """
+    This method is used to check if telegraf binary is currently running on the system or not.
+    In order to check whether it needs to be restarted from the watcher daemon
+    """
+    return get_telegraf_pid(is_lad) is not None
+
 
 def stop_telegraf_service(is_lad):
     """
@@ -458,10 +644,8 @@ def stop_telegraf_service(is_lad):
             with open(telegraf_pid_path, "r") as f:
                 pid = f.read()
             if pid != "":
-                # Check if the process running is indeed telegraf, ignore if the process output doesn't contain telegraf
-                proc = subprocess.Popen(["ps -o cmd= {0}".format(pid)], stdout=subprocess.PIPE, shell=True)
-                output = proc.communicate()[0]
-                if telegraf_bin in output:
+                # Check if the process running is indeed telegraf, ignore if the process isn't telegraf
+                if get_process_executable(pid.strip()) == telegraf_bin:
                     os.kill(int(pid), signal.SIGKILL)
                 else:
                     return False, "Found a different process running with PID {0}. Failed to stop telegraf.".format(pid)
@@ -514,20 +698,19 @@ def setup_telegraf_service(telegraf_bin, telegraf_d_conf_dir, telegraf_agent_con
 
     if os.path.isfile(telegraf_service_template_path):
 
-        copyfile(telegraf_service_template_path, telegraf_service_path)
+        service = _read_file(telegraf_service_template_path)
+        service = service.replace("%TELEGRAF_BIN%", telegraf_bin)
+        service = service.replace("%TELEGRAF_AGENT_CONFIG%", telegraf_agent_conf)
+        service = service.replace("%TELEGRAF_CONFIG_DIR%", telegraf_d_conf_dir)
 
-        if os.path.isfile(telegraf_service_path):
-            os.system(r"sed -i 's+%TELEGRAF_BIN%+{1}+' {0}".format(telegraf_service_path, telegraf_bin))
-            os.system(r"sed -i 's+%TELEGRAF_AGENT_CONFIG%+{1}+' {0}".format(telegraf_service_path, telegraf_agent_conf))
-            os.system(r"sed -i 's+%TELEGRAF_CONFIG_DIR%+{1}+' {0}".format(telegraf_service_path, telegraf_d_conf_dir))
+        # Only reload systemd if the service file actually changed
+        if _read_file(telegraf_service_path) != service:
+            _write_file_atomically(telegraf_service_path, service)
 
             daemon_reload_status = os.system("sudo systemctl daemon-reload")
             if daemon_reload_status != 0:
                 raise Exception("Unable to reload systemd after Telegraf service file change. Failed to setup telegraf service.")
                 return False
-        else:
-            raise Exception("Unable to copy Telegraf service template file to {0}. Failed to setup telegraf service.".format(telegraf_service_path))
-            return False
     else:
         raise Exception("Telegraf service template file does not exist at {0}. Failed to setup telegraf service.".format(telegraf_service_template_path))
         return False
@@ -562,6 +745,11 @@ def start_telegraf(is_lad):
             log_messages += "Unable to start Telegraf service. Failed to start telegraf service."
             return False, log_messages
 
+        telegraf_pid = _wait_for_telegraf_pid(is_lad)
+        if telegraf_pid is None or not _wait_for_telegraf_ready(telegraf_pid):
+            log_messages += "Telegraf service exited after being started. Failed to start telegraf service. Check telegraf.log for more info."
+            return False, log_messages
+
     #Else start telegraf as a process and save the pid to a file so that we can terminate it while disabling/uninstalling
     else:
         _, configFolder = get_handler_vars()
@@ -572,12 +760,11 @@ def start_telegraf(is_lad):
 
         binary_exec_command = "{0} --config {1} --config-directory {2}".format(telegraf_bin, telegraf_agent_conf, telegraf_d_conf_dir)
         proc = subprocess.Popen(binary_exec_command.split(" "), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        # Sleeping for 3 seconds before checking if the process is still running, to give it ample time to relay crash info
-        time.sleep(3)
-        p = proc.poll()
+        # Wait until telegraf is ready (or crashed), to relay crash info
+        ready = _wait_for_telegraf_ready(proc.pid, is_alive=lambda: proc.poll() is None)
 
         # Process is running successfully
-        if p is None:
+        if ready:
             telegraf_pid = proc.pid
 
             # Write this pid to a file for future use
@@ -590,9 +777,47 @@ def start_telegraf(is_lad):
     return True, log_messages
 
 
+def reload_telegraf(is_lad):
+    """
+    Make the running telegraf reload its config (SIGHUP, as the ExecReload of the metrics-sourcer service), without
+    the metric gap of a restart. Telegraf is restarted if it isn't running.
+    :param is_lad: boolean whether the extension is LAD or not (AMA)
+    """
+    telegraf_pid = get_telegraf_pid(is_lad)
+    if telegraf_pid is None:
+        return start_telegraf(is_lad)
+
+    previous_sockets = _get_socket_inodes(telegraf_pid)
+    try:
+        os.kill(telegraf_pid, signal.SIGHUP)
+    except OSError as e:
+        return False, "Unable to signal telegraf (pid {0}) to reload its config - {1}. Failed to reload telegraf.".format(telegraf_pid, e)
+    if not _wait_for_telegraf_ready(telegraf_pid, previous_sockets):
+        return False, "Telegraf exited while reloading its config. Failed to reload telegraf. Check telegraf.log for more info."
+    return True, ""
+
+
+def apply_config_changes(is_lad):
+    """
+    Apply the config written by the last handle_config call to telegraf: reload the config if only settings changed,
+    restart telegraf if its input or output plugins changed, and leave it alone if the config didn't change.
+    Telegraf is started if it isn't running.
+    :param is_lad: boolean whether the extension is LAD or not (AMA)
+    """
+    global _pending_config_change
+    config_change, _pending_config_change = _pending_config_change, None
+
+    if config_change == "restart" or not is_running(is_lad):
+        return start_telegraf(is_lad)
+    if config_change == "reload":
+        return reload_telegraf(is_lad)
+    return True, "Telegraf config is unchanged. Not restarting telegraf."
+
+
 def handle_config(config_data, me_url, mdsd_url, is_lad):
     """
-    The main method to perfom the task of parsing the config , writing them to disk, setting up, stopping, removing and starting telegraf
+    The main method to perfom the task of parsing the config , writing them to disk, setting up, stopping, removing and starting telegraf.
+    Only the changes to the deployed config are written; apply_config_changes then reloads or restarts telegraf as needed.
     :param config_data: Parsed Metrics Configuration from which telegraf config is created
     :param me_url: The url to which telegraf will send metrics to for MetricsExtension
     :param mdsd_url: The url to which telegraf will send metrics to for MDSD
@@ -665,8 +890,11 @@ def handle_config(config_data, me_url, mdsd_url, is_lad):
     telegraf_d_conf_dir = telegraf_conf_dir + "telegraf.d/"
 
 
-    #call the method to write the configs
-    write_configs(output, telegraf_conf_dir, telegraf_d_conf_dir)
+    #call the method to write the configs, and remember how to apply them (see apply_config_changes)
+    global _pending_config_change
+    config_change = write_configs(output, telegraf_conf_dir, telegraf_d_conf_dir)
+    if config_change == "restart" or _pending_config_change is None:
+        _pending_config_change = config_change
 
     # Setup Telegraf service.
     # If the VM has systemd, then we will copy over the systemd unit file and use that to start/stop
@@ -152,6 +152,8 @@ GUIDRegex = '[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-f
 OAuthTokenResource = 'https://management.core.windows.net/'
 OMSServiceValidationEndpoint = 'https://global.oms.opinsights.azure.com/ManagedIdentityService.svc/Validate'
 AutoManagedWorkspaceCreationSleepSeconds = 20
+# Seconds to wait for the telemetry process to write its buffered events and exit
+TelemetryStopTimeoutSeconds = 10
 
 # vmResourceId Metadata Service
 VMResourceIDMetadataHost = '169.254.169.254'
@@ -360,8 +362,25 @@ def stop_telemetry_process():
             for pids in f.readlines():
                 kill_cmd = "kill " + pids
                 run_command_and_log(kill_cmd)
+                wait_for_process_exit(pids.strip(), TelemetryStopTimeoutSeconds)
                 run_command_and_log("rm "+pids_filepath)
 
+def wait_for_process_exit(pid, timeout):
+    """
+    Wait up to timeout seconds for the process to exit
+    :return: True if the process is gone
+    """
+    deadline = time.time() + timeout
+    while True:
+        try:
+            os.kill(int(pid), 0)
+        except (OSError, ValueError):
+            return True
+        if time.time() >= deadline:
+            hutil_log_info('Process {0} still running after {1} seconds'.format(pid, timeout))
+            return False
+        time.sleep(0.1)
+
 def start_telemetry_process():
     """
     Start telemetry process that performs periodic monitoring activities
@@ -388,11 +407,17 @@ def telemetry():
     watcher_thread = Thread(target = watcher.watch)
     self_mon_thread = Thread(target = watcher.monitor_health)
 
+    # stop_telemetry_process sends SIGTERM: stop the watcher so that it writes
+    # the telemetry events it buffered before the process exits
+    signal.signal(signal.SIGTERM, lambda signum, frame: watcher.stop())
+
     watcher_thread.start()
     self_mon_thread.start()
 
-    watcher_thread.join()
-    self_mon_thread.join()
+    # Join with a timeout, so that the main thread gets to run the signal handler
+    for thread in [watcher_thread, self_mon_thread]:
+        while thread.is_alive():
+            thread.join(1)
 
     return 0, ""
 
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+#
+# OmsAgent extension
+#
+# Copyright 2014 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Compares Watcher.check_for_fatal_oms_logs with the line by line scan it replaced, on synthetic omsagent logs:
+# - "long gap": GBs of logs older than 10 minutes, then the recent minutes (e.g. the first check after a restart)
+# - "recent": a log entirely written in the last 10 minutes, which has to be scanned in full
+# Usage: benchmark_fatal_log_scan.py [size in MB, default 2048] [directory for the log, default /tmp]
+
+import env
+import os
+import shutil
+import sys
+import tempfile
+import time
+import watcherutil
+
+ChunkLines = 8192
+
+
+def fluent_log_line(log_time, level, message):
+    return "{0} +0000 [{1}]: {2}\n".format(time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(log_time)), level, message)
+
+
+def make_chunk(log_time):
+    lines = []
+    for i in range(0, ChunkLines):
+        if i % 64 == 0:
+            lines.append(fluent_log_line(log_time, "error", "Unexpected error Errno::ECONNRESET"))
+            lines.append("  /opt/microsoft/omsagent/plugin/out_oms.rb:{0}:in `handle_record'\n".format(i))
+        elif i % 16 == 0:
+            lines.append(fluent_log_line(log_time, "warn", "buffer flush took longer time than slow_flush_log_threshold"))
+        else:
+            lines.append(fluent_log_line(log_time, "info", "Sent data to ODS in {0} ms".format(i)))
+    return "".join(lines).encode("utf-8")
+
+
+def write_log(path, size, stale):
+    now = int(time.time())
+    with open(path, "wb") as f:
+        written = 0
+        chunk = make_chunk(now - 24 * 3600 if stale else now - 60)
+        while written < size:
+            f.write(chunk)
+            written += len(chunk)
+        f.write(make_chunk(now - 60))
+        f.write(fluent_log_line(now - 10, "warn", "Fatal error, can not clear buffer file").encode("utf-8"))
+
+
+def scan_line_by_line(watcher, path):
+    """
+        The scan check_for_fatal_oms_logs used to do: parse every line, check the warn and error ones against
+        every error statement.
+    """
+    read_start_time = int(time.time())
+    with open(path, "r") as f:
+        for text in f:
+            res = watcherutil.reg_ex.match(text)
+            if res:
+                log_entry_time = watcher.get_total_seconds_from_epoch_for_fluent_logs(res.group(1))
+                if (log_entry_time + (10 * 60) < read_start_time):
+                    pass
+                elif (res.group(2) == "warn" or res.group(2) == "error"):
+                    for error_statement in watcherutil.ErrorStatements:
+                        if (error_statement in res.group(3)):
+                            return True
+    return False
+
+
+def timeit(func):
+    start = time.time()
+    result = func()
+    return time.time() - start, result
+
+
+def report(name, size, seconds, found):
+    print("{0:<30}{1:>10.2f} s{2:>10.1f} MB/s  found={3}".format(name, seconds, size / seconds / 1024 / 1024, found))
+
+
+if __name__ == '__main__':
+    size = int(sys.argv[1]) * 1024 * 1024 if len(sys.argv) > 1 else 2048 * 1024 * 1024
+    log_dir = tempfile.mkdtemp(dir=sys.argv[2] if len(sys.argv) > 2 else None)
+    watcher = watcherutil.Watcher(lambda message: None, lambda message: None)
+    watcherutil.OmsAgentLogFile = os.path.join(log_dir, "omsagent.log")
+    try:
+        for name, stale in (("long gap", True), ("recent", False)):
+            write_log(watcherutil.OmsAgentLogFile, size, stale)
+            file_size = os.path.getsize(watcherutil.OmsAgentLogFile)
+            print("{0}: {1} MB".format(name, file_size // 1024 // 1024))
+            seconds, found = timeit(lambda: scan_line_by_line(watcher, watcherutil.OmsAgentLogFile))
+            report("  line by line", file_size, seconds, found)
+            seconds, found = timeit(lambda: watcher.check_for_fatal_oms_logs(watcherutil.LogFileMarker()))
+            report("  check_for_fatal_oms_logs", file_size, seconds, found)
+    finally:
+        shutil.rmtree(log_dir)
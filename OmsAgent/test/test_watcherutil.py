@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+#
+# OmsAgent extension
+#
+# Copyright 2014 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import env
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import watcherutil
+
+OmsAgentUid = 1001
+ClockTicks = 100.0
+
+
+class FakeProc(object):
+    """
+        Synthetic /proc tree.
+    """
+    def __init__(self):
+        self.root = tempfile.mkdtemp()
+        self.write("meminfo", "MemTotal:        8000000 kB\nMemFree:         4000000 kB\n")
+        self.set_uptime(1000)
+
+    def write(self, path, content):
+        path = os.path.join(self.root, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "w") as f:
+            f.write(content)
+
+    def set_uptime(self, uptime):
+        self.write("uptime", "{0} 3000.00\n".format(uptime))
+
+    def add_process(self, pid, name, utime, stime, start_time, rss_kb, uid=OmsAgentUid):
+        fields = ["S", "1", str(pid), str(pid), "0", "-1", "4194560", "100", "0", "0", "0",
+                  str(utime), str(stime), "0", "0", "20", "0", "2", "0", str(int(start_time * ClockTicks)),
+                  "300000000", str(rss_kb // 4)]
+        self.write(os.path.join(str(pid), "stat"), "{0} ({1}) {2}\n".format(pid, name, " ".join(fields)))
+        self.write(os.path.join(str(pid), "status"),
+                   "Name:\t{0}\nUid:\t{1}\t{1}\t{1}\t{1}\nVmRSS:\t{2} kB\n".format(name, uid, rss_kb))
+
+    def remove_process(self, pid):
+        shutil.rmtree(os.path.join(self.root, str(pid)))
+
+    def cleanup(self):
+        shutil.rmtree(self.root)
+
+
+class TestProcessResourceSampler(unittest.TestCase):
+    def setUp(self):
+        self.proc = FakeProc()
+        self.sampler = watcherutil.ProcessResourceSampler(proc_root=self.proc.root, user_name="root")
+        self.sampler._uid = OmsAgentUid
+        self.sampler._clock_ticks = ClockTicks
+
+    def tearDown(self):
+        self.proc.cleanup()
+
+    def test_first_sample_is_lifetime_average(self):
+        # 200s of CPU over its 800s of life, 400MB of RSS
+        self.proc.add_process(1234, "omsagent", 15000, 5000, 200, 400000)
+        # A worker with the same name: 50s over 500s
+        self.proc.add_process(1240, "omsagent", 4000, 1000, 500, 400000)
+        # Not omsagent, or not run by the omsagent user, or with spaces in its name
+        self.proc.add_process(99, "ruby", 50000, 0, 100, 2000000)
+        self.proc.add_process(100, "omsagent", 50000, 0, 100, 2000000, uid=0)
+        self.proc.add_process(101, "omsagent worker", 50000, 0, 100, 2000000)
+
+        memory, cpu = self.sampler.sample()
+        self.assertEqual(memory, 10.0)
+        self.assertEqual(cpu, 35.0)
+
+    def test_cpu_is_computed_over_the_interval(self):
+        self.proc.add_process(1234, "omsagent", 15000, 5000, 200, 400000)
+        self.proc.add_process(1240, "omsagent", 4000, 1000, 500, 400000)
+        self.sampler.sample()
+
+        # 30s of CPU in 60s, and the worker exited
+        self.proc.set_uptime(1060)
+        self.proc.add_process(1234, "omsagent", 17000, 6000, 200, 800000)
+        self.proc.remove_process(1240)
+        self.assertEqual(self.sampler.sample(), (10.0, 50.0))
+
+        # The pid got reused by a new process, started 20s ago: all its CPU time is in the interval
+        self.proc.set_uptime(1180)
+        self.proc.add_process(1234, "omsagent", 1000, 200, 1160, 400000)
+        self.assertEqual(self.sampler.sample(), (5.0, 10.0))
+
+    def test_no_process(self):
+        self.assertEqual(self.sampler.sample(), (0.0, 0.0))
+        self.proc.set_uptime(1060)
+        self.assertEqual(self.sampler.sample(), (0.0, 0.0))
+
+    def test_errors_report_no_usage(self):
+        errors = []
+        watcher = watcherutil.Watcher(errors.append, lambda message: None)
+        watcher._resource_sampler = self.sampler
+        os.remove(os.path.join(self.proc.root, "meminfo"))
+        self.assertEqual(watcher.get_oms_agent_resource_usage(), (0.0, 0.0))
+        self.assertEqual(len(errors), 1)
+
+
+class TestSelfMonitorInfo(unittest.TestCase):
+    def test_resource_history(self):
+        self_mon_info = watcherutil.SelfMonitorInfo()
+        self.assertEqual(self_mon_info.average_resource_usage(), (0.0, 0.0))
+        for i in range(0, watcherutil.ResourceHistoryLength + 5):
+            self_mon_info.add_resource_usage(float(i), 2.0 * i)
+        # Only the last samples are kept
+        self.assertEqual(len(self_mon_info._memory_history), watcherutil.ResourceHistoryLength)
+        self.assertEqual(self_mon_info.average_resource_usage(), (9.5, 19.0))
+
+
+
+class TestTelemetryEventBatcher(unittest.TestCase):
+    def setUp(self):
+        self.events_dir = tempfile.mkdtemp()
+        self.now = 1000.0
+        self.logs = []
+        watcher = watcherutil.Watcher(self.logs.append, self.logs.append)
+        self.batcher = watcherutil.TelemetryEventBatcher(watcher.create_telemetry_event, self.logs.append,
+                                                         events_dir=self.events_dir, window=900,
+                                                         max_pending_files=3, clock=lambda: self.now)
+
+    def tearDown(self):
+        shutil.rmtree(self.events_dir)
+
+    def read_events(self):
+        events = []
+        for fn in sorted(os.listdir(self.events_dir)):
+            self.assertTrue(fn.endswith(".tld"))
+            with open(os.path.join(self.events_dir, fn)) as f:
+                parameters = json.loads(f.read())["parameters"]
+            events.append(dict((p["name"], p["value"]) for p in parameters))
+        return events
+
+    def test_events_are_batched_and_deduplicated(self):
+        for i in range(0, 3):
+            self.batcher.add("ODSIngestion", "True", "Sending succeeded", "300000")
+            self.batcher.add("agenttelemetry", "True", "Memory : {0}".format(i), "300000")
+            self.assertEqual(self.batcher.flush(), 0)
+            self.now += 300
+        self.assertEqual(os.listdir(self.events_dir), [])
+
+        self.assertEqual(self.batcher.flush(), 3)
+        events = self.read_events()
+        self.assertEqual([e["Message"] for e in events],
+                         ["Sending succeeded (occurred 3 times)", "Memory : 0", "Memory : 1"])
+        self.assertEqual(events[0]["Operation"], "ODSIngestion")
+        self.assertEqual(events[0]["OperationSuccess"], True)
+
+        # A new window starts with the next event
+        self.assertEqual(self.batcher.flush(force=True), 0)
+        self.batcher.add("ODSIngestion", "True", "Sending succeeded", "300000")
+        self.assertEqual(self.batcher.flush(), 0)
+
+    def test_pending_files_are_bounded(self):
+        with open(os.path.join(self.events_dir, "1.tld"), "w") as f:
+            f.write("{}")
+        self.batcher.add("ODSIngestion", "True", "Sending succeeded", "300000")
+        self.batcher.add("agenttelemetry", "True", "Memory : 0", "300000")
+        self.batcher.add("dscsetlcm", "False", "Failed to apply", "300000")
+        self.assertEqual(self.batcher.flush(force=True), 2)
+
+        # Failures first, the rest is dropped
+        os.remove(os.path.join(self.events_dir, "1.tld"))
+        self.assertEqual([e["Message"] for e in self.read_events()], ["Failed to apply", "Sending succeeded"])
+        self.assertTrue("dropped 1 of 3" in self.logs[-1])
+
+        self.batcher.add("dscsetlcm", "False", "Failed to apply", "300000")
+        self.assertEqual(self.batcher.flush(force=True), 1)
+        self.batcher.add("dscsetlcm", "False", "Failed to apply", "300000")
+        self.assertEqual(self.batcher.flush(force=True), 0)
+
+    def test_event_files_are_renamed_into_place(self):
+        self.batcher.write_event("{}")
+        self.batcher.write_event("{}")
+        names = sorted(os.listdir(self.events_dir))
+        self.assertEqual(names, ["1000000000.tld", "1000000001.tld"])
+
+
+class TestWatcherStop(unittest.TestCase):
+    def setUp(self):
+        self.events_dir = tempfile.mkdtemp()
+        self.logs = []
+        self.watcher = watcherutil.Watcher(self.logs.append, self.logs.append)
+        self.watcher._telemetry_batcher = watcherutil.TelemetryEventBatcher(
+            self.watcher.create_telemetry_event, self.logs.append, events_dir=self.events_dir)
+
+    def tearDown(self):
+        self.watcher.stop()
+        shutil.rmtree(self.events_dir)
+
+    def test_buffered_events_are_written_on_stop(self):
+        watch_thread = threading.Thread(target=self.watcher.watch)
+        watch_thread.start()
+        self.watcher._telemetry_batcher.add("dscsetlcm", "False", "Failed to apply", "300000")
+        self.assertEqual(os.listdir(self.events_dir), [])
+
+        # The watch loop returns right away instead of finishing its 5 minutes sleep
+        self.watcher.stop()
+        watch_thread.join(5)
+        self.assertFalse(watch_thread.is_alive())
+        self.assertEqual(len(os.listdir(self.events_dir)), 1)
+
+    def test_monitor_health_stops(self):
+        monitor_thread = threading.Thread(target=self.watcher.monitor_health)
+        monitor_thread.start()
+        self.watcher.stop()
+        monitor_thread.join(5)
+        self.assertFalse(monitor_thread.is_alive())
+
+
+
+def fluent_log_line(log_time, level, message):
+    return "{0} +0000 [{1}]: {2}\n".format(time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(log_time)), level, message)
+
+
+class TestFatalLogScan(unittest.TestCase):
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+        self.log_file = os.path.join(self.log_dir, "omsagent.log")
+        self.saved = watcherutil.OmsAgentLogFile, watcherutil.LogScanBlockSize
+        watcherutil.OmsAgentLogFile = self.log_file
+        watcherutil.LogScanBlockSize = 4096
+        self.watcher = watcherutil.Watcher(lambda message: None, lambda message: None)
+        self.marker = watcherutil.LogFileMarker()
+        self.now = int(time.time())
+
+    def tearDown(self):
+        watcherutil.OmsAgentLogFile, watcherutil.LogScanBlockSize = self.saved
+        shutil.rmtree(self.log_dir)
+
+    def append(self, *lines):
+        with open(self.log_file, "a") as f:
+            f.write("".join(lines))
+
+    def test_fatal_log_is_found_once(self):
+        self.append(fluent_log_line(self.now - 60, "info", "starting"),
+                    fluent_log_line(self.now - 30, "warn", "Fatal error, can not clear buffer file"),
+                    fluent_log_line(self.now - 20, "info", "retrying"))
+        self.assertTrue(self.watcher.check_for_fatal_oms_logs(self.marker))
+        self.assertFalse(self.watcher.check_for_fatal_oms_logs(self.marker))
+        self.assertEqual(self.marker._last_pos, os.path.getsize(self.log_file))
+
+        self.append(fluent_log_line(self.now - 10, "error", "Errono::ENOSPC error=28 No space left on the device"))
+        self.assertTrue(self.watcher.check_for_fatal_oms_logs(self.marker))
+
+    def test_other_logs_are_ignored(self):
+        self.append(fluent_log_line(self.now - 3600, "error", "No space left on the device"),
+                    fluent_log_line(self.now - 30, "info", "No space left on the device"),
+                    fluent_log_line(self.now - 20, "error", "flush failed"),
+                    "  No space left on the device (Errno::ENOSPC)\n",
+                    fluent_log_line(self.now - 10, "error", "No space left"))
+        self.assertFalse(self.watcher.check_for_fatal_oms_logs(self.marker))
+
+    def test_partial_line_is_scanned_once_complete(self):
+        line = fluent_log_line(self.now - 10, "warn", "Fatal error, can not clear buffer file")
+        self.append(fluent_log_line(self.now - 20, "info", "starting"), line[:30])
+        self.assertFalse(self.watcher.check_for_fatal_oms_logs(self.marker))
+        self.append(line[30:])
+        self.assertTrue(self.watcher.check_for_fatal_oms_logs(self.marker))
+
+    def test_rotation(self):
+        fatal_line = fluent_log_line(self.now - 10, "error", "No space left on the device")
+        self.append(*[fluent_log_line(self.now - 20, "info", "line {0}".format(i)) for i in range(0, 100)])
+        self.assertFalse(self.watcher.check_for_fatal_oms_logs(self.marker))
+
+        # Replaced by a new file, with the same first line
+        os.rename(self.log_file, self.log_file + ".1")
+        self.append(*[fluent_log_line(self.now - 20, "info", "line {0}".format(i)) for i in range(0, 100)])
+        self.assertFalse(self.watcher.check_for_fatal_oms_logs(self.marker))
+        os.rename(self.log_file, self.log_file + ".2")
+        self.append(fatal_line)
+        self.assertTrue(self.watcher.check_for_fatal_oms_logs(self.marker))
+
+        # Truncated in place
+        self.append(*[fluent_log_line(self.now - 20, "info", "line {0}".format(i)) for i in range(0, 100)])
+        self.assertFalse(self.watcher.check_for_fatal_oms_logs(self.marker))
+        with open(self.log_file, "w") as f:
+            f.write(fatal_line)
+        self.assertTrue(self.watcher.check_for_fatal_oms_logs(self.marker))
+
+    def test_stale_logs_are_skipped(self):
+        # Hours of old logs, with stack traces and old fatal errors, then the last minutes
+        lines = []
+        for i in range(0, 5000):
+            lines.append(fluent_log_line(self.now - 5 * 3600 + i, "error", "No space left on the device"))
+            lines.append("  /opt/microsoft/omsagent/plugin/out_oms.rb:{0}:in `write'\n".format(i))
+        recent_pos = len("".join(lines))
+        lines.append(fluent_log_line(self.now - 60, "info", "recovered"))
+        self.append(*lines)
+
+        with open(self.log_file, "rb") as f:
+            size = os.path.getsize(self.log_file)
+            offset = self.watcher.find_log_offset(f, 0, size, self.now - watcherutil.FatalLogMaxAge)
+        self.assertTrue(recent_pos - watcherutil.LogScanBlockSize <= offset <= recent_pos)
+        self.assertFalse(self.watcher.check_for_fatal_oms_logs(self.marker))
+        self.assertEqual(self.marker._last_pos, os.path.getsize(self.log_file))
+
+        self.append(fluent_log_line(self.now - 10, "warn", "Fatal error, can not clear buffer file"))
+        self.assertTrue(self.watcher.check_for_fatal_oms_logs(self.marker))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -29,12 +29,14 @@ import traceback
 import shutil
 import sys
 import json
-import uuid
-from threading import Thread
+import tempfile
+from threading import Thread, Lock, Event
 import re
-import hashlib
+import pwd
+from collections import deque
 from omsagent import run_command_and_log
 from omsagent import RestartOMSAgentServiceCommand
+from omsagent import AgentUser
 
 """
     Write now hardcode memory threshold to watch for to 20 %.
@@ -46,14 +48,30 @@ from omsagent import RestartOMSAgentServiceCommand
 MemoryThresholdToWatchFor = 20
 OmsAgentPidFile = "/var/opt/microsoft/omsagent/run/omsagent.pid"
 OmsAgentLogFile = "/var/opt/microsoft/omsagent/log/omsagent.log"
+OmsAgentProcessName = "omsagent"
+# Number of resource usage samples kept in SelfMonitorInfo (an hour of health checks).
+ResourceHistoryLength = 10
 reg_ex = re.compile('([0-9]{4}-[0-9]{2}-[0-9]{2}.*)\[(\w+)\]:(.*)')
 maxMessageSize = 100
+WAAgentEventsDir = "/var/lib/waagent/events"
+# Telemetry events are buffered for this many seconds, and identical ones written once with their count.
+TelemetryBatchWindow = 15 * 60
+# Max number of event files waiting for the guest agent (which refuses to write more than 1000 itself).
+MaxPendingEventFiles = 100
 OMSExtensionVersion = '1.13.5'
 """
 We can add to the list below with more error messages to identify non recoverable errors.
 """
 ErrorStatements = ["Errono::ENOSPC error=", "Fatal error, can not clear buffer file", "No space left on the device"]
 
+# The log is scanned in blocks for the error statements, and only the lines containing one are parsed.
+# Searching each of them with bytes.find is an order of magnitude faster than a regex alternation of them.
+error_statements_bytes = [e.encode('utf-8') for e in ErrorStatements]
+reg_ex_bytes = re.compile(reg_ex.pattern.encode('utf-8'))
+LogScanBlockSize = 1024 * 1024
+# Log lines older than this many seconds are ignored, and skipped over by bisection when the log grew a lot.
+FatalLogMaxAge = 10 * 60
+
 class SelfMonitorInfo(object):
     """
         Class to hold self mon info for omsagent.
@@ -64,6 +82,21 @@ class SelfMonitorInfo(object):
         self._error_count = 0
         self._memory_used_in_percent = 0
         self._consecutive_high_memory_usage = 0
+        self._memory_history = deque(maxlen=ResourceHistoryLength)
+        self._cpu_history = deque(maxlen=ResourceHistoryLength)
+
+    def add_resource_usage(self, memory, cpu):
+        self._memory_history.append(memory)
+        self._cpu_history.append(cpu)
+
+    def average_resource_usage(self):
+        """
+            return tuple : average memory, cpu of the recent samples.
+        """
+        if (len(self._memory_history) == 0):
+            return 0.0, 0.0
+        count = float(len(self._memory_history))
+        return round(sum(self._memory_history) / count, 1), round(sum(self._cpu_history) / count, 1)
 
     def reset(self):
         self._consecutive_error_count = 0
@@ -105,17 +138,215 @@ class SelfMonitorInfo(object):
         else:
             return "Red"
 
+class ProcessResourceSampler(object):
+    """
+        Samples the memory and CPU usage of the omsagent processes from /proc, without spawning any process.
+        CPU usage is computed from the CPU time the processes used since the previous sample, over the time
+        actually elapsed, in percent of one CPU (as top reports it).
+    """
+    def __init__(self, proc_root="/proc", process_name=OmsAgentProcessName, user_name=AgentUser):
+        self._proc_root = proc_root
+        self._process_name = process_name
+        try:
+            self._uid = pwd.getpwnam(user_name).pw_uid
+        except KeyError:
+            self._uid = None
+        try:
+            self._clock_ticks = float(os.sysconf("SC_CLK_TCK"))
+        except (ValueError, OSError, AttributeError):
+            self._clock_ticks = 100.0
+        # CPU ticks of each process at the previous sample, by (pid, start time) so that reused pids don't mix.
+        self._last_cpu_ticks = {}
+        self._last_uptime = None
+
+    def _read(self, *path):
+        with open(os.path.join(self._proc_root, *path)) as f:
+            return f.read()
+
+    def _read_uptime(self):
+        return float(self._read("uptime").split()[0])
+
+    def _read_mem_total_kb(self):
+        for line in self._read("meminfo").splitlines():
+            if line.startswith("MemTotal:"):
+                return float(line.split()[1])
+        raise ValueError("MemTotal not found in meminfo")
+
+    def _read_process(self, pid):
+        """
+            return tuple : (pid, start time), CPU ticks and resident memory in kB of an omsagent process,
+            or None if it isn't one (or exited meanwhile).
+        """
+        try:
+            stat = self._read(pid, "stat")
+            status = self._read(pid, "status")
+        except (IOError, OSError):
+            return None
+
+        # The command name is in parentheses and may contain spaces, so split the fields after the last one.
+        name = stat[stat.find("(") + 1:stat.rfind(")")]
+        if (name != self._process_name):
+            return None
+        fields = stat[stat.rfind(")") + 2:].split()
+        # utime, stime and starttime are fields 14, 15 and 22 of /proc/<pid>/stat, the state being field 3.
+        cpu_ticks = int(fields[11]) + int(fields[12])
+        start_ticks = int(fields[19])
+
+        uid = None
+        rss_kb = 0
+        for line in status.splitlines():
+            if line.startswith("Uid:"):
+                uid = int(line.split()[1])
+            elif line.startswith("VmRSS:"):
+                rss_kb = int(line.split()[1])
+        if (self._uid is not None and uid != self._uid):
+            return None
+        return (pid, start_ticks), cpu_ticks, rss_kb
+
+    def sample(self):
+        """
+            return tuple : memory, cpu usage in percent of all the omsagent processes.
+        """
+        uptime = self._read_uptime()
+        mem_total_kb = self._read_mem_total_kb()
+
+        cpu_ticks = {}
+        cpu_seconds = 0.0
+        rss_kb = 0
+        for pid in os.listdir(self._proc_root):
+            if (not pid.isdigit()):
+                continue
+            process = self._read_process(pid)
+            if (process is None):
+                continue
+            key, ticks, rss = process
+            cpu_ticks[key] = ticks
+            rss_kb += rss
+
+            if (self._last_uptime is None):
+                # First sample: average over the lifetime of the process.
+                elapsed = uptime - key[1] / self._clock_ticks
+                if (elapsed > 0):
+                    cpu_seconds += ticks / self._clock_ticks / elapsed
+            else:
+                # A process started since the previous sample used all its CPU time in the interval.
+                cpu_seconds += (ticks - self._last_cpu_ticks.get(key, 0)) / self._clock_ticks
+
+        cpu_usage = 0.0
+        if (self._last_uptime is None):
+            cpu_usage = cpu_seconds * 100
+        elif (uptime > self._last_uptime):
+            cpu_usage = cpu_seconds * 100 / (uptime - self._last_uptime)
+
+        self._last_cpu_ticks = cpu_ticks
+        self._last_uptime = uptime
+        return round(rss_kb * 100 / mem_total_kb, 1), round(max(cpu_usage, 0.0), 1)
+
+class TelemetryEventBatcher(object):
+    """
+        Buffers telemetry events over a window and writes them to the guest agent events directory in one go.
+        The guest agent reads a single event per .tld file, so the identical events of a window (e.g. the same
+        status reported every 5 minutes) are written as one event with their count. Each file is written to a
+        temporary name then renamed, so that the agent never picks up a partial event, and no more files are
+        written when too many of them are already waiting for the agent.
+    """
+    def __init__(self, create_event, hutil_log, events_dir=WAAgentEventsDir, window=TelemetryBatchWindow,
+                 max_pending_files=MaxPendingEventFiles, clock=time.time):
+        """
+        Constructor.
+        :param create_event: Function rendering an event from operation, success, message and duration.
+        :param hutil_log: Normal logging function (e.g., hutil.log).
+        """
+        self._create_event = create_event
+        self._hutil_log = hutil_log
+        self._events_dir = events_dir
+        self._window = window
+        self._max_pending_files = max_pending_files
+        self._clock = clock
+        self._lock = Lock()
+        self._keys = []
+        self._counts = {}
+        self._durations = {}
+        self._window_start = None
+
+    def add(self, operation, operation_success, message, duration):
+        key = (operation, str(operation_success).lower(), message)
+        with self._lock:
+            if (self._window_start is None):
+                self._window_start = self._clock()
+            if (key not in self._counts):
+                self._keys.append(key)
+                self._counts[key] = 0
+                self._durations[key] = duration
+            self._counts[key] += 1
+
+    def flush(self, force=False):
+        """
+            Write the buffered events if the window is over (or force is set).
+            return int : number of event files written.
+        """
+        with self._lock:
+            if (self._window_start is None):
+                return 0
+            if (not force and self._clock() - self._window_start < self._window):
+                return 0
+            keys, counts, durations = self._keys, self._counts, self._durations
+            self._keys = []
+            self._counts = {}
+            self._durations = {}
+            self._window_start = None
+
+        # Failures first, so that they make it if the agent is lagging behind.
+        keys = [k for k in keys if k[1] != "true"] + [k for k in keys if k[1] == "true"]
+        available = self._max_pending_files - self.count_pending_files()
+        written = 0
+        for key in keys[:max(available, 0)]:
+            operation, operation_success, message = key
+            if (counts[key] > 1):
+                message += " (occurred {0} times)".format(counts[key])
+            self.write_event(self._create_event(operation, operation_success, message, durations[key]))
+            written += 1
+        if (written < len(keys)):
+            self._hutil_log("Too many telemetry events pending in {0}, dropped {1} of {2}".format(
+                self._events_dir, len(keys) - written, len(keys)))
+        return written
+
+    def count_pending_files(self):
+        try:
+            return len([f for f in os.listdir(self._events_dir) if f.endswith(".tld")])
+        except OSError:
+            return 0
+
+    def write_event(self, event):
+        offset = int(self._clock() * 1000000)
+        fd, temp_fn = tempfile.mkstemp(dir=self._events_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w') as fh:
+                fh.write(event)
+
+            fn_template = os.path.join(self._events_dir, '{0}.tld')
+            fn = fn_template.format(offset)
+            while os.path.isfile(fn):
+                offset += 1
+                fn = fn_template.format(offset)
+            os.rename(temp_fn, fn)
+        except Exception:
+            os.remove(temp_fn)
+            raise
+
+        self._hutil_log(fn)
+
 class LogFileMarker(object):
     """
         Class to hold omsagent log file marker information.
     """
     def __init__(self):
         self._last_pos = 0
-        self._last_crc = ""
+        self._last_inode = None
 
     def reset_marker(self):
         self._last_pos = 0
-        self._last_crc = ""
+        self._last_inode = None
 
 class Watcher(object):
     """
@@ -132,23 +363,19 @@ class Watcher(object):
         self._hutil_log = hutil_log
         self._consecutive_error_count = 0
         self._consecutive_restarts_due_to_error = 0
+        self._resource_sampler = ProcessResourceSampler()
+        self._telemetry_batcher = TelemetryEventBatcher(self.create_telemetry_event, hutil_log)
+        self._stop_event = Event()
 
-    def write_waagent_event(self, event):
-        offset = str(int(time.time() * 1000000))
-
-        temp_fn = '/var/lib/waagent/events/'+str(uuid.uuid4())
-        with open(temp_fn,'w+') as fh:
-            fh.write(event)
-
-        fn_template = '/var/lib/waagent/events/{}.tld'
-        fn = fn_template.format(offset)
-        while os.path.isfile(fn):
-            offset += 1
-            fn = fn_template.format(offset)
-
-        shutil.move(temp_fn, fn)
+    def stop(self):
+        """
+            Stop the watch and monitor_health loops. The watch loop writes the telemetry events it buffered before
+            returning, so that they are not lost when the extension is disabled or the process restarted.
+        """
+        self._stop_event.set()
 
-        self._hutil_log(fn)
+    def write_waagent_event(self, event):
+        self._telemetry_batcher.write_event(event)
 
     def create_telemetry_event(self, operation, operation_success, message, duration):
         template = """ {{
@@ -212,9 +439,8 @@ class Watcher(object):
                             # Truncating the message to prevent flooding the system
                             message = status_data["message"][:maxMessageSize]
 
-                            event = self.create_telemetry_event(operation,operation_success,message,"300000")
-                            self._hutil_log("Writing telemetry event: "+event)
-                            self.write_waagent_event(event)
+                            self._hutil_log("Adding telemetry event: {0} {1} {2}".format(operation, operation_success, message))
+                            self._telemetry_batcher.add(operation,operation_success,message,"300000")
                             self._hutil_log("Successfully processed telemetry status file: "+sf)
 
                         except Exception:
@@ -231,7 +457,15 @@ class Watcher(object):
                     self._hutil_log("Telemetry status file not updated in last 5 mins: "+sf)
             else:
                 self._hutil_log("Telemetry status file does not exist: "+sf)
-        pass
+
+        self.flush_telemetry()
+
+    def flush_telemetry(self, force=False):
+        try:
+            self._telemetry_batcher.flush(force)
+        except Exception:
+            self._hutil_log("Error writing telemetry events")
+            self._hutil_log("Exception info: "+traceback.format_exc())
 
     def watch(self):
         """
@@ -241,16 +475,18 @@ class Watcher(object):
         :return: None
         """
         self._hutil_log('started watcher thread')
-        while True:
-            self._hutil_log('watcher thread waking')
-
-            self.upload_telemetry()
+        try:
+            while not self._stop_event.is_set():
+                self._hutil_log('watcher thread waking')
 
-            # Sleep 5 minutes
-            self._hutil_log('watcher thread sleeping')
-            time.sleep(60 * 5)
+                self.upload_telemetry()
 
-        pass
+                # Sleep 5 minutes
+                self._hutil_log('watcher thread sleeping')
+                self._stop_event.wait(60 * 5)
+        finally:
+            self._hutil_log('watcher thread stopping')
+            self.flush_telemetry(force=True)
 
     def monitor_heartbeat(self, self_mon_info, log_file_marker):
         """
@@ -337,9 +573,11 @@ class Watcher(object):
         """
 
         resource_usage = self.get_oms_agent_resource_usage()
-        message = "Memory : {0}, CPU : {1}".format(resource_usage[0], resource_usage[1])
-        event = self.create_telemetry_event("agenttelemetry","True",message,"300000")
-        self.write_waagent_event(event)
+        self_mon_info.add_resource_usage(resource_usage[0], resource_usage[1])
+        average_usage = self_mon_info.average_resource_usage()
+        message = "Memory : {0}, CPU : {1}, Average memory : {2}, Average CPU : {3}".format(
+            resource_usage[0], resource_usage[1], average_usage[0], average_usage[1])
+        self._telemetry_batcher.add("agenttelemetry","True",message,"300000")
 
         self_mon_info._memory_used_in_percent = resource_usage[0]
 
@@ -371,9 +609,9 @@ class Watcher(object):
         sleepTime =  6 * 60
 
         # sleep before starting the monitoring.
-        time.sleep(sleepTime)
+        self._stop_event.wait(sleepTime)
 
-        while True:
+        while not self._stop_event.is_set():
             try:
                 # Monitor heartbeat and logs.
                 self.monitor_heartbeat(self_mon_info, log_file_marker)
@@ -388,7 +626,7 @@ class Watcher(object):
                 self._hutil_error('Error in monitoring health of the omsagent. Exception={0}'.format(e))
 
             finally:
-                time.sleep(sleepTime)
+                self._stop_event.wait(sleepTime)
 
     def take_corrective_action(self, self_mon_info):
         """
@@ -435,57 +673,29 @@ class Watcher(object):
         read_start_time = int(time.time())
 
         if os.path.isfile(OmsAgentLogFile):
-            last_crc = log_file_marker._last_crc
-            last_pos = log_file_marker._last_pos
-
             # We do not want to propogate any exception to the caller.
-
+            f = None
             try:
-                f = open(OmsAgentLogFile, "r")
-
-                text = f.readline()
-
-                #  Handle log rotate. Check for CRC of first line of the log file.
-                #  Some of the agents like Splunk uses this technique.
-                #  If it matches with previous CRC, then file has not changed.
-                #  If it is not matching then file has changed and do not seek from
-                #  the last_pos rather continue from the begining.
-
-                if (text != ''):
-                    crc = hashlib.sha256(text).hexdigest()
-                    self._hutil_log("Last crc = {0}, current crc= {1} position = {2}".format(last_crc, crc, last_pos))
-                    if (last_crc == crc):
-
-                        if (last_pos > 0):
-                            f.seek(last_pos)
-                    else:
-                        self._hutil_log("File has changed do not seek from the offset. current crc = {0}".format(crc))
-
-                    log_file_marker._last_crc = crc
-                    total_lines_read = 1
-
-                while True:
-                    text = f.readline()
-
-                    if (text == ''):
-                        log_file_marker._last_pos = f.tell()
-                        break
-
-                    total_lines_read += 1
-                    res = reg_ex.match(text)
-
-                    if res:
-                        log_entry_time = self.get_total_seconds_from_epoch_for_fluent_logs(res.group(1))
-                        if (log_entry_time + (10 * 60) < read_start_time):
-                            # ignore log line if we are reading logs older than 10 minutes.
-                            pass
-                        elif (res.group(2) == "warn" or res.group(2) == "error"):
-                            for error_statement in ErrorStatements:
-                                if (res.group(3) in error_statement):
-                                    self._hutil_error("Found non recoverable error log in agent log file")
-
-                                    # File should be closed in the finally block.
-                                    return True
+                f = open(OmsAgentLogFile, "rb")
+                st = os.fstat(f.fileno())
+
+                #  Handle log rotate. If the log file was replaced (another inode) or truncated,
+                #  do not seek from the last position rather continue from the begining.
+                last_pos = log_file_marker._last_pos
+                self._hutil_log("Last inode = {0}, current inode = {1} position = {2}".format(
+                    log_file_marker._last_inode, st.st_ino, last_pos))
+                if (log_file_marker._last_inode != st.st_ino or st.st_size < last_pos):
+                    self._hutil_log("File has changed do not seek from the offset. current inode = {0}".format(
+                        st.st_ino))
+                    last_pos = 0
+                log_file_marker._last_inode = st.st_ino
+
+                min_log_time = read_start_time - FatalLogMaxAge
+                start_pos = self.find_log_offset(f, last_pos, st.st_size, min_log_time)
+                found, log_file_marker._last_pos = self.scan_for_fatal_logs(f, start_pos, min_log_time)
+                if (found):
+                    self._hutil_error("Found non recoverable error log in agent log file")
+                    return True
 
                 self._hutil_log("Did not find any non recoverable logs in omsagent log file")
 
@@ -493,12 +703,89 @@ class Watcher(object):
                 self._hutil_error ("Caught an exception {0}".format(traceback.format_exc()))
 
             finally:
-                f.close()
+                if (f is not None):
+                    f.close()
         else:
             self._hutil_error ("Omsagent log file not found : {0}".format(OmsAgentLogFile))
 
         return False
 
+    def get_log_line_time(self, line):
+        res = reg_ex_bytes.match(line)
+        if (res is None):
+            return None
+        return self.get_total_seconds_from_epoch_for_fluent_logs(res.group(1).decode('utf-8', 'replace'))
+
+    def find_log_offset(self, f, start_pos, end_pos, min_log_time):
+        """
+            Bisect the log between start_pos and end_pos for the lines logged from min_log_time, so that
+            the (possibly GBs of) older lines after a long gap are not read at all.
+            The log lines being in chronological order, returns the start of a line logged before min_log_time
+            (or start_pos), from which all the lines logged from min_log_time can be scanned.
+        """
+        low = start_pos
+        high = end_pos
+        while (high - low > LogScanBlockSize):
+            middle = (low + high) // 2
+            f.seek(middle)
+            # Skip the rest of the line the middle falls in, and the lines without a timestamp (e.g. stack traces).
+            block = f.read(min(LogScanBlockSize // 16, high - middle))
+            line_start = block.find(b'\n') + 1
+            line_time = None
+            while (line_start > 0):
+                line_end = block.find(b'\n', line_start)
+                if (line_end < 0):
+                    break
+                line_time = self.get_log_line_time(block[line_start:line_end])
+                if (line_time is not None):
+                    break
+                line_start = line_end + 1
+
+            if (line_time is not None and line_time < min_log_time):
+                low = middle + line_start
+            else:
+                # Either the lines are recent from here on, or there is no full line to tell: look before.
+                high = middle
+        return low
+
+    def scan_for_fatal_logs(self, f, start_pos, min_log_time):
+        """
+            Scan the log from start_pos in large blocks. Only the lines with one of the ErrorStatements are parsed.
+            return tuple : whether a warn or error line logged from min_log_time has one of the ErrorStatements,
+            and the position to scan from next time (after that line, or after the last complete line).
+        """
+        f.seek(start_pos)
+        pos = start_pos
+        pending = b''
+        while True:
+            block = f.read(LogScanBlockSize)
+            if (not block):
+                return False, pos
+            pending += block
+            last_line_end = pending.rfind(b'\n')
+            if (last_line_end < 0):
+                continue
+
+            line_starts = set()
+            for error_statement in error_statements_bytes:
+                match = pending.find(error_statement, 0, last_line_end)
+                while (match >= 0):
+                    line_start = pending.rfind(b'\n', 0, match) + 1
+                    line_starts.add(line_start)
+                    match = pending.find(error_statement, pending.find(b'\n', match), last_line_end)
+
+            for line_start in sorted(line_starts):
+                line_end = pending.find(b'\n', line_start)
+                res = reg_ex_bytes.match(pending, line_start, line_end)
+                if (res and (res.group(2) == b"warn" or res.group(2) == b"error")):
+                    log_entry_time = self.get_total_seconds_from_epoch_for_fluent_logs(
+                        res.group(1).decode('utf-8', 'replace'))
+                    if (log_entry_time >= min_log_time):
+                        return True, pos + line_end + 1
+
+            pos += last_line_end + 1
+            pending = pending[last_line_end + 1:]
+
     def get_oms_agent_resource_usage(self):
         """
             If we hit any exception in getting resoource usage of the omsagent return 0,0
@@ -512,21 +799,7 @@ class Watcher(object):
         try:
             mem_usage = 0.0
             cpu_usage = 0.0
-            with open(OmsAgentPidFile, 'r') as infile:
-                pid = infile.readline()	 # Get pid of omsagent process.
-
-                # top output:
-                # $1 - PID,
-                # $2 - account,
-                # $9 - CPU,
-                # $10 - Memory,
-                # $12 - Process name
-                out = subprocess.Popen('top -bn1 | grep -i omsagent | awk \'{print $1 " " $2 " " $9 " " $10  " " $12}\'', shell=True, stdout=subprocess.PIPE)
-                for line in out.stdout:
-                    s = line.split()
-
-                    if (len(s) >= 4 and s[0] == pid and s[1] == 'omsagent' and s[4] == 'omsagent'):
-                        return float(s[3]) , float(s[2])
+            return self._resource_sampler.sample()
 
         except Exception as e:
             self._hutil_error('Error getting memory usage for omsagent process. Exception={0}'.format(e))
@@ -51,14 +51,15 @@ class DiskUtil(object):
 
         self.command_executor = CommandExecutor(self.logger)
 
-    def copy(self, ongoing_item_config, status_prefix=''):
+    def copy(self, ongoing_item_config, status_prefix='', block_map=None):
         copy_task = TransactionalCopyTask(logger=self.logger,
                                           disk_util=self,
                                           hutil=self.hutil,
                                           ongoing_item_config=ongoing_item_config,
                                           patching=self.distro_patcher,
                                           encryption_environment=self.encryption_environment,
-                                          status_prefix=status_prefix)
+                                          status_prefix=status_prefix,
+                                          block_map=block_map)
         try:
             mem_fs_result = copy_task.prepare_mem_fs()
             if mem_fs_result != CommonVariables.process_success:
@@ -71,6 +72,109 @@ class DiskUtil(object):
         finally:
             copy_task.clear_mem_fs()
 
+    def get_used_byte_ranges(self, dev_path, file_system=None):
+        """
+        returns the (start, end) byte ranges allocated by the filesystem on dev_path, end exclusive,
+        or None if the allocation map can't be read and the whole device has to be treated as used
+        """
+        if not file_system:
+            proc_comm = ProcessCommunicator()
+            self.command_executor.Execute("{0} -s TYPE -o value {1}".format(self.distro_patcher.blkid_path, dev_path),
+                                          communicator=proc_comm,
+                                          suppress_logging=True)
+            file_system = proc_comm.stdout.strip()
+
+        try:
+            if file_system in ['ext2', 'ext3', 'ext4']:
+                return self._get_ext_used_byte_ranges(dev_path)
+            elif file_system == 'xfs':
+                return self._get_xfs_used_byte_ranges(dev_path)
+        except Exception as e:
+            self.logger.log(msg="failed to read allocation map of {0}: {1}, stack trace: {2}".format(dev_path, e, traceback.format_exc()),
+                            level=CommonVariables.WarningLevel)
+            return None
+
+        self.logger.log(msg="no allocation map support for file system '{0}' on {1}".format(file_system, dev_path))
+        return None
+
+    def _get_ext_used_byte_ranges(self, dev_path):
+        proc_comm = ProcessCommunicator()
+        return_code = self.command_executor.Execute("dumpe2fs {0}".format(dev_path),
+                                                    communicator=proc_comm,
+                                                    suppress_logging=True)
+        if return_code != CommonVariables.process_success:
+            return None
+
+        return self.parse_dumpe2fs_used_byte_ranges(proc_comm.stdout)
+
+    def parse_dumpe2fs_used_byte_ranges(self, dumpe2fs_output):
+        if not re.search(r'^Filesystem state:\s+clean\s*$', dumpe2fs_output, re.MULTILINE) or \
+           re.search(r'^Filesystem features:.*\bneeds_recovery\b', dumpe2fs_output, re.MULTILINE):
+            # block bitmaps can't be trusted until the journal is replayed
+            self.logger.log(msg="file system is not clean, not using its allocation map",
+                            level=CommonVariables.WarningLevel)
+            return None
+
+        block_size = int(re.search(r'^Block size:\s+(\d+)', dumpe2fs_output, re.MULTILINE).group(1))
+        block_count = int(re.search(r'^Block count:\s+(\d+)', dumpe2fs_output, re.MULTILINE).group(1))
+
+        free_block_ranges = []
+        # group sections are indented, the unindented "Free blocks:" superblock line is a count
+        for free_blocks in re.findall(r'^\s+Free blocks: (.*)$', dumpe2fs_output, re.MULTILINE):
+            for free_range in free_blocks.split(','):
+                free_range = free_range.strip()
+                if not free_range:
+                    continue
+                first, _, last = free_range.partition('-')
+                free_block_ranges.append((int(first), int(last or first) + 1))
+
+        return self._invert_block_ranges(free_block_ranges, block_count, block_size)
+
+    def _get_xfs_used_byte_ranges(self, dev_path):
+        proc_comm = ProcessCommunicator()
+        return_code = self.command_executor.Execute('xfs_db -r -c "sb 0" -c "p blocksize agblocks dblocks" {0}'.format(dev_path),
+                                                    communicator=proc_comm,
+                                                    suppress_logging=True)
+        if return_code != CommonVariables.process_success:
+            return None
+        superblock_output = proc_comm.stdout
+
+        proc_comm = ProcessCommunicator()
+        return_code = self.command_executor.Execute('xfs_db -r -c "freesp -d" {0}'.format(dev_path),
+                                                    communicator=proc_comm,
+                                                    suppress_logging=True)
+        if return_code != CommonVariables.process_success:
+            return None
+
+        return self.parse_xfs_used_byte_ranges(superblock_output, proc_comm.stdout)
+
+    def parse_xfs_used_byte_ranges(self, superblock_output, freesp_output):
+        block_size = int(re.search(r'^blocksize = (\d+)', superblock_output, re.MULTILINE).group(1))
+        ag_blocks = int(re.search(r'^agblocks = (\d+)', superblock_output, re.MULTILINE).group(1))
+        block_count = int(re.search(r'^dblocks = (\d+)', superblock_output, re.MULTILINE).group(1))
+
+        free_block_ranges = []
+        # "freesp -d" lists free extents as "agno agbno len" before the histogram
+        for ag_number, ag_block, length in re.findall(r'^\s*(\d+)\s+(\d+)\s+(\d+)\s*$', freesp_output, re.MULTILINE):
+            first = int(ag_number) * ag_blocks + int(ag_block)
+            free_block_ranges.append((first, first + int(length)))
+
+        return self._invert_block_ranges(free_block_ranges, block_count, block_size)
+
+    def _invert_block_ranges(self, free_block_ranges, block_count, block_size):
+        used_byte_ranges = []
+        position = 0
+
+        for first, end in sorted(free_block_ranges):
+            if first > position:
+                used_byte_ranges.append((position * block_size, first * block_size))
+            position = max(position, end)
+
+        if position < block_count:
+            used_byte_ranges.append((position * block_size, block_count * block_size))
+
+        return used_byte_ranges
+
     def format_disk(self, dev_path, file_system):
         mkfs_command = ""
         if file_system in CommonVariables.format_supported_file_systems:
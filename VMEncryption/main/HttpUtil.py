@@ -21,13 +21,20 @@ import datetime
 import traceback
 import urlparse
 import httplib
+import select
 import shlex
+import socket
 import subprocess
 from Common import CommonVariables
 from subprocess import *
 from Utils.WAAgentUtil import waagent
 
 class HttpUtil(object):
+    # methods that can be sent again when the response was lost, as the server acting twice on them is harmless
+    idempotent_methods = ('GET', 'HEAD', 'OPTIONS')
+    # the calls carry AAD tokens and wrapped passphrases: always over TLS, whatever the scheme of the uri
+    connection_class = httplib.HTTPSConnection
+
     """description of class"""
     def __init__(self, logger):
         self.logger = logger
@@ -41,9 +48,13 @@ class HttpUtil(object):
         self.proxyHost = Config.get("HttpProxy.Host")
         self.proxyPort = Config.get("HttpProxy.Port")
         self.connection = None
+        self.request_sent = False
+        # keep-alive connections, keyed by (scheme, host, port)
+        self.connections = {}
 
     """
     snapshot also called this. so we should not write the file/read the file in this method.
+    the response has to be read before the next Call reuses its connection.
     """
 
     def Call(self, method, http_uri, data, headers):
@@ -51,23 +62,71 @@ class HttpUtil(object):
             uri_obj = urlparse.urlparse(http_uri)
             #parse the uri str here
             if self.proxyHost is None or self.proxyPort is None:
-                self.connection = httplib.HTTPSConnection(uri_obj.hostname, timeout = 10)
-                if uri_obj.query is not None:
-                    self.connection.request(method = method, url=(uri_obj.path +'?'+ uri_obj.query), body = data, headers = headers)
+                if uri_obj.query:
+                    url = uri_obj.path + '?' + uri_obj.query
                 else:
-                    self.connection.request(method = method, url=(uri_obj.path), body = data, headers = headers)
-                resp = self.connection.getresponse()
+                    url = uri_obj.path
             else:
                 self.logger.log("proxyHost is not empty, so use the proxy to call the http.")
-                self.connection = httplib.HTTPSConnection(self.proxyHost, self.proxyPort, timeout = 10)
-                if uri_obj.scheme.lower() == "https":
-                    self.connection.set_tunnel(uri_obj.hostname, 443)
-                else:
-                    self.connection.set_tunnel(uri_obj.hostname, 80)
-                self.connection.request(method = method, url = (http_uri), body = data, headers = headers)
-                resp = self.connection.getresponse()
-            return resp
+                url = http_uri
+
+            try:
+                return self._request(uri_obj, method, url, data, headers)
+            except (httplib.HTTPException, socket.error) as e:
+                self._close_connection(uri_obj)
+                if self.request_sent and method.upper() not in self.idempotent_methods:
+                    # the server may have acted on the request already, it must not be sent twice
+                    raise
+                self.logger.log("Retrying http call on a new connection after error: {0}".format(e))
+                return self._request(uri_obj, method, url, data, headers)
         except Exception as e:
             errorMsg = "Failed to call http with error: {0}, stack trace: {1}".format(e, traceback.format_exc())
             self.logger.log(errorMsg)
-            return None
\ No newline at end of file
+            return None
+
+    def close(self):
+        for connection in self.connections.values():
+            connection.close()
+        self.connections = {}
+
+    def _request(self, uri_obj, method, url, data, headers):
+        self.request_sent = False
+        self.connection = self._get_connection(uri_obj)
+        self.connection.request(method = method, url = url, body = data, headers = headers)
+        self.request_sent = True
+        return self.connection.getresponse()
+
+    def _get_connection(self, uri_obj):
+        key = (uri_obj.scheme.lower(), uri_obj.hostname, uri_obj.port)
+        connection = self.connections.get(key)
+        if connection is not None and self._is_closed_by_server(connection):
+            self._close_connection(uri_obj)
+            connection = None
+        if connection is None:
+            if self.proxyHost is None or self.proxyPort is None:
+                connection = self.connection_class(uri_obj.hostname, uri_obj.port, timeout = 10)
+            else:
+                connection = self.connection_class(self.proxyHost, self.proxyPort, timeout = 10)
+                if key[0] == "https":
+                    connection.set_tunnel(uri_obj.hostname, uri_obj.port or 443)
+                else:
+                    connection.set_tunnel(uri_obj.hostname, uri_obj.port or 80)
+            self.connections[key] = connection
+        return connection
+
+    def _is_closed_by_server(self, connection):
+        """
+        an idle keep-alive connection is readable only once the server closed it (or sent something unexpected)
+        """
+        if connection.sock is None:
+            return False
+        try:
+            return bool(select.select([connection.sock], [], [], 0)[0])
+        except (select.error, socket.error, ValueError):
+            return True
+
+    def _close_connection(self, uri_obj):
+        key = (uri_obj.scheme.lower(), uri_obj.hostname, uri_obj.port)
+        connection = self.connections.pop(key, None)
+        if connection is not None:
+            connection.close()
@@ -25,15 +25,80 @@ import traceback
 import re
 import os
 import subprocess
+import time
 
 from tempfile import mkstemp 
 from HttpUtil import HttpUtil
 from urlparse import urlparse
 
+class AccessTokenCache(object):
+    """
+    AAD access tokens and Key Vault authorize uris, reused until shortly before the token expires.
+    The bearer tokens are kept in memory only, for the lifetime of the extension process.
+    """
+    def __init__(self, logger, refresh_margin=300):
+        self.logger = logger
+        self.refresh_margin = refresh_margin
+        self.tokens = {}
+        self.authorize_uris = {}
+
+    def get_token(self, authorize_uri, resource, client_id):
+        now = time.time()
+        for key in [k for k, v in self.tokens.items() if v["expires_on"] - self.refresh_margin <= now]:
+            del self.tokens[key]
+        entry = self.tokens.get(self._token_key(authorize_uri, resource, client_id))
+        if entry:
+            self.logger.log("using cached access token, expires on {0}".format(entry["expires_on"]))
+            return entry["access_token"]
+        return None
+
+    def set_token(self, authorize_uri, resource, client_id, access_token, expires_on=None):
+        if expires_on is None:
+            expires_on = self.get_token_expiry(access_token)
+        if expires_on is None:
+            self.logger.log("access token has no known expiry, not caching it")
+            return
+        self.tokens[self._token_key(authorize_uri, resource, client_id)] = {"access_token": access_token,
+                                                                         "expires_on": int(expires_on)}
+
+    def invalidate_token(self, authorize_uri, resource, client_id):
+        self.tokens.pop(self._token_key(authorize_uri, resource, client_id), None)
+
+    def get_authorize_uri(self, key_vault_url):
+        return self.authorize_uris.get(key_vault_url.rstrip('/'))
+
+    def set_authorize_uri(self, key_vault_url, authorize_uri):
+        self.authorize_uris[key_vault_url.rstrip('/')] = authorize_uri
+
+    def get_token_expiry(self, access_token):
+        """
+        returns the exp claim of a JWT access token, or None if it can't be decoded
+        """
+        try:
+            payload = access_token.split('.')[1]
+            payload += '=' * (-len(payload) % 4)
+            return int(json.loads(base64.urlsafe_b64decode(str(payload)))["exp"])
+        except Exception:
+            return None
+
+    def _token_key(self, authorize_uri, resource, client_id):
+        return "{0}|{1}|{2}".format(authorize_uri, resource, client_id)
+
+# shared by the KeyVaultUtil instances of the extension process, so that retries don't authenticate again
+access_token_cache = None
+
 class KeyVaultUtil(object):
-    def __init__(self, logger):
+    def __init__(self, logger, token_cache=None):
+        global access_token_cache
         self.api_version = "2015-06-01"
         self.logger = logger
+        if token_cache is None:
+            if access_token_cache is None:
+                access_token_cache = AccessTokenCache(logger)
+            token_cache = access_token_cache
+        self.token_cache = token_cache
+        # one keep-alive connection per host for discovery, token, wrapkey and secret calls
+        self.http_util = None
 
     def urljoin(self,*args):
         """
@@ -50,28 +115,24 @@ class KeyVaultUtil(object):
         try:
             self.logger.log("start creating kek secret")
             passphrase_encoded = base64.standard_b64encode(Passphrase)
-            keys_uri = self.urljoin(KeyVaultURL, "keys")
-
-            http_util = HttpUtil(self.logger)
-            headers = {}
-            result = http_util.Call(method='GET', http_uri=keys_uri, data=None, headers=headers)
-            http_util.connection.close()
-            """
-            get the access token 
-            """
-            self.logger.log("getting the access token.")
-            bearerHeader = result.getheader("www-authenticate")
 
-            authorize_uri = self.get_authorize_uri(bearerHeader)
+            authorize_uri = self.get_key_vault_authorize_uri(KeyVaultURL)
             if authorize_uri is None:
                 self.logger.log("the authorize uri is None")
                 return None
 
             parsed_url = urlparse(KeyVaultURL)
-            vault_domain = re.findall(r".*(vault.*)", parsed_url.netloc)[0]
+            vault_domains = re.findall(r".*(vault.*)", parsed_url.netloc)
+            vault_domain = vault_domains[0] if vault_domains else parsed_url.netloc
             kv_resource_name = parsed_url.scheme + '://' + vault_domain
 
-            access_token = self.get_access_token(kv_resource_name, authorize_uri, AADClientID, AADClientCertThumbprint, AADClientSecret)
+            """
+            get the access token 
+            """
+            self.logger.log("getting the access token.")
+            access_token = self.token_cache.get_token(authorize_uri, kv_resource_name, AADClientID)
+            if access_token is None:
+                access_token = self.get_access_token(kv_resource_name, authorize_uri, AADClientID, AADClientCertThumbprint, AADClientSecret)
             if access_token is None:
                 self.logger.log("the access token is None")
                 return None
@@ -85,14 +146,46 @@ class KeyVaultUtil(object):
                 secret_value = self.encrypt_passphrase(access_token, passphrase_encoded, KeyVaultURL, KeyEncryptionKeyURL, AADClientID, KeyEncryptionAlgorithm, AADClientSecret)
             if secret_value is None:
                 self.logger.log("secret value is None")
+                # the cached token may have been revoked, authenticate again on the next attempt
+                self.token_cache.invalidate_token(authorize_uri, kv_resource_name, AADClientID)
                 return None
 
             secret_id = self.create_secret(access_token, KeyVaultURL, secret_value, KeyEncryptionAlgorithm, DiskEncryptionKeyFileName)
+            if secret_id is None:
+                self.token_cache.invalidate_token(authorize_uri, kv_resource_name, AADClientID)
 
             return secret_id
         except Exception as e:
             self.logger.log("Failed to create_kek_secret with error: {0}, stack trace: {1}".format(e, traceback.format_exc()))
             raise
+        finally:
+            if self.http_util:
+                self.http_util.close()
+
+    def get_key_vault_authorize_uri(self, KeyVaultURL):
+        """
+        discovers the AAD authority of the key vault from the challenge of an unauthenticated call
+        """
+        authorize_uri = self.token_cache.get_authorize_uri(KeyVaultURL)
+        if authorize_uri is not None:
+            return authorize_uri
+
+        keys_uri = self.urljoin(KeyVaultURL, "keys")
+        result = self.get_http_util().Call(method='GET', http_uri=keys_uri, data=None, headers={})
+        if result is None:
+            return None
+        result.read()
+        bearerHeader = result.getheader("www-authenticate")
+
+        authorize_uri = self.get_authorize_uri(bearerHeader)
+        if authorize_uri is not None:
+            self.token_cache.set_authorize_uri(KeyVaultURL, authorize_uri)
+        return authorize_uri
+
+    def get_http_util(self):
+        if self.http_util is None:
+            self.http_util = HttpUtil(self.logger)
+        return self.http_util
 
     def is_adal_available(self):
         try:
@@ -123,6 +216,10 @@ class KeyVaultUtil(object):
             context = adal.AuthenticationContext(AuthorizeUri)
             result_json = context.acquire_token_with_client_certificate(KeyVaultResourceName, AADClientID, prv_data, AADClientCertThumbprint)
             access_token = result_json["accessToken"]
+            expires_on = None
+            if result_json.get("expiresIn"):
+                expires_on = time.time() + int(result_json["expiresIn"])
+            self.token_cache.set_token(AuthorizeUri, KeyVaultResourceName, AADClientID, access_token, expires_on)
             return access_token
         elif self.is_scl_adal_available():
             # On RHEL, support for python-pip and the adal library are made available outside of default python via SCL 
@@ -136,6 +233,7 @@ class KeyVaultUtil(object):
             access_token = subprocess.check_output(['scl', 'enable', 'python27', scl_args]).rstrip()
             if os.path.isfile(tmp_path): 
                 os.remove(tmp_path)
+            self.token_cache.set_token(AuthorizeUri, KeyVaultResourceName, AADClientID, access_token)
             return access_token
         else:
             raise Exception('Python ADAL library required for client certificate authentication was not found')
@@ -154,18 +252,22 @@ class KeyVaultUtil(object):
             token_uri = AuthorizeUri + "/oauth2/token"
             request_content = "resource=" + urllib.quote(KeyVaultResourceName) + "&client_id=" + AADClientID + "&client_secret=" + urllib.quote(AADClientSecret) + "&grant_type=client_credentials"
             headers = {}
-            http_util = HttpUtil(self.logger)
-            result = http_util.Call(method='POST', http_uri=token_uri, data=request_content, headers=headers)
+            result = self.get_http_util().Call(method='POST', http_uri=token_uri, data=request_content, headers=headers)
 
             self.logger.log("{0} {1}".format(result.status, result.getheaders()))
             result_content = result.read()
             if result.status != httplib.OK and result.status != httplib.ACCEPTED:
                 self.logger.log(str(result_content))
                 return None
-            http_util.connection.close()
 
             result_json = json.loads(result_content)
             access_token = result_json["access_token"]
+            expires_on = None
+            if result_json.get("expires_on"):
+                expires_on = int(result_json["expires_on"])
+            elif result_json.get("expires_in"):
+                expires_on = time.time() + int(result_json["expires_in"])
+            self.token_cache.set_token(AuthorizeUri, KeyVaultResourceName, AADClientID, access_token, expires_on)
             return access_token
 
     """
@@ -184,15 +286,13 @@ class KeyVaultUtil(object):
             headers["Content-Type"] = "application/json"
             headers["Authorization"] = "Bearer " + str(AccessToken)
             relative_path = KeyEncryptionKeyURL + "/wrapkey" + '?api-version=' + self.api_version
-            http_util = HttpUtil(self.logger)
-            result = http_util.Call(method='POST', http_uri=relative_path, data=request_content, headers=headers)
+            result = self.get_http_util().Call(method='POST', http_uri=relative_path, data=request_content, headers=headers)
 
             result_content = result.read()
             self.logger.log("result_content is: {0}".format(result_content))
             self.logger.log("{0} {1}".format(result.status, result.getheaders()))
             if result.status != httplib.OK and result.status != httplib.ACCEPTED:
                 return None
-            http_util.connection.close()
             result_json = json.loads(result_content)
             secret_value = result_json[u'value']
             return secret_value
@@ -215,18 +315,16 @@ class KeyVaultUtil(object):
             else:
                 request_content = '{{"value":"{0}","attributes":{{"enabled":"true"}},"tags":{{"DiskEncryptionKeyEncryptionAlgorithm":"{1}","DiskEncryptionKeyFileName":"{2}"}}}}'\
                     .format(str(secret_value), KeyEncryptionAlgorithm, DiskEncryptionKeyFileName)
-            http_util = HttpUtil(self.logger)
             headers = {}
             headers["Content-Type"] = "application/json"
             headers["Authorization"] = "Bearer " + AccessToken
-            result = http_util.Call(method='PUT', http_uri=secret_keyvault_uri + '?api-version=' + self.api_version, data=request_content, headers=headers)
+            result = self.get_http_util().Call(method='PUT', http_uri=secret_keyvault_uri + '?api-version=' + self.api_version, data=request_content, headers=headers)
 
             self.logger.log("{0} {1}".format(result.status, result.getheaders()))
             result_content = result.read()
             # Do NOT log the result_content. It contains the uploaded secret and we don't want that in the logs.
             result_json = json.loads(result_content)
             secret_id = result_json["id"]
-            http_util.connection.close()
             if result.status != httplib.OK and result.status != httplib.ACCEPTED:
                 self.logger.log("the result status failed.")
                 return None
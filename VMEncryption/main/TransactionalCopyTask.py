@@ -16,6 +16,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import bisect
+import json
 import subprocess
 import os
 import os.path
@@ -28,14 +30,119 @@ from ConfigUtil import ConfigUtil
 from OnGoingItemConfig import *
 
 
+class CopyBlockMap(object):
+    """
+    The slices of a copy (block_size units counted from the start of the source)
+    that hold filesystem data. Slices that are not in the map are skipped.
+
+    The map is computed before the copy starts and persisted, because the source
+    filesystem can no longer be read consistently once the copy is under way.
+    """
+    def __init__(self, path, logger):
+        self.path = path
+        self.logger = logger
+        self.source_path = None
+        self.total_size = None
+        self.block_size = None
+        self.ranges = []
+        self._range_starts = []
+
+    def create(self, source_path, total_size, block_size, used_byte_ranges):
+        """
+        used_byte_ranges is a list of (start, end) byte offsets, end exclusive
+        """
+        self.source_path = source_path
+        self.total_size = total_size
+        self.block_size = block_size
+
+        ranges = []
+        for start, end in sorted(used_byte_ranges):
+            end = min(end, total_size)
+            if end <= start:
+                continue
+            first_block = start // block_size
+            last_block = (end - 1) // block_size
+            if ranges and first_block <= ranges[-1][1] + 1:
+                ranges[-1][1] = max(ranges[-1][1], last_block)
+            else:
+                ranges.append([first_block, last_block])
+
+        self._set_ranges(ranges)
+
+        map_content = json.dumps({
+            'source_path': source_path,
+            'total_size': total_size,
+            'block_size': block_size,
+            'ranges': ranges
+        })
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(map_content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.path)
+
+        self.logger.log(msg="copy block map for {0}: {1} of {2} slices hold data".format(source_path,
+                                                                                        self.get_block_count(),
+                                                                                        self._get_total_block_count()))
+
+    def load(self, source_path, total_size, block_size):
+        """
+        returns False if there is no map or it was created for a different copy
+        """
+        if not os.path.exists(self.path):
+            return False
+
+        try:
+            with open(self.path, 'r') as f:
+                map_content = json.load(f)
+        except ValueError:
+            self.logger.log(msg="ignoring unreadable copy block map {0}".format(self.path),
+                            level=CommonVariables.WarningLevel)
+            return False
+
+        if map_content['source_path'] != source_path or \
+           map_content['total_size'] != total_size or \
+           map_content['block_size'] != block_size:
+            self.logger.log(msg="ignoring copy block map created for {0}".format(map_content['source_path']),
+                            level=CommonVariables.WarningLevel)
+            return False
+
+        self.source_path = source_path
+        self.total_size = total_size
+        self.block_size = block_size
+        self._set_ranges(map_content['ranges'])
+        return True
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def contains(self, block_index):
+        position = bisect.bisect_right(self._range_starts, block_index) - 1
+        return position >= 0 and block_index <= self.ranges[position][1]
+
+    def get_block_count(self):
+        return sum(last - first + 1 for first, last in self.ranges)
+
+    def _get_total_block_count(self):
+        return (self.total_size + self.block_size - 1) // self.block_size
+
+    def _set_ranges(self, ranges):
+        self.ranges = ranges
+        self._range_starts = [first for first, last in ranges]
+
+
 class TransactionalCopyTask(object):
     """
     copy_total_size is in byte, skip_target_size is also in byte
     slice_size is in byte 50M
     """
-    def __init__(self, logger, hutil, disk_util, ongoing_item_config, patching, encryption_environment, status_prefix=''):
+    def __init__(self, logger, hutil, disk_util, ongoing_item_config, patching, encryption_environment, status_prefix='', block_map=None):
         """
         copy_total_size is in bytes.
+        block_map is an optional CopyBlockMap, slices outside of it are not copied.
         """
         self.command_executer = CommandExecutor(logger)
         self.ongoing_item_config = ongoing_item_config
@@ -59,6 +166,7 @@ class TransactionalCopyTask(object):
         self.tmpfs_mount_point = "/mnt/azure_encrypt_tmpfs"
         self.slice_file_path = self.tmpfs_mount_point + "/slice_file"
         self.copy_command = self.patching.dd_path
+        self.block_map = block_map
 
     def resume_copy_internal(self, copy_slice_item_backup_file_size, skip_block, original_total_copy_size):
         block_size_of_slice_item_backup = 512
@@ -155,6 +263,11 @@ class TransactionalCopyTask(object):
             while self.current_slice_index < self.total_slice_size:
                 skip_block = (self.total_slice_size - self.current_slice_index - 1)
 
+                if self.block_map and not self.block_map.contains(skip_block):
+                    # no filesystem data in this slice, the index is committed with the next copied slice
+                    self.current_slice_index += 1
+                    continue
+
                 if self.current_slice_index == 0:
                     if self.last_slice_size > 0:
                         copy_result = self.copy_last_slice(skip_block)
@@ -192,6 +305,11 @@ class TransactionalCopyTask(object):
             while self.current_slice_index < self.total_slice_size:
                 skip_block = self.current_slice_index
 
+                if self.block_map and not self.block_map.contains(skip_block):
+                    # no filesystem data in this slice, the index is committed with the next copied slice
+                    self.current_slice_index += 1
+                    continue
+
                 if self.current_slice_index == (self.total_slice_size - 1):
                     if self.last_slice_size > 0:
                         copy_result = self.copy_last_slice(skip_block)
@@ -44,6 +44,7 @@ from DecryptionMarkConfig import DecryptionMarkConfig
 from EncryptionMarkConfig import EncryptionMarkConfig
 from EncryptionEnvironment import EncryptionEnvironment
 from OnGoingItemConfig import OnGoingItemConfig
+from TransactionalCopyTask import CopyBlockMap
 from ProcessLock import ProcessLock
 from CommandExecutor import CommandExecutor, ProcessCommunicator
 from __builtin__ import int
@@ -1257,6 +1258,25 @@ def decrypt_inplace_copy_data(passphrase_file,
         ongoing_item_config.mount_point = crypt_item.mount_point
         ongoing_item_config.commit()
 
+        # only copy the extents the filesystem has allocated, the map has to be taken before
+        # any data is copied back since the mapper stops reading consistently after that
+        block_map = CopyBlockMap(encryption_environment.azure_decrypt_copy_block_map_path, logger)
+        block_map.clear()
+        used_byte_ranges = disk_util.get_used_byte_ranges(ongoing_item_config.current_source_path,
+                                                          crypt_item.file_system)
+        if used_byte_ranges is not None:
+            block_map.create(source_path=ongoing_item_config.current_source_path,
+                             total_size=ongoing_item_config.current_total_copy_size,
+                             block_size=ongoing_item_config.current_block_size,
+                             used_byte_ranges=used_byte_ranges)
+
+    block_map = CopyBlockMap(encryption_environment.azure_decrypt_copy_block_map_path, logger)
+    if not block_map.load(source_path=ongoing_item_config.get_current_source_path(),
+                          total_size=ongoing_item_config.get_current_total_copy_size(),
+                          block_size=ongoing_item_config.get_current_block_size()):
+        logger.log(msg="no copy block map found, copying the whole device")
+        block_map = None
+
     current_phase = ongoing_item_config.get_phase()
 
     while current_phase != CommonVariables.DecryptionPhaseDone:
@@ -1264,7 +1284,9 @@ def decrypt_inplace_copy_data(passphrase_file,
                    level=CommonVariables.InfoLevel)
 
         if current_phase == CommonVariables.DecryptionPhaseCopyData:
-            copy_result = disk_util.copy(ongoing_item_config=ongoing_item_config, status_prefix=status_prefix)
+            copy_result = disk_util.copy(ongoing_item_config=ongoing_item_config,
+                                         status_prefix=status_prefix,
+                                         block_map=block_map)
             if copy_result == CommonVariables.process_success:
                 mount_point = ongoing_item_config.get_mount_point()
                 if mount_point and mount_point != "None":
@@ -1285,6 +1307,8 @@ def decrypt_inplace_copy_data(passphrase_file,
                 return current_phase
 
     ongoing_item_config.clear_config()
+    if block_map:
+        block_map.clear()
 
     return current_phase
 
@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+#
+# VM Encryption extension
+#
+# Copyright 2015 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Requires Python 2.7+
+#
+
+import errno
+import json
+import os
+import os.path
+import struct
+import time
+import zlib
+
+from Common import CommonVariables
+
+# Linux value, os.SEEK_DATA is only exposed on python 3.3+
+SEEK_DATA = getattr(os, 'SEEK_DATA', 3)
+
+
+class OSEncryptionCopyTask(object):
+    """
+    Chunked in-place copy of the plaintext OS partition into /dev/mapper/osencrypt.
+
+    The mapper sits on top of the same sectors it is fed from, so the offset of
+    every chunk and the checksums of its sectors are journaled to durable storage
+    before it is written through the mapper. The journal holds no data: /boot is
+    not encrypted. After a restart, each sector of the interrupted chunk is either
+    still plaintext on the source or already encrypted, in which case it reads
+    back through the mapper, so the chunk is put together again from both and
+    rewritten, and the copy continues from the following offset. Regions that are
+    holes in the source, or blocks made only of zeroes, are not written, which
+    matches the 'dd conv=sparse' behavior this replaces.
+    """
+    sector_size = 512
+
+    def __init__(self,
+                 logger,
+                 hutil,
+                 source_path,
+                 destination_path,
+                 journal_path,
+                 chunk_size=8 * 1024 * 1024,
+                 sparse=True,
+                 sparse_block_size=64 * 1024,
+                 status_interval=30,
+                 status_operation='EnableEncryptionOSVolume'):
+        if chunk_size % sparse_block_size != 0:
+            raise Exception("chunk_size {0} is not a multiple of sparse_block_size {1}".format(chunk_size,
+                                                                                               sparse_block_size))
+
+        self.logger = logger
+        self.hutil = hutil
+        self.source_path = source_path
+        self.destination_path = destination_path
+        self.journal_path = journal_path
+        self.chunk_size = chunk_size
+        self.sparse = sparse
+        self.sparse_block_size = sparse_block_size
+        self.status_interval = status_interval
+        self.status_operation = status_operation
+
+        self.total_size = 0
+        self.bytes_written = 0
+        self.bytes_skipped = 0
+        self._zero_chunk = b'\0' * chunk_size
+        self._zero_block = b'\0' * sparse_block_size
+        self._seek_data_supported = sparse
+
+    def has_journal(self):
+        return os.path.exists(self.journal_path)
+
+    def begin_copy(self):
+        source_fd = os.open(self.source_path, os.O_RDONLY)
+        try:
+            destination_fd = os.open(self.destination_path, os.O_RDWR)
+            try:
+                self.total_size = os.lseek(source_fd, 0, os.SEEK_END)
+                offset = self._resume(source_fd, destination_fd)
+
+                self.logger.log("Copying {0} to {1}, {2} bytes, starting at offset {3}".format(self.source_path,
+                                                                                            self.destination_path,
+                                                                                            self.total_size,
+                                                                                            offset))
+
+                start_time = time.time()
+                start_offset = offset
+                last_status_time = start_time
+
+                while offset < self.total_size:
+                    if self.sparse:
+                        next_offset = self._next_data_offset(source_fd, offset)
+                        if next_offset > offset:
+                            self.bytes_skipped += next_offset - offset
+                            offset = next_offset
+                            continue
+
+                    length = min(self.chunk_size, self.total_size - offset)
+                    data = self._read_chunk(source_fd, offset, length)
+
+                    if self.sparse and data == self._zero_chunk[:length]:
+                        self.bytes_skipped += length
+                    else:
+                        self._write_journal(offset, data)
+                        self._write_chunk(destination_fd, offset, data)
+
+                    offset += length
+
+                    now = time.time()
+                    if now - last_status_time >= self.status_interval:
+                        self._report_progress(offset, offset - start_offset, now - start_time)
+                        last_status_time = now
+
+                os.fsync(destination_fd)
+                self._remove_journal()
+                self._report_progress(offset, offset - start_offset, time.time() - start_time)
+            finally:
+                os.close(destination_fd)
+        finally:
+            os.close(source_fd)
+
+        return CommonVariables.process_success
+
+    def _resume(self, source_fd, destination_fd):
+        """
+        completes the journaled chunk, if any, and returns the offset to continue from
+        """
+        stale_journal_path = self.journal_path + '.tmp'
+        if os.path.exists(stale_journal_path):
+            os.remove(stale_journal_path)
+
+        if not self.has_journal():
+            return 0
+
+        with open(self.journal_path, 'rb') as f:
+            header = json.loads(f.readline().decode('utf-8'))
+            checksums = f.read()
+
+        if header['total_size'] != self.total_size:
+            raise Exception("Copy journal {0} was recorded for a {1} byte device, found {2} bytes".format(self.journal_path,
+                                                                                                         header['total_size'],
+                                                                                                         self.total_size))
+
+        offset = header['offset']
+        length = header['length']
+        sector_count = (length + self.sector_size - 1) // self.sector_size
+        if len(checksums) != 4 * sector_count or (zlib.crc32(checksums) & 0xffffffff) != header['crc32']:
+            raise Exception("Copy journal {0} is corrupt".format(self.journal_path))
+        checksums = struct.unpack('<{0}I'.format(sector_count), checksums)
+
+        self.logger.log("Completing journaled chunk at offset {0}, {1} bytes".format(offset, length))
+
+        # sector writes are atomic: each sector holds either its plaintext or its ciphertext
+        plaintext = self._read_chunk(source_fd, offset, length)
+        decrypted = self._read_destination(destination_fd, offset, length)
+        sectors = []
+        for i in range(0, sector_count):
+            sector_start = i * self.sector_size
+            sector_end = sector_start + self.sector_size
+            if self._checksum(plaintext[sector_start:sector_end]) == checksums[i]:
+                sectors.append(plaintext[sector_start:sector_end])
+            elif self._checksum(decrypted[sector_start:sector_end]) == checksums[i]:
+                sectors.append(decrypted[sector_start:sector_end])
+            else:
+                raise Exception("Sector at offset {0} matches neither the plaintext nor the encrypted copy".format(offset + sector_start))
+
+        self.bytes_written = header['bytes_written']
+        self.bytes_skipped = header['bytes_skipped']
+        self._write_chunk(destination_fd, offset, b''.join(sectors))
+
+        return offset + length
+
+    def _checksum(self, data):
+        return zlib.crc32(data) & 0xffffffff
+
+    def _sector_checksums(self, data):
+        checksums = [self._checksum(data[i:i + self.sector_size]) for i in range(0, len(data), self.sector_size)]
+        return struct.pack('<{0}I'.format(len(checksums)), *checksums)
+
+    def _next_data_offset(self, fd, offset):
+        """
+        returns the start of the next data region at or after offset, aligned down to sparse_block_size
+        """
+        if not self._seek_data_supported:
+            return offset
+
+        try:
+            data_offset = os.lseek(fd, offset, SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # no data past offset, the rest of the source is a hole
+                return self.total_size
+            self._seek_data_supported = False
+            return offset
+
+        data_offset -= data_offset % self.sparse_block_size
+        return max(offset, min(data_offset, self.total_size))
+
+    def _read_destination(self, fd, offset, length):
+        """
+        reads back through the mapper, i.e. decrypted
+        """
+        return self._read_at(fd, offset, length, self.destination_path)
+
+    def _read_chunk(self, fd, offset, length):
+        return self._read_at(fd, offset, length, self.source_path)
+
+    def _read_at(self, fd, offset, length, path):
+        os.lseek(fd, offset, os.SEEK_SET)
+        pieces = []
+        remaining = length
+        while remaining > 0:
+            piece = os.read(fd, remaining)
+            if not piece:
+                raise Exception("Unexpected end of {0} at offset {1}".format(path, offset + length - remaining))
+            pieces.append(piece)
+            remaining -= len(piece)
+        return b''.join(pieces)
+
+    def _write_chunk(self, fd, offset, data):
+        """
+        writes data at offset, leaving out sparse_block_size blocks that are all zeroes
+        """
+        if not self.sparse:
+            self._write_at(fd, offset, data)
+        else:
+            run_start = None
+            for block_start in range(0, len(data), self.sparse_block_size):
+                block = data[block_start:block_start + self.sparse_block_size]
+                if block == self._zero_block[:len(block)]:
+                    if run_start is not None:
+                        self._write_at(fd, offset + run_start, data[run_start:block_start])
+                        run_start = None
+                elif run_start is None:
+                    run_start = block_start
+            if run_start is not None:
+                self._write_at(fd, offset + run_start, data[run_start:])
+
+        os.fsync(fd)
+
+    def _write_at(self, fd, offset, data):
+        os.lseek(fd, offset, os.SEEK_SET)
+        self._write_all(fd, data)
+        self.bytes_written += len(data)
+
+    def _write_journal(self, offset, data):
+        checksums = self._sector_checksums(data)
+        header = {
+            'total_size': self.total_size,
+            'offset': offset,
+            'length': len(data),
+            'crc32': self._checksum(checksums),
+            'bytes_written': self.bytes_written,
+            'bytes_skipped': self.bytes_skipped
+        }
+
+        tmp_path = self.journal_path + '.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            self._write_all(fd, json.dumps(header).encode('utf-8') + b'\n')
+            self._write_all(fd, checksums)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        os.rename(tmp_path, self.journal_path)
+        self._fsync_journal_dir()
+
+    def _write_all(self, fd, data):
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+
+    def _remove_journal(self):
+        if self.has_journal():
+            os.remove(self.journal_path)
+            self._fsync_journal_dir()
+
+    def _fsync_journal_dir(self):
+        dir_fd = os.open(os.path.dirname(os.path.abspath(self.journal_path)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    def _report_progress(self, offset, bytes_processed, elapsed):
+        percent = int(offset * 100.0 / self.total_size) if self.total_size else 100
+        throughput = bytes_processed / elapsed if elapsed > 0 else 0
+
+        if throughput > 0:
+            eta = "{0}s".format(int((self.total_size - offset) / throughput))
+        else:
+            eta = "unknown"
+
+        message = "OS disk encryption in progress: {0}% ({1} MB written, {2} MB skipped), {3:.1f} MB/s, ETA {4}".format(percent,
+                                                                                                                       self.bytes_written // (1024 * 1024),
+                                                                                                                       self.bytes_skipped // (1024 * 1024),
+                                                                                                                       throughput / (1024 * 1024),
+                                                                                                                       eta)
+        self.logger.log(message)
+
+        if self.hutil:
+            self.hutil.do_status_report(operation=self.status_operation,
+                                        status=CommonVariables.extension_success_status,
+                                        status_code=str(CommonVariables.success),
+                                        message=message)
@@ -22,7 +22,7 @@
 import os.path
 import re
 
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from uuid import UUID
 
 from Common import *
@@ -40,75 +40,30 @@ class OSEncryptionState(object):
         self.state_executed = False
         self.state_marker = os.path.join(self.context.encryption_environment.os_encryption_markers_path, self.state_name)
 
-        self.command_executor = CommandExecutor(self.context.logger)
+        self.command_executor = self.context.command_executor
+        self.disk_util = self.context.disk_util
+        self.bek_util = self.context.bek_util
+        self.encryption_config = self.context.encryption_config
 
-        self.disk_util = DiskUtil(hutil=self.context.hutil,
-                                  patching=self.context.distro_patcher,
-                                  logger=self.context.logger,
-                                  encryption_environment=self.context.encryption_environment)
+        # device discovery runs once, when the first state is constructed, and is shared by all states
+        self.context.get_device_inventory()
 
-        self.bek_util = BekUtil(disk_util=self.disk_util,
-                                logger=self.context.logger)
-
-        self.encryption_config = EncryptionConfig(encryption_environment=self.context.encryption_environment,
-                                                  logger=self.context.logger)
-
-        rootfs_mountpoint = '/'
-
-        if self._is_in_memfs_root():
-            rootfs_mountpoint = '/oldroot'
-
-        self.rootfs_sdx_path = self._get_fs_partition(rootfs_mountpoint)[0]
+    @property
+    def rootfs_sdx_path(self):
+        return self.context.get_device_inventory().rootfs_sdx_path
 
-        if self.rootfs_sdx_path == "none":
-            self.context.logger.log("self.rootfs_sdx_path is none, parsing UUID from fstab")
-            self.rootfs_sdx_path = self._parse_uuid_from_fstab('/')
-            self.context.logger.log("rootfs_uuid: {0}".format(self.rootfs_sdx_path))
-
-        if self.rootfs_sdx_path and (self.rootfs_sdx_path.startswith("/dev/disk/by-uuid/") or self._is_uuid(self.rootfs_sdx_path)):
-            self.rootfs_sdx_path = self.disk_util.query_dev_sdx_path_by_uuid(self.rootfs_sdx_path)
-
-        self.context.logger.log("self.rootfs_sdx_path: {0}".format(self.rootfs_sdx_path))
-
-        self.rootfs_disk = None
-        self.rootfs_block_device = None
-        self.bootfs_block_device = None
-        
-        if self.disk_util.is_os_disk_lvm():
-            proc_comm = ProcessCommunicator()
-            self.command_executor.Execute('pvs', True, communicator=proc_comm)
-
-            for line in proc_comm.stdout.split("\n"):
-                if "rootvg" in line:
-                    self.rootfs_block_device = line.strip().split()[0]
-                    self.rootfs_disk = self.rootfs_block_device[:-1]
-                    self.bootfs_block_device = self.rootfs_disk + '2'
-        elif not self.rootfs_sdx_path:
-            self.rootfs_disk = '/dev/sda'
-            self.rootfs_block_device = '/dev/sda2'
-            self.bootfs_block_device = '/dev/sda1'
-        elif self.rootfs_sdx_path == '/dev/mapper/osencrypt' or self.rootfs_sdx_path.startswith('/dev/dm-'):
-            self.rootfs_block_device = '/dev/mapper/osencrypt'
-            bootfs_uuid = self._parse_uuid_from_fstab('/boot')
-            self.context.logger.log("bootfs_uuid: {0}".format(bootfs_uuid))
-            self.bootfs_block_device = self.disk_util.query_dev_sdx_path_by_uuid(bootfs_uuid)
-        else:
-            self.rootfs_block_device = self.disk_util.query_dev_id_path_by_sdx_path(self.rootfs_sdx_path)
-            if not self.rootfs_block_device.startswith('/dev/disk/by-id/'):
-                self.context.logger.log("rootfs_block_device: {0}".format(self.rootfs_block_device))
-                raise Exception("Could not find rootfs block device")
+    @property
+    def rootfs_disk(self):
+        return self.context.get_device_inventory().rootfs_disk
 
-            self.rootfs_disk = self.rootfs_block_device[:self.rootfs_block_device.index("-part")]
-            self.bootfs_block_device = self.rootfs_disk + "-part2"
+    @property
+    def rootfs_block_device(self):
+        return self.context.get_device_inventory().rootfs_block_device
 
-            if self._get_block_device_size(self.bootfs_block_device) > self._get_block_device_size(self.rootfs_block_device):
-                self.context.logger.log("Swapping partition identifiers for rootfs and bootfs")
-                self.rootfs_block_device, self.bootfs_block_device = self.bootfs_block_device, self.rootfs_block_device
+    @property
+    def bootfs_block_device(self):
+        return self.context.get_device_inventory().bootfs_block_device
 
-        self.context.logger.log("rootfs_disk: {0}".format(self.rootfs_disk))
-        self.context.logger.log("rootfs_block_device: {0}".format(self.rootfs_block_device))
-        self.context.logger.log("bootfs_block_device: {0}".format(self.bootfs_block_device))
-        
     def should_enter(self):
         self.context.logger.log("OSEncryptionState.should_enter() called for {0}".format(self.state_name))
 
@@ -140,20 +95,159 @@ class OSEncryptionState(object):
 
         return self.state_executed
 
+OSDeviceInventory = namedtuple('OSDeviceInventory',
+                               ['rootfs_sdx_path',
+                                'rootfs_disk',
+                                'rootfs_block_device',
+                                'bootfs_block_device'])
+
+class OSEncryptionStateContext(object):
+    """
+    State shared by all OSEncryptionState objects of a state machine.
+
+    Helpers, the device inventory, the mount table and the BEK passphrase file
+    are created on first use and reused across state transitions. Cached
+    discovery results stay valid until invalidate() is called.
+    """
+    def __init__(self, hutil, distro_patcher, logger, encryption_environment):
+        super(OSEncryptionStateContext, self).__init__()
+
+        self.hutil = hutil
+        self.distro_patcher = distro_patcher
+        self.logger = logger
+        self.encryption_environment = encryption_environment
+
+        self.command_executor = CommandExecutor(self.logger)
+
+        self.disk_util = DiskUtil(hutil=self.hutil,
+                                  patching=self.distro_patcher,
+                                  logger=self.logger,
+                                  encryption_environment=self.encryption_environment)
+
+        self.bek_util = BekUtil(disk_util=self.disk_util,
+                                logger=self.logger)
+
+        self.encryption_config = EncryptionConfig(encryption_environment=self.encryption_environment,
+                                                  logger=self.logger)
+
+        self.state_timings = OrderedDict()
+
+        self._device_inventory = None
+        self._mounts = None
+        self._bek_passphrase_file = None
+
+    def invalidate(self, devices=False, mounts=True, passphrase=True):
+        """
+        drops cached discovery results, they are recomputed on next use
+        """
+        if devices:
+            self._device_inventory = None
+        if mounts:
+            self._mounts = None
+        if passphrase:
+            self._bek_passphrase_file = None
+
+    def get_mounts(self):
+        """
+        returns (device, mountpoint, fstype) tuples parsed from /proc/mounts
+        """
+        if self._mounts is None:
+            self._mounts = []
+            for line in file('/proc/mounts'):
+                self._mounts.append(tuple([s.decode('string_escape') for s in line.split()[:3]]))
+
+        return self._mounts
+
+    def get_bek_passphrase_file(self):
+        if self._bek_passphrase_file is None or not os.path.exists(self._bek_passphrase_file):
+            self._bek_passphrase_file = self.bek_util.get_bek_passphrase_file(self.encryption_config)
+
+        return self._bek_passphrase_file
+
+    def get_device_inventory(self):
+        if self._device_inventory is None:
+            self._device_inventory = self._discover_devices()
+
+        return self._device_inventory
+
+    def record_state_timing(self, state_name, phase, elapsed):
+        self.state_timings.setdefault(state_name, OrderedDict())[phase] = elapsed
+        self.logger.log("State {0} {1} took {2:.3f}s".format(state_name, phase, elapsed))
+
+    def _discover_devices(self):
+        rootfs_mountpoint = '/'
+
+        if self._is_in_memfs_root():
+            rootfs_mountpoint = '/oldroot'
+
+        rootfs_sdx_path = self._get_fs_partition(rootfs_mountpoint)[0]
+
+        if rootfs_sdx_path == "none":
+            self.logger.log("rootfs_sdx_path is none, parsing UUID from fstab")
+            rootfs_sdx_path = self._parse_uuid_from_fstab('/')
+            self.logger.log("rootfs_uuid: {0}".format(rootfs_sdx_path))
+
+        if rootfs_sdx_path and (rootfs_sdx_path.startswith("/dev/disk/by-uuid/") or self._is_uuid(rootfs_sdx_path)):
+            rootfs_sdx_path = self.disk_util.query_dev_sdx_path_by_uuid(rootfs_sdx_path)
+
+        self.logger.log("rootfs_sdx_path: {0}".format(rootfs_sdx_path))
+
+        rootfs_disk = None
+        rootfs_block_device = None
+        bootfs_block_device = None
+
+        if self.disk_util.is_os_disk_lvm():
+            proc_comm = ProcessCommunicator()
+            self.command_executor.Execute('pvs', True, communicator=proc_comm)
+
+            for line in proc_comm.stdout.split("\n"):
+                if "rootvg" in line:
+                    rootfs_block_device = line.strip().split()[0]
+                    rootfs_disk = rootfs_block_device[:-1]
+                    bootfs_block_device = rootfs_disk + '2'
+        elif not rootfs_sdx_path:
+            rootfs_disk = '/dev/sda'
+            rootfs_block_device = '/dev/sda2'
+            bootfs_block_device = '/dev/sda1'
+        elif rootfs_sdx_path == '/dev/mapper/osencrypt' or rootfs_sdx_path.startswith('/dev/dm-'):
+            rootfs_block_device = '/dev/mapper/osencrypt'
+            bootfs_uuid = self._parse_uuid_from_fstab('/boot')
+            self.logger.log("bootfs_uuid: {0}".format(bootfs_uuid))
+            bootfs_block_device = self.disk_util.query_dev_sdx_path_by_uuid(bootfs_uuid)
+        else:
+            rootfs_block_device = self.disk_util.query_dev_id_path_by_sdx_path(rootfs_sdx_path)
+            if not rootfs_block_device.startswith('/dev/disk/by-id/'):
+                self.logger.log("rootfs_block_device: {0}".format(rootfs_block_device))
+                raise Exception("Could not find rootfs block device")
+
+            rootfs_disk = rootfs_block_device[:rootfs_block_device.index("-part")]
+            bootfs_block_device = rootfs_disk + "-part2"
+
+            if self._get_block_device_size(bootfs_block_device) > self._get_block_device_size(rootfs_block_device):
+                self.logger.log("Swapping partition identifiers for rootfs and bootfs")
+                rootfs_block_device, bootfs_block_device = bootfs_block_device, rootfs_block_device
+
+        self.logger.log("rootfs_disk: {0}".format(rootfs_disk))
+        self.logger.log("rootfs_block_device: {0}".format(rootfs_block_device))
+        self.logger.log("bootfs_block_device: {0}".format(bootfs_block_device))
+
+        return OSDeviceInventory(rootfs_sdx_path=rootfs_sdx_path,
+                                 rootfs_disk=rootfs_disk,
+                                 rootfs_block_device=rootfs_block_device,
+                                 bootfs_block_device=bootfs_block_device)
+
     def _get_fs_partition(self, fs):
         result = None
         dev = os.lstat(fs).st_dev
 
-        for line in file('/proc/mounts'):
-            line = [s.decode('string_escape') for s in line.split()[:3]]
-            if dev == os.lstat(line[1]).st_dev:
-                result = tuple(line)
+        for mount in self.get_mounts():
+            if dev == os.lstat(mount[1]).st_dev:
+                result = mount
 
         return result
 
     def _is_in_memfs_root(self):
-        mounts = file('/proc/mounts', 'r').read()
-        return bool(re.search(r'/\s+tmpfs', mounts))
+        return any(mount[1] == '/' and mount[2] == 'tmpfs' for mount in self.get_mounts())
 
     def _parse_uuid_from_fstab(self, mountpoint):
         contents = file('/etc/fstab', 'r').read()
@@ -178,9 +272,3 @@ class OSEncryptionState(object):
             return False
         else:
             return True
-
-OSEncryptionStateContext = namedtuple('OSEncryptionStateContext',
-                                      ['hutil',
-                                       'distro_patcher',
-                                       'logger',
-                                       'encryption_environment'])
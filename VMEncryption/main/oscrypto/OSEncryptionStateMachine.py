@@ -23,6 +23,7 @@ import inspect
 import os
 import sys
 import traceback
+import time
 from time import sleep
 
 scriptdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
@@ -62,11 +63,21 @@ class OSEncryptionStateMachine(object):
     ]
 
     def on_enter_state(self):
-        self.state_objs[self.state].enter()
+        start_time = time.time()
+        try:
+            self.state_objs[self.state].enter()
+        finally:
+            # states mount, unmount and pivot filesystems, cached mounts and BEK mount are stale afterwards
+            self.context.invalidate()
+            self.context.record_state_timing(self.state, 'enter', time.time() - start_time)
 
     def should_exit_previous_state(self):
         # when this is called, self.state is still the "source" state in the transition
-        return self.state_objs[self.state].should_exit()
+        start_time = time.time()
+        try:
+            return self.state_objs[self.state].should_exit()
+        finally:
+            self.context.record_state_timing(self.state, 'should_exit', time.time() - start_time)
 
     def __init__(self, hutil, distro_patcher, logger, encryption_environment):
         super(OSEncryptionStateMachine, self).__init__()
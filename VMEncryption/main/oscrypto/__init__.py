@@ -15,3 +15,4 @@
 
 from OSEncryptionState import *
 from OSEncryptionStateMachine import *
+from OSEncryptionCopyTask import *
@@ -57,7 +57,7 @@ class EncryptBlockDeviceState(OSEncryptionState):
         self.command_executor.Execute('mount /boot', False)
         # self._find_bek_and_execute_action('_dump_passphrase')
 
-        self.context.hutil.do_status_report(operation='EnableEncryptionDataVolumes',
+        self.context.hutil.do_status_report(operation='EnableEncryptionOSVolume',
                                             status=CommonVariables.extension_success_status,
                                             status_code=str(CommonVariables.success),
                                             message='OS disk encryption started')
@@ -98,7 +98,7 @@ class EncryptBlockDeviceState(OSEncryptionState):
         if not ismethod(callback_method):
             raise Exception("{0} is not a method".format(callback_method_name))
 
-        bek_path = self.bek_util.get_bek_passphrase_file(self.encryption_config)
+        bek_path = self.context.get_bek_passphrase_file()
         callback_method(bek_path)    
 
     def _get_root_fs_size_in_sectors(self, sector_size):
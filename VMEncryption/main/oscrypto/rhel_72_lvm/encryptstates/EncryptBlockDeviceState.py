@@ -25,6 +25,7 @@ import sys
 from inspect import ismethod
 from time import sleep
 from OSEncryptionState import *
+from OSEncryptionCopyTask import *
 
 class EncryptBlockDeviceState(OSEncryptionState):
     def __init__(self, context):
@@ -47,16 +48,23 @@ class EncryptBlockDeviceState(OSEncryptionState):
         self.context.logger.log("Entering encrypt_block_device state")
         
         self.command_executor.Execute('mount /boot', False)
+        copy_task = self._create_copy_task()
+
         # self._find_bek_and_execute_action('_dump_passphrase')
-        self._find_bek_and_execute_action('_luks_format')
-        self._find_bek_and_execute_action('_luks_open')
+        if copy_task.has_journal():
+            self.context.logger.log("Found OS disk copy journal, resuming interrupted encryption")
+        else:
+            self._find_bek_and_execute_action('_luks_format')
 
-        self.context.hutil.do_status_report(operation='EnableEncryptionDataVolumes',
+        if not os.path.exists('/dev/mapper/osencrypt'):
+            self._find_bek_and_execute_action('_luks_open')
+
+        self.context.hutil.do_status_report(operation='EnableEncryptionOSVolume',
                                             status=CommonVariables.extension_success_status,
                                             status_code=str(CommonVariables.success),
                                             message='OS disk encryption started')
 
-        self.command_executor.Execute('dd if={0} of=/dev/mapper/osencrypt conv=sparse bs=64K'.format(self.rootfs_block_device), True)
+        copy_task.begin_copy()
 
     def should_exit(self):
         self.context.logger.log("Verifying if machine should exit encrypt_block_device state")
@@ -66,6 +74,14 @@ class EncryptBlockDeviceState(OSEncryptionState):
 
         return super(EncryptBlockDeviceState, self).should_exit()
 
+    def _create_copy_task(self, sparse=True):
+        return OSEncryptionCopyTask(logger=self.context.logger,
+                                    hutil=self.context.hutil,
+                                    source_path=self.rootfs_block_device,
+                                    destination_path='/dev/mapper/osencrypt',
+                                    journal_path='/boot/luks/oscopyjournal',
+                                    sparse=sparse)
+
     def _luks_format(self, bek_path):
         self.command_executor.Execute('mkdir /boot/luks', True)
         self.command_executor.Execute('dd if=/dev/zero of=/boot/luks/osluksheader bs=33554432 count=1', True)
@@ -92,5 +108,5 @@ class EncryptBlockDeviceState(OSEncryptionState):
         if not ismethod(callback_method):
             raise Exception("{0} is not a method".format(callback_method_name))
 
-        bek_path = self.bek_util.get_bek_passphrase_file(self.encryption_config)
+        bek_path = self.context.get_bek_passphrase_file()
         callback_method(bek_path)        
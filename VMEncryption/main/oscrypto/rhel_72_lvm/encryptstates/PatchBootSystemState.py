@@ -238,5 +238,5 @@ class PatchBootSystemState(OSEncryptionState):
         if not ismethod(callback_method):
             raise Exception("{0} is not a method".format(callback_method_name))
 
-        bek_path = self.bek_util.get_bek_passphrase_file(self.encryption_config)
+        bek_path = self.context.get_bek_passphrase_file()
         callback_method(bek_path)    
@@ -280,3 +280,40 @@ class TestDiskUtil(unittest.TestCase):
         self.assertTrue("\n/dev/mapper/mapper_name2 /mnt/point2 ext4 defaults,nofail 0 0" in open_mock.content_dict["/etc/fstab"])
         self.assertTrue("\nmapper_name /dev/dev_path /test_passphrase_path" in open_mock.content_dict["/etc/crypttab"])
         self.assertTrue("\nmapper_name2 /dev/dev_path2 /test_passphrase_path" in open_mock.content_dict["/etc/crypttab"])
+
+    def test_parse_dumpe2fs_used_byte_ranges(self):
+        dumpe2fs_output = """Filesystem volume name:   <none>
+Filesystem features:      has_journal ext_attr resize_inode dir_index filetype extent sparse_super
+Filesystem state:         clean
+Block count:              65536
+Free blocks:              57000
+Block size:               4096
+
+
+Group 0: (Blocks 0-32767)
+  Primary superblock at 0, Group descriptors at 1-1
+  1000 free blocks, 8181 free inodes, 2 directories
+  Free blocks: 31768-32767
+  Free inodes: 12-8192
+Group 1: (Blocks 32768-65535)
+  32768 free blocks, 8192 free inodes, 0 directories
+  Free blocks: 32768-65535
+  Free inodes: 8193-16384
+"""
+        self.assertEqual(self.disk_util.parse_dumpe2fs_used_byte_ranges(dumpe2fs_output),
+                         [(0, 31768 * 4096)])
+
+        dirty_output = dumpe2fs_output.replace("sparse_super", "sparse_super needs_recovery")
+        self.assertIsNone(self.disk_util.parse_dumpe2fs_used_byte_ranges(dirty_output))
+
+    def test_parse_xfs_used_byte_ranges(self):
+        superblock_output = "blocksize = 4096\nagblocks = 1000\ndblocks = 2000\n"
+        freesp_output = """   agno    agbno      len
+      0      100      900
+      1        0      500
+   from      to extents  blocks    pct
+    512    1023       2    1400 100.00
+total free extents 2
+"""
+        self.assertEqual(self.disk_util.parse_xfs_used_byte_ranges(superblock_output, freesp_output),
+                         [(0, 100 * 4096), (1500 * 4096, 2000 * 4096)])
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+#
+# *********************************************************
+# Copyright (c) Microsoft. All rights reserved.
+#
+# Apache 2.0 License
+#
+# You may obtain a copy of the License at
+# http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+#
+# *********************************************************
+
+""" Unit tests for the KeyVaultUtil module, run against a local fake AAD and Key Vault endpoint """
+
+import httplib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import urlparse
+import mock
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from console_logger import ConsoleLogger
+
+# HttpUtil reads the proxy configuration through waagent, which may not be installed on test machines
+try:
+    import main.Utils.WAAgentUtil
+except Exception:
+    sys.modules['main.Utils.WAAgentUtil'] = mock.MagicMock()
+
+from main.KeyVaultUtil import KeyVaultUtil, AccessTokenCache
+from main.HttpUtil import HttpUtil
+
+
+class FakeKeyVaultHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _respond(self, status, body, headers=None):
+        content = json.dumps(body)
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _record(self):
+        length = int(self.headers.getheader('Content-Length') or 0)
+        body = self.rfile.read(length) if length else None
+        self.server.requests.append((self.command, self.path.split('?')[0], self.client_address[1], body))
+
+    def _drop(self):
+        # the request is lost, as if the server closed an idle connection while it was sent
+        self.close_connection = True
+
+    def do_GET(self):
+        self._record()
+        if self.path == '/drop':
+            return self._drop()
+        if self.path == '/close-after-response':
+            self._respond(200, {})
+            # without telling the client, as servers closing idle keep-alive connections do
+            self.close_connection = True
+            return
+        challenge = 'Bearer authorization="{0}/tenant", resource="{0}"'.format(self.server.base_uri)
+        self._respond(401, {}, {'WWW-Authenticate': challenge})
+
+    def do_POST(self):
+        self._record()
+        if self.path == '/drop':
+            return self._drop()
+        if self.path.startswith('/tenant/oauth2/token'):
+            self._respond(200, {'access_token': 'fake-token', 'expires_in': '3600'})
+        else:
+            self._respond(200, {'kid': 'kek', 'value': 'wrapped-passphrase'})
+
+    def do_PUT(self):
+        self._record()
+        self._respond(200, {'id': self.server.base_uri + self.path.split('?')[0]})
+
+
+class TestKeyVaultUtil(unittest.TestCase):
+    def setUp(self):
+        self.logger = ConsoleLogger()
+        self.workdir = tempfile.mkdtemp()
+        self.token_cache = AccessTokenCache(self.logger)
+
+        waagent_patcher = mock.patch('main.HttpUtil.waagent')
+        fake_waagent = waagent_patcher.start()
+        fake_waagent.ConfigurationProvider.return_value.get.return_value = None
+        self.addCleanup(waagent_patcher.stop)
+
+        # the fake key vault serves plain http, HttpUtil itself only ever connects over TLS
+        connection_patcher = mock.patch.object(HttpUtil, 'connection_class', httplib.HTTPConnection)
+        connection_patcher.start()
+        self.addCleanup(connection_patcher.stop)
+
+        self.server = HTTPServer(('127.0.0.1', 0), FakeKeyVaultHandler)
+        self.server.requests = []
+        self.server.base_uri = 'http://127.0.0.1:{0}'.format(self.server.server_address[1])
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.workdir)
+
+    def _create_kek_secret(self, key_vault_util):
+        return key_vault_util.create_kek_secret(Passphrase='passphrase',
+                                                KeyVaultURL=self.server.base_uri,
+                                                KeyEncryptionKeyURL=self.server.base_uri + '/keys/kek/1',
+                                                AADClientID='client',
+                                                AADClientCertThumbprint=None,
+                                                KeyEncryptionAlgorithm='RSA-OAEP',
+                                                AADClientSecret='secret',
+                                                DiskEncryptionKeyFileName='LinuxPassPhraseFileName')
+
+    def _requests(self):
+        return [(method, path) for method, path, port, body in self.server.requests]
+
+    def test_create_kek_secret_reuses_connection(self):
+        secret_id = self._create_kek_secret(KeyVaultUtil(self.logger, token_cache=self.token_cache))
+
+        self.assertTrue(secret_id.startswith(self.server.base_uri + '/secrets/'))
+        self.assertEqual([method for method, path in self._requests()], ['GET', 'POST', 'POST', 'PUT'])
+        self.assertEqual(self._requests()[1][1], '/tenant/oauth2/token')
+        self.assertEqual(self._requests()[2][1], '/keys/kek/1/wrapkey')
+        self.assertEqual(len(set(port for method, path, port, body in self.server.requests)), 1)
+
+    def test_cached_token_skips_discovery_and_authentication(self):
+        self._create_kek_secret(KeyVaultUtil(self.logger, token_cache=self.token_cache))
+        self.server.requests = []
+
+        # a retry in the same extension process picks up the cached token
+        secret_id = self._create_kek_secret(KeyVaultUtil(self.logger, token_cache=self.token_cache))
+
+        self.assertIsNotNone(secret_id)
+        self.assertEqual([method for method, path in self._requests()], ['POST', 'PUT'])
+        self.assertEqual(self._requests()[0][1], '/keys/kek/1/wrapkey')
+
+    def test_expired_token_is_refreshed(self):
+        token_cache = self.token_cache
+        token_cache.set_authorize_uri(self.server.base_uri, self.server.base_uri + '/tenant')
+        token_cache.set_token(self.server.base_uri + '/tenant', 'http://127.0.0.1:{0}'.format(self.server.server_address[1]),
+                              'client', 'stale-token', time.time() + 60)
+
+        self._create_kek_secret(KeyVaultUtil(self.logger, token_cache=self.token_cache))
+
+        self.assertEqual([path for method, path in self._requests()][0], '/tenant/oauth2/token')
+
+    def test_token_cache_is_in_memory_only(self):
+        self._create_kek_secret(KeyVaultUtil(self.logger))
+
+        self.assertTrue(KeyVaultUtil(self.logger).token_cache is KeyVaultUtil(self.logger).token_cache)
+        self.assertEqual(os.listdir(self.workdir), [])
+
+    def test_lost_request_is_retried_only_if_idempotent(self):
+        http_util = HttpUtil(self.logger)
+        self.assertIsNone(http_util.Call(method='POST', http_uri=self.server.base_uri + '/drop', data='{}', headers={}))
+        self.assertEqual(self._requests(), [('POST', '/drop')])
+
+        self.server.requests = []
+        self.assertIsNone(http_util.Call(method='GET', http_uri=self.server.base_uri + '/drop', data=None, headers={}))
+        self.assertEqual(self._requests(), [('GET', '/drop'), ('GET', '/drop')])
+        http_util.close()
+
+    def test_connection_closed_by_server_is_not_reused(self):
+        http_util = HttpUtil(self.logger)
+        result = http_util.Call(method='GET', http_uri=self.server.base_uri + '/close-after-response', data=None, headers={})
+        result.read()
+        time.sleep(0.2)
+
+        result = http_util.Call(method='POST', http_uri=self.server.base_uri + '/keys/kek/1/wrapkey', data='{}', headers={})
+        self.assertEqual(result.status, 200)
+        self.assertEqual([method for method, path in self._requests()], ['GET', 'POST'])
+        http_util.close()
+
+    def test_plain_http_uri_is_sent_over_tls(self):
+        with mock.patch.object(HttpUtil, 'connection_class', httplib.HTTPSConnection):
+            http_util = HttpUtil(self.logger)
+            connection = http_util._get_connection(urlparse.urlparse(self.server.base_uri + '/keys/kek/1'))
+        self.assertTrue(isinstance(connection, httplib.HTTPSConnection))
+        http_util.close()
+
+    def test_token_expiry_from_jwt(self):
+        token_cache = AccessTokenCache(self.logger)
+        payload = json.dumps({'exp': 1500000000}).encode('base64').replace('\n', '').rstrip('=')
+        self.assertEqual(token_cache.get_token_expiry('header.' + payload + '.signature'), 1500000000)
+        self.assertIsNone(token_cache.get_token_expiry('opaque-token'))
+
+
+if __name__ == '__main__':
+    unittest.main()
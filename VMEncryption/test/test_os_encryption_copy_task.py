@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+#
+# *********************************************************
+# Copyright (c) Microsoft. All rights reserved.
+#
+# Apache 2.0 License
+#
+# You may obtain a copy of the License at
+# http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+#
+# *********************************************************
+
+""" Unit tests for the OSEncryptionCopyTask module, run against sparse loop image files """
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+import mock
+
+testdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(testdir, '..', 'main'))
+sys.path.append(os.path.join(testdir, '..', 'main', 'oscrypto'))
+
+from OSEncryptionCopyTask import OSEncryptionCopyTask
+from console_logger import ConsoleLogger
+
+MB = 1024 * 1024
+
+
+class InterruptedCopyTask(OSEncryptionCopyTask):
+    """ fails after a number of chunk writes, leaving the journal of the last chunk behind """
+    def __init__(self, fail_after, *args, **kwargs):
+        super(InterruptedCopyTask, self).__init__(*args, **kwargs)
+        self.writes_left = fail_after
+
+    def _write_chunk(self, fd, offset, data):
+        if self.writes_left == 0:
+            raise IOError("simulated reboot")
+        self.writes_left -= 1
+        super(InterruptedCopyTask, self)._write_chunk(fd, offset, data)
+
+
+class TornWriteCopyTask(OSEncryptionCopyTask):
+    """ fails in the middle of a chunk write, after a number of sectors went through """
+    def __init__(self, fail_after_sectors, *args, **kwargs):
+        super(TornWriteCopyTask, self).__init__(*args, **kwargs)
+        self.sectors_left = fail_after_sectors
+
+    def _write_at(self, fd, offset, data):
+        if self.sectors_left is not None and len(data) > self.sectors_left * self.sector_size:
+            super(TornWriteCopyTask, self)._write_at(fd, offset, data[:self.sectors_left * self.sector_size])
+            raise IOError("simulated reboot")
+        if self.sectors_left is not None:
+            self.sectors_left -= len(data) // self.sector_size
+        super(TornWriteCopyTask, self)._write_at(fd, offset, data)
+
+
+XOR_TABLE = bytes(bytearray(i ^ 0x5a for i in range(256)))
+
+
+class InPlaceCopyTask(TornWriteCopyTask):
+    """ the destination is the source itself seen through an XOR 'cipher', as the mapper is """
+    def _write_at(self, fd, offset, data):
+        super(InPlaceCopyTask, self)._write_at(fd, offset, data.translate(XOR_TABLE))
+
+    def _read_destination(self, fd, offset, length):
+        return super(InPlaceCopyTask, self)._read_destination(fd, offset, length).translate(XOR_TABLE)
+
+
+class CopyTaskTestCase(unittest.TestCase):
+    def setUp(self):
+        self.logger = ConsoleLogger()
+        self.hutil = mock.MagicMock()
+        self.workdir = tempfile.mkdtemp()
+        self.source = os.path.join(self.workdir, 'rootfs.img')
+        self.destination = os.path.join(self.workdir, 'osencrypt.img')
+        self.journal = os.path.join(self.workdir, 'oscopyjournal')
+
+        # 16MB image with data at 0, 5MB and the last 64K, holes and zero blocks elsewhere
+        self.regions = [(0, os.urandom(MB)), (5 * MB, os.urandom(2 * MB)), (16 * MB - 64 * 1024, os.urandom(64 * 1024))]
+        with open(self.source, 'wb') as f:
+            f.truncate(16 * MB)
+            for offset, data in self.regions:
+                f.seek(offset)
+                f.write(data)
+            f.seek(10 * MB)
+            f.write(b'\0' * MB)
+
+        # fill the destination so that skipped regions are detectable
+        with open(self.destination, 'wb') as f:
+            f.write(b'\xff' * 16 * MB)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def _create_task(self, task_class=OSEncryptionCopyTask, *args, **kwargs):
+        kwargs.setdefault('chunk_size', MB)
+        kwargs.setdefault('source_path', self.source)
+        kwargs.setdefault('destination_path', self.destination)
+        return task_class(*args,
+                          logger=self.logger,
+                          hutil=self.hutil,
+                          journal_path=self.journal,
+                          status_interval=0,
+                          **kwargs)
+
+    def _read_destination(self):
+        with open(self.destination, 'rb') as f:
+            return f.read()
+
+    def _assert_regions_copied(self, contents):
+        for offset, data in self.regions:
+            self.assertEqual(contents[offset:offset + len(data)], data)
+
+
+class TestOSEncryptionCopyTask(CopyTaskTestCase):
+    def test_sparse_copy_skips_holes_and_zero_blocks(self):
+        task = self._create_task()
+        task.begin_copy()
+
+        contents = self._read_destination()
+        self._assert_regions_copied(contents)
+        self.assertEqual(contents[2 * MB:3 * MB], b'\xff' * MB)
+        self.assertEqual(contents[10 * MB:11 * MB], b'\xff' * MB)
+        self.assertEqual(task.bytes_written, 3 * MB + 64 * 1024)
+        self.assertEqual(task.bytes_skipped + task.bytes_written, 16 * MB)
+        self.assertFalse(os.path.exists(self.journal))
+
+    def test_non_sparse_copy_writes_everything(self):
+        self._create_task(sparse=False).begin_copy()
+
+        with open(self.source, 'rb') as f:
+            self.assertEqual(self._read_destination(), f.read())
+
+    def test_resume_replays_journaled_chunk(self):
+        task = self._create_task(InterruptedCopyTask, 2)
+        self.assertRaises(IOError, task.begin_copy)
+        self.assertTrue(os.path.exists(self.journal))
+
+        resumed_task = self._create_task()
+        self.assertTrue(resumed_task.has_journal())
+        resumed_task.begin_copy()
+
+        self._assert_regions_copied(self._read_destination())
+        self.assertEqual(resumed_task.bytes_written, 3 * MB + 64 * 1024)
+        self.assertFalse(os.path.exists(self.journal))
+
+    def test_journal_holds_no_plaintext(self):
+        task = self._create_task(InterruptedCopyTask, 1)
+        self.assertRaises(IOError, task.begin_copy)
+
+        with open(self.journal, 'rb') as f:
+            journal = f.read()
+        # the offset and the checksums of the 1MB chunk at 5MB, none of its data
+        self.assertTrue(len(journal) < 16 * 1024)
+        self.assertFalse(self.regions[1][1][:512] in journal)
+
+    def test_resume_completes_torn_in_place_chunk(self):
+        # the chunk at 5MB is half written when the VM goes down: its first sectors are encrypted
+        # in place, the others still hold the plaintext
+        task = self._create_task(InPlaceCopyTask, 2048 + 1000, destination_path=self.source)
+        self.assertRaises(IOError, task.begin_copy)
+        self.assertTrue(os.path.exists(self.journal))
+
+        resumed_task = self._create_task(InPlaceCopyTask, None, destination_path=self.source)
+        resumed_task.begin_copy()
+        self.assertFalse(os.path.exists(self.journal))
+
+        with open(self.source, 'rb') as f:
+            contents = f.read().translate(XOR_TABLE)
+        self._assert_regions_copied(contents)
+        self.assertEqual(resumed_task.bytes_written, 3 * MB + 64 * 1024)
+
+    def test_resume_rejects_journal_for_other_device(self):
+        self.assertRaises(IOError, self._create_task(InterruptedCopyTask, 1).begin_copy)
+
+        with open(self.source, 'ab') as f:
+            f.truncate(32 * MB)
+
+        self.assertRaises(Exception, self._create_task().begin_copy)
+
+    def test_progress_reported_in_status(self):
+        self._create_task().begin_copy()
+
+        self.assertTrue(self.hutil.do_status_report.called)
+        self.assertEqual(self.hutil.do_status_report.call_args[1]['operation'], 'EnableEncryptionOSVolume')
+        message = self.hutil.do_status_report.call_args[1]['message']
+        self.assertIn('100%', message)
+        self.assertIn('MB/s', message)
+        self.assertIn('ETA', message)
+
+
+class TestOSEncryptionCopyTaskOnLoopDevices(CopyTaskTestCase):
+    """
+    Interrupted and resumed copy between two loop devices backed by the same image, as the rootfs partition and the
+    mapper on top of it are. A reboot is simulated by detaching the devices, which drops their page caches.
+    """
+    def setUp(self):
+        super(TestOSEncryptionCopyTaskOnLoopDevices, self).setUp()
+        self.loop_devices = []
+        with open(self.source, 'rb') as f:
+            self.expected = f.read()
+        try:
+            self._attach()
+        except (OSError, subprocess.CalledProcessError):
+            self._detach()
+            self.skipTest('loop devices are not available')
+
+    def tearDown(self):
+        self._detach()
+        super(TestOSEncryptionCopyTaskOnLoopDevices, self).tearDown()
+
+    def _attach(self):
+        with open(os.devnull, 'w') as devnull:
+            for i in range(0, 2):
+                device = subprocess.check_output(['losetup', '-f', '--show', self.source], stderr=devnull)
+                self.loop_devices.append(device.decode('utf-8').strip())
+
+    def _detach(self):
+        while self.loop_devices:
+            subprocess.call(['losetup', '-d', self.loop_devices.pop()])
+
+    def test_resume_after_reboot(self):
+        source_device, mapper_device = self.loop_devices
+        task = self._create_task(TornWriteCopyTask, 2048 + 1000, source_path=source_device,
+                                 destination_path=mapper_device)
+        self.assertRaises(IOError, task.begin_copy)
+
+        self._detach()
+        self._attach()
+        source_device, mapper_device = self.loop_devices
+        resumed_task = self._create_task(source_path=source_device, destination_path=mapper_device)
+        self.assertTrue(resumed_task.has_journal())
+        resumed_task.begin_copy()
+        self.assertFalse(os.path.exists(self.journal))
+
+        self._detach()
+        with open(self.source, 'rb') as f:
+            self.assertEqual(f.read(), self.expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+#
+# *********************************************************
+# Copyright (c) Microsoft. All rights reserved.
+#
+# Apache 2.0 License
+#
+# You may obtain a copy of the License at
+# http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+#
+# *********************************************************
+
+""" Unit tests for the shared OSEncryptionStateContext """
+
+import os
+import sys
+import unittest
+import mock
+
+testdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(testdir, '..', 'main'))
+sys.path.append(os.path.join(testdir, '..', 'main', 'oscrypto'))
+
+from OSEncryptionState import OSEncryptionState, OSEncryptionStateContext, OSDeviceInventory
+from EncryptionEnvironment import EncryptionEnvironment
+from console_logger import ConsoleLogger
+from test_utils import MockDistroPatcher
+
+
+class TestOSEncryptionStateContext(unittest.TestCase):
+    def setUp(self):
+        self.logger = ConsoleLogger()
+        self.context = OSEncryptionStateContext(hutil=None,
+                                                distro_patcher=MockDistroPatcher('Ubuntu', '16.04', '4.15'),
+                                                logger=self.logger,
+                                                encryption_environment=EncryptionEnvironment(None, self.logger))
+        self.inventory = OSDeviceInventory(rootfs_sdx_path='/dev/sda1',
+                                           rootfs_disk='/dev/disk/by-id/scsi-0',
+                                           rootfs_block_device='/dev/disk/by-id/scsi-0-part1',
+                                           bootfs_block_device='/dev/disk/by-id/scsi-0-part2')
+
+    def test_device_discovery_shared_across_states(self):
+        with mock.patch.object(OSEncryptionStateContext, '_discover_devices', return_value=self.inventory) as discover_mock:
+            first_state = OSEncryptionState('FirstState', self.context)
+            second_state = OSEncryptionState('SecondState', self.context)
+
+            self.assertEqual(discover_mock.call_count, 1)
+            self.assertEqual(second_state.rootfs_block_device, '/dev/disk/by-id/scsi-0-part1')
+            self.assertEqual(first_state.bootfs_block_device, '/dev/disk/by-id/scsi-0-part2')
+            self.assertIs(first_state.disk_util, second_state.disk_util)
+            self.assertIs(first_state.bek_util, second_state.bek_util)
+
+            self.context.invalidate()
+            first_state.rootfs_disk
+            self.assertEqual(discover_mock.call_count, 1)
+
+            self.context.invalidate(devices=True)
+            first_state.rootfs_disk
+            self.assertEqual(discover_mock.call_count, 2)
+
+    def test_mounts_cached_until_invalidated(self):
+        mounts = "none / tmpfs rw 0 0\n/dev/sda1 /oldroot ext4 rw 0 0\n"
+        with mock.patch('__builtin__.file', mock.mock_open(read_data=mounts), create=True) as file_mock:
+            file_mock.return_value.__iter__ = lambda handle: iter(mounts.splitlines(True))
+
+            self.assertTrue(self.context._is_in_memfs_root())
+            self.assertEqual(self.context.get_mounts()[1], ('/dev/sda1', '/oldroot', 'ext4'))
+            self.assertEqual(file_mock.call_count, 1)
+
+            self.context.invalidate()
+            self.context.get_mounts()
+            self.assertEqual(file_mock.call_count, 2)
+
+    @mock.patch('os.path.exists', return_value=True)
+    def test_bek_passphrase_file_reused_while_present(self, exists_mock):
+        with mock.patch.object(self.context.bek_util, 'get_bek_passphrase_file', return_value='/mnt/azure_bek_disk/LinuxPassPhraseFileName') as bek_mock:
+            self.context.get_bek_passphrase_file()
+            self.context.get_bek_passphrase_file()
+            self.assertEqual(bek_mock.call_count, 1)
+
+            exists_mock.return_value = False
+            self.context.get_bek_passphrase_file()
+            self.assertEqual(bek_mock.call_count, 2)
+
+    def test_record_state_timing(self):
+        self.context.record_state_timing('prereq', 'enter', 1.5)
+        self.context.record_state_timing('prereq', 'should_exit', 0.25)
+
+        self.assertEqual(self.context.state_timings['prereq'], {'enter': 1.5, 'should_exit': 0.25})
+
+
+if __name__ == '__main__':
+    unittest.main()
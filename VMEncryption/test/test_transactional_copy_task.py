@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+#
+# *********************************************************
+# Copyright (c) Microsoft. All rights reserved.
+#
+# Apache 2.0 License
+#
+# You may obtain a copy of the License at
+# http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied. See the License for the specific language governing
+# permissions and limitations under the License.
+#
+# *********************************************************
+
+""" Unit tests for the CopyBlockMap used by TransactionalCopyTask """
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from main.TransactionalCopyTask import CopyBlockMap
+from console_logger import ConsoleLogger
+
+MB = 1024 * 1024
+
+
+class TestCopyBlockMap(unittest.TestCase):
+    def setUp(self):
+        self.logger = ConsoleLogger()
+        self.workdir = tempfile.mkdtemp()
+        self.map_path = os.path.join(self.workdir, 'copy_block_map.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_used_ranges_map_to_slices(self):
+        block_map = CopyBlockMap(self.map_path, self.logger)
+        block_map.create(source_path='/dev/mapper/data',
+                         total_size=1000 * MB,
+                         block_size=50 * MB,
+                         used_byte_ranges=[(0, MB), (49 * MB, 51 * MB), (990 * MB, 2000 * MB)])
+
+        self.assertEqual(block_map.ranges, [[0, 1], [19, 19]])
+        self.assertTrue(block_map.contains(0))
+        self.assertTrue(block_map.contains(1))
+        self.assertFalse(block_map.contains(2))
+        self.assertFalse(block_map.contains(18))
+        self.assertTrue(block_map.contains(19))
+        self.assertEqual(block_map.get_block_count(), 3)
+
+    def test_load_checks_copy_parameters(self):
+        CopyBlockMap(self.map_path, self.logger).create(source_path='/dev/mapper/data',
+                                                        total_size=1000 * MB,
+                                                        block_size=50 * MB,
+                                                        used_byte_ranges=[(100 * MB, 101 * MB)])
+
+        block_map = CopyBlockMap(self.map_path, self.logger)
+        self.assertTrue(block_map.load('/dev/mapper/data', 1000 * MB, 50 * MB))
+        self.assertTrue(block_map.contains(2))
+        self.assertFalse(block_map.contains(3))
+
+        self.assertFalse(CopyBlockMap(self.map_path, self.logger).load('/dev/mapper/other', 1000 * MB, 50 * MB))
+        self.assertFalse(CopyBlockMap(self.map_path, self.logger).load('/dev/mapper/data', 2000 * MB, 50 * MB))
+
+        block_map.clear()
+        self.assertFalse(os.path.exists(self.map_path))
+        self.assertFalse(block_map.load('/dev/mapper/data', 1000 * MB, 50 * MB))
+
+
+if __name__ == '__main__':
+    unittest.main()